@@ -0,0 +1,4 @@
+"""Benchmarks for the PBX. Run from the repository root, e.g.
+
+    python -m benchmarks.engine_capacity --engines thread asyncio
+"""
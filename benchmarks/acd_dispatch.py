@@ -0,0 +1,234 @@
+"""ACD queue dispatch: agents picked from a heap against a scan of the members.
+
+Two parts:
+
+  structure   pbx_acd in this process with a stand-in call table: one queue
+              of --agents agents.  One agent frees up and one caller
+              arrives per hand-over, either with --waiting callers in line
+              (every agent busy) or with half the agents idle (nobody in
+              line); hand-overs per second for the heaps, and for a queue
+              that finds the longest-idle agent by a pass over every
+              member - what pbx_acd avoids.
+  end-to-end  a PBX with the same queue; --agents VoipClient agents that
+              answer and hang up after about --talk seconds, and --agents +
+              --waiting callers that dial the queue again as soon as a call
+              ends, so about --waiting of them are always in line.
+              Hand-overs per second and the line length, from the PBX's
+              metrics, over --seconds.
+
+    python -m benchmarks.acd_dispatch --agents 5000 --waiting 3000
+"""
+
+import argparse
+import asyncio
+import functools
+import os
+import random
+import tempfile
+import time
+import urllib.request
+from collections import deque
+
+import pbx_acd
+from benchmarks.common import free_port, raise_nofile, spawn_pbx
+from pbx_calltable import IDLE, RINGING
+from voip_client import VoipClient
+
+QUEUE = "5100"
+
+
+# ============================================================
+#  STRUCTURE
+# ============================================================
+
+class ScanQueue:
+    """The same queue finding its longest-idle agent with a pass over the members."""
+
+    def __init__(self, members, state, connect):
+        self.members = members
+        self.state = state
+        self.connect = connect
+        self.idle_since = {}
+        self.line = deque()
+        self.stamp = 0
+
+    def changed(self, agent):
+        if self.state[agent] == IDLE:
+            self.stamp += 1
+            self.idle_since.setdefault(agent, self.stamp)
+            self.dispatch()
+        else:
+            self.idle_since.pop(agent, None)
+
+    def enqueue(self, caller):
+        self.line.append(caller)
+        self.dispatch()
+
+    def dispatch(self):
+        while self.line:
+            best = None
+            for m in self.members:
+                since = self.idle_since.get(m)
+                if since is not None and (best is None or since < self.idle_since[best]):
+                    best = m
+            if best is None:
+                return
+            del self.idle_since[best]
+            self.connect(QUEUE, self.line.popleft(), None, None, best)
+
+
+def structure(agents, waiting, handovers, strategy, scan):
+    """Hand-overs/s: one agent freed and one caller added per hand-over.
+
+    With `waiting` callers in line every agent is busy and each one freed
+    takes the head of the line; with none, half the agents stay idle and
+    each caller takes one of them.
+    """
+    members = [f"5{i:05d}" for i in range(agents)]
+    state = dict.fromkeys(members, IDLE)
+    busy = deque()
+
+    def connect(queue, caller, trunk, cdr, agent):
+        state[agent] = RINGING
+        busy.append(agent)
+        changed(agent)
+        return pbx_acd.OK
+
+    if scan:
+        queue = ScanQueue(members, state, connect)
+        changed, enqueue = queue.changed, queue.enqueue
+        for m in members:
+            changed(m)
+    else:
+        pbx_acd.configure({QUEUE: (strategy, members)}, connect, state.get)
+        changed = pbx_acd.changed
+        enqueue = functools.partial(pbx_acd.enqueue, QUEUE)
+    for i in range(agents + waiting if waiting else agents // 2):
+        enqueue(f"7{i:06d}")
+    t0 = time.perf_counter()
+    for i in range(handovers):
+        agent = busy.popleft()
+        state[agent] = IDLE
+        changed(agent)
+        enqueue(f"8{i:06d}")
+    took = time.perf_counter() - t0
+    assert len(busy) == (agents if waiting else agents // 2)
+    return handovers / took
+
+
+# ============================================================
+#  END TO END
+# ============================================================
+
+def send(client, msg):
+    if client.transport is not None:
+        client.transport.write(client.codec.encode(msg))
+
+
+async def agent_loop(client, talk):
+    loop = asyncio.get_running_loop()
+    async for msg in client.events():
+        mtype = msg["type"]
+        if mtype == "incoming_call":
+            send(client, {"type": "answer"})
+        elif mtype == "call_answered":
+            loop.call_later(talk * (0.5 + random.random()), send, client, {"type": "hangup"})
+
+
+async def caller_loop(client):
+    events = client.events()
+    send(client, {"type": "call", "to": QUEUE})
+    async for msg in events:
+        if msg["type"] in ("hangup", "no_answer", "error"):
+            send(client, {"type": "call", "to": QUEUE})
+
+
+def scrape(admin):
+    text = urllib.request.urlopen(f"http://127.0.0.1:{admin}/metrics").read().decode()
+    out = {}
+    for line in text.splitlines():
+        if line.startswith(("pbx_queue_waiting", "pbx_queue_calls_total")):
+            name, value = line.rsplit(" ", 1)
+            out[name] = float(value)
+    return out
+
+
+async def end_to_end(args, path):
+    port, admin = free_port(), free_port()
+    pbx = spawn_pbx(port, "--engine", "asyncio", "--queues", path, "--admin-port", str(admin),
+                    "--ring-timeout", "0")
+    try:
+        sem = asyncio.Semaphore(500)
+
+        async def register(ext):
+            client = VoipClient("127.0.0.1", port, ext, reconnect=False, timeout=60)
+            async with sem:
+                await client.register()
+            return client
+
+        agents = await asyncio.gather(*(register(f"5{i:05d}") for i in range(args.agents)))
+        callers = await asyncio.gather(*(register(f"58{i:05d}")
+                                         for i in range(args.agents + args.waiting)))
+        tasks = [asyncio.create_task(agent_loop(c, args.talk)) for c in agents]
+        tasks += [asyncio.create_task(caller_loop(c)) for c in callers]
+        await asyncio.sleep(args.warmup)
+        before = scrape(admin)
+        t0 = time.perf_counter()
+        depth = []
+        while time.perf_counter() - t0 < args.seconds:
+            await asyncio.sleep(0.5)
+            depth.append(scrape(admin)[f'pbx_queue_waiting{{queue="{QUEUE}"}}'])
+        after = scrape(admin)
+        took = time.perf_counter() - t0
+        key = f'pbx_queue_calls_total{{queue="{QUEUE}",result="dispatched"}}'
+        rate = (after[key] - before[key]) / took
+        await asyncio.gather(*(c.close() for c in agents + callers))
+        for t in tasks:
+            t.cancel()
+        return rate, sum(depth) / len(depth), max(depth)
+    finally:
+        pbx.terminate()
+        pbx.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--agents", type=int, default=5000)
+    parser.add_argument("--waiting", type=int, default=3000, help="callers kept in line")
+    parser.add_argument("--handovers", type=int, default=200_000,
+                        help="structure: agent hand-overs timed")
+    parser.add_argument("--strategy", choices=pbx_acd.STRATEGIES, default=pbx_acd.LONGEST_IDLE)
+    parser.add_argument("--seconds", type=float, default=10.0, help="end-to-end: measured time")
+    parser.add_argument("--talk", type=float, default=2.0,
+                        help="end-to-end: mean seconds an agent stays in a call")
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--no-e2e", action="store_true", help="structure part only")
+    args = parser.parse_args()
+    raise_nofile()
+
+    print(f"structure: {args.agents} agents, {args.strategy} (scan: longest-idle)")
+    for waiting, label in ((args.waiting, f"{args.waiting} callers in line"),
+                           (0, f"{args.agents // 2} agents idle")):
+        heap = structure(args.agents, waiting, args.handovers, args.strategy, False)
+        scan = structure(args.agents, waiting, max(1, args.handovers // 50), args.strategy, True)
+        print(f"  {label:24} heap {heap:10.0f} hand-overs/s   scan {scan:8.0f} hand-overs/s")
+    if args.no_e2e:
+        return
+
+    fd, path = tempfile.mkstemp(suffix=".queues")
+    with os.fdopen(fd, "w") as f:
+        f.write(f"queue {QUEUE} {args.strategy}\n")
+        for i in range(0, args.agents, 100):
+            members = " ".join(f"5{j:05d}" for j in range(i, min(i + 100, args.agents)))
+            f.write(f"member {QUEUE} {members}\n")
+    try:
+        rate, mean, peak = asyncio.run(end_to_end(args, path))
+    finally:
+        os.remove(path)
+    print(f"end-to-end: {args.agents} agents, {args.agents + args.waiting} callers redialling")
+    print(f"  {rate:8.0f} calls handed to agents/s; line {mean:.0f} callers on average, "
+          f"{peak:.0f} at most")
+
+
+if __name__ == "__main__":
+    main()
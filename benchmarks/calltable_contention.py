@@ -0,0 +1,131 @@
+"""Contention microbenchmark for the call table.
+
+Worker threads hammer handle_call/handle_hangup on a small, overlapping set
+of extensions while a checker thread takes consistent snapshots and looks
+for double-booking: every local ringing or in_call leg must point at a
+peer in the same state that points straight back at it.
+
+`--legacy` replays the old check-then-set sequence (read both states, then
+write each leg in its own critical section) to show the race it had.  It
+skips message encoding, so its ops/s is not comparable with the default run.
+
+    python -m benchmarks.calltable_contention --threads 8 --extensions 32
+"""
+
+import argparse
+import random
+import sys
+import threading
+import time
+
+import pbx_codec
+import pbx_server
+from pbx_calltable import CALL, IDLE, IN_CALL
+
+
+class NullConn:
+    __slots__ = ()
+    codec = pbx_codec.JSON
+
+    def send(self, data):
+        return True
+
+
+def legacy_local_call(caller_ext, callee_ext):
+    """The pre-CallTable handle_local_call state logic, without messaging."""
+    caller = pbx_server.get_client(caller_ext)
+    callee = pbx_server.get_client(callee_ext)
+    if caller is None or callee is None or caller_ext == callee_ext:
+        return
+    if caller.state != IDLE:
+        return
+    if callee.state == IDLE:
+        pbx_server.set_state(caller_ext, IN_CALL, peer=callee_ext)
+        pbx_server.set_state(callee_ext, IN_CALL, peer=caller_ext)
+
+
+def legacy_hangup(ext):
+    me = pbx_server.get_client(ext)
+    if me is None or me.state != IN_CALL:
+        return
+    peer_ext = me.peer
+    pbx_server.set_state(ext, IDLE)
+    pbx_server.set_state(peer_ext, IDLE)
+
+
+def find_violations(snapshot):
+    by_ext = {ext: (state, peer, remote) for ext, state, peer, remote, _ in snapshot}
+    bad = 0
+    for ext, (state, peer, remote) in by_ext.items():
+        if state not in CALL or remote:
+            continue
+        other = by_ext.get(peer)
+        if other is None or other[0] != state or other[1] != ext:
+            bad += 1
+    return bad
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--extensions", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--legacy", action="store_true", help="use the old non-atomic transitions")
+    args = parser.parse_args()
+
+    # Force frequent thread switches so races actually surface
+    sys.setswitchinterval(1e-6)
+
+    exts = [f"5{i:03d}" for i in range(args.extensions)]
+    for ext in exts:
+        pbx_server.clients.register(ext, NullConn(), ("bench", 0))
+
+    if args.legacy:
+        call, hangup = legacy_local_call, legacy_hangup
+    else:
+        def call(a, b):
+            pbx_server.handle_call(a, b, "5", "7", "5000")
+        hangup = pbx_server.handle_hangup
+
+    stop = threading.Event()
+    ops = [0] * args.threads
+    snapshots = [0]
+    violations = [0]
+
+    def worker(n):
+        rnd = random.Random(n)
+        done = 0
+        while not stop.is_set():
+            a, b = rnd.choice(exts), rnd.choice(exts)
+            if rnd.random() < 0.6:
+                call(a, b)
+            else:
+                hangup(a)
+            done += 1
+        ops[n] = done
+
+    def checker():
+        while not stop.is_set():
+            violations[0] += find_violations(pbx_server.clients.snapshot())
+            snapshots[0] += 1
+            time.sleep(0.001)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.threads)]
+    threads.append(threading.Thread(target=checker))
+    for t in threads:
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    total = sum(ops)
+    print(f"mode={'legacy' if args.legacy else 'calltable'} threads={args.threads} "
+          f"extensions={args.extensions}")
+    print(f"  {total} ops in {args.duration:.1f}s = {total / args.duration:,.0f} ops/s")
+    print(f"  {snapshots[0]} snapshots checked, {violations[0]} double-booked legs seen")
+    return 1 if violations[0] and not args.legacy else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
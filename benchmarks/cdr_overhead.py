@@ -0,0 +1,107 @@
+"""Call setup rate with CDRs off and on.
+
+A PBX per setting is driven through call/answer/hangup cycles, as in
+metrics_overhead, and the call rate and setup latency compared; rounds
+alternate the settings so drift hits both alike.  With CDRs on, the number
+of records in the store afterwards is checked against the calls made.
+Call rates are noisy when the load generator shares the PBX's CPUs, so the
+PBX's own CPU time per call is reported too.
+
+    python -m benchmarks.cdr_overhead --engine asyncio --format sqlite
+"""
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+
+import pbx_cdr
+from benchmarks.common import cpu_seconds, free_port, percentiles, spawn_pbx
+from benchmarks.engine_capacity import Endpoint, call_cycles
+
+
+def stored(path, fmt):
+    if fmt == "sqlite":
+        with sqlite3.connect(path) as db:
+            return db.execute("SELECT COUNT(*) FROM cdr").fetchone()[0]
+    with open(path, "rb") as f:
+        return sum(1 for _ in f)
+
+
+async def drive(port, pairs, duration):
+    endpoints = [Endpoint(f"5{i:06d}") for i in range(2 * pairs)]
+    try:
+        await asyncio.gather(*(ep.register(port) for ep in endpoints))
+        setups = []
+        stop_at = time.perf_counter() + duration
+        await asyncio.gather(*(
+            call_cycles(endpoints[2 * i], endpoints[2 * i + 1], stop_at, setups)
+            for i in range(pairs)
+        ))
+        return setups
+    finally:
+        for ep in endpoints:
+            if ep.writer is not None:
+                ep.writer.close()
+
+
+def run(args, path):
+    port = free_port()
+    extra = ["--engine", args.engine]
+    if path:
+        extra += ["--cdr", path, "--cdr-format", args.format]
+    proc = spawn_pbx(port, *extra)
+    try:
+        cpu0 = cpu_seconds(proc.pid)
+        setups = asyncio.run(drive(port, args.pairs, args.duration))
+        time.sleep(args.interval)    # let the last CDR batch be written
+        cpu = cpu_seconds(proc.pid) - cpu0
+    finally:
+        proc.terminate()    # the PBX writes out the queued CDRs on SIGTERM
+        proc.wait()
+    return setups, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--engine", choices=["thread", "asyncio"], default="asyncio")
+    parser.add_argument("--format", choices=pbx_cdr.FORMATS, default="sqlite")
+    parser.add_argument("--pairs", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--rounds", type=int, default=2, help="alternating runs per setting")
+    parser.add_argument("--interval", type=float, default=0.5,
+                        help="seconds to wait for the PBX's last CDR write")
+    args = parser.parse_args()
+
+    print(f"{args.engine} engine, {args.format} CDRs, {args.pairs} pairs, "
+          f"{args.duration:g}s per run")
+    print(f"{'cdr':4} {'calls/s':>8} {'p50 ms':>7} {'p99 ms':>7} {'cpu us/call':>11} "
+          f"{'stored':>8}")
+    rates = {False: [], True: []}
+    costs = {False: [], True: []}
+    with tempfile.TemporaryDirectory() as tmp:
+        for r in range(args.rounds):
+            for cdr in (False, True):
+                path = os.path.join(tmp, f"cdr{r}.{'db' if args.format == 'sqlite' else 'jsonl'}")
+                setups, cpu = run(args, path if cdr else None)
+                rate = len(setups) / args.duration
+                rates[cdr].append(rate)
+                costs[cdr].append(cpu / max(1, len(setups)) * 1e6)
+                pct = percentiles(setups)
+                count = f"{stored(path, args.format):8d}" if cdr else f"{'-':>8}"
+                print(f"{'on' if cdr else 'off':4} {rate:8.0f} {pct[50] * 1000:7.2f} "
+                      f"{pct[99] * 1000:7.2f} {costs[cdr][-1]:11.1f} {count}")
+
+    def mean(xs):
+        return sum(xs) / len(xs)
+
+    off, on = mean(rates[False]), mean(rates[True])
+    print(f"\nmean calls/s: off {off:.0f}, on {on:.0f} ({(on - off) / off * 100:+.1f}%)")
+    off, on = mean(costs[False]), mean(costs[True])
+    print(f"PBX CPU per call: off {off:.1f} us, on {on:.1f} us ({(on - off) / off * 100:+.1f}%)")
+
+
+if __name__ == "__main__":
+    main()
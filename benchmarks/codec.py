@@ -0,0 +1,79 @@
+"""Encode/decode cost of every signalling message, JSON vs binary framing.
+
+Decoding goes through FrameReader.feed(), the same path the engines use,
+with one frame per call so per-message overhead is included.
+
+    python -m benchmarks.codec
+"""
+
+import argparse
+import time
+
+from pbx_codec import BINARY, JSON, FrameReader
+
+SAMPLES = [
+    {"type": "register", "extension": "5001"},
+    {"type": "register_ok", "extension": "5001"},
+    {"type": "call", "to": "7002"},
+    {"type": "call_proceeding", "to": "7002"},
+    {"type": "incoming_call", "from": "5001"},
+    {"type": "incoming_call_waiting", "from": "5001"},
+    {"type": "answer"},
+    {"type": "call_answered", "by": "7002"},
+    {"type": "hangup"},
+    {"type": "hangup", "by": "5001"},
+    {"type": "busy", "to": "7002"},
+    {"type": "ivr", "to": "5000"},
+    {"type": "ivr_choice", "digit": "3"},
+    {"type": "ivr_message", "text": "--- IVR Center A (5000) ---\n0 → Πληροφορίες\n"},
+    {"type": "ivr_info", "text": "Το τηλεφωνικό κέντρο λειτουργεί Δευτέρα–Παρασκευή 09:00–17:00."},
+    {"type": "chat", "text": "καλημέρα"},
+    {"type": "chat", "from": "5001", "text": "καλημέρα"},
+    {"type": "chat_sent", "to": "7002"},
+    {"type": "error", "reason": "Δεν υπάρχει κλήση για απάντηση."},
+    {"type": "trunk_call", "from": "5001", "to": "7002"},
+    {"type": "trunk_call_answered", "from": "7002", "to": "5001"},
+    {"type": "trunk_hangup", "from": "5001", "to": "7002"},
+    {"type": "trunk_busy", "from": "7002", "to": "5001"},
+    {"type": "trunk_chat", "from": "5001", "to": "7002", "text": "καλημέρα"},
+]
+
+
+def per_op_ns(fn, arg, n):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn(arg)
+    return (time.perf_counter() - t0) / n * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", type=int, default=20_000, help="iterations per message")
+    args = parser.parse_args()
+
+    print(f"{'message':24} {'bytes':>11} {'encode ns':>15} {'decode ns':>15}")
+    print(f"{'':24} {'json':>5} {'bin':>5} {'json':>7} {'bin':>7} {'json':>7} {'bin':>7}")
+    totals = [0.0, 0.0, 0.0, 0.0]
+    for msg in SAMPLES:
+        row = []
+        for codec in (JSON, BINARY):
+            frame = codec.encode(msg)
+            reader = FrameReader()
+            assert reader.feed(frame) == [msg], (codec.name, msg)
+            row.append((
+                len(frame),
+                per_op_ns(codec.encode, msg, args.n),
+                per_op_ns(reader.feed, frame, args.n),
+            ))
+        (js, je, jd), (bs, be, bd) = row
+        totals = [totals[0] + je, totals[1] + be, totals[2] + jd, totals[3] + bd]
+        label = msg["type"] + ("" if len(msg) > 1 or msg["type"] != "hangup" else " (client)")
+        print(f"{label:24} {js:5d} {bs:5d} {je:7.0f} {be:7.0f} {jd:7.0f} {bd:7.0f}")
+
+    k = len(SAMPLES)
+    print(f"{'mean':24} {'':5} {'':5} {totals[0] / k:7.0f} {totals[1] / k:7.0f} "
+          f"{totals[2] / k:7.0f} {totals[3] / k:7.0f}")
+
+
+if __name__ == "__main__":
+    main()
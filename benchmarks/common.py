@@ -0,0 +1,78 @@
+"""Helpers shared by the benchmark scripts."""
+
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def raise_nofile():
+    """Lift the soft fd limit to the hard limit; returns the new soft limit."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawn_pbx(port, *extra, mode="A", prefix="5", remote_prefix="7", ivr_ext="5000",
+              trunk_remote_port=None, trunk_listen_port=None, log=None):
+    """Start pbx_server.py on 127.0.0.1 and wait until it accepts connections."""
+    trunk_listen_port = trunk_listen_port or free_port()
+    trunk_remote_port = trunk_remote_port or free_port()
+    cmd = [
+        sys.executable, os.path.join(ROOT, "pbx_server.py"),
+        "--host", "127.0.0.1", "--port", str(port), "--mode", mode,
+        "--prefix", prefix, "--remote-prefix", remote_prefix, "--ivr-ext", ivr_ext,
+        "--trunk-remote-host", "127.0.0.1", "--trunk-remote-port", str(trunk_remote_port),
+        "--trunk-listen-port", str(trunk_listen_port), *extra,
+    ]
+    out = open(log, "w") if log else subprocess.DEVNULL
+    proc = subprocess.Popen(cmd, cwd=ROOT, stdout=out, stderr=subprocess.STDOUT,
+                            preexec_fn=raise_nofile)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("PBX did not start: " + " ".join(cmd))
+
+
+def proc_status(pid):
+    """VmRSS (MiB) and thread count of a process, read from /proc."""
+    rss = threads = 0
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) / 1024
+            elif line.startswith("Threads:"):
+                threads = int(line.split()[1])
+    return rss, threads
+
+
+def cpu_seconds(pid):
+    """User + system CPU time of a process so far, from /proc."""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    """Nearest-rank percentiles of a list of numbers."""
+    if not samples:
+        return {p: float("nan") for p in points}
+    ordered = sorted(samples)
+    n = len(ordered)
+    return {p: ordered[min(n - 1, max(0, int(round(p / 100 * n)) - 1))] for p in points}
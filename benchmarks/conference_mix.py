@@ -0,0 +1,129 @@
+"""Conference rooms one core mixes in real time.
+
+For each room size, --participants participants are spread over rooms of
+that size, each with its own UDP socket as in the server.  Every tick a
+driver socket sends one 20 ms frame in --codec to every participant (not
+timed); then the mixer's work is timed: reading the frames into the
+jitter buffers, decoding, the NumPy mix of all rooms, encoding and sending
+every participant its mix.  Rooms per core is how many rooms of that size
+fit into 20 ms of one CPU.  On alternate ticks the rooms are mixed one by
+one instead of a block of equal-sized rooms at a time, for comparison.
+
+    python -m benchmarks.conference_mix --participants 1500 --sizes 3,10,50
+"""
+
+import argparse
+import random
+import socket
+import struct
+import time
+
+import numpy as np
+
+import pbx_conference
+import pbx_transcode
+from benchmarks.common import raise_nofile
+
+RTP = struct.Struct("!BBHII")
+
+
+def make_rooms(size, participants, codec):
+    driver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    driver.bind(("127.0.0.1", 0))
+    driver.setblocking(False)
+    driver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 << 20)
+    rooms = []
+    for r in range(max(1, participants // size)):
+        room = pbx_conference.Room(f"r{r}")
+        for i in range(size):
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.bind(("127.0.0.1", 0))
+            s.setblocking(False)
+            room.members.append(pbx_conference.Member(f"{r}-{i}", room, [s], codec=codec))
+        rooms.append(room)
+    return driver, rooms
+
+
+def offer(driver, members, seq, payloads):
+    """One frame to every participant; returns how many the kernel took."""
+    sent = 0
+    for i, m in enumerate(members):
+        pkt = RTP.pack(0x80, 96, seq & 0xFFFF, seq * pbx_conference.SAMPLES, i) + payloads[i % 64]
+        try:
+            driver.sendto(pkt, ("127.0.0.1", m.port))
+            sent += 1
+        except BlockingIOError:
+            pass
+    return sent
+
+
+def drain(driver):
+    while True:
+        try:
+            driver.recv(4096)
+        except BlockingIOError:
+            return
+
+
+def run(size, args):
+    driver, rooms = make_rooms(size, args.participants, args.codec)
+    layout = pbx_conference.Layout(rooms)
+    per_room = pbx_conference.Layout([])
+    per_room.blocks = [pbx_conference.Block([room]) for room in rooms]
+    members = [m for room in rooms for m in room.members]
+    rng = random.Random(1)
+    payloads = [pbx_transcode.encode(np.array([rng.randint(-12000, 12000) for _ in range(160)]),
+                                     args.codec) for _ in range(64)]
+    recv = mixed = mixed_per_room = 0.0
+    ticks = 0
+    for seq in range(args.warmup + args.ticks):
+        offer(driver, members, seq, payloads)
+        time.sleep(0.002)    # let loopback deliver
+        t0 = time.perf_counter()
+        for m in members:
+            m.receive()
+        t1 = time.perf_counter()
+        pbx_conference.mix(per_room if seq % 2 else layout)
+        t2 = time.perf_counter()
+        drain(driver)
+        if seq < args.warmup:
+            continue
+        recv += t1 - t0
+        if seq % 2:
+            mixed_per_room += t2 - t1
+        else:
+            mixed += t2 - t1
+            ticks += 1
+    for m in members:
+        for s in m.socks:
+            s.close()
+    driver.close()
+    recv /= 2 * ticks
+    return len(rooms), recv, mixed / ticks, mixed_per_room / ticks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--participants", type=int, default=1500)
+    parser.add_argument("--sizes", default="3,10,50", help="room sizes to try")
+    parser.add_argument("--ticks", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--codec", choices=pbx_transcode.CODECS, default=pbx_transcode.L16)
+    args = parser.parse_args()
+    raise_nofile()
+
+    budget = pbx_conference.PTIME
+    print(f"{args.participants} participants, 20 ms {args.codec} frames, {args.ticks} ticks")
+    print(f"{'size':>4} {'rooms':>6} {'recv us':>8} {'mix+send us':>11} {'tick us':>8} "
+          f"{'rooms/core':>10} | {'per-room mix+send us':>20} {'rooms/core':>10}")
+    for size in (int(x) for x in args.sizes.split(",")):
+        rooms, recv, mixed, mixed_per_room = run(size, args)
+        tick = recv + mixed
+        tick_per_room = recv + mixed_per_room
+        print(f"{size:4d} {rooms:6d} {recv * 1e6:8.0f} {mixed * 1e6:11.0f} {tick * 1e6:8.0f} "
+              f"{rooms * budget / tick:10.0f} | {mixed_per_room * 1e6:20.0f} "
+              f"{rooms * budget / tick_per_room:10.0f}")
+
+
+if __name__ == "__main__":
+    main()
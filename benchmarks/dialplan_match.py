@@ -0,0 +1,118 @@
+"""Dial plan matches per second with a large rule set.
+
+Builds --rules random rules (10-digit patterns behind literal prefixes of
+2-7 digits, some with [ranges], some open-ended with `.`, and * short
+codes), compiles them into the pbx_dialplan automaton and times matching
+random numbers: once with the result cache disabled, once with a warm
+cache over a --hot working set.  For comparison, the rules as regexes
+tried one by one in order of specificity until one matches - the scan
+the automaton avoids - on a --scan sample.
+
+    python -m benchmarks.dialplan_match --rules 50000
+"""
+
+import argparse
+import random
+import re
+import time
+
+import pbx_dialplan
+from pbx_dialplan import Automaton, Rule
+
+ACTIONS = [pbx_dialplan.ROUTE, pbx_dialplan.LOCAL, pbx_dialplan.BLOCK]
+DIGITS = "0123456789"
+
+
+def random_rules(count, rnd):
+    patterns = set()
+    rules = []
+    while len(rules) < count:
+        kind = rnd.random()
+        prefix = "".join(rnd.choices(DIGITS, k=rnd.randint(2, 7)))
+        if kind < 0.75:
+            pattern = prefix + "X" * (10 - len(prefix))
+        elif kind < 0.85:
+            lo = rnd.randint(0, 8)
+            hi = rnd.randint(lo + 1, 9)
+            pattern = f"{prefix}[{lo}-{hi}]" + "X" * (9 - len(prefix))
+        elif kind < 0.95:
+            pattern = prefix + "."
+        else:
+            pattern = "*" + prefix[:4]
+        if pattern in patterns:
+            continue
+        patterns.add(pattern)
+        if pattern[0] == "*":
+            rules.append(Rule(pattern, pbx_dialplan.REWRITE, "5001"))
+        else:
+            rules.append(Rule(pattern, rnd.choice(ACTIONS)))
+    return rules
+
+
+def as_regex(pattern):
+    out = []
+    for ch in pattern:
+        if ch == "X":
+            out.append("[0-9]")
+        elif ch in "[]-":
+            out.append(ch)
+        elif ch == ".":
+            out.append(".+")
+        else:
+            out.append(re.escape(ch))
+    return re.compile("".join(out))
+
+
+def timed(match, numbers):
+    t0 = time.perf_counter()
+    for n in numbers:
+        match(n)
+    return len(numbers) / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rules", type=int, default=50_000)
+    parser.add_argument("--matches", type=int, default=500_000)
+    parser.add_argument("--hot", type=int, default=10_000, help="distinct numbers in the cached run")
+    parser.add_argument("--scan", type=int, default=200, help="numbers matched by the regex scan")
+    args = parser.parse_args()
+
+    rnd = random.Random(1)
+    rules = random_rules(args.rules, rnd)
+
+    t0 = time.perf_counter()
+    plan = Automaton(rules, cache_size=0)
+    build = time.perf_counter() - t0
+
+    numbers = ["".join(rnd.choices(DIGITS, k=10)) for _ in range(args.matches)]
+    cold = timed(plan.match, numbers)
+    matched = sum(1 for n in numbers[:10_000] if plan.match(n) is not None)
+
+    plan.cache_size = 65536
+    hot = [rnd.choice(numbers[:args.hot]) for _ in range(args.matches)]
+    timed(plan.match, hot)  # warm up
+    warm = timed(plan.match, hot)
+
+    ordered = sorted(rules, key=lambda r: r.rank)
+    regexes = [(as_regex(r.pattern).fullmatch, r) for r in ordered]
+
+    def scan(number):
+        for fullmatch, rule in regexes:
+            if fullmatch(number):
+                return rule
+        return None
+
+    sample = numbers[:args.scan]
+    for n in sample:
+        assert scan(n) is plan.match(n), n
+    linear = timed(scan, sample)
+
+    print(f"{len(plan):,} rules, compiled in {build * 1000:.0f} ms to {plan.states:,} states")
+    print(f"  uncached:   {cold:12,.0f} matches/s  ({matched / 100:.0f}% of numbers matched)")
+    print(f"  cached:     {warm:12,.0f} matches/s  ({args.hot:,} hot numbers)")
+    print(f"  regex scan: {linear:12,.0f} matches/s")
+
+
+if __name__ == "__main__":
+    main()
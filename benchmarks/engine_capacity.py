@@ -0,0 +1,120 @@
+"""How many idle and active extensions one PBX process holds, per engine.
+
+For each engine the benchmark starts a PBX, registers --idle extensions that
+then sit idle, and drives --pairs of them through call/answer/hangup cycles
+for --duration seconds.  It reports registration time, server RSS and thread
+count, and the completed call rate with setup latency percentiles.
+
+    python -m benchmarks.engine_capacity --engines thread asyncio --idle 5000
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.common import free_port, percentiles, proc_status, raise_nofile, spawn_pbx
+
+
+class Endpoint:
+    def __init__(self, ext):
+        self.ext = ext
+        self.reader = None
+        self.writer = None
+
+    async def register(self, port):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+        self.send({"type": "register", "extension": self.ext})
+        await self.expect("register_ok")
+
+    def send(self, obj):
+        self.writer.write(json.dumps(obj).encode("utf-8") + b"\n")
+
+    async def expect(self, mtype):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError(f"{self.ext}: connection closed")
+            if json.loads(line).get("type") == mtype:
+                return
+
+
+async def call_cycles(caller, callee, stop_at, setups):
+    while time.perf_counter() < stop_at:
+        t0 = time.perf_counter()
+        caller.send({"type": "call", "to": callee.ext})
+        await callee.expect("incoming_call")
+        setups.append(time.perf_counter() - t0)
+        callee.send({"type": "answer"})
+        await caller.expect("call_answered")
+        caller.send({"type": "hangup"})
+        await callee.expect("hangup")
+        await caller.expect("hangup")
+
+
+async def run_engine(engine, idle, pairs, duration, concurrency):
+    port = free_port()
+    proc = spawn_pbx(port, "--engine", engine, "--backlog", "4096")
+    endpoints = [Endpoint(f"5{i:06d}") for i in range(idle + 2 * pairs)]
+    try:
+        sem = asyncio.Semaphore(concurrency)
+
+        async def register(ep):
+            async with sem:
+                await ep.register(port)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(register(ep) for ep in endpoints))
+        reg_time = time.perf_counter() - t0
+        await asyncio.sleep(0.5)
+        rss, threads = proc_status(proc.pid)
+
+        active = endpoints[idle:]
+        setups = []
+        stop_at = time.perf_counter() + duration
+        await asyncio.gather(*(
+            call_cycles(active[2 * i], active[2 * i + 1], stop_at, setups)
+            for i in range(pairs)
+        ))
+        pct = percentiles(setups)
+        return {
+            "engine": engine,
+            "endpoints": len(endpoints),
+            "register_s": reg_time,
+            "rss_mib": rss,
+            "threads": threads,
+            "calls_per_s": len(setups) / duration,
+            "p50_ms": pct[50] * 1000,
+            "p99_ms": pct[99] * 1000,
+        }
+    finally:
+        for ep in endpoints:
+            if ep.writer is not None:
+                ep.writer.close()
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--engines", nargs="+", default=["thread", "asyncio"])
+    parser.add_argument("--idle", type=int, default=2000, help="extensions that only register")
+    parser.add_argument("--pairs", type=int, default=50, help="caller/callee pairs placing calls")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--concurrency", type=int, default=200, help="parallel registrations")
+    args = parser.parse_args()
+
+    limit = raise_nofile()
+    if args.idle + 2 * args.pairs + 100 > limit:
+        parser.error(f"need more file descriptors than the limit ({limit})")
+
+    print(f"{'engine':8} {'endpoints':>9} {'reg s':>7} {'RSS MiB':>8} {'threads':>7} "
+          f"{'calls/s':>8} {'p50 ms':>7} {'p99 ms':>7}")
+    for engine in args.engines:
+        r = asyncio.run(run_engine(engine, args.idle, args.pairs, args.duration, args.concurrency))
+        print(f"{r['engine']:8} {r['endpoints']:9d} {r['register_s']:7.2f} {r['rss_mib']:8.1f} "
+              f"{r['threads']:7d} {r['calls_per_s']:8.0f} {r['p50_ms']:7.2f} {r['p99_ms']:7.2f}")
+
+
+if __name__ == "__main__":
+    main()
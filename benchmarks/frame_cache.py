@@ -0,0 +1,80 @@
+"""Encoding time saved by pre-encoded frames.
+
+A local call setup sends six messages (call_proceeding, incoming_call,
+call_answered to both sides, hangup to both sides); each is encoded once
+by building a dict and calling codec.encode(), as the handlers used to,
+and once through the server's Templates.  Error replies and the IVR info
+text are constants and compare codec.encode() with a cached Frame.
+
+    python -m benchmarks.frame_cache -n 200000
+"""
+
+import argparse
+import time
+
+import pbx_codec
+import pbx_server as s
+
+
+def per_op_ns(fn, n, repeat=5):
+    """Best of `repeat` runs, which filters out scheduling noise."""
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(n)
+        best = min(best, time.perf_counter() - t0)
+    return best / n * 1e9
+
+
+def setup_dicts(codec, k):
+    encode = codec.encode
+    for _ in range(k):
+        encode({"type": "call_proceeding", "to": "7002"})
+        encode({"type": "incoming_call", "from": "5001"})
+        encode({"type": "call_answered", "by": "7002"})
+        encode({"type": "call_answered", "by": "5001"})
+        encode({"type": "hangup", "by": "5001"})
+        encode({"type": "hangup", "by": "5001"})
+
+
+def setup_frames(codec, k):
+    for _ in range(k):
+        s.CALL_PROCEEDING.encode(codec, "7002")
+        s.INCOMING_CALL.encode(codec, "5001")
+        s.CALL_ANSWERED.encode(codec, "7002")
+        s.CALL_ANSWERED.encode(codec, "5001")
+        s.HANGUP.encode(codec, "5001")
+        s.HANGUP.encode(codec, "5001")
+
+
+def constant_dicts(codec, k):
+    encode = codec.encode
+    for _ in range(k):
+        encode({"type": "error", "reason": "Δεν υπάρχει κλήση για απάντηση."})
+        encode(s.IVR_INFO.obj)
+
+
+def constant_frames(codec, k):
+    error = s.ERRORS["no_call_to_answer"]
+    for _ in range(k):
+        error.encode(codec)
+        s.IVR_INFO.encode(codec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", type=int, default=100_000, help="iterations per measurement")
+    args = parser.parse_args()
+
+    print(f"{'framing':8} {'workload':22} {'dict ns':>8} {'frame ns':>8} {'saved':>8}")
+    for codec in (pbx_codec.JSON, pbx_codec.BINARY):
+        for name, plain, cached in (("call setup (6 msgs)", setup_dicts, setup_frames),
+                                    ("error + ivr_info", constant_dicts, constant_frames)):
+            before = per_op_ns(lambda k: plain(codec, k), args.n)
+            after = per_op_ns(lambda k: cached(codec, k), args.n)
+            print(f"{codec.name:8} {name:22} {before:8.0f} {after:8.0f} "
+                  f"{(before - after) / before * 100:7.0f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""IVR sessions: many callers inside menu trees, and none left behind.
+
+Two parts:
+
+  structure   pbx_ivr in this process with callbacks that only count:
+              a tree of --menus submenus under a main menu, each going back
+              up on its timeout.  --sessions callers enter; memory per
+              session; keys per second over random sessions (submenus, back
+              up, info texts); then the wheel is turned past every timeout
+              until all have been hung up, and what is left.
+  end-to-end  a PBX with the same tree in a menus file with --timeout
+              second menus; --clients VoipClients enter the IVR and go
+              into a submenu, then half of them disconnect and the rest
+              just wait.  The PBX's sessions and RSS with them inside,
+              after the disconnects and once the timeouts have run out.
+
+    python -m benchmarks.ivr_sessions --sessions 200000 --clients 2000
+"""
+
+import argparse
+import asyncio
+import gc
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+import pbx_ivr
+import pbx_timers
+from benchmarks.common import free_port, proc_status, raise_nofile, spawn_pbx
+from pbx_calltable import IDLE
+from pbx_timers import Wheel
+from voip_client import VoipClient
+
+
+def tree(menus, timeout):
+    """{name: (timeout, prompt, options)}: main with menus submenus, each with info and a way back."""
+    main = {"0": (pbx_ivr.INFO, pbx_ivr.DEFAULT_INFO), "#": (pbx_ivr.HANGUP, None)}
+    definitions = {"main": (timeout, "Κεντρικό μενού", main)}
+    for i in range(1, menus + 1):
+        name = f"sub{i}"
+        main[str(i % 10)] = (pbx_ivr.MENU, name)
+        definitions[name] = (timeout, f"Υπομενού {i}", {
+            "0": (pbx_ivr.INFO, f"Πληροφορίες {i}"),
+            "*": (pbx_ivr.MENU, "main"),
+            "t": (pbx_ivr.MENU, "main"),
+        })
+    return definitions
+
+
+def menus_file(definitions):
+    fd, path = tempfile.mkstemp(suffix=".menus")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        for name, (timeout, prompt, _) in definitions.items():
+            f.write(f"menu {name} {timeout} {prompt}\n")
+        for name, (_, _, options) in definitions.items():
+            for key, (action, arg) in options.items():
+                arg = "" if arg is None else " " + arg.replace("\n", "\\n")
+                f.write(f"option {name} {key} {action}{arg}\n")
+    return path
+
+
+# ============================================================
+#  STRUCTURE
+# ============================================================
+
+def structure(args):
+    sent = [0]
+
+    def send(ext, frame):
+        sent[0] += 1
+
+    def ignore(ext, arg):
+        pass
+
+    # A wheel of our own, turned by hand on a clock of our own
+    pbx_timers.wheel = wheel = Wheel(now=0.0)
+    pbx_ivr.configure(tree(args.menus, args.timeout), "5000", send, ignore, ignore, ignore,
+                      lambda ext: IDLE)
+    exts = [f"5{i:06d}" for i in range(args.sessions)]
+    keys = [str(i) for i in range(min(args.menus, 9) + 1)] + ["*"]
+
+    t0 = time.perf_counter()
+    for ext in exts:
+        pbx_ivr.enter(ext)
+    enter_rate = len(exts) / (time.perf_counter() - t0)
+    for ext in exts:
+        pbx_ivr.leave(ext)
+
+    # Memory on a second pass: tracing slows down what it traces
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for ext in exts:
+        pbx_ivr.enter(ext)
+    per_session = (tracemalloc.get_traced_memory()[0] - before) / len(exts)
+    tracemalloc.stop()
+
+    rnd = random.Random(1)
+    presses = [(rnd.choice(exts), rnd.choice(keys)) for _ in range(args.keys)]
+    t0 = time.perf_counter()
+    for ext, key in presses:
+        pbx_ivr.choose(ext, key)
+    key_rate = len(presses) / (time.perf_counter() - t0)
+
+    # Nobody presses anything more: submenus time out back to main, main
+    # hangs up on its first timeout, and any menu after MAX_TIMEOUTS
+    now, fired, took = 0.0, 0, 0.0
+    while pbx_ivr.active() and now < args.timeout * (pbx_ivr.MAX_TIMEOUTS + 2):
+        now += wheel.resolution
+        t0 = time.perf_counter()
+        fired += wheel.advance(now)
+        took += time.perf_counter() - t0
+    return enter_rate, per_session, key_rate, fired / took, pbx_ivr.active(), len(wheel)
+
+
+# ============================================================
+#  END TO END
+# ============================================================
+
+def scrape(admin):
+    text = urllib.request.urlopen(f"http://127.0.0.1:{admin}/metrics").read().decode()
+    for line in text.splitlines():
+        if line.startswith("pbx_ivr_sessions "):
+            return int(float(line.rsplit(" ", 1)[1]))
+    return None
+
+
+async def end_to_end(args, path):
+    port, admin = free_port(), free_port()
+    pbx = spawn_pbx(port, "--engine", "asyncio", "--ivr-menus", path,
+                    "--admin-port", str(admin))
+    try:
+        sem = asyncio.Semaphore(500)
+        idle_rss = proc_status(pbx.pid)[0]
+
+        async def enter(i):
+            client = VoipClient("127.0.0.1", port, f"5{i:05d}", reconnect=False, timeout=60)
+            async with sem:
+                await client.register()
+                await client.ivr("5000")
+                await client.ivr_choice(str(1 + i % min(args.menus, 9)))
+            return client
+
+        clients = await asyncio.gather(*(enter(i) for i in range(args.clients)))
+        inside = (scrape(admin), proc_status(pbx.pid)[0])
+        await asyncio.gather(*(c.close() for c in clients[::2]))
+        await asyncio.sleep(0.5)
+        closed = scrape(admin)
+        t0 = time.perf_counter()
+        while scrape(admin) and time.perf_counter() - t0 < args.timeout * (pbx_ivr.MAX_TIMEOUTS + 2):
+            await asyncio.sleep(0.2)
+        left = scrape(admin), time.perf_counter() - t0
+        await asyncio.gather(*(c.close() for c in clients[1::2]))
+        return idle_rss, inside, closed, left
+    finally:
+        pbx.terminate()
+        pbx.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=200_000)
+    parser.add_argument("--menus", type=int, default=5, help="submenus under the main menu")
+    parser.add_argument("--keys", type=int, default=500_000, help="structure: key presses timed")
+    parser.add_argument("--timeout", type=float, default=2.0, help="seconds each menu waits")
+    parser.add_argument("--clients", type=int, default=2000, help="end-to-end: callers in the IVR")
+    parser.add_argument("--no-e2e", action="store_true", help="structure part only")
+    args = parser.parse_args()
+    raise_nofile()
+
+    enter_rate, per_session, key_rate, expire_rate, active, armed = structure(args)
+    print(f"structure: {args.sessions} sessions, {args.menus} submenus")
+    print(f"  enter  {enter_rate:10.0f} sessions/s   {per_session:.0f} bytes per session")
+    print(f"  keys   {key_rate:10.0f} presses/s")
+    print(f"  expiry {expire_rate:10.0f} timeouts/s   afterwards {active} sessions, "
+          f"{armed} timers armed")
+    if args.no_e2e:
+        return
+
+    path = menus_file(tree(args.menus, args.timeout))
+    try:
+        idle_rss, inside, closed, left = asyncio.run(end_to_end(args, path))
+    finally:
+        os.remove(path)
+    print(f"end-to-end: {args.clients} callers in submenus, half disconnect, half wait")
+    print(f"  PBX RSS {idle_rss:.1f} MiB idle, {inside[1]:.1f} MiB with {inside[0]} sessions")
+    print(f"  {closed} sessions after the disconnects, {left[0]} after {left[1]:.1f} s of timeouts")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Handler-side cost of logging: print() against pbx_log.
+
+--threads threads each log --records connect/register/disconnect style
+lines, the way client threads do during a registration storm.  Output goes
+to a pipe read by a separate process, like a container's log driver;
+--reader-delay slows that reader down to mimic a congested driver.  Reported
+is the time a handler spends per record and the wall time until every line
+has been written.
+
+    python -m benchmarks.log_overhead --threads 8 --records 20000
+"""
+
+import argparse
+import io
+import subprocess
+import sys
+import threading
+import time
+
+import pbx_log
+from benchmarks.common import percentiles
+
+READER = """
+import sys, time
+delay = float(sys.argv[1])
+n = 0
+for chunk in iter(lambda: sys.stdin.buffer.read(65536), b""):
+    n += chunk.count(b"\\n")
+    if delay:
+        time.sleep(delay)
+print(n, file=sys.stderr)
+"""
+
+
+def storm(log_one, threads, records):
+    """Per-record handler latencies (seconds) of `threads` threads logging concurrently."""
+    samples = [[] for _ in range(threads)]
+    start = threading.Barrier(threads)
+
+    def work(t):
+        out = samples[t]
+        addr = ("10.0.0.1", 40000 + t)
+        start.wait()
+        for i in range(records):
+            t0 = time.perf_counter()
+            log_one(f"5{t:02d}{i % 1000:03d}", addr)
+            out.append(time.perf_counter() - t0)
+
+    ts = [threading.Thread(target=work, args=(t,)) for t in range(threads)]
+    for th in ts:
+        th.start()
+    for th in ts:
+        th.join()
+    return [s for per in samples for s in per]
+
+
+def run(kind, args):
+    reader = subprocess.Popen([sys.executable, "-c", READER, str(args.reader_delay)],
+                              stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    out = io.TextIOWrapper(reader.stdin, encoding="utf-8")
+
+    if kind == "print":
+        def log_one(ext, addr):
+            print(f"[PBX] Extension {ext} registered από {addr}", file=out, flush=True)
+    else:
+        pbx_log.configure("info", kind, out=out)
+        pbx_log.start()
+
+        def log_one(ext, addr):
+            pbx_log.info("register", "Extension {ext} registered από {addr}", ext=ext, addr=addr)
+
+    t0 = time.perf_counter()
+    samples = storm(log_one, args.threads, args.records)
+    if kind != "print":
+        pbx_log.stop()
+    out.close()
+    lines = int(reader.stderr.read())
+    reader.wait()
+    wall = time.perf_counter() - t0
+    return samples, wall, lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--records", type=int, default=20_000, help="records per thread")
+    parser.add_argument("--reader-delay", type=float, default=0.0,
+                        help="seconds the reader sleeps after each 64 KiB read")
+    args = parser.parse_args()
+
+    print(f"{args.threads} threads x {args.records} records, reader delay {args.reader_delay:g}s")
+    print(f"{'logger':12} {'mean us':>8} {'p99 us':>8} {'max ms':>8} {'wall s':>7} {'lines':>8}")
+    for kind in ("print", "text", "json"):
+        samples, wall, lines = run(kind, args)
+        pct = percentiles(samples, (99,))
+        label = kind if kind == "print" else f"pbx_log {kind}"
+        print(f"{label:12} {sum(samples) / len(samples) * 1e6:8.2f} {pct[99] * 1e6:8.2f} "
+              f"{max(samples) * 1e3:8.2f} {wall:7.2f} {lines:8d}")
+
+
+if __name__ == "__main__":
+    main()
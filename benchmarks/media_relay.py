@@ -0,0 +1,181 @@
+"""Media relay throughput and added latency at many simultaneous calls.
+
+A PBX with --media-ports gets --calls calls set up and answered over
+signalling; every endpoint then sends an RTP-sized packet (12-byte header
++ 160 bytes, G.711 at 20 ms) to its relay port every --ptime ms, in both
+directions, for --duration seconds.  The receiving endpoint takes the send
+time out of the packet, so latency is sender -> relay -> receiver on the
+loopback, measured by one clock.  Reported are offered and relayed packets
+per second, loss, the PBX's CPU time per relayed packet and latency
+percentiles.  The load generator needs about as much CPU as the relay, so
+on few cores it can fall behind the planned rate.
+
+    python -m benchmarks.media_relay --calls 1000 --duration 10
+"""
+
+import argparse
+import asyncio
+import json
+import select
+import socket
+import struct
+import time
+
+from benchmarks.common import (cpu_seconds, free_port, percentiles, proc_status, raise_nofile,
+                               spawn_pbx)
+from benchmarks.engine_capacity import Endpoint
+
+RTP = struct.Struct("!BBHII")
+STAMP = struct.Struct("!d")
+PAYLOAD = 160
+
+
+class MediaEndpoint(Endpoint):
+    async def expect(self, mtype):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError(f"{self.ext}: connection closed")
+            msg = json.loads(line)
+            if msg.get("type") == mtype:
+                return msg
+
+
+async def set_up(port, calls):
+    """Register and answer `calls` calls; returns [(relay address, relay address)]."""
+    endpoints = [MediaEndpoint(f"5{i:06d}") for i in range(2 * calls)]
+    sem = asyncio.Semaphore(200)
+
+    async def register(ep):
+        async with sem:
+            await ep.register(port)
+
+    async def call(caller, callee):
+        async with sem:
+            caller.send({"type": "call", "to": callee.ext})
+            await callee.expect("incoming_call")
+            callee.send({"type": "answer"})
+            a = await caller.expect("call_answered")
+            b = await callee.expect("call_answered")
+            return (a["media_host"], a["media_port"]), (b["media_host"], b["media_port"])
+
+    await asyncio.gather(*(register(ep) for ep in endpoints))
+    pairs = await asyncio.gather(*(call(endpoints[2 * i], endpoints[2 * i + 1])
+                                   for i in range(calls)))
+    return endpoints, pairs
+
+
+def stream(pairs, ptime, duration):
+    """Send on every leg every `ptime` seconds and time what comes back out."""
+    legs = []
+    for a, b in pairs:
+        for relay in (a, b):
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.bind(("127.0.0.1", 0))
+            s.setblocking(False)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            legs.append((s, relay))
+    poll = select.epoll()
+    for s, _ in legs:
+        poll.register(s.fileno(), select.EPOLLIN)
+    by_fd = {s.fileno(): s for s, _ in legs}
+    packet = bytearray(RTP.size + PAYLOAD)
+    buf = bytearray(2048)
+
+    def drain(timeout, latencies):
+        got = 0
+        for fd, _ in poll.poll(timeout):
+            s = by_fd[fd]
+            while True:
+                try:
+                    n = s.recv_into(buf)
+                except BlockingIOError:
+                    break
+                now = time.perf_counter()
+                if n >= RTP.size + STAMP.size and latencies is not None:
+                    latencies.append(now - STAMP.unpack_from(buf, RTP.size)[0])
+                got += 1
+        return got
+
+    # Latch both legs of every relay, then throw away what the latching let through
+    for s, relay in legs:
+        s.sendto(b"latch", relay)
+    time.sleep(0.2)
+    for s, relay in legs:
+        s.sendto(b"latch", relay)
+    time.sleep(0.2)
+    while drain(0, None):
+        pass
+
+    # Legs are spread evenly over each ptime instead of sending in bursts
+    latencies = []
+    sent = received = 0
+    gap = ptime / len(legs)
+    start = time.perf_counter()
+    n = 0
+    while True:
+        due = start + n * gap
+        if due >= start + duration:
+            break
+        wait = due - time.perf_counter()
+        if wait <= 0 and n % 64 == 0:
+            received += drain(0, latencies)    # behind schedule, but keep receiving
+        while wait > 0:
+            received += drain(wait, latencies)
+            wait = due - time.perf_counter()
+        seq, i = divmod(n, len(legs))
+        s, relay = legs[i]
+        RTP.pack_into(packet, 0, 0x80, 0, seq & 0xFFFF, seq * PAYLOAD, i)
+        STAMP.pack_into(packet, RTP.size, time.perf_counter())
+        try:
+            s.sendto(packet, relay)
+            sent += 1
+        except BlockingIOError:
+            pass
+        n += 1
+    end = time.perf_counter()
+    deadline = end + 0.5
+    while time.perf_counter() < deadline:
+        received += drain(0.05, latencies)
+    for s, _ in legs:
+        s.close()
+    return sent, received, end - start, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=1000)
+    parser.add_argument("--ptime", type=float, default=20.0, help="ms between packets per leg")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--engine", choices=["thread", "asyncio"], default="asyncio")
+    parser.add_argument("--media-ports", default="20000-29999")
+    args = parser.parse_args()
+    raise_nofile()
+
+    port = free_port()
+    proc = spawn_pbx(port, "--engine", args.engine, "--backlog", "4096",
+                     "--media-ports", args.media_ports)
+    try:
+        endpoints, pairs = asyncio.run(set_up(port, args.calls))
+        rss, threads = proc_status(proc.pid)
+        cpu0 = cpu_seconds(proc.pid)
+        sent, received, secs, latencies = stream(pairs, args.ptime / 1000, args.duration)
+        cpu = cpu_seconds(proc.pid) - cpu0
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    pct = percentiles(latencies)
+    streams = 2 * args.calls
+    print(f"{args.calls} calls ({streams} streams), {args.ptime:g} ms ptime, "
+          f"{args.engine} engine, PBX RSS {rss:.0f} MiB, {threads} threads")
+    print(f"offered  {sent / secs:9.0f} pkt/s ({streams * 1000 / args.ptime:.0f} planned)")
+    print(f"relayed  {received / secs:9.0f} pkt/s, loss {(1 - received / max(1, sent)) * 100:.2f}%")
+    print(f"relay    {cpu / secs * 100:.0f}% of a CPU, "
+          f"{cpu / max(1, received) * 1e6:.1f} us CPU per packet")
+    print(f"latency  p50 {pct[50] * 1e6:.0f} us  p95 {pct[95] * 1e6:.0f} us  "
+          f"p99 {pct[99] * 1e6:.0f} us")
+
+
+if __name__ == "__main__":
+    main()
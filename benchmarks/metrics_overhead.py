@@ -0,0 +1,109 @@
+"""Cost of recording metrics, per operation and end to end.
+
+First the recording primitives and Session.feed() with metrics on and off
+(pbx_server.Session with a no-op handler), then a PBX per setting driven through
+call/answer/hangup cycles, comparing call rate and setup latency.
+
+    python -m benchmarks.metrics_overhead --engine asyncio
+"""
+
+import argparse
+import asyncio
+import time
+
+import pbx_codec
+import pbx_metrics
+import pbx_server
+from benchmarks.common import free_port, percentiles, spawn_pbx
+from benchmarks.engine_capacity import Endpoint, call_cycles
+
+
+def per_op_ns(fn, n, repeat=5):
+    """Best of `repeat` runs, which filters out scheduling noise."""
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(n)
+        best = min(best, time.perf_counter() - t0)
+    return best / n * 1e9
+
+
+def micro(n):
+    counter = pbx_metrics.registrations
+    hist = pbx_metrics.messages
+
+    def inc(k):
+        for _ in range(k):
+            counter.inc()
+
+    def observe(k):
+        for _ in range(k):
+            hist.observe("call", 0.0002)
+
+    frame = pbx_codec.JSON.encode({"type": "call", "to": "7002"})
+
+    class Idle(pbx_server.Session):
+        def handle(self, msg):
+            pass
+
+    def feed(k):
+        session = Idle(None)
+        for _ in range(k):
+            session.feed(frame)
+
+    print(f"{'operation':28} {'ns/op':>8}")
+    print(f"{'Counter.inc':28} {per_op_ns(inc, n):8.0f}")
+    print(f"{'Histogram.observe':28} {per_op_ns(observe, n):8.0f}")
+    pbx_metrics.enabled = False
+    off = per_op_ns(feed, n)
+    pbx_metrics.enabled = True
+    on = per_op_ns(feed, n)
+    print(f"{'feed+dispatch, metrics off':28} {off:8.0f}")
+    print(f"{'feed+dispatch, metrics on':28} {on:8.0f}  (+{on - off:.0f} ns, "
+          f"{(on - off) / off * 100:.1f}%)")
+
+
+async def end_to_end(engine, metrics, pairs, duration):
+    port = free_port()
+    extra = ["--engine", engine] + ([] if metrics else ["--no-metrics"])
+    proc = spawn_pbx(port, *extra)
+    endpoints = [Endpoint(f"5{i:06d}") for i in range(2 * pairs)]
+    try:
+        await asyncio.gather(*(ep.register(port) for ep in endpoints))
+        setups = []
+        stop_at = time.perf_counter() + duration
+        await asyncio.gather(*(
+            call_cycles(endpoints[2 * i], endpoints[2 * i + 1], stop_at, setups)
+            for i in range(pairs)
+        ))
+        return len(setups) / duration, percentiles(setups)
+    finally:
+        for ep in endpoints:
+            if ep.writer is not None:
+                ep.writer.close()
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", type=int, default=100_000, help="iterations per micro benchmark")
+    parser.add_argument("--engine", choices=["thread", "asyncio"], default="asyncio")
+    parser.add_argument("--pairs", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--rounds", type=int, default=2, help="alternating runs per setting")
+    args = parser.parse_args()
+
+    micro(args.n)
+
+    print(f"\n{args.engine} engine, {args.pairs} pairs, {args.duration:g}s per run")
+    print(f"{'metrics':8} {'calls/s':>8} {'p50 ms':>7} {'p99 ms':>7}")
+    for _ in range(args.rounds):
+        for metrics in (False, True):
+            rate, pct = asyncio.run(end_to_end(args.engine, metrics, args.pairs, args.duration))
+            print(f"{'on' if metrics else 'off':8} {rate:8.0f} {pct[50] * 1000:7.2f} "
+                  f"{pct[99] * 1000:7.2f}")
+
+
+if __name__ == "__main__":
+    main()
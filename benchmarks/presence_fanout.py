@@ -0,0 +1,120 @@
+"""Cost of presence fan-out with many watchers.
+
+--watchers subscribers each watch --watch extensions picked at random from
+--extensions registered ones (500 x 1,000 of 10,000 by default, so every
+extension has about 50 watchers).  Timed in process, on a CallTable with
+pbx_presence as its listener:
+
+  change    set_state() with the listener, against no listener and against
+            a listener that checks every subscription for the extension
+            (what the work would be without the reverse index);
+  flush     one interval's worth (--per-interval) of changes on hot
+            extensions, then flush() building real presence frames: how
+            many messages and states go out against one message per
+            watcher per change uncoalesced.
+
+    python -m benchmarks.presence_fanout --watchers 500 --watch 1000
+"""
+
+import argparse
+import random
+import time
+
+import pbx_codec
+import pbx_presence
+from pbx_calltable import IDLE, IN_CALL, CallTable
+from pbx_server import PRESENCE
+
+
+def per_change_us(table, exts, n):
+    t0 = time.perf_counter()
+    for i in range(n):
+        table.set_state(exts[i % len(exts)], IN_CALL if i & 1 else IDLE)
+    return (time.perf_counter() - t0) / n * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--extensions", type=int, default=10_000)
+    parser.add_argument("--watchers", type=int, default=500)
+    parser.add_argument("--watch", type=int, default=1000, help="extensions per watcher")
+    parser.add_argument("--changes", type=int, default=50_000)
+    parser.add_argument("--per-interval", type=int, default=1000,
+                        help="changes between two flushes")
+    parser.add_argument("--hot", type=int, default=200,
+                        help="extensions the per-interval changes fall on")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    table = CallTable()
+    exts = [str(100000 + i) for i in range(args.extensions)]
+    for ext in exts:
+        table.register(ext, None, None)
+
+    sent = {"messages": 0, "states": 0, "bytes": 0}
+
+    def deliver(sub, states):
+        sent["messages"] += 1
+        sent["states"] += len(states)
+        sent["bytes"] += len(PRESENCE.encode(pbx_codec.JSON, states))
+
+    def state_of(ext):
+        rec = table.get(ext)
+        return rec.state if rec is not None else pbx_presence.OFFLINE
+
+    pbx_presence.configure(deliver, state_of)
+    subscriptions = []
+    t0 = time.perf_counter()
+    for w in range(args.watchers):
+        watched = rng.sample(exts, args.watch)
+        pbx_presence.subscribe((pbx_presence.ENDPOINT, f"w{w}"), watched)
+        subscriptions.append(((pbx_presence.ENDPOINT, f"w{w}"), set(watched)))
+    subscribe_s = time.perf_counter() - t0
+    pbx_presence.flush()    # the initial states nobody asked for here
+    watchers = {ext: len(subs) for ext, subs in pbx_presence._watchers.items()}
+    print(f"{args.watchers} watchers x {args.watch} of {args.extensions} extensions, "
+          f"{sum(watchers.values()) / len(exts):.0f} watchers per extension, "
+          f"subscribing took {subscribe_s * 1000:.0f} ms")
+
+    order = rng.choices(exts, k=args.changes)
+    table.listener = None
+    bare = per_change_us(table, order, args.changes)
+    table.listener = pbx_presence.changed
+    indexed = per_change_us(table, order, args.changes)
+    pbx_presence.flush()
+
+    def scan(ext):
+        for sub, watched in subscriptions:
+            if ext in watched:
+                pbx_presence._mark(sub, ext)
+
+    table.listener = scan
+    scanned = per_change_us(table, order, args.changes // 10)
+    pbx_presence._pending.clear()
+    print(f"change   no listener {bare:6.2f} us   indexed {indexed:6.2f} us   "
+          f"scan all subscriptions {scanned:7.2f} us")
+
+    table.listener = pbx_presence.changed
+    hot = rng.sample(exts, args.hot)
+    rounds = max(1, args.changes // args.per_interval)
+    flush_s = 0.0
+    uncoalesced = 0
+    for sub_key in sent:
+        sent[sub_key] = 0
+    for r in range(rounds):
+        batch = rng.choices(hot, k=args.per_interval)
+        for i, ext in enumerate(batch):
+            table.set_state(ext, IN_CALL if (r + i) & 1 else IDLE)
+            uncoalesced += watchers.get(ext, 0)
+        t0 = time.perf_counter()
+        pbx_presence.flush()
+        flush_s += time.perf_counter() - t0
+    print(f"flush    {args.per_interval} changes on {args.hot} extensions per interval: "
+          f"{flush_s / rounds * 1000:.1f} ms per flush, "
+          f"{sent['messages'] / rounds:.0f} messages with {sent['states'] / rounds:.0f} states "
+          f"({sent['bytes'] / rounds / 1024:.0f} KiB) instead of "
+          f"{uncoalesced / rounds:.0f} messages uncoalesced")
+
+
+if __name__ == "__main__":
+    main()
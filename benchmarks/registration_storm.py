@@ -0,0 +1,273 @@
+"""Registration storm: --phones endpoints reconnect at once while calls go on.
+
+A PBX is spawned and --callers extensions register and start calling each
+other in pairs (call -> incoming_call -> hangup, one call per pair every
+--call-interval).  Then every phone connects and registers at the same
+moment, the way they all do after a network outage.  A phone that gets an
+error with retry_after waits that long and tries again; one whose
+connection fails or times out retries after a second or two, like a real
+phone.  The phones are driven from --procs processes and each connects
+from one of --sources loopback addresses (127.0.x.y), so the per-IP limit
+has something to work with.
+
+The storm runs twice: without admission control and with the limits given
+by --limits.  For each run: call setup latency of the registered callers
+before and during the storm, the CPU the server spent in the first
+--measure seconds, how long until every phone was registered, and the
+refusals and failed attempts it took.  The drivers need cores of their
+own; on a machine with fewer than --procs + 2 the latencies mostly show
+the drivers competing with the server.  A run that does not get
+every phone registered within --deadline (or whose server dies) reports
+how many made it.
+
+    python -m benchmarks.registration_storm --phones 20000 --engine asyncio
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import random
+import shlex
+import socket
+import subprocess
+import time
+from collections import Counter
+
+from benchmarks.common import cpu_seconds, free_port, percentiles, raise_nofile, spawn_pbx
+from loadgen import Center, Endpoint, StepFailed, register
+
+HOST = "127.0.0.1"
+IP_BIND_ADDRESS_NO_PORT = getattr(socket, "IP_BIND_ADDRESS_NO_PORT", 24)     # Linux
+
+
+class Caller:
+    """Pairs of registered extensions calling each other; records setup latency."""
+
+    def __init__(self, pairs, interval):
+        self.pairs = pairs
+        self.interval = interval
+        self.samples = []
+        self.failed = 0
+        self.record = False
+
+    async def run_pair(self, a, b):
+        while True:
+            t0 = time.perf_counter()
+            ringing = b.expect("incoming_call")
+            try:
+                a.send({"type": "call", "to": b.ext})
+                _, t1 = await asyncio.wait_for(ringing, 5)
+                if self.record:
+                    self.samples.append(t1 - t0)
+                gone = b.expect("hangup")
+                a.send({"type": "hangup"})
+                await asyncio.wait_for(gone, 5)
+            except (asyncio.TimeoutError, ConnectionError, StepFailed):
+                if self.record:
+                    self.failed += 1
+                a.reset()
+                b.reset()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        return [asyncio.create_task(self.run_pair(a, b)) for a, b in self.pairs]
+
+    async def measure(self, seconds):
+        self.samples, self.failed, self.record = [], 0, True
+        await asyncio.sleep(seconds)
+        self.record = False
+        return self.samples, self.failed
+
+
+async def phone(ext, port, source, outcome, timeout, rng):
+    """Register one phone, following retry_after hints; returns when registered."""
+    loop = asyncio.get_running_loop()
+    while True:
+        ep = Endpoint(ext)
+        # waiting before connecting: a refusal comes before we say anything
+        reply = ep.expect("register_ok", "error")
+        sock = socket.socket()
+        try:
+            # source address only: ports bound up front would run out (TIME_WAIT) by the next run
+            sock.setsockopt(socket.SOL_IP, IP_BIND_ADDRESS_NO_PORT, 1)
+            sock.bind((source, 0))
+            sock.setblocking(False)
+            await asyncio.wait_for(loop.sock_connect(sock, (HOST, port)), timeout)
+            await loop.create_connection(lambda: ep, sock=sock)
+        except (OSError, asyncio.TimeoutError):
+            sock.close()
+            outcome["connect_failed"] += 1
+            await asyncio.sleep(1 + rng.random())
+            continue
+        ep.send({"type": "register", "extension": ext})
+        try:
+            msg, _ = await asyncio.wait_for(reply, timeout)
+        except (ConnectionError, asyncio.TimeoutError):
+            ep.close()
+            outcome["register_failed"] += 1
+            await asyncio.sleep(1 + rng.random())
+            continue
+        if msg["type"] == "register_ok":
+            return ep
+        ep.close()
+        outcome["refused"] += 1
+        await asyncio.sleep(msg.get("retry_after") or 1)
+
+
+async def phones(first, count, port, args, seed):
+    """Register `count` phones; (registered, seconds, outcome) once all are or the deadline passes."""
+    rng = random.Random(seed)
+    outcome = Counter()
+    sources = [f"127.0.{1 + k // 250}.{1 + k % 250}" for k in range(args.sources)]
+    t0 = time.perf_counter()
+    tasks = [asyncio.create_task(
+        phone(f"5{i:06d}", port, sources[i % len(sources)], outcome, args.timeout, rng))
+        for i in range(first, first + count)]
+    _, pending = await asyncio.wait(tasks, timeout=args.deadline)
+    took = time.perf_counter() - t0
+    for task in pending:
+        task.cancel()
+    return len(tasks) - len(pending), took, outcome, [t.result() for t in tasks if t not in pending]
+
+
+def phone_process(first, count, port, args, seed, results, stop):
+    """One driver process (a single one runs out of descriptors and CPU first)."""
+    raise_nofile()
+
+    async def run():
+        registered, took, outcome, eps = await phones(first, count, port, args, seed)
+        results.put((registered, took, outcome))
+        # phones stay connected until the caller measurement is over
+        await asyncio.get_running_loop().run_in_executor(None, stop.wait)
+        for ep in eps:
+            ep.close()
+
+    asyncio.run(run())
+
+
+async def storm(args, extra):
+    port = free_port()
+    proc = spawn_pbx(port, "--engine", args.engine, "--backlog", str(args.backlog), *extra,
+                     log=args.server_log)
+    drivers = []
+    stop = None
+    try:
+        pairs = []
+        for i in range(args.callers // 2):
+            a = await register_retrying(f"59{2 * i:05d}", port)
+            b = await register_retrying(f"59{2 * i + 1:05d}", port)
+            pairs.append((a, b))
+        caller = Caller(pairs, args.call_interval)
+        tasks = caller.start()
+        before, _ = await caller.measure(2.0)
+
+        # spawned, not forked: a fork would inherit this process's running loop
+        ctx = multiprocessing.get_context("spawn")
+        results = ctx.Queue()
+        stop = ctx.Event()
+        share = -(-args.phones // args.procs)
+        for k in range(args.procs):
+            count = min(share, args.phones - k * share)
+            drivers.append(ctx.Process(
+                target=phone_process, args=(k * share, count, port, args, k, results, stop)))
+        for driver in drivers:
+            driver.start()
+        busy = asyncio.create_task(server_cpu(proc.pid, args.measure))
+        samples, failed = await caller.measure(args.measure)
+        outcome = Counter()
+        outcome["cpu"], outcome["peak"] = await busy
+        loop = asyncio.get_running_loop()
+        took = 0.0
+        for _ in drivers:
+            registered, seconds, counts = await loop.run_in_executor(
+                None, results.get, True, args.deadline + 60)
+            outcome.update(counts)
+            outcome["registered"] += registered
+            took = max(took, seconds)
+        if proc.poll() is not None:
+            outcome["server_died"] = 1
+        stop.set()
+        for task in tasks:
+            task.cancel()
+        for a, b in pairs:
+            a.close()
+            b.close()
+        return before, samples, failed, took, outcome
+    finally:
+        if stop is not None:
+            stop.set()
+        for driver in drivers:
+            driver.join(10)
+            if driver.is_alive():
+                driver.kill()
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+async def server_cpu(pid, seconds, step=0.5):
+    """CPU seconds the server used over `seconds`, and its busiest `step` as a share of a core."""
+    start = last = cpu_seconds(pid)
+    peak = 0.0
+    for _ in range(int(seconds / step)):
+        await asyncio.sleep(step)
+        now = cpu_seconds(pid)
+        peak = max(peak, (now - last) / step)
+        last = now
+    return last - start, peak
+
+
+async def register_retrying(ext, port):
+    while True:
+        try:
+            return await register(Center(f"{HOST}:{port}:5"), ext, "json", 5)
+        except (OSError, asyncio.TimeoutError):
+            await asyncio.sleep(0.5)
+
+
+def ms(samples):
+    p = percentiles(samples)
+    return " ".join(f"p{k} {v * 1000:7.1f}" for k, v in p.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--phones", type=int, default=20_000)
+    parser.add_argument("--callers", type=int, default=100, help="registered before the storm")
+    parser.add_argument("--call-interval", type=float, default=0.05)
+    parser.add_argument("--measure", type=float, default=10.0,
+                        help="seconds of caller latency recorded from the storm's start")
+    parser.add_argument("--sources", type=int, default=200, help="source addresses of the phones")
+    parser.add_argument("--timeout", type=float, default=10.0, help="per connect and register")
+    parser.add_argument("--deadline", type=float, default=120.0,
+                        help="seconds the phones get to register")
+    parser.add_argument("--procs", type=int, default=4, help="processes driving the phones")
+    parser.add_argument("--server-log", help="file for the output of the PBX")
+    parser.add_argument("--engine", choices=("thread", "asyncio"), default="asyncio")
+    parser.add_argument("--backlog", type=int, default=1024)
+    parser.add_argument("--limits", default="--max-connections 25000 --register-rate 1000 "
+                                            "--register-burst 200 --ip-rate 50 --ip-burst 50",
+                        help="pbx_server.py flags of the run with admission control")
+    args = parser.parse_args()
+    raise_nofile()
+
+    print(f"{args.phones} phones from {args.sources} addresses, {args.callers} callers, "
+          f"{args.engine} engine")
+    for label, extra in (("no limits", ()), ("admission", shlex.split(args.limits))):
+        before, during, failed, took, outcome = asyncio.run(storm(args, extra))
+        print(f"{label:10} calls before  {ms(before)} ms")
+        print(f"{'':10} calls during  {ms(during)} ms, {len(during)} calls, {failed} failed; "
+              f"server CPU {outcome['cpu']:.1f} s, busiest {outcome['peak']:.0%} of a core")
+        done = ("server died, " if outcome["server_died"] else "") + (
+            f"all phones registered in {took:.1f} s" if outcome["registered"] == args.phones
+            else f"{outcome['registered']} phones registered in {took:.1f} s")
+        print(f"{'':10} {done}; refused {outcome['refused']}, "
+              f"connect failed {outcome['connect_failed']}, "
+              f"register failed {outcome['register_failed']}")
+
+
+if __name__ == "__main__":
+    main()
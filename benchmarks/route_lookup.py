@@ -0,0 +1,61 @@
+"""Route lookups per second with a large prefix table.
+
+Loads --prefixes random prefixes (2-8 digits) spread over --trunks trunks
+and times longest-prefix lookups of random 10-digit numbers, once with the
+lookup cache disabled and once with a warm cache over a --hot working set.
+
+    python -m benchmarks.route_lookup --prefixes 100000
+"""
+
+import argparse
+import random
+import time
+
+from pbx_routing import RouteTable
+
+
+def timed(table, numbers):
+    lookup = table.lookup
+    t0 = time.perf_counter()
+    for n in numbers:
+        lookup(n)
+    return len(numbers) / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--prefixes", type=int, default=100_000)
+    parser.add_argument("--trunks", type=int, default=12)
+    parser.add_argument("--lookups", type=int, default=500_000)
+    parser.add_argument("--hot", type=int, default=10_000, help="distinct numbers in the cached run")
+    args = parser.parse_args()
+
+    rnd = random.Random(1)
+    trunks = [f"site{i}" for i in range(args.trunks)]
+    prefixes = {}
+    while len(prefixes) < args.prefixes:
+        length = rnd.randint(2, 8)
+        prefixes["".join(rnd.choices("0123456789", k=length))] = rnd.choice(trunks)
+
+    t0 = time.perf_counter()
+    table = RouteTable(cache_size=0)
+    table.replace(prefixes)
+    build = time.perf_counter() - t0
+
+    numbers = ["".join(rnd.choices("0123456789", k=10)) for _ in range(args.lookups)]
+    cold = timed(table, numbers)
+    matched = sum(1 for n in numbers[:10_000] if table.lookup(n) is not None)
+
+    cached = RouteTable()
+    cached.replace(prefixes)
+    hot = [rnd.choice(numbers[:args.hot]) for _ in range(args.lookups)]
+    timed(cached, hot)  # warm up
+    warm = timed(cached, hot)
+
+    print(f"{len(table):,} prefixes over {args.trunks} trunks, built in {build * 1000:.1f} ms")
+    print(f"  uncached: {cold:12,.0f} lookups/s  ({matched / 100:.0f}% of numbers routed)")
+    print(f"  cached:   {warm:12,.0f} lookups/s  ({args.hot:,} hot numbers)")
+
+
+if __name__ == "__main__":
+    main()
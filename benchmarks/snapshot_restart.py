@@ -0,0 +1,113 @@
+"""Restart cost with a registration snapshot of --extensions extensions.
+
+In process: writing the snapshot (what the writer thread does every
+interval), loading it (mmap + header check) against parsing the same
+records as JSON and as a pickle, and one resume lookup (find()).  Then
+the server itself: time from spawning pbx_server.py until it accepts
+connections, without --snapshot and with the snapshot file in place.
+
+    python -m benchmarks.snapshot_restart --extensions 100000
+"""
+
+import argparse
+import json
+import os
+import pickle
+import random
+import tempfile
+import time
+
+import pbx_snapshot
+from benchmarks.common import free_port, spawn_pbx
+from pbx_calltable import IDLE, IN_CALL
+
+
+def records(n, rng):
+    out = []
+    for i in range(n):
+        ext = str(500000 + i)
+        in_call = i % 5 == 0
+        out.append((rng.randbytes(pbx_snapshot.TOKEN_BYTES), ext, rng.choice(pbx_snapshot.CODECS),
+                    "json" if i % 3 else "binary", IN_CALL if in_call else IDLE,
+                    str(500000 + (i ^ 1)) if in_call else None, False, None))
+    return out
+
+
+def best_ms(fn, runs=5):
+    best = float("inf")
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000
+
+
+def startup_ms(extra, runs, prepare=None):
+    best = float("inf")
+    for _ in range(runs):
+        if prepare is not None:
+            prepare()
+        t0 = time.perf_counter()
+        proc = spawn_pbx(free_port(), *extra)
+        best = min(best, time.perf_counter() - t0)
+        proc.terminate()
+        proc.wait()
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--extensions", type=int, default=100_000)
+    parser.add_argument("--lookups", type=int, default=100_000)
+    parser.add_argument("--starts", type=int, default=3, help="server starts per variant")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    recs = records(args.extensions, rng)
+    tmp = tempfile.mkdtemp(prefix="pbx-snapshot-")
+    path = os.path.join(tmp, "snapshot.bin")
+
+    write_ms = best_ms(lambda: pbx_snapshot.write(path, recs))
+    size = os.path.getsize(path)
+    print(f"{args.extensions} extensions: write {write_ms:.0f} ms, {size / 1024:.0f} KiB "
+          f"({size / args.extensions:.1f} bytes per extension)")
+
+    as_json = json.dumps([[r[0].hex(), *r[1:]] for r in recs]).encode()
+    as_pickle = pickle.dumps(recs)
+
+    def mapped():
+        pbx_snapshot.load(path).close()
+
+    print(f"load     mmap {best_ms(mapped):8.3f} ms   "
+          f"json {best_ms(lambda: json.loads(as_json)):8.1f} ms   "
+          f"pickle {best_ms(lambda: pickle.loads(as_pickle)):8.1f} ms")
+
+    snap = pbx_snapshot.load(path)
+    tokens = [r[0] for r in rng.choices(recs, k=args.lookups)]
+    t0 = time.perf_counter()
+    for token in tokens:
+        snap.find(token)
+    find_us = (time.perf_counter() - t0) / args.lookups * 1e6
+    print(f"resume   find() {find_us:.1f} us per lookup ({1e6 / find_us:.0f} per second)")
+    snap.close()
+
+    # the server rewrites its snapshot at exit, so each start gets a fresh copy
+    data = open(path, "rb").read()
+    served = os.path.join(tmp, "served.bin")
+
+    def restore():
+        with open(served, "wb") as f:
+            f.write(data)
+
+    plain = startup_ms((), args.starts)
+    restored = startup_ms(("--snapshot", served, "--snapshot-interval", "3600"), args.starts,
+                          restore)
+    print(f"startup  to accepting connections: {plain:.0f} ms without a snapshot, "
+          f"{restored:.0f} ms with {args.extensions} snapshotted extensions")
+    for name in os.listdir(tmp):
+        os.remove(os.path.join(tmp, name))
+    os.rmdir(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Timer insert and cancel cost with --armed timers already armed.
+
+In process, per operation, on what the no-answer and keepalive timeouts
+run on and on what they could have been built on instead:
+
+  wheel     pbx_timers.Wheel, the hashed timing wheel;
+  heap      a heapq of (due, seq, timer) with lazy cancel: a cancelled
+            entry is only flagged and stays in the heap until it comes up
+            (behind a lock, like the wheel: timers are armed from any thread);
+  sched     the standard library's sched.scheduler (cancel() is a list
+            remove and a heapify, so only --sched-ops of them are timed);
+  thread    one threading.Timer per timeout, as per-call threads would be;
+            only --threads of them, each is an OS thread.
+
+The armed timers are due 1 to --spread seconds out; inserts go in at the
+same spread and cancels hit random armed timers.  Then the wheel's own
+upkeep: one advance() per tick over --ticks ticks with everything armed.
+
+    python -m benchmarks.timer_wheel --armed 100000
+"""
+
+import argparse
+import heapq
+import itertools
+import random
+import sched
+import threading
+import time
+
+from pbx_timers import RESOLUTION, Wheel
+
+
+def noop():
+    pass
+
+
+def per_op_us(fn, items):
+    t0 = time.perf_counter()
+    for item in items:
+        fn(item)
+    return (time.perf_counter() - t0) / len(items) * 1e6
+
+
+def bench_wheel(args, delays, victims):
+    wheel = Wheel(now=0.0)
+    armed = [wheel.schedule(d, noop) for d in delays[:args.armed]]
+    insert = per_op_us(lambda d: armed.append(wheel.schedule(d, noop)), delays[args.armed:])
+    cancel = per_op_us(lambda i: wheel.cancel(armed[i]), victims)
+    return insert, cancel, len(wheel)
+
+
+class LazyHeap:
+    """heapq timers; cancel() flags the entry, the heap drops it when it comes up."""
+
+    def __init__(self):
+        self.heap = []
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+
+    def schedule(self, delay, fn):
+        entry = [delay, next(self.seq), fn]
+        with self.lock:
+            heapq.heappush(self.heap, entry)
+        return entry
+
+    def cancel(self, entry):
+        with self.lock:
+            entry[2] = None
+
+
+def bench_heap(args, delays, victims):
+    heap = LazyHeap()
+    armed = [heap.schedule(d, noop) for d in delays[:args.armed]]
+    insert = per_op_us(lambda d: armed.append(heap.schedule(d, noop)), delays[args.armed:])
+    cancel = per_op_us(lambda i: heap.cancel(armed[i]), victims)
+    return insert, cancel, len(heap.heap)
+
+
+def bench_sched(args, delays, victims):
+    s = sched.scheduler(time.monotonic, time.sleep)
+    now = time.monotonic()
+    armed = [s.enterabs(now + d, 0, noop) for d in delays[:args.armed]]
+    insert = per_op_us(lambda d: armed.append(s.enterabs(now + d, 0, noop)),
+                       delays[args.armed:])
+    cancel = per_op_us(lambda i: s.cancel(armed[i]), victims[:args.sched_ops])
+    return insert, cancel, len(s.queue)
+
+
+def bench_threads(args, delays):
+    timers = []
+
+    def start(d):
+        timer = threading.Timer(d, noop)
+        timer.daemon = True
+        timer.start()
+        timers.append(timer)
+
+    insert = per_op_us(start, delays[:args.threads])
+    cancel = per_op_us(lambda t: t.cancel(), list(timers))
+    for timer in timers:
+        timer.join()
+    return insert, cancel
+
+
+def bench_advance(args, delays):
+    """Mean and worst advance() over --ticks ticks, and the timers that fired."""
+    wheel = Wheel(now=0.0)
+    for d in delays[:args.armed]:
+        wheel.schedule(d, noop)
+    times = []
+    for tick in range(1, args.ticks + 1):
+        t0 = time.perf_counter()
+        wheel.advance(tick * wheel.resolution)
+        times.append(time.perf_counter() - t0)
+    return sum(times) / len(times) * 1e6, max(times) * 1e6, wheel.fired
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--armed", type=int, default=100_000, help="timers armed before timing")
+    parser.add_argument("--ops", type=int, default=100_000, help="inserts and cancels timed")
+    parser.add_argument("--spread", type=float, default=120.0,
+                        help="timers are due within this many seconds")
+    parser.add_argument("--sched-ops", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=1000)
+    parser.add_argument("--ticks", type=int, default=600, help="wheel ticks to advance through")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    delays = [1 + rng.random() * (args.spread - 1) for _ in range(args.armed + args.ops)]
+    victims = rng.sample(range(args.armed + args.ops), args.ops)
+
+    print(f"{args.armed} timers armed, due within {args.spread:.0f} s; "
+          f"{args.ops} inserts then {args.ops} cancels")
+    for name, bench in (("wheel", bench_wheel), ("heap", bench_heap), ("sched", bench_sched)):
+        insert, cancel, left = bench(args, delays, victims)
+        note = f"  ({left} timers left armed)"
+        if name == "heap":
+            note = f"  ({left} entries still in the heap, cancelled ones included)"
+        elif name == "sched":
+            note = f"  (cancel over {args.sched_ops} ops)"
+        print(f"{name:6} insert {insert:6.2f} us  cancel {cancel:8.2f} us{note}")
+    insert, cancel = bench_threads(args, delays)
+    print(f"{'thread':6} insert {insert:6.2f} us  cancel {cancel:8.2f} us  "
+          f"({args.threads} threading.Timer, one thread each)")
+
+    mean, worst, fired = bench_advance(args, delays)
+    print(f"wheel  advance {mean:.1f} us per {RESOLUTION * 1000:.0f} ms tick on average, "
+          f"{worst:.0f} us at worst; {fired} timers fired in {args.ticks} ticks")
+
+
+if __name__ == "__main__":
+    main()
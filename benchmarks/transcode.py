@@ -0,0 +1,88 @@
+"""Transcoding throughput in samples per second on one core.
+
+Every conversion the media path can need is timed three ways: one 20 ms
+frame (160 samples) at a time through pbx_transcode.converter(), as the
+relay converts each packet; --batch frames at once through decode() and
+encode(), as the conference mixer converts a whole room block; and
+sample by sample with the reference functions the tables are built from.
+Legs per core is samples/s over the 8000 samples/s one leg carries, i.e.
+how many one-way streams a single core could convert if it did nothing
+else.
+
+    python -m benchmarks.transcode --batch 500
+"""
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+import pbx_transcode as t
+
+FRAME = 160
+
+REFERENCE = {
+    (t.PCMU, t.L16): lambda data: [t.ulaw_to_linear(u) for u in data],
+    (t.PCMA, t.L16): lambda data: [t.alaw_to_linear(a) for a in data],
+    (t.L16, t.PCMU): lambda data: [t.linear_to_ulaw(s) for s in data],
+    (t.L16, t.PCMA): lambda data: [t.linear_to_alaw(s) for s in data],
+    (t.PCMU, t.PCMA): lambda data: [t.linear_to_alaw(t.ulaw_to_linear(u)) for u in data],
+    (t.PCMA, t.PCMU): lambda data: [t.linear_to_ulaw(t.alaw_to_linear(a)) for a in data],
+}
+
+
+def samples_per_s(fn, samples, seconds):
+    """Best rate of five runs, each repeating fn for about seconds / 5."""
+    best = 0.0
+    for _ in range(5):
+        n = 0
+        t0 = time.perf_counter()
+        end = t0 + seconds / 5
+        while True:
+            fn()
+            n += 1
+            now = time.perf_counter()
+            if now >= end:
+                break
+        best = max(best, n * samples / (now - t0))
+    return best
+
+
+def payload(codec, frames, rng):
+    linear = np.array([rng.randint(-12000, 12000) for _ in range(frames * FRAME)])
+    return t.encode(linear, codec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch", type=int, default=500, help="frames per batched conversion")
+    parser.add_argument("--seconds", type=float, default=1.0, help="per measurement")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    print(f"20 ms frames of {FRAME} samples, batches of {args.batch} frames")
+    print(f"{'conversion':12} {'frame Msps':>10} {'legs':>7} {'batch Msps':>10} {'legs':>7} "
+          f"{'python Msps':>11} {'legs':>5}")
+    for (src, dst), reference in REFERENCE.items():
+        frame = payload(src, 1, rng)
+        batch = payload(src, args.batch, rng)
+        convert = t.converter(src, dst)
+        if src == t.L16:
+            samples = t.decode(frame, t.L16).tolist()
+        else:
+            samples = frame
+        if {src, dst} == {t.PCMU, t.PCMA}:
+            batched = lambda: convert(batch)        # translate has no batched form of its own
+        else:
+            batched = lambda: t.encode(t.decode(batch, src), dst)
+        rates = (samples_per_s(lambda: convert(frame), FRAME, args.seconds),
+                 samples_per_s(batched, args.batch * FRAME, args.seconds),
+                 samples_per_s(lambda: reference(samples), FRAME, args.seconds))
+        print(f"{src + '>' + dst:12} " + " ".join(
+            f"{r / 1e6:{w}.2f} {r / t.RATE:{lw}.0f}"
+            for r, w, lw in zip(rates, (10, 10, 11), (7, 7, 5))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Trunk throughput with and without write coalescing.
+
+A producer thread pushes --messages trunk_chat messages through an
+OutboundQueue over a socketpair while the other end decodes them with
+FrameReader, the same path a trunk takes.  Each run uses a different batch
+window; "off" writes every message on its own like endpoint queues do.
+
+    python -m benchmarks.trunk_batching --messages 200000
+"""
+
+import argparse
+import socket
+import threading
+import time
+
+import pbx_codec
+import pbx_outq
+from pbx_outq import OutboundQueue
+
+
+def run(window, args):
+    pbx_outq.configure("trunk", 64 * 1024 * 1024, 16 * 1024 * 1024, "drop",
+                       window, args.batch_bytes)
+    pbx_outq._batch_stats["trunk"] = pbx_outq.BatchStats()
+    a, b = socket.socketpair()
+    q = OutboundQueue(a, "trunk")
+    codec = pbx_codec.CODECS[args.framing]
+    frames = [codec.encode({"type": "trunk_chat", "from": str(5000 + i % 1000),
+                            "to": "7002", "text": "καλημέρα"}) for i in range(1000)]
+    received = [0]
+
+    def reader():
+        fr = pbx_codec.FrameReader()
+        while received[0] < args.messages:
+            data = b.recv(65536)
+            if not data:
+                break
+            received[0] += len(fr.feed(data))
+
+    t = threading.Thread(target=reader)
+    t.start()
+    t0 = time.perf_counter()
+    for i in range(args.messages):
+        q.send(frames[i % 1000])
+    t.join()
+    elapsed = time.perf_counter() - t0
+    q.close()
+    b.close()
+    return elapsed, received[0], pbx_outq.batch_stats("trunk")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--windows", default="off,0,0.5,2", help="batch windows in ms")
+    parser.add_argument("--batch-bytes", type=int, default=64 * 1024)
+    parser.add_argument("--framing", choices=sorted(pbx_codec.CODECS), default="json")
+    args = parser.parse_args()
+
+    print(f"{'window':>8} {'msgs/s':>12} {'writes':>9} {'msgs/write':>11} "
+          f"{'avg flush':>10} {'max flush':>10}")
+    for w in args.windows.split(","):
+        window = None if w == "off" else float(w) / 1000
+        elapsed, n, st = run(window, args)
+        writes = st["batches"] if window is not None else n
+        print(f"{w:>8} {n / elapsed:12,.0f} {writes:9,} {n / max(writes, 1):11.1f} "
+              f"{st['avg_flush_latency'] * 1000:8.3f}ms {st['max_flush_latency'] * 1000:8.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""Trunk flaps: what reaches the other PBX while the trunk keeps dropping.
+
+Two PBXs are spawned, A's trunk link to B running through a relay in this
+process.  --pairs calls go up from A to B and their callers send chat
+messages, numbered in their text, that cross the trunk as trunk_chat and
+that the callees on B check off.  Each run has two phases:
+
+  steady   --steady messages as fast as the chain takes them (at most
+           --window in flight), nothing cut: the throughput the spool and
+           its acks must not cost.  Best of --repeat;
+  flap     --rate messages/s for --seconds while the relay cuts A's link
+           every --flap-every seconds and refuses connections for --down
+           seconds; in each outage one more caller hangs up.  Then up to
+           --settle seconds for the rest to arrive.
+
+A run without the spool (--trunk-spool 0, what trunks did before) and
+one with it.  For the flap phase: messages delivered, lost, duplicated
+and out of order, the hangups that reached B, and how long after the
+stream ended the last message arrived.
+
+    python -m benchmarks.trunk_flap --rate 5000 --seconds 10
+"""
+
+import argparse
+import asyncio
+import shlex
+import subprocess
+import time
+
+from benchmarks.common import free_port, raise_nofile, spawn_pbx
+from loadgen import Center, Endpoint, register
+
+HOST = "127.0.0.1"
+
+
+class Relay:
+    """TCP relay to `target` that can drop every connection and refuse new ones."""
+
+    def __init__(self, port, target):
+        self.port = port
+        self.target = target
+        self.server = None
+        self.links = set()
+        self.cuts = 0
+
+    async def listen(self):
+        self.server = await asyncio.start_server(self.relay, HOST, self.port, reuse_address=True)
+
+    async def relay(self, reader, writer):
+        try:
+            up_reader, up_writer = await asyncio.open_connection(HOST, self.target)
+        except OSError:
+            writer.close()
+            return
+        link = (writer, up_writer)
+        self.links.add(link)
+
+        async def pipe(src, dst):
+            try:
+                while data := await src.read(65536):
+                    dst.write(data)
+                    await dst.drain()
+            except (ConnectionError, OSError):
+                pass
+            finally:
+                dst.transport.abort()
+
+        await asyncio.gather(pipe(reader, up_writer), pipe(up_reader, writer))
+        self.links.discard(link)
+
+    async def cut(self, down):
+        """Abort every relayed connection and refuse new ones for `down` seconds."""
+        self.cuts += 1
+        self.server.close()
+        for a, b in list(self.links):
+            a.transport.abort()
+            b.transport.abort()
+        await asyncio.sleep(down)
+        await self.listen()
+
+    async def close(self):
+        self.server.close()
+        for a, b in list(self.links):
+            a.transport.abort()
+            b.transport.abort()
+        while self.links:
+            await asyncio.sleep(0.01)
+
+
+class Sink(Endpoint):
+    """A callee on B: keeps the number of every chat it gets."""
+
+    def __init__(self, ext, tally):
+        super().__init__(ext)
+        self.tally = tally
+        self.got = []
+
+    def received(self, msg, now):
+        if msg.get("type") == "chat":
+            self.got.append(int(msg["text"]))
+            self.tally[0] += 1
+            self.tally[1] = now
+            return
+        super().received(msg, now)
+
+
+async def call(a, b):
+    """Set up a trunk call a -> b, retrying until the trunk is there."""
+    while True:
+        ringing = b.expect("incoming_call")
+        a.send({"type": "call", "to": b.ext})
+        try:
+            await asyncio.wait_for(ringing, 2)
+            answered = a.expect("call_answered")
+            b.send({"type": "answer"})
+            await asyncio.wait_for(answered, 2)
+            return
+        except asyncio.TimeoutError:
+            a.reset()
+            b.reset()
+            a.send({"type": "hangup"})
+            await asyncio.sleep(0.5)
+
+
+async def steady(pairs, sent, tally, args):
+    """Messages per second through the chain with at most --window in flight."""
+    base = tally[0]
+    t0 = time.perf_counter()
+    n = 0
+    while n < args.steady:
+        if n - (tally[0] - base) >= args.window:
+            await asyncio.sleep(0.0005)
+            continue
+        for _ in range(min(100, args.steady - n)):
+            a, _ = pairs[n % len(pairs)]
+            a.send({"type": "chat", "text": str(sent[n % len(pairs)])})
+            sent[n % len(pairs)] += 1
+            n += 1
+        await asyncio.sleep(0)
+    deadline = time.perf_counter() + args.settle
+    while tally[0] - base < n and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    return (tally[0] - base) / (tally[1] - t0)
+
+
+async def flap(pairs, hangups, relay, sent, tally, args):
+    """Paced stream with the relay cutting the trunk; the outcome counters."""
+    for _, b in pairs:
+        b.got = []
+    first = list(sent)
+    gone = [b.expect("hangup") for _, b in hangups]
+
+    async def cutter():
+        for a, _ in hangups:
+            await asyncio.sleep(args.flap_every)
+            outage = asyncio.create_task(relay.cut(args.down))
+            await asyncio.sleep(args.down / 2)
+            a.send({"type": "hangup"})
+            await outage
+
+    cuts = asyncio.create_task(cutter())
+    t0 = time.perf_counter()
+    n = 0
+    while (now := time.perf_counter()) - t0 < args.seconds:
+        for _ in range(int((now - t0) * args.rate) - n):
+            k = n % len(pairs)
+            pairs[k][0].send({"type": "chat", "text": str(sent[k])})
+            sent[k] += 1
+            n += 1
+        await asyncio.sleep(0.005)
+    ended = time.perf_counter()
+    await cuts
+
+    expected = sum(s - f for s, f in zip(sent, first))
+    deadline = time.perf_counter() + args.settle
+    while time.perf_counter() < deadline:
+        if sum(len(set(b.got)) for _, b in pairs) >= expected and all(g.done() for g in gone):
+            break
+        await asyncio.sleep(0.05)
+
+    out = {"sent": expected, "delivered": 0, "duplicated": 0, "reordered": 0,
+           "hangups": sum(g.done() for g in gone), "drain": max(0.0, tally[1] - ended)}
+    for k, (_, b) in enumerate(pairs):
+        unique = {x for x in b.got if x >= first[k]}
+        out["delivered"] += len(unique)
+        out["duplicated"] += len(b.got) - len(unique)
+        out["reordered"] += sum(1 for x, y in zip(b.got, b.got[1:]) if y < x)
+    out["lost"] = out["sent"] - out["delivered"]
+    return out
+
+
+async def run(args, spool):
+    extra = ["--engine", args.engine, "--trunk-framing", args.framing,
+             "--trunk-spool", str(spool), *shlex.split(args.server_flags)]
+    a_port, b_port = free_port(), free_port()
+    a_trunk, b_trunk, relay_port = free_port(), free_port(), free_port()
+    relay = Relay(relay_port, b_trunk)
+    await relay.listen()
+    b = spawn_pbx(b_port, *extra, mode="B", prefix="7", remote_prefix="5", ivr_ext="7000",
+                  trunk_remote_port=a_trunk, trunk_listen_port=b_trunk)
+    a = spawn_pbx(a_port, *extra, mode="A", trunk_remote_port=relay_port,
+                  trunk_listen_port=a_trunk, log=args.server_log)
+    try:
+        tally = [0, 0.0]
+        center_a, center_b = Center(f"{HOST}:{a_port}:5"), Center(f"{HOST}:{b_port}:7")
+        pairs = []
+        for i in range(args.pairs + args.seconds // args.flap_every):
+            caller = await register(center_a, f"5{i:04d}", args.framing, 5)
+            callee = await register(center_b, f"7{i:04d}", args.framing, 5,
+                                    endpoint=lambda ext: Sink(ext, tally))
+            await call(caller, callee)
+            pairs.append((caller, callee))
+        streams, hangups = pairs[:args.pairs], pairs[args.pairs:]
+        sent = [0] * len(streams)
+        rate = 0.0
+        for _ in range(args.repeat):
+            rate = max(rate, await steady(streams, sent, tally, args))
+        out = await flap(streams, hangups, relay, sent, tally, args)
+        out["steady"] = rate
+        out["hangups_of"] = len(hangups)
+        out["cuts"] = relay.cuts
+        for caller, callee in pairs:
+            caller.reset()
+            callee.reset()
+            caller.close()
+            callee.close()
+        return out
+    finally:
+        await relay.close()
+        for proc in (a, b):
+            proc.terminate()
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pairs", type=int, default=20, help="calls carrying the chat stream")
+    parser.add_argument("--steady", type=int, default=100_000, help="messages of the steady phase")
+    parser.add_argument("--window", type=int, default=5000, help="steady phase: most in flight")
+    parser.add_argument("--repeat", type=int, default=3, help="steady phases run (the best counts)")
+    parser.add_argument("--rate", type=float, default=5000, help="flap phase: messages per second")
+    parser.add_argument("--seconds", type=int, default=10, help="flap phase: length of the stream")
+    parser.add_argument("--flap-every", type=int, default=2,
+                        help="seconds between cuts of the trunk link")
+    parser.add_argument("--down", type=float, default=0.5,
+                        help="seconds the relay refuses connections after a cut")
+    parser.add_argument("--settle", type=float, default=20.0,
+                        help="seconds allowed for what is still on its way")
+    parser.add_argument("--spool", type=int, default=100_000, help="--trunk-spool of the spooled run")
+    parser.add_argument("--engine", choices=("thread", "asyncio"), default="asyncio")
+    parser.add_argument("--framing", choices=("json", "binary"), default="json")
+    parser.add_argument("--server-flags", default="--trunk-retry-min 0.1 --trunk-retry-max 2",
+                        help="more pbx_server.py flags for both PBXs")
+    parser.add_argument("--server-log", help="file for the output of PBX A")
+    args = parser.parse_args()
+    raise_nofile()
+
+    print(f"{args.pairs} calls A -> B, {args.engine} engine, {args.framing} framing; "
+          f"flap phase {args.rate:.0f} msgs/s for {args.seconds} s, cut every "
+          f"{args.flap_every} s for {args.down} s")
+    for label, spool in (("no spool", 0), ("spool", args.spool)):
+        out = asyncio.run(run(args, spool))
+        print(f"{label:8} steady {out['steady']:8.0f} msgs/s")
+        print(f"{'':8} flap   {out['cuts']} cuts: {out['delivered']}/{out['sent']} delivered, "
+              f"{out['lost']} lost, {out['duplicated']} duplicated, {out['reordered']} out of "
+              f"order; hangups {out['hangups']}/{out['hangups_of']}; last message "
+              f"{out['drain']:.2f} s after the stream ended")
+
+
+if __name__ == "__main__":
+    main()
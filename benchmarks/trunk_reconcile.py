@@ -0,0 +1,190 @@
+"""Call-state reconciliation: cost against the number of calls and of differences.
+
+Two processes stand for PBX A and PBX B, each with a CallTable holding
+--calls calls across the trunk between them (the table keeps the
+pbx_reconcile digest current as the calls are set up), and talk JSON
+lines over a socketpair as they would over the trunk.  --diverged of the
+calls exist on one side only, half on each.  Then:
+
+  digest   A runs a pbx_reconcile round; both sides hang up their orphans;
+  full     A sends its whole table (in --chunk pairs per message: a line
+           of the trunk holds at most a MiB), B diffs it against its own
+           and sends back what A has to hang up - the exchange
+           reconciliation avoids.
+
+For each: bytes on the wire, messages and wall time until both sides are
+done; for the digest, also the orphans each side hung up.  Last, what the
+digest costs the call path: a remote leg set up and released with the
+index attached and without.
+
+    python -m benchmarks.trunk_reconcile --calls 1000,10000,100000 --diverged 10
+"""
+
+import argparse
+import multiprocessing
+import socket
+import time
+
+import pbx_codec
+import pbx_reconcile
+from pbx_calltable import IN_CALL, CallTable
+
+PREFIX = {"A": "5", "B": "7"}
+
+
+class Side:
+    """One PBX: its call table, and the trunk as a socket of JSON lines."""
+
+    def __init__(self, node, sock, calls, diverged):
+        self.node = node
+        self.peer = "B" if node == "A" else "A"
+        self.sock = sock
+        self.sent = [0, 0]          # messages, bytes
+        self.orphans = []
+        self.table = CallTable()
+        self.table.index = pbx_reconcile
+        pbx_reconcile._trunks.clear()       # from the previous run, in this process
+        pbx_reconcile.configure(node, self.send, self.hangup)
+        # A lacks the first half of the diverged calls, B the second half
+        half = diverged // 2
+        skip = range(0, half) if node == "A" else range(half, diverged)
+        for i in range(calls):
+            if i in skip:
+                continue
+            local, remote = self.ext(node, i), self.ext(self.peer, i)
+            self.table.register(local, None, None)
+            self.table.reserve(local, remote, True, self.peer, state=IN_CALL)
+
+    @staticmethod
+    def ext(node, i):
+        return f"{PREFIX[node]}{i:06d}"
+
+    def pairs(self):
+        return [(ext, peer) for ext, state, peer, remote, _ in self.table.snapshot()
+                if remote and state == IN_CALL]
+
+    def send(self, trunk, msg):
+        data = pbx_codec.JSON.encode(msg)
+        self.sent[0] += 1
+        self.sent[1] += len(data)
+        self.sock.sendall(data)
+
+    def hangup(self, local, remote):
+        if self.table.release(local, remote)[0] is not None:
+            self.orphans.append(local)
+
+    def messages(self):
+        reader = pbx_codec.FrameReader()
+        while True:
+            data = self.sock.recv(1 << 20)
+            if not data:
+                return
+            yield from reader.feed(data)
+
+
+def responder(sock, calls, diverged):
+    """PBX B: answers rounds and full tables until told to stop."""
+    side = Side("B", sock, calls, diverged)
+    theirs = set()
+    sock.sendall(pbx_codec.JSON.encode({"type": "bench_ready"}))
+    for msg in side.messages():
+        mtype = msg["type"]
+        if mtype in pbx_reconcile.TYPES:
+            pbx_reconcile.handle(msg, "A")
+        elif mtype == "bench_full":
+            theirs.update(tuple(p) for p in msg["pairs"])
+            if msg["last"]:
+                ours = {(peer, ext) for ext, peer in side.pairs()}
+                side.send("A", {"type": "bench_full_reply",
+                                "drop": [list(p) for p in theirs - ours]})
+                theirs = set()
+        elif mtype == "bench_end":
+            side.send("A", {"type": "bench_result", "orphans": len(side.orphans),
+                            "messages": side.sent[0], "bytes": side.sent[1]})
+            side.orphans, side.sent = [], [0, 0]
+        elif mtype == "bench_quit":
+            return
+
+
+def run(calls, diverged, chunk):
+    a_sock, b_sock = socket.socketpair()
+    ctx = multiprocessing.get_context("fork")
+    child = ctx.Process(target=responder, args=(b_sock, calls, diverged))
+    child.start()
+    side = Side("A", a_sock, calls, diverged)
+    messages = side.messages()
+    assert next(messages)["type"] == "bench_ready"
+    out = {}
+
+    t0 = time.perf_counter()
+    pbx_reconcile.start("B")
+    for msg in messages:
+        if msg["type"] in pbx_reconcile.TYPES:
+            pbx_reconcile.handle(msg, "B")
+            if not pbx_reconcile._rounds:
+                break
+    side.send("B", {"type": "bench_end"})
+    result = next(messages)
+    out["digest"] = (time.perf_counter() - t0, side.sent[0] + result["messages"] - 1,
+                     side.sent[1] + result["bytes"], len(side.orphans), result["orphans"])
+
+    side.sent = [0, 0]
+    t0 = time.perf_counter()
+    pairs = [list(p) for p in side.pairs()]
+    for i in range(0, len(pairs), chunk):
+        side.send("B", {"type": "bench_full", "pairs": pairs[i:i + chunk],
+                        "last": i + chunk >= len(pairs)})
+    reply = next(messages)
+    for local, remote in reply["drop"]:
+        side.hangup(local, remote)
+    out["full"] = (time.perf_counter() - t0, side.sent[0] + 1,
+                   side.sent[1] + len(pbx_codec.JSON.encode(reply)))
+
+    side.send("B", {"type": "bench_quit"})
+    child.join()
+    return out
+
+
+def call_path(n):
+    """Microseconds per remote leg set up and released, with and without the index."""
+    out = []
+    for index in (None, pbx_reconcile):
+        table = CallTable()
+        table.index = index
+        exts = [f"5{i:06d}" for i in range(n)]
+        for ext in exts:
+            table.register(ext, None, None)
+        t0 = time.perf_counter()
+        for ext in exts:
+            table.reserve(ext, "7" + ext[1:], True, "B")
+            table.release(ext, "7" + ext[1:])
+        out.append((time.perf_counter() - t0) / n * 1e6)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", default="1000,10000,100000",
+                        help="comma-separated numbers of calls across the trunk")
+    parser.add_argument("--diverged", type=int, default=10,
+                        help="calls that exist on one side only")
+    parser.add_argument("--chunk", type=int, default=10_000, help="full: pairs per message")
+    parser.add_argument("--ops", type=int, default=100_000, help="call path: legs timed")
+    args = parser.parse_args()
+
+    print(f"{args.diverged} calls diverged, {pbx_reconcile.LEAVES} leaves in "
+          f"{pbx_reconcile.GROUPS} groups")
+    for calls in (int(c) for c in args.calls.split(",")):
+        out = run(calls, args.diverged, args.chunk)
+        took, messages, size, orphans_a, orphans_b = out["digest"]
+        print(f"{calls:7} calls  digest {took * 1000:8.1f} ms {size / 1024:9.1f} KiB "
+              f"{messages:2} messages; orphans hung up A {orphans_a} B {orphans_b}")
+        took, messages, size = out["full"]
+        print(f"{'':13} full   {took * 1000:8.1f} ms {size / 1024:9.1f} KiB {messages:2} messages")
+    bare, indexed = call_path(args.ops)
+    print(f"call path: remote leg set up and released in {bare:.2f} us, "
+          f"{indexed:.2f} us with the digest kept")
+
+
+if __name__ == "__main__":
+    main()
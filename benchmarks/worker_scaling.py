@@ -0,0 +1,79 @@
+"""Call throughput of one PBX as --workers grows.
+
+For each worker count a PBX is started and --clients load processes drive
+--pairs caller/callee pairs each through call/answer/hangup cycles.  Pairs
+are random extensions, so with N workers about (N-1)/N of the calls cross
+between workers over their internal links.  Scaling needs free cores: the
+PBX workers and the client processes compete for the same CPUs.
+
+    python -m benchmarks.worker_scaling --workers 1 2 4 --clients 4
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks.common import free_port, percentiles, raise_nofile, spawn_pbx
+from benchmarks.engine_capacity import Endpoint, call_cycles
+
+
+async def drive(port, client, pairs, duration):
+    endpoints = [Endpoint(f"5{client:02d}{i:04d}") for i in range(2 * pairs)]
+    try:
+        await asyncio.gather(*(ep.register(port) for ep in endpoints))
+        setups = []
+        stop_at = time.perf_counter() + duration
+        await asyncio.gather(*(
+            call_cycles(endpoints[2 * i], endpoints[2 * i + 1], stop_at, setups)
+            for i in range(pairs)
+        ))
+        return setups
+    finally:
+        for ep in endpoints:
+            if ep.writer is not None:
+                ep.writer.close()
+
+
+def client_process(port, client, pairs, duration):
+    raise_nofile()
+    return asyncio.run(drive(port, client, pairs, duration))
+
+
+def run(engine, workers, clients, pairs, duration):
+    port = free_port()
+    proc = spawn_pbx(port, "--engine", engine, "--workers", str(workers), "--backlog", "4096")
+    try:
+        time.sleep(0.5)    # let the workers link up
+        with ProcessPoolExecutor(clients) as pool:
+            results = list(pool.map(client_process, [port] * clients, range(clients),
+                                    [pairs] * clients, [duration] * clients))
+        setups = [s for r in results for s in r]
+        return len(setups) / duration, percentiles(setups)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--engine", choices=["thread", "asyncio"], default="asyncio")
+    parser.add_argument("--clients", type=int, default=4, help="load generating processes")
+    parser.add_argument("--pairs", type=int, default=25, help="call pairs per client process")
+    parser.add_argument("--duration", type=float, default=5.0)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs, {args.engine} engine, "
+          f"{args.clients} x {args.pairs} pairs, {args.duration:g}s per run")
+    print(f"{'workers':>7} {'calls/s':>8} {'speedup':>8} {'p50 ms':>7} {'p99 ms':>7}")
+    base = None
+    for n in args.workers:
+        rate, pct = run(args.engine, n, args.clients, args.pairs, args.duration)
+        base = base or rate
+        print(f"{n:7d} {rate:8.0f} {rate / base:8.2f} {pct[50] * 1000:7.2f} {pct[99] * 1000:7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,115 +1,144 @@
-import socket
-import threading
-import json
 import argparse
+import asyncio
+import os
 import sys
+import threading
 
+import pbx_codec
+from voip_client import VoipClient, VoipError
 
-def send_msg(conn, obj):
-    try:
-        data = json.dumps(obj).encode("utf-8") + b"\n"
-        conn.sendall(data)
-    except Exception:
-        pass
-
-
-def receiver_thread(conn):
-    f = conn.makefile("r", encoding="utf-8")
-    try:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                msg = json.loads(line)
-            except json.JSONDecodeError:
-                continue
-
-            mtype = msg.get("type")
-
-            if mtype == "register_ok":
-                ext = msg.get("extension")
-                print(f"[SERVER] Καταχωρήθηκες ως extension {ext}")
-
-            elif mtype == "call_proceeding":
-                to = msg.get("to")
-                print(f"[SERVER] Γίνεται κλήση προς {to}...")
-
-            elif mtype == "incoming_call":
-                frm = msg.get("from")
-                print(f"[SERVER] Νέα κλήση από {frm}. Πληκτρολόγησε 'answer' για απάντηση.")
-
-            elif mtype == "incoming_call_waiting":
-                frm = msg.get("from")
-                print(f"[SERVER] CALL WAITING: Νέα κλήση από {frm} (ήδη σε κλήση).")
-
-            elif mtype == "call_answered":
-                by = msg.get("by")
-                print(f"[SERVER] Η κλήση απαντήθηκε από {by}.")
-
-            elif mtype == "hangup":
-                by = msg.get("by")
-                print(f"[SERVER] Η κλήση τερματίστηκε από {by}.")
-
-            elif mtype == "busy":
-                to = msg.get("to")
-                print(f"[SERVER] Μήνυμα: {{'type': 'busy', 'to': '{to}'}}")
-
-            elif mtype == "ivr_message":
-                text = msg.get("text", "")
-                print("\n" + text + "\nΓράψε 'digit <n>' για να επιλέξεις (π.χ. digit 3)\n")
-
-            elif mtype == "ivr_info":
-                text = msg.get("text", "")
-                print(f"[SERVER][IVR INFO] {text}")
-
-            elif mtype == "chat":
-                frm = msg.get("from")
-                text = msg.get("text", "")
-                print(f"[CHAT] {frm}: {text}")
-
-            elif mtype == "chat_sent":
-                to = msg.get("to")
-                print(f"[SERVER] Το μήνυμα στάλθηκε προς {to}.")
-
-            elif mtype == "error":
-                reason = msg.get("reason", "Άγνωστο σφάλμα.")
-                print(f"[SERVER][ERROR] {reason}")
 
-            else:
-                # Unknown or debug message
-                print(f"[SERVER] Μήνυμα: {msg}")
-    except Exception as e:
-        print(f"[CLIENT] Σφάλμα receiver: {e}")
-    finally:
-        print("[CLIENT] Η σύνδεση με τον server τερματίστηκε.")
+def stdin_lines(loop, queue):
+    """Feed stdin lines into `queue` (None at EOF); input() blocks, so in its own thread."""
+    while True:
         try:
-            conn.close()
-        except Exception:
-            pass
-        # exit entire process if receiver dies
-        sys.exit(0)
-
-
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--server-ip", required=True)
-    parser.add_argument("--server-port", type=int, required=True)
-    parser.add_argument("--extension", required=True)
-    args = parser.parse_args()
+            line = input("> ")
+        except EOFError:
+            line = None
+        loop.call_soon_threadsafe(queue.put_nowait, line)
+        if line is None or line.strip().lower() == "quit":
+            return
+
+
+async def printer(client, lines):
+    async for msg in client.events():
+        handle_server_msg(msg)
+    # The connection is gone for good (without reconnect): that ends the command loop too
+    lines.put_nowait(None)
+
+
+def handle_server_msg(msg):
+    mtype = msg.get("type")
+
+    if mtype == "register_ok":
+        ext = msg.get("extension")
+        print(f"[SERVER] Καταχωρήθηκες ως extension {ext}")
+        if "codec" in msg:
+            print(f"[SERVER] Codec ήχου: {msg['codec'] or 'χωρίς μετατροπή'}")
+        if "resume_token" in msg:
+            print(f"[SERVER] Token συνέχισης (--resume): {msg['resume_token']}")
+
+    elif mtype == "resume_ok":
+        ext = msg.get("extension")
+        print(f"[SERVER] Συνέχεια ως extension {ext} ({msg.get('state')}"
+              + (f" με {msg['peer']}" if msg.get("peer") else "") + ")")
+
+    elif mtype == "call_proceeding":
+        to = msg.get("to")
+        print(f"[SERVER] Γίνεται κλήση προς {to}...")
+
+    elif mtype == "incoming_call":
+        frm = msg.get("from")
+        print(f"[SERVER] Νέα κλήση από {frm}. Πληκτρολόγησε 'answer' για απάντηση.")
+
+    elif mtype == "incoming_call_waiting":
+        frm = msg.get("from")
+        print(f"[SERVER] CALL WAITING: Νέα κλήση από {frm} (ήδη σε κλήση).")
+
+    elif mtype == "call_answered":
+        by = msg.get("by")
+        print(f"[SERVER] Η κλήση απαντήθηκε από {by}.")
+
+    elif mtype == "hangup":
+        by = msg.get("by")
+        print(f"[SERVER] Η κλήση τερματίστηκε από {by}.")
+
+    elif mtype == "no_answer":
+        print(f"[SERVER] Η κλήση από {msg.get('from')} προς {msg.get('to')} δεν απαντήθηκε.")
+
+    elif mtype == "busy":
+        to = msg.get("to")
+        print(f"[SERVER] Μήνυμα: {{'type': 'busy', 'to': '{to}'}}")
+
+    elif mtype == "ivr_message":
+        text = msg.get("text", "")
+        print("\n" + text + "\nΓράψε 'digit <n>' για να επιλέξεις (π.χ. digit 3)\n")
+
+    elif mtype == "ivr_info":
+        text = msg.get("text", "")
+        print(f"[SERVER][IVR INFO] {text}")
+
+    elif mtype == "chat":
+        frm = msg.get("from")
+        text = msg.get("text", "")
+        print(f"[CHAT] {frm}: {text}")
+
+    elif mtype == "chat_sent":
+        to = msg.get("to")
+        print(f"[SERVER] Το μήνυμα στάλθηκε προς {to}.")
+
+    elif mtype == "conference_joined":
+        room = msg.get("room")
+        members = ", ".join(msg.get("members", [])) or "κανείς ακόμη"
+        print(f"[SERVER] Μπήκες στο conference {room} (μέσα: {members}).")
+        if msg.get("media_port"):
+            print(f"[SERVER] Media: {msg.get('media_host')}:{msg.get('media_port')} "
+                  f"({msg.get('codec')}, {msg.get('ptime')} ms)")
+
+    elif mtype == "conference_member_joined":
+        print(f"[SERVER] Ο {msg.get('ext')} μπήκε στο conference {msg.get('room')}.")
+
+    elif mtype == "conference_member_left":
+        print(f"[SERVER] Ο {msg.get('ext')} βγήκε από το conference {msg.get('room')}.")
+
+    elif mtype == "conference_left":
+        print(f"[SERVER] Βγήκες από το conference {msg.get('room')}.")
+
+    elif mtype == "presence":
+        for ext, state in sorted(msg.get("states", {}).items()):
+            print(f"[BLF] {ext}: {state}")
+
+    elif mtype == "disconnected":
+        print("[CLIENT] Η σύνδεση με τον server τερματίστηκε."
+              + (" Επανασύνδεση..." if msg.get("reconnect") else ""))
+
+    elif mtype == "error":
+        reason = msg.get("reason", "Άγνωστο σφάλμα.")
+        print(f"[SERVER][ERROR] {reason}")
+        if "retry_after" in msg:
+            print(f"[SERVER] Δοκίμασε ξανά σε {msg['retry_after']} δευτερόλεπτα.")
 
-    # Connect
-    conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    conn.connect((args.server_ip, args.server_port))
+    else:
+        # Unknown or debug message
+        print(f"[SERVER] Μήνυμα: {msg}")
+
+
+async def run(args):
+    client = VoipClient(args.server_ip, args.server_port, args.extension, framing=args.framing,
+                        codecs=args.codec, resume_token=args.resume,
+                        reconnect=not args.no_reconnect)
+    lines = asyncio.Queue()
+    events = asyncio.create_task(printer(client, lines))
+
+    # Register (always sent as JSON; the reply says whether binary was accepted)
+    try:
+        await client.register()
+    except (OSError, asyncio.TimeoutError, VoipError) as e:
+        print(f"[CLIENT] Αποτυχία σύνδεσης/καταχώρησης: {e}")
+        await client.close()
+        return None
     print(f"[CLIENT] Συνδέθηκες στο PBX {args.server_ip}:{args.server_port}")
 
-    # Register
-    send_msg(conn, {"type": "register", "extension": args.extension})
-
-    # Start receiver thread
-    t = threading.Thread(target=receiver_thread, args=(conn,), daemon=True)
-    t.start()
-
     # Small help
     print("\nΔιαθέσιμες εντολές:")
     print("  call <ext>   → ξεκινά κλήση")
@@ -118,6 +147,9 @@ def main():
     print("  ivr <ext>    → κλήση στο IVR (5000 ή 7000)")
     print("  digit <n>    → επιλογή σε IVR (0–9)")
     print("  msg <text>   → στέλνει μήνυμα chat στον συνομιλητή")
+    print("  conference <room> → μπαίνει σε conference (hangup για έξοδο)")
+    print("  watch <ext|prefix*> ... → παρακολουθεί την κατάσταση extensions (BLF)")
+    print("  unwatch      → σταματά την παρακολούθηση")
     print("  quit         → έξοδος\n")
 
     if args.extension.startswith("5"):
@@ -132,50 +164,93 @@ def main():
         print("  - Μπορείς να καλέσεις remote 5XXX μέσω trunk.\n")
 
     # Command loop
+    reader = threading.Thread(target=stdin_lines, args=(asyncio.get_running_loop(), lines),
+                              daemon=True)
+    reader.start()
     while True:
-        try:
-            cmd = input("> ").strip()
-        except EOFError:
+        cmd = await lines.get()
+        if cmd is None:
             break
-
+        cmd = cmd.strip()
         if not cmd:
             continue
 
         parts = cmd.split()
         op = parts[0].lower()
 
-        if op == "call" and len(parts) == 2:
-            ext = parts[1]
-            send_msg(conn, {"type": "call", "to": ext})
+        if op == "quit":
+            print("[CLIENT] Έξοδος...")
+            break
 
-        elif op == "answer":
-            send_msg(conn, {"type": "answer"})
+        # Replies, errors included, are printed as events; nothing more to do with them here
+        try:
+            if op == "call" and len(parts) == 2:
+                await client.call(parts[1])
 
-        elif op == "hangup":
-            send_msg(conn, {"type": "hangup"})
+            elif op == "answer":
+                await client.answer()
 
-        elif op == "ivr" and len(parts) == 2:
-            ivr_ext = parts[1]
-            send_msg(conn, {"type": "ivr", "to": ivr_ext})
+            elif op == "hangup":
+                await client.hangup()
 
-        elif op == "digit" and len(parts) == 2:
-            digit = parts[1]
-            send_msg(conn, {"type": "ivr_choice", "digit": digit})
+            elif op == "ivr" and len(parts) == 2:
+                await client.ivr(parts[1])
 
-        elif op == "msg" and len(parts) >= 2:
-            text = " ".join(parts[1:])
-            send_msg(conn, {"type": "chat", "text": text})
+            elif op == "digit" and len(parts) == 2:
+                await client.ivr_choice(parts[1])
 
-        elif op == "quit":
-            print("[CLIENT] Έξοδος...")
-            try:
-                conn.close()
-            except Exception:
-                pass
-            sys.exit(0)
-
-        else:
-            print("Άγνωστη εντολή. Διαθέσιμες: call, answer, hangup, ivr, digit, msg, quit.")
+            elif op == "msg" and len(parts) >= 2:
+                await client.chat(" ".join(parts[1:]))
+
+            elif op == "conference" and len(parts) == 2:
+                await client.conference(parts[1])
+
+            elif op == "watch" and len(parts) >= 2:
+                exts = [p for p in parts[1:] if not p.endswith("*")]
+                prefixes = [p[:-1] for p in parts[1:] if p.endswith("*") and len(p) > 1]
+                await client.subscribe(exts, prefixes)
+
+            elif op == "unwatch":
+                await client.unsubscribe()
+
+            else:
+                print("Άγνωστη εντολή. Διαθέσιμες: call, answer, hangup, ivr, digit, msg, "
+                      "conference, watch, unwatch, quit.")
+        except VoipError:
+            pass
+        except ConnectionError:
+            print("[CLIENT] Δεν υπάρχει σύνδεση με τον server.")
+        except asyncio.TimeoutError:
+            print("[CLIENT] Καμία απάντηση από τον server.")
+
+    await client.close()
+    await events
+    return reader
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--server-ip", required=True)
+    parser.add_argument("--server-port", type=int, required=True)
+    parser.add_argument("--extension", required=True)
+    parser.add_argument("--framing", choices=sorted(pbx_codec.CODECS), default="json",
+                        help="signalling framing to ask the server for")
+    parser.add_argument("--codec", action="append", choices=["PCMU", "PCMA", "L16"],
+                        help="audio codec this endpoint sends, best first (repeatable)")
+    parser.add_argument("--resume", metavar="TOKEN",
+                        help="resume the registration the server gave this token "
+                             "instead of registering again")
+    parser.add_argument("--no-reconnect", action="store_true",
+                        help="exit when the connection drops instead of reconnecting")
+    args = parser.parse_args()
+    try:
+        reader = asyncio.run(run(args))
+    except KeyboardInterrupt:
+        return
+    if reader is not None and reader.is_alive():
+        # Still blocked in input() (the connection went away): it cannot be interrupted
+        sys.stdout.flush()
+        os._exit(0)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,421 @@
+"""Headless load generator speaking the PBX endpoint protocol.
+
+Registers a pool of extensions on every center, then starts scripted
+scenarios at a target rate and times each protocol step, from the message
+that triggers it to the message that completes it on the other side:
+
+    local     call → incoming_call, answer → call_answered, hangup → peer hangup
+    trunk     the same with caller and callee on two different centers
+    ivr       ivr → ivr_message, ivr_choice 0 → ivr_info
+    chat      a local call carrying a burst of chat → peer chat
+    register  a fresh connection: connect + register → register_ok (storms)
+
+    python loadgen.py --center 127.0.0.1:5000:5 --center 127.0.0.1:5001:7 \\
+        --extensions 5000 --cps 200 --duration 30 --mix local=3,trunk=3,ivr=1,chat=1,register=1
+
+A center is HOST:PORT:PREFIX; its IVR is PREFIX000 unless given as a fourth
+field.  Extensions are PREFIX followed by a zero-padded index starting at
+10, so they never collide with the IVR or the numbers its digits dial.
+"""
+
+import argparse
+import asyncio
+import random
+import socket
+import time
+from collections import Counter, defaultdict, deque
+
+import pbx_codec
+from benchmarks.common import percentiles, raise_nofile
+
+SCENARIOS = ("local", "trunk", "ivr", "chat", "register")
+
+
+class StepFailed(Exception):
+    pass
+
+
+class Center:
+    def __init__(self, spec):
+        parts = spec.split(":")
+        if len(parts) not in (3, 4) or not parts[1].isdigit() or not parts[2]:
+            raise ValueError(f"bad center {spec!r} (expected HOST:PORT:PREFIX[:IVR])")
+        self.host = parts[0]
+        self.port = int(parts[1])
+        self.prefix = parts[2]
+        self.ivr_ext = parts[3] if len(parts) == 4 else f"{self.prefix}000"
+        self.idle = deque()    # registered endpoints not in a scenario
+
+    def __str__(self):
+        return f"{self.host}:{self.port} ({self.prefix}XXX)"
+
+
+# ============================================================
+#  ENDPOINT
+# ============================================================
+
+class Endpoint(asyncio.Protocol):
+    """One registered extension.
+
+    Incoming messages complete the oldest pending expect() whose types
+    match; anything nobody waits for is dropped.
+    """
+
+    def __init__(self, ext):
+        self.ext = ext
+        self.codec = pbx_codec.JSON
+        self.reader = pbx_codec.FrameReader()
+        self.transport = None
+        self.waiters = []
+        self.closed = False
+
+    def connection_made(self, transport):
+        transport.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.transport = transport
+
+    def data_received(self, data):
+        now = time.perf_counter()
+        for msg in self.reader.feed(data):
+            self.received(msg, now)
+
+    def received(self, msg, now):
+        mtype = msg.get("type")
+        if mtype == "register_ok":
+            self.codec = pbx_codec.choose(msg.get("framing"))
+        elif mtype == "ping":
+            self.transport.write(self.codec.encode({"type": "pong"}))
+            return
+        for i, (types, fut) in enumerate(self.waiters):
+            if not fut.done() and mtype in types:
+                del self.waiters[i]
+                fut.set_result((msg, now))
+                break
+
+    def connection_lost(self, exc):
+        self.closed = True
+        for _, fut in self.waiters:
+            if not fut.done():
+                fut.set_exception(ConnectionError(f"{self.ext}: σύνδεση έκλεισε"))
+        self.waiters.clear()
+
+    def send(self, obj):
+        if self.closed:
+            raise StepFailed(f"{self.ext}: σύνδεση έκλεισε")
+        self.transport.write(self.codec.encode(obj))
+
+    def expect(self, *types):
+        """Future resolved with (msg, receive time) by the next message of these types."""
+        self.waiters = [w for w in self.waiters if not w[1].done()]
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters.append((types, fut))
+        return fut
+
+    def reset(self):
+        for _, fut in self.waiters:
+            fut.cancel()
+        self.waiters.clear()
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+async def register(center, ext, framing, timeout, endpoint=Endpoint):
+    loop = asyncio.get_running_loop()
+    _, ep = await asyncio.wait_for(
+        loop.create_connection(lambda: endpoint(ext), center.host, center.port), timeout)
+    msg = {"type": "register", "extension": ext}
+    if framing != "json":
+        msg["framing"] = framing
+    reply = ep.expect("register_ok")
+    ep.send(msg)
+    try:
+        await asyncio.wait_for(reply, timeout)
+    except BaseException:
+        ep.close()
+        raise
+    return ep
+
+
+# ============================================================
+#  LOAD GENERATOR
+# ============================================================
+
+class LoadGen:
+    def __init__(self, args, centers):
+        self.args = args
+        self.centers = centers
+        self.timeout = args.timeout
+        self.rnd = random.Random(args.seed)
+        self.samples = defaultdict(list)     # step -> latencies (s)
+        self.started = Counter()
+        self.completed = Counter()
+        self.failed = Counter()
+        self.skipped = Counter()
+        self.errors = Counter()
+        self.storm_next = 0
+
+    def ext(self, center, index):
+        return f"{center.prefix}{10 + index:0{self.width}d}"
+
+    async def register_pool(self):
+        """Register --extensions endpoints on every center; returns the elapsed seconds."""
+        n = self.args.extensions
+        self.width = max(3, len(str(10 + n + self.args.storm_pool)))
+        sem = asyncio.Semaphore(self.args.concurrency)
+
+        async def one(center, i):
+            async with sem:
+                ep = await register(center, self.ext(center, i), self.args.framing,
+                                    self.timeout)
+            center.idle.append(ep)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(c, i) for c in self.centers for i in range(n)))
+        return time.perf_counter() - t0
+
+    async def step(self, name, sender, obj, receiver, expected, ack=None):
+        """Send obj and time it until `receiver` gets `expected`.
+
+        `ack` is the reply the sender itself must get for the step to count;
+        an error or busy instead fails the step right away.
+        """
+        fails = ("error", "busy")
+        done = receiver.expect(expected, *fails) if receiver is sender else receiver.expect(expected)
+        acked = sender.expect(ack, *fails) if ack else None
+        t0 = time.perf_counter()
+        try:
+            sender.send(obj)
+            async with asyncio.timeout(self.timeout):
+                if acked is not None:
+                    reply, _ = await acked
+                    if reply["type"] != ack:
+                        raise StepFailed(f"{name}: {reply.get('reason', reply['type'])}")
+                msg, t1 = await done
+        except TimeoutError:
+            raise StepFailed(f"{name}: timeout") from None
+        finally:
+            done.cancel()
+            if acked is not None:
+                acked.cancel()
+        if msg["type"] != expected:
+            raise StepFailed(f"{name}: {msg.get('reason', msg['type'])}")
+        self.samples[name].append(t1 - t0)
+        return msg
+
+    # ---- scenarios ----
+
+    async def call(self, a, b):
+        await self.step("call → incoming_call", a, {"type": "call", "to": b.ext},
+                        b, "incoming_call", ack="call_proceeding")
+        await self.step("answer → call_answered", b, {"type": "answer"},
+                        a, "call_answered", ack="call_answered")
+
+    async def hangup(self, a, b):
+        await self.step("hangup → peer hangup", a, {"type": "hangup"},
+                        b, "hangup", ack="hangup")
+
+    async def scenario_local(self, a, b):
+        await self.call(a, b)
+        if self.args.hold:
+            await asyncio.sleep(self.args.hold)
+        await self.hangup(a, b)
+
+    scenario_trunk = scenario_local
+
+    async def scenario_chat(self, a, b):
+        await self.call(a, b)
+        burst = await asyncio.gather(*(
+            self.step("chat → peer chat", a, {"type": "chat", "text": f"load {k}"},
+                      b, "chat", ack="chat_sent")
+            for k in range(self.args.chat_burst)
+        ), return_exceptions=True)
+        await self.hangup(a, b)
+        for r in burst:
+            if isinstance(r, BaseException):
+                raise r
+
+    async def scenario_ivr(self, a, center):
+        await self.step("ivr → ivr_message", a, {"type": "ivr", "to": center.ivr_ext},
+                        a, "ivr_message")
+        await self.step("ivr_choice → ivr_info", a, {"type": "ivr_choice", "digit": "0"},
+                        a, "ivr_info")
+
+    async def scenario_register(self, center):
+        k = self.storm_next
+        self.storm_next = (k + 1) % self.args.storm_pool
+        t0 = time.perf_counter()
+        try:
+            ep = await register(center, self.ext(center, self.args.extensions + k),
+                                self.args.framing, self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise StepFailed(f"register: {str(e) or 'timeout'}") from None
+        self.samples["connect+register → register_ok"].append(time.perf_counter() - t0)
+        ep.close()
+
+    # ---- scheduling ----
+
+    def take(self, center):
+        while center.idle:
+            ep = center.idle.popleft()
+            if not ep.closed:
+                return ep
+        return None
+
+    def release(self, center, ep):
+        if ep is not None and not ep.closed:
+            ep.reset()
+            center.idle.append(ep)
+
+    async def run_one(self, name):
+        rnd = self.rnd
+        center = rnd.choice(self.centers)
+        if name == "trunk":
+            other = rnd.choice([c for c in self.centers if c is not center])
+        elif name in ("local", "chat"):
+            other = center
+        else:
+            other = None
+
+        eps = []
+        if name != "register":
+            a = self.take(center)
+            b = self.take(other) if other is not None else None
+            if a is None or (other is not None and b is None):
+                self.release(center, a)
+                self.release(other, b)
+                self.skipped[name] += 1
+                return
+            eps = [(center, a)] + ([(other, b)] if b is not None else [])
+
+        self.started[name] += 1
+        try:
+            if name == "register":
+                await self.scenario_register(center)
+            elif name == "ivr":
+                await self.scenario_ivr(a, center)
+            else:
+                await getattr(self, "scenario_" + name)(a, b)
+            self.completed[name] += 1
+        except (StepFailed, ConnectionError) as e:
+            self.failed[name] += 1
+            self.errors[str(e)] += 1
+            # Leave the endpoints idle again before they go back to the pool
+            for _, ep in eps:
+                if not ep.closed:
+                    ep.transport.write(ep.codec.encode({"type": "hangup"}))
+            await asyncio.sleep(0.2)
+        finally:
+            for c, ep in eps:
+                self.release(c, ep)
+
+    async def run(self, mix):
+        loop = asyncio.get_running_loop()
+        names = list(mix)
+        weights = [mix[n] for n in names]
+        interval = 1.0 / self.args.cps
+        tasks = set()
+        start = loop.time()
+        i = 0
+        while i * interval < self.args.duration:
+            delay = start + i * interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            task = asyncio.create_task(self.run_one(self.rnd.choices(names, weights)[0]))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            i += 1
+        arrivals = loop.time() - start
+        if tasks:
+            await asyncio.gather(*tasks)
+        return i, arrivals, loop.time() - start
+
+    def report(self, launched, arrivals, elapsed):
+        print(f"\n{launched} scenarios σε {arrivals:.1f}s ({launched / arrivals:.0f}/s, στόχος "
+              f"{self.args.cps:g}/s), ολοκλήρωση σε {elapsed:.1f}s")
+        print(f"\n{'scenario':10} {'started':>8} {'ok':>8} {'failed':>7} {'skipped':>8} {'ok/s':>8}")
+        for name in SCENARIOS:
+            if self.started[name] or self.skipped[name]:
+                print(f"{name:10} {self.started[name]:8d} {self.completed[name]:8d} "
+                      f"{self.failed[name]:7d} {self.skipped[name]:8d} "
+                      f"{self.completed[name] / elapsed:8.1f}")
+        print(f"\n{'step':32} {'count':>8} {'per s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        for name, samples in self.samples.items():
+            pct = percentiles(samples)
+            print(f"{name:32} {len(samples):8d} {len(samples) / elapsed:8.1f} "
+                  f"{pct[50] * 1000:8.2f} {pct[95] * 1000:8.2f} {pct[99] * 1000:8.2f}")
+        if self.errors:
+            print("\nσφάλματα:")
+            for reason, n in self.errors.most_common(10):
+                print(f"  {n:6d}  {reason}")
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise ValueError(f"unknown scenario {name!r} (one of {', '.join(SCENARIOS)})")
+        mix[name] = float(weight) if weight else 1.0
+    return {n: w for n, w in mix.items() if w > 0}
+
+
+async def amain(args, centers, mix):
+    gen = LoadGen(args, centers)
+    print(f"[LOADGEN] Καταχώρηση {args.extensions} extensions ανά κέντρο: "
+          + ", ".join(str(c) for c in centers))
+    try:
+        took = await gen.register_pool()
+    except (OSError, asyncio.TimeoutError) as e:
+        raise SystemExit(f"[LOADGEN] Αποτυχία καταχώρησης: {str(e) or 'timeout'}")
+    total = args.extensions * len(centers)
+    print(f"[LOADGEN] {total} extensions καταχωρήθηκαν σε {took:.2f}s ({total / took:.0f}/s)")
+    try:
+        gen.report(*await gen.run(mix))
+    finally:
+        for c in centers:
+            for ep in c.idle:
+                ep.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--center", action="append", metavar="HOST:PORT:PREFIX[:IVR]",
+                        help="PBX to load (repeat per center; default: the docker-compose pair)")
+    parser.add_argument("--extensions", type=int, default=1000, help="registered extensions per center")
+    parser.add_argument("--cps", type=float, default=50, help="scenarios started per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of new arrivals")
+    parser.add_argument("--mix", default="local=3,trunk=3,ivr=1,chat=1,register=1",
+                        help="scenario weights, e.g. local=1,trunk=1")
+    parser.add_argument("--hold", type=float, default=0, help="seconds a call stays up before hangup")
+    parser.add_argument("--chat-burst", type=int, default=10, help="chat messages per chat scenario")
+    parser.add_argument("--storm-pool", type=int, default=1000,
+                        help="extensions cycled through by the register scenario")
+    parser.add_argument("--framing", choices=sorted(pbx_codec.CODECS), default="json")
+    parser.add_argument("--timeout", type=float, default=5, help="seconds before a step fails")
+    parser.add_argument("--concurrency", type=int, default=200, help="parallel initial registrations")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    try:
+        centers = [Center(s) for s in args.center or ["127.0.0.1:5000:5", "127.0.0.1:5001:7"]]
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    if not mix:
+        parser.error("empty --mix")
+    if "trunk" in mix and len(centers) < 2:
+        parser.error("trunk scenarios need at least two centers")
+    if args.cps <= 0 or args.storm_pool <= 0:
+        parser.error("--cps and --storm-pool must be positive")
+
+    limit = raise_nofile()
+    if args.extensions * len(centers) + 100 > limit:
+        parser.error(f"need more file descriptors than the limit ({limit})")
+
+    asyncio.run(amain(args, centers, mix))
+
+
+if __name__ == "__main__":
+    main()
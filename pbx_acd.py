@@ -0,0 +1,281 @@
+"""ACD call queues (hunt groups): calls to a queue extension go to its agents.
+
+Queues file format (one entry per line, `#` starts a comment):
+
+    queue <ext> <strategy>                  a queue, picking agents by
+                                            longest-idle or round-robin
+    member <queue-ext> <ext> [<ext> ...]    its agents (local extensions)
+
+An agent can take a queue call while it is registered and idle.  Each
+queue keeps its idle agents in a heap, lazily: an agent that becomes idle
+is pushed with a key that becomes its `current` one, an agent that stops
+being idle only loses its current key, and pick() pops until it finds an
+entry that is still current - O(log n) per change and per pick, never a
+scan of the members.  The key is the strategy:
+
+    longest-idle   a counter stamped when the agent went idle: the
+                   smallest has waited longest
+    round-robin    (lap, position in the member list): the next idle
+                   agent after the last one picked, in member order;
+                   those behind the last pick wait for the next lap
+
+The heaps follow the call table through its listener (changed()), so
+every state change counts, whoever causes it.  They are only a hint:
+changed() reads the state after the fact and two threads may report one
+agent out of order, so the server takes an agent with an atomic
+call-table reservation, and one that turns out busy is just dropped.
+
+A caller that finds no idle agent waits in the queue's FIFO and gets the
+next agent that frees up.  It leaves the line by hanging up or timing
+out, which the server reports with abandon().
+"""
+
+import heapq
+import itertools
+import threading
+from collections import deque
+
+from pbx_calltable import IDLE
+
+LONGEST_IDLE = "longest-idle"
+ROUND_ROBIN = "round-robin"
+STRATEGIES = (LONGEST_IDLE, ROUND_ROBIN)
+
+# connect() outcomes
+OK = "ok"
+AGENT_GONE = "agent_gone"       # not idle after all: try the next one
+CALLER_GONE = "caller_gone"     # left the line meanwhile: the agent stays free
+
+queues = {}             # queue ext -> Queue
+agents = {}             # agent ext -> queues it is a member of
+_connect = None         # connect(queue, caller, trunk, cdr, agent) -> outcome
+_state_of = None        # state_of(ext) -> call-table state, None when not registered
+_lock = threading.Lock()
+_stamps = itertools.count()
+
+stats = {"dispatched": 0, "abandoned": 0, "agent_gone": 0}
+
+
+class Waiter:
+    """A caller in line; `trunk` is set for one on another PBX, which has no record here."""
+
+    __slots__ = ("caller", "trunk", "cdr", "gone")
+
+    def __init__(self, caller, trunk, cdr):
+        self.caller = caller
+        self.trunk = trunk
+        self.cdr = cdr
+        self.gone = False
+
+
+class Queue:
+    """One queue: its idle-agent heap and its line of callers; used under the module lock."""
+
+    def __init__(self, ext, strategy, members):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"queue {ext}: unknown strategy {strategy!r}")
+        self.ext = ext
+        self.strategy = strategy
+        self.members = {m: i for i, m in enumerate(dict.fromkeys(members))}
+        self.heap = []          # (key, agent), stale entries included
+        self.current = {}       # idle agent -> its key in the heap
+        self.lap = 0            # round-robin: lap and position of the last pick
+        self.last = -1
+        self.line = deque()     # Waiters, oldest first (some gone)
+        self.waiting = {}       # caller -> its Waiter
+        self.dispatched = 0
+        self.abandoned = 0
+
+    def idle(self, agent):
+        """agent is idle; False when it already was."""
+        if agent in self.current:
+            return False
+        if self.strategy == LONGEST_IDLE:
+            key = next(_stamps)
+        else:
+            pos = self.members[agent]
+            key = (self.lap, pos) if pos > self.last else (self.lap + 1, pos)
+        self.restore(agent, key)
+        return True
+
+    def restore(self, agent, key):
+        if agent not in self.current:
+            self.current[agent] = key
+            heapq.heappush(self.heap, (key, agent))
+            if len(self.heap) > 2 * len(self.current) + 64:
+                # Mostly stale: agents that went busy without being picked
+                self.heap = [(k, a) for a, k in self.current.items()]
+                heapq.heapify(self.heap)
+
+    def busy(self, agent):
+        self.current.pop(agent, None)
+
+    def pick(self):
+        """Take the idle agent the strategy says is next: (agent, key), or None."""
+        heap, current = self.heap, self.current
+        while heap:
+            key, agent = heapq.heappop(heap)
+            if current.get(agent) == key:
+                del current[agent]
+                if self.strategy == ROUND_ROBIN:
+                    self.lap, self.last = key
+                return agent, key
+        return None
+
+    def next_waiter(self):
+        line = self.line
+        while line and line[0].gone:
+            line.popleft()
+        return line[0] if line else None
+
+    def __len__(self):
+        return len(self.waiting)
+
+
+def configure(definitions, connect, state_of):
+    """Set up the queues of {ext: (strategy, members)} and the server's callbacks."""
+    global _connect, _state_of
+    built = {ext: Queue(ext, strategy, members) for ext, (strategy, members) in definitions.items()}
+    queues.clear()
+    queues.update(built)
+    agents.clear()
+    for q in built.values():
+        for member in q.members:
+            agents.setdefault(member, []).append(q)
+    _connect = connect
+    _state_of = state_of
+    for member in agents:
+        changed(member)
+
+
+def load_queues(path):
+    """Parse a queues file into {queue ext: (strategy, [members])}."""
+    queues_ = {}
+    members = {}
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            kind = fields[0]
+            if kind == "queue" and len(fields) == 3 and fields[2] in STRATEGIES:
+                queues_[fields[1]] = fields[2]
+            elif kind == "member" and len(fields) >= 3:
+                members.setdefault(fields[1], []).extend(fields[2:])
+            else:
+                raise ValueError(f"{path}:{lineno}: cannot parse {line.strip()!r}")
+
+    for ext in members:
+        if ext not in queues_:
+            raise ValueError(f"{path}: members for unknown queue {ext!r}")
+    return {ext: (strategy, members.get(ext, [])) for ext, strategy in queues_.items()}
+
+
+# ============================================================
+#  AGENTS AND CALLERS
+# ============================================================
+
+def changed(ext):
+    """The call table changed ext's record (CallTable.listener)."""
+    member_of = agents.get(ext)
+    if member_of is None:
+        return
+    idle = _state_of(ext) == IDLE
+    ready = []
+    _lock.acquire()
+    try:
+        for q in member_of:
+            if not idle:
+                q.busy(ext)
+            elif q.idle(ext) and q.line:
+                ready.append(q)
+    finally:
+        _lock.release()
+    for q in ready:
+        _dispatch(q)
+
+
+def enqueue(queue_ext, caller, trunk=None, cdr=None):
+    """A call for a queue: to an idle agent now, or in line for the next one."""
+    q = queues[queue_ext]
+    waiter = Waiter(caller, trunk, cdr)
+    _lock.acquire()
+    try:
+        old = q.waiting.get(caller)
+        if old is not None:
+            old.gone = True
+        q.waiting[caller] = waiter
+        q.line.append(waiter)
+    finally:
+        _lock.release()
+    _dispatch(q)
+
+
+def abandon(queue_ext, caller):
+    """caller left the line of queue_ext; its Waiter, or None when it was not waiting."""
+    q = queues.get(queue_ext)
+    if q is None:
+        return None
+    with _lock:
+        waiter = q.waiting.pop(caller, None)
+        if waiter is None:
+            return None
+        waiter.gone = True
+        q.abandoned += 1
+        stats["abandoned"] += 1
+    return waiter
+
+
+def _dispatch(q):
+    """Hand callers in line to idle agents while there are both."""
+    while True:
+        _lock.acquire()
+        try:
+            waiter = q.next_waiter()
+            if waiter is None:
+                return
+            picked = q.pick()
+            if picked is None:
+                return
+            q.line.popleft()
+            del q.waiting[waiter.caller]
+        finally:
+            _lock.release()
+        agent, key = picked
+        outcome = _connect(q.ext, waiter.caller, waiter.trunk, waiter.cdr, agent)
+        if outcome == OK:
+            with _lock:
+                q.dispatched += 1
+                stats["dispatched"] += 1
+            continue
+        with _lock:
+            if outcome == CALLER_GONE:
+                q.restore(agent, key)
+            elif waiter.caller not in q.waiting:
+                # Agent busy after all: the caller keeps its place
+                stats["agent_gone"] += 1
+                q.waiting[waiter.caller] = waiter
+                q.line.appendleft(waiter)
+
+
+# ============================================================
+#  INSPECTION
+# ============================================================
+
+def waiting():
+    with _lock:
+        return {(ext,): len(q) for ext, q in queues.items()}
+
+
+def idle_agents():
+    with _lock:
+        return {(ext,): len(q.current) for ext, q in queues.items()}
+
+
+def calls():
+    with _lock:
+        out = {}
+        for ext, q in queues.items():
+            out[ext, "dispatched"] = q.dispatched
+            out[ext, "abandoned"] = q.abandoned
+        return out
@@ -0,0 +1,171 @@
+"""Admission control: refuse endpoint connections the PBX cannot take right now.
+
+Checked once per accepted endpoint connection, before it gets a thread
+(thread engine) or a session and outbound buffer (asyncio engine):
+
+  max_connections   endpoint connections open at once;
+  per-IP rate       token bucket per source address, so one host (or a
+                    NAT full of phones) cannot take the whole capacity;
+  register rate     global token bucket.  A new endpoint connection
+                    exists to register (or resume), so it is charged its
+                    registration here, where refusing it costs nothing.
+
+A refused connection gets one JSON error with a `retry_after` hint in
+seconds and is closed.  A bucket that refuses books each refused caller
+the next free slot at its rate, and the hint points at that slot: 20k
+phones turned away in the same second come back spread out at the rate
+the PBX admits them, not all together in the next one.  Every limit is
+off (0) unless configured; trunk and worker links are never checked.
+"""
+
+import random
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+import pbx_codec
+
+FULL_RETRY = 5.0        # base hint when the connection limit is reached
+MAX_RETRY = 60.0
+MAX_SOURCES = 100_000   # per-IP buckets kept; the least recently seen goes first
+
+max_connections = 0
+ip_rate = 0.0
+ip_burst = 0
+register_rate = 0.0
+register_burst = 0
+
+_open = 0
+_lock = threading.Lock()
+_register = None
+_sources = OrderedDict()        # source IP -> TokenBucket, least recently seen first
+
+stats = {"connections": 0, "register": 0, "ip": 0}      # refusals by limit
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst`."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp", "booked")
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic() if now is None else now
+        self.booked = 0.0       # last retry slot handed out
+
+    def take(self, now):
+        """0 when a token was taken, else seconds until the caller's retry slot."""
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if tokens >= 1:
+            self.tokens = tokens - 1
+            return 0
+        self.tokens = tokens
+        slot = max(self.booked + 1 / self.rate, now + (1 - tokens) / self.rate)
+        self.booked = min(slot, now + MAX_RETRY)
+        return self.booked - now
+
+
+def configure(connections=0, per_ip_rate=0.0, per_ip_burst=0, reg_rate=0.0, reg_burst=0):
+    """Set the limits (0: unlimited); bursts default to one second's worth."""
+    global max_connections, ip_rate, ip_burst, register_rate, register_burst, _register
+    if min(connections, per_ip_rate, per_ip_burst, reg_rate, reg_burst) < 0:
+        raise ValueError("admission limits cannot be negative")
+    max_connections = connections
+    ip_rate = per_ip_rate
+    ip_burst = per_ip_burst or max(1, int(per_ip_rate))
+    register_rate = reg_rate
+    register_burst = reg_burst or max(1, int(reg_rate))
+    _register = TokenBucket(register_rate, register_burst) if register_rate else None
+    _sources.clear()
+
+
+def _hint(wait):
+    # a little jitter: the same slot for many (or the cap) should not mean the same instant
+    return round(min(MAX_RETRY, wait * (1 + random.random() * 0.1)), 1) or 0.1
+
+
+def _source(ip, now):
+    # An LRU with a hard cap: O(1) per connection however many addresses
+    # show up.  The evicted bucket is the one idle longest, by then
+    # usually full again anyway.
+    bucket = _sources.get(ip)
+    if bucket is None:
+        if len(_sources) >= MAX_SOURCES:
+            _sources.popitem(last=False)
+        bucket = _sources[ip] = TokenBucket(ip_rate, ip_burst, now)
+    else:
+        _sources.move_to_end(ip)
+    return bucket
+
+
+def admit(ip):
+    """None when a new endpoint connection from `ip` may proceed, else a retry_after hint.
+
+    An admitted connection counts as open until closed() is called for it.
+    """
+    global _open
+    with _lock:
+        if max_connections and _open >= max_connections:
+            stats["connections"] += 1
+            return _hint(FULL_RETRY * (1 + random.random()))
+        now = time.monotonic()
+        if ip_rate:
+            wait = _source(ip, now).take(now)
+            if wait:
+                stats["ip"] += 1
+                return _hint(wait)
+        if _register is not None:
+            wait = _register.take(now)
+            if wait:
+                stats["register"] += 1
+                return _hint(wait)
+        _open += 1
+    return None
+
+
+def adopted():
+    """Count a connection another worker admitted and handed to us."""
+    global _open
+    with _lock:
+        _open += 1
+
+
+def closed():
+    global _open
+    with _lock:
+        _open -= 1
+
+
+def open_connections():
+    return _open
+
+
+def refuse(sock, retry_after):
+    """Turn away a freshly accepted socket without blocking.
+
+    Whatever the endpoint already sent (its register) is read off first:
+    closing with unread data would reset the connection, and the reset
+    throws away the error before the endpoint reads it.
+    """
+    try:
+        sock.setblocking(False)
+        sock.send(refusal(retry_after))
+        sock.shutdown(socket.SHUT_WR)
+        while sock.recv(65536):
+            pass
+    except OSError:
+        pass
+    sock.close()
+
+
+def refusal(retry_after):
+    """The bytes a refused connection gets (JSON: nothing was negotiated yet)."""
+    return pbx_codec.JSON.encode({
+        "type": "error",
+        "reason": "Το τηλεφωνικό κέντρο είναι φορτωμένο, δοκίμασε ξανά αργότερα.",
+        "retry_after": retry_after
+    })
@@ -0,0 +1,235 @@
+"""asyncio engine: a single event loop serves every endpoint and trunk socket.
+
+The call logic lives in pbx_server.py and is engine-agnostic: handlers only
+ever call send_json(conn, ...), so all this module has to provide is an
+outbound `conn` on top of an asyncio transport (pbx_outq.AsyncOutbound) and
+a way to feed received bytes into the session objects.
+"""
+
+import asyncio
+import socket
+
+import pbx_admission
+import pbx_log
+import pbx_metrics
+import pbx_spool
+from pbx_outq import AsyncOutbound
+
+# connections accepted per wakeup before the loop gets back to the others
+ACCEPT_BATCH = 100
+
+
+class SessionProtocol(asyncio.Protocol):
+    """Hands received bytes to a session created by session_factory(conn, addr).
+
+    A `counted` connection is one pbx_admission counts as open; losing it
+    tells pbx_admission so.
+    """
+
+    def __init__(self, session_factory, kind="client", closed=None, counted=False):
+        self.session_factory = session_factory
+        self.kind = kind
+        self.closed = closed
+        self.counted = counted
+        self.transport = None
+        self.conn = None
+        self.session = None
+        self.addr = None
+
+    def connection_made(self, transport):
+        sock = transport.get_extra_info("socket")
+        if sock is not None and sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.transport = transport
+        self.addr = transport.get_extra_info("peername")
+        self.conn = AsyncOutbound(transport, self.kind)
+        self.session = self.session_factory(self.conn, self.addr)
+
+    def data_received(self, data):
+        try:
+            self.session.feed(data)
+        except Exception as e:
+            # Same outcome as the thread engine: a failing session is dropped
+            pbx_log.warning("connection_error", "Σφάλμα σύνδεσης {addr}: {error}",
+                            addr=self.addr, error=e)
+            self.transport.abort()
+            return
+        if self.session.detached:
+            # Handed to another worker: stop reading and close only our descriptor
+            self.transport.pause_reading()
+            self.transport.close()
+
+    def pause_writing(self):
+        self.conn.pause_writing()
+
+    def resume_writing(self):
+        self.conn.resume_writing()
+
+    def connection_lost(self, exc):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+        if self.counted:
+            pbx_admission.closed()
+        if self.closed is not None and not self.closed.done():
+            self.closed.set_result(exc)
+
+
+async def trunk_outbound_connector(trunk, host, port, link_session_factory):
+    """Keep one outbound trunk connection alive, backing off between attempts."""
+    loop = asyncio.get_running_loop()
+    attempt = 0
+    while True:
+        closed = loop.create_future()
+        try:
+            _, protocol = await loop.create_connection(
+                lambda: SessionProtocol(
+                    lambda conn, addr: link_session_factory(trunk, conn), "trunk", closed
+                ),
+                host, port,
+            )
+        except OSError as e:
+            delay = pbx_spool.backoff(attempt)
+            attempt += 1
+            pbx_log.warning("trunk_out_retry",
+                            "TRUNK {trunk} outbound απέτυχε ({error}), retry σε {delay:.1f}sec",
+                            trunk=trunk, error=e, delay=delay)
+            await asyncio.sleep(delay)
+            continue
+        # kept: the protocol lets go of its session when the connection is lost
+        session = protocol.session
+        await closed
+        if session is not None and session.greeted:
+            attempt = 0
+        else:
+            # connected but dropped before the hello went through: back off as well
+            await asyncio.sleep(pbx_spool.backoff(attempt))
+            attempt += 1
+
+
+async def adopt_handed_off(worker, client_session_factory):
+    """Take over the connections other workers pass to us (worker mode)."""
+    loop = asyncio.get_running_loop()
+
+    async def adopt(sock, payload):
+        sock.setblocking(False)
+        pbx_admission.adopted()     # admitted by the worker that accepted it
+        _, proto = await loop.connect_accepted_socket(
+            lambda: SessionProtocol(client_session_factory, counted=True), sock)
+        if payload:
+            proto.data_received(payload)
+
+    def ready():
+        while True:
+            try:
+                got = worker.receive()
+            except BlockingIOError:
+                return
+            if got is not None:
+                loop.create_task(adopt(*got))
+
+    worker.inbox.setblocking(False)
+    loop.add_reader(worker.inbox.fileno(), ready)
+
+
+def accept_clients(srv, client_session_factory):
+    """Accept endpoint connections on the loop, admission control first.
+
+    Not loop.create_server(): that builds a transport and protocol for
+    every connection, and a connection pbx_admission refuses should cost
+    no more than the accept and the error.
+    """
+    loop = asyncio.get_running_loop()
+
+    def protocol():
+        return SessionProtocol(client_session_factory, counted=True)
+
+    def ready():
+        for _ in range(ACCEPT_BATCH):
+            try:
+                sock, addr = srv.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # Out of descriptors and the like: the connection waits in the backlog
+                pbx_log.warning("accept_failed", "Αδύνατο accept: {error}", error=e)
+                return
+            retry_after = pbx_admission.admit(addr[0])
+            if retry_after is not None:
+                pbx_admission.refuse(sock, retry_after)
+                continue
+            sock.setblocking(False)
+            loop.create_task(loop.connect_accepted_socket(protocol, sock))
+
+    loop.add_reader(srv.fileno(), ready)
+
+
+async def tick(interval, fn):
+    """Call fn every `interval` seconds on the loop."""
+    while True:
+        await asyncio.sleep(interval)
+        fn()
+
+
+async def serve(args, trunks, client_session_factory, trunk_session_factory,
+                link_session_factory, worker=None, worker_link_factory=None, tickers=()):
+    loop = asyncio.get_running_loop()
+    servers = []
+    connectors = [tick(interval, fn) for interval, fn in tickers]
+
+    if worker is not None:
+        for peer, sock in worker.links.items():
+            sock.setblocking(False)
+            await loop.connect_accepted_socket(
+                lambda peer=peer: SessionProtocol(
+                    lambda conn, addr: worker_link_factory(peer, conn), "trunk"),
+                sock,
+            )
+        await adopt_handed_off(worker, client_session_factory)
+
+    if worker is None or worker.is_hub:
+        trunk_srv = await loop.create_server(
+            lambda: SessionProtocol(trunk_session_factory, "trunk"),
+            "0.0.0.0", args.trunk_listen_port,
+            reuse_address=True,
+        )
+        pbx_log.info("trunk_listen", "TRUNK listener στο 0.0.0.0:{port}",
+                     port=args.trunk_listen_port)
+        servers.append(trunk_srv)
+        connectors += [
+            trunk_outbound_connector(name, host, port, link_session_factory)
+            for name, (host, port) in trunks.items()
+        ]
+
+    client_srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client_srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if worker is not None:
+        client_srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    client_srv.bind((args.host, args.port))
+    client_srv.listen(args.backlog)
+    client_srv.setblocking(False)
+    accept_clients(client_srv, client_session_factory)
+    label = "" if worker is None else f", worker {worker.id}"
+    pbx_log.info("listen", "{mode} listening on {host}:{port} (asyncio{label})",
+                 mode=args.mode, host=args.host, port=args.port, label=label)
+
+    if args.admin_port:
+        admin_port = args.admin_port + (worker.id if worker is not None else 0)
+        servers.append(await pbx_metrics.start_admin_async(args.admin_host, admin_port))
+        pbx_log.info("admin_listen", "Admin/metrics στο {host}:{port}",
+                     host=args.admin_host, port=admin_port)
+
+    # the endpoint listener has no serve_forever(): the loop's own future keeps us running
+    await asyncio.gather(*(srv.serve_forever() for srv in servers), *connectors,
+                         loop.create_future())
+
+
+def run(args, trunks, client_session_factory, trunk_session_factory, link_session_factory,
+        worker=None, worker_link_factory=None, tickers=()):
+    """Run the whole PBX (or one worker of it) on one event loop until interrupted.
+
+    `tickers` are (interval, fn) pairs called periodically on the loop, for
+    the work the thread engine gives a thread of its own.
+    """
+    asyncio.run(serve(args, trunks, client_session_factory, trunk_session_factory,
+                      link_session_factory, worker, worker_link_factory, tickers))
@@ -0,0 +1,358 @@
+"""Registration / call table with sharded locking.
+
+Extensions are spread over a fixed number of shards, each with its own
+lock, so unrelated extensions never contend.  Every state transition that
+involves two legs (local call setup, hangup) takes both shard locks in a
+fixed order and checks-and-sets both records in one critical section, so
+two callers can never reserve the same idle callee.
+
+A call goes idle -> ringing -> in_call: both legs ring from setup until
+the callee answers (answer(), or connect() for the leg whose peer is on
+another PBX), and a call can be released from either state.
+
+An optional `listener` is called with the extension after every change
+of a record's state, registration included, once the locks are released
+(pbx_presence uses it).  An optional `index` is told, under the lock,
+whenever a leg starts or stops being in a call with another PBX:
+index.add(trunk, ext, peer) and index.discard(...) (pbx_reconcile).
+"""
+
+import threading
+
+IDLE = "idle"
+RINGING = "ringing"
+IN_CALL = "in_call"
+CONFERENCE = "conference"    # peer is the room name
+CALL = (RINGING, IN_CALL)    # states a call can be released from
+
+# reserve_pair() outcomes
+OK = "ok"
+CALLER_MISSING = "caller_missing"
+CALLER_BUSY = "caller_busy"
+CALLEE_MISSING = "callee_missing"
+CALLEE_BUSY = "callee_busy"
+
+
+class Extension:
+    """One registered endpoint. Mutated only under its shard's lock."""
+
+    __slots__ = ("ext", "conn", "addr", "codec", "token", "state", "peer", "remote", "trunk", "cdr",
+                 "incoming")
+
+    def __init__(self, ext, conn, addr, codec=None, token=None):
+        self.ext = ext
+        self.conn = conn
+        self.addr = addr
+        self.codec = codec    # media codec negotiated at register (None: not negotiated)
+        self.token = token    # resume token (pbx_snapshot)
+        self.state = IDLE
+        self.peer = None
+        self.remote = False
+        self.trunk = None     # trunk link the peer is reached through (remote calls)
+        self.cdr = None       # pbx_cdr.Call of the current call (both legs share a local one)
+        self.incoming = False  # the called leg (the one that answers)
+
+    def _set(self, state, peer=None, remote=False, trunk=None, cdr=None, incoming=False):
+        self.state = state
+        self.peer = peer
+        self.remote = remote
+        self.trunk = trunk
+        self.cdr = cdr
+        self.incoming = incoming
+
+    def __repr__(self):
+        return f"<Extension {self.ext} {self.state} peer={self.peer} remote={self.remote}>"
+
+
+class CallTable:
+    def __init__(self, shards=64):
+        if shards & (shards - 1):
+            raise ValueError("shards must be a power of two")
+        self._mask = shards - 1
+        self._maps = [{} for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self.listener = None    # listener(ext) after each state change
+        self.index = None       # told of remote calls starting and ending
+
+    def _changed(self, ext):
+        listener = self.listener
+        if listener is not None:
+            listener(ext)
+
+    def _index(self, ext):
+        return hash(ext) & self._mask
+
+    def _track(self, rec, state, peer, remote, trunk):
+        """Tell `index` about rec's remote call changing; under rec's shard lock."""
+        index = self.index
+        if index is None:
+            return
+        if rec.remote and rec.state in CALL:
+            index.discard(rec.trunk, rec.ext, rec.peer)
+        if remote and state in CALL:
+            index.add(trunk, rec.ext, peer)
+
+    def _lock_pair(self, a, b):
+        """Locks for two shard indexes, in acquisition order."""
+        if a == b:
+            return (self._locks[a],)
+        if a > b:
+            a, b = b, a
+        return (self._locks[a], self._locks[b])
+
+    # --------------------------------------------------------
+    #  Registration
+    # --------------------------------------------------------
+
+    def get(self, ext):
+        # A single dict lookup is atomic; callers must not rely on the
+        # fields staying consistent without going through a transition.
+        return self._maps[self._index(ext)].get(ext)
+
+    def register(self, ext, conn, addr, codec=None, token=None):
+        rec = Extension(ext, conn, addr, codec, token)
+        i = self._index(ext)
+        with self._locks[i]:
+            self._maps[i][ext] = rec
+        self._changed(ext)
+        return rec
+
+    def unregister(self, ext, conn=None):
+        """Remove ext, but only if it still belongs to `conn` (when given)."""
+        i = self._index(ext)
+        with self._locks[i]:
+            rec = self._maps[i].get(ext)
+            if rec is None or (conn is not None and rec.conn is not conn):
+                return None
+            del self._maps[i][ext]
+            if rec.remote:
+                self._track(rec, IDLE, None, False, None)
+        self._changed(ext)
+        return rec
+
+    def __len__(self):
+        return sum(len(m) for m in self._maps)
+
+    def __contains__(self, ext):
+        return ext in self._maps[self._index(ext)]
+
+    # --------------------------------------------------------
+    #  State transitions
+    # --------------------------------------------------------
+
+    def set_state(self, ext, state, peer=None, remote=False, trunk=None):
+        i = self._index(ext)
+        with self._locks[i]:
+            rec = self._maps[i].get(ext)
+            if rec is None:
+                return None
+            self._track(rec, state, peer, remote, trunk)
+            rec._set(state, peer, remote, trunk)
+        self._changed(ext)
+        return rec
+
+    def reserve(self, ext, peer, remote, trunk=None, cdr=None, state=RINGING, incoming=False):
+        """idle -> ringing (or `state`) for a single leg; returns the record or None if not idle."""
+        i = self._index(ext)
+        with self._locks[i]:
+            rec = self._maps[i].get(ext)
+            if rec is None or rec.state != IDLE:
+                return None
+            if remote:
+                self._track(rec, state, peer, remote, trunk)
+            rec._set(state, peer, remote, trunk, cdr, incoming)
+        self._changed(ext)
+        return rec
+
+    def reserve_pair(self, caller_ext, callee_ext, cdr=None, via=None):
+        """Atomically move both legs of a local call from idle to ringing.
+
+        Returns (outcome, caller, callee); the records are those seen inside
+        the critical section (None when not registered).  Both legs get the
+        same `cdr`.  With `via` the caller is not idle but ringing `via` (an
+        ACD queue it waits in), and its own cdr carries on.
+        """
+        i, j = self._index(caller_ext), self._index(callee_ext)
+        locks = self._lock_pair(i, j)
+        for lk in locks:
+            lk.acquire()
+        try:
+            caller = self._maps[i].get(caller_ext)
+            callee = self._maps[j].get(callee_ext)
+            if caller is None:
+                return CALLER_MISSING, None, callee
+            if via is None:
+                if caller.state != IDLE or caller_ext == callee_ext:
+                    return CALLER_BUSY, caller, callee
+            elif (caller.state != RINGING or caller.peer != via or caller.remote
+                  or caller_ext == callee_ext):
+                return CALLER_BUSY, caller, callee
+            else:
+                cdr = caller.cdr
+            if callee is None:
+                return CALLEE_MISSING, caller, None
+            if callee.state != IDLE:
+                return CALLEE_BUSY, caller, callee
+            caller._set(RINGING, callee_ext, False, None, cdr)
+            callee._set(RINGING, caller_ext, False, None, cdr, incoming=True)
+        finally:
+            for lk in reversed(locks):
+                lk.release()
+        self._changed(caller_ext)
+        self._changed(callee_ext)
+        return OK, caller, callee
+
+    def redirect(self, ext, peer, new_peer):
+        """A leg ringing `peer` rings `new_peer` instead (a queue handing on the call).
+
+        Returns the record, or None when ext is not ringing `peer`.
+        """
+        i = self._index(ext)
+        with self._locks[i]:
+            rec = self._maps[i].get(ext)
+            if rec is None or rec.state != RINGING or rec.peer != peer:
+                return None
+            if rec.remote:
+                self._track(rec, RINGING, new_peer, True, rec.trunk)
+            rec.peer = new_peer
+        self._changed(ext)
+        return rec
+
+    def answer(self, ext):
+        """ringing -> in_call for the called leg ext and, in a local call, its caller.
+
+        Returns ext's record, or None when no call is ringing for ext to answer.
+        """
+        i = self._index(ext)
+        with self._locks[i]:
+            me = self._maps[i].get(ext)
+            if me is None or me.state != RINGING or not me.incoming:
+                return None
+            peer_ext = me.peer
+            if me.remote:
+                me.state = IN_CALL
+        if me.remote:
+            self._changed(ext)
+            return me
+
+        j = self._index(peer_ext)
+        locks = self._lock_pair(i, j)
+        for lk in locks:
+            lk.acquire()
+        try:
+            # Re-check: the call may have ended while we re-acquired the locks
+            if self._maps[i].get(ext) is not me or me.state != RINGING or me.peer != peer_ext:
+                return None
+            peer = self._maps[j].get(peer_ext)
+            if peer is None or peer.state != RINGING or peer.peer != ext or peer.remote:
+                return None
+            me.state = peer.state = IN_CALL
+        finally:
+            for lk in reversed(locks):
+                lk.release()
+        self._changed(ext)
+        self._changed(peer_ext)
+        return me
+
+    def connect(self, ext, peer):
+        """ringing -> in_call for one leg still ringing with `peer`; returns the record or None."""
+        i = self._index(ext)
+        with self._locks[i]:
+            rec = self._maps[i].get(ext)
+            if rec is None or rec.state != RINGING or rec.peer != peer:
+                return None
+            rec.state = IN_CALL
+        self._changed(ext)
+        return rec
+
+    def release(self, ext, peer, states=CALL):
+        """ringing or in_call (or one of `states`) -> idle for one leg still with `peer`.
+
+        Returns (record, cdr of the call it left), or (None, None).
+        """
+        i = self._index(ext)
+        with self._locks[i]:
+            rec = self._maps[i].get(ext)
+            if rec is None or rec.state not in states or rec.peer != peer:
+                return None, None
+            cdr = rec.cdr
+            if rec.remote:
+                self._track(rec, IDLE, None, False, None)
+            rec._set(IDLE)
+        self._changed(ext)
+        return rec, cdr
+
+    def release_pair(self, ext, states=CALL):
+        """Hang up ext and, for a local call, its peer - in one transition.
+
+        Only a call in one of `states` is released (ringing or in_call).
+        Returns (me, peer_ext, trunk, peer_rec, cdr); me is None when ext was
+        not in a call, trunk is the link of a remote peer (None for local
+        calls), peer_rec is set only if the local peer was released too and
+        cdr is the pbx_cdr.Call of the call that ended.
+        """
+        i = self._index(ext)
+        with self._locks[i]:
+            me = self._maps[i].get(ext)
+            if me is None or me.state not in states:
+                return None, None, None, None, None
+            state, peer_ext, remote, trunk, cdr = me.state, me.peer, me.remote, me.trunk, me.cdr
+            if remote:
+                self._track(me, IDLE, None, False, None)
+                me._set(IDLE)
+        if remote:
+            self._changed(ext)
+            return me, peer_ext, trunk, None, cdr
+
+        j = self._index(peer_ext)
+        locks = self._lock_pair(i, j)
+        for lk in locks:
+            lk.acquire()
+        try:
+            # Re-check: the call may have ended while we re-acquired the locks
+            if self._maps[i].get(ext) is not me or me.state != state or me.peer != peer_ext:
+                return None, None, None, None, None
+            cdr = me.cdr
+            me._set(IDLE)
+            peer = self._maps[j].get(peer_ext)
+            if peer is not None and peer.state == state and peer.peer == ext and not peer.remote:
+                peer._set(IDLE)
+            else:
+                peer = None
+        finally:
+            for lk in reversed(locks):
+                lk.release()
+        self._changed(ext)
+        if peer is not None:
+            self._changed(peer_ext)
+        return me, peer_ext, None, peer, cdr
+
+    # --------------------------------------------------------
+    #  Inspection
+    # --------------------------------------------------------
+
+    def snapshot(self):
+        """Consistent copy of every record as (ext, state, peer, remote, trunk) tuples."""
+        for lk in self._locks:
+            lk.acquire()
+        try:
+            return [
+                (r.ext, r.state, r.peer, r.remote, r.trunk)
+                for m in self._maps for r in m.values()
+            ]
+        finally:
+            for lk in reversed(self._locks):
+                lk.release()
+
+    def export(self):
+        """Consistent copy for pbx_snapshot: (token, ext, codec, conn, state, peer, remote, trunk)."""
+        for lk in self._locks:
+            lk.acquire()
+        try:
+            return [
+                (r.token, r.ext, r.codec, r.conn, r.state, r.peer, r.remote, r.trunk)
+                for m in self._maps for r in m.values()
+            ]
+        finally:
+            for lk in reversed(self._locks):
+                lk.release()
@@ -0,0 +1,248 @@
+"""Call Detail Records, written in batches by a background thread.
+
+Handlers open a Call when a leg is set up, stamp it when it is answered
+and close it when it ends; a setup that fails (busy, not registered,
+dial-plan violation) is recorded in one go.  Finished calls go into a
+SimpleQueue, so the signalling path only pays for a put() and never waits
+on the disk.  The writer thread takes whatever has queued up, at most
+`batch` records, and stores them in one transaction (SQLite) or one
+write() (rotating JSON-lines files), then waits out `interval` before the
+next batch so a busy PBX commits a few times a second, not per call.
+
+With CDRs off (the default) begin() returns None and every other call is a
+no-op on None.
+"""
+
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import pbx_log
+
+# outcomes
+ANSWERED = "answered"
+UNANSWERED = "unanswered"       # hung up (or disconnected) before an answer
+NO_ANSWER = "no_answer"         # rang until the no-answer timeout
+BUSY = "busy"
+UNREGISTERED = "unregistered"
+DIAL_PLAN = "dial_plan"
+
+FORMATS = ("sqlite", "jsonl")
+
+# finished records waiting for the writer; beyond this they are dropped
+MAX_PENDING = 100_000
+
+FIELDS = ("caller", "callee", "kind", "trunk", "ivr", "setup", "answer", "end", "outcome")
+
+_queue = queue.SimpleQueue()
+_writer = None
+
+stats = {"written": 0, "dropped": 0, "failed": 0, "batches": 0}
+
+
+class Call:
+    """One call leg as seen by this PBX; times are Unix timestamps."""
+
+    __slots__ = FIELDS
+
+    def __init__(self, caller, callee, kind, trunk=None, ivr=False, setup=None):
+        self.caller = caller
+        self.callee = callee
+        self.kind = kind        # local, trunk_out, trunk_in
+        self.trunk = trunk
+        self.ivr = ivr          # set up from an IVR menu choice
+        self.setup = time.time() if setup is None else setup
+        self.answer = None
+        self.end = None
+        self.outcome = None
+
+    def row(self):
+        return (self.caller, self.callee, self.kind, self.trunk, int(self.ivr),
+                self.setup, self.answer, self.end, self.outcome)
+
+
+def begin(caller, callee, kind, trunk=None, ivr=False):
+    """A Call for a leg being set up, or None when CDRs are off."""
+    if _writer is None:
+        return None
+    return Call(caller, callee, kind, trunk, ivr)
+
+
+def answered(call):
+    if call is not None and call.answer is None:
+        call.answer = time.time()
+
+
+def redirected(call, callee):
+    """The call now rings `callee` (an ACD queue handed it to an agent)."""
+    if call is not None:
+        call.callee = callee
+
+
+def end(call, outcome=None):
+    """Close a call and queue it; later calls for the same leg are ignored."""
+    if call is None or call.end is not None:
+        return
+    call.end = time.time()
+    call.outcome = outcome or (ANSWERED if call.answer is not None else UNANSWERED)
+    _submit(call)
+
+
+def failed(caller, callee, kind, outcome, trunk=None, ivr=False):
+    """Record a setup that never became a call."""
+    if _writer is None:
+        return
+    call = Call(caller, callee, kind, trunk, ivr)
+    call.end = call.setup
+    call.outcome = outcome
+    _submit(call)
+
+
+def _submit(call):
+    if _queue.qsize() >= MAX_PENDING:
+        stats["dropped"] += 1
+        return
+    _queue.put(call)
+
+
+def pending():
+    return _queue.qsize()
+
+
+# ============================================================
+#  SINKS
+# ============================================================
+
+class SQLiteSink:
+    def __init__(self, path):
+        # Opened by the writer thread, which is the only one using it
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS cdr ("
+            "id INTEGER PRIMARY KEY, caller TEXT, callee TEXT, kind TEXT, trunk TEXT, "
+            "ivr INTEGER, setup_time REAL, answer_time REAL, end_time REAL, outcome TEXT)"
+        )
+        self.db.commit()
+
+    def write(self, calls):
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO cdr (caller, callee, kind, trunk, ivr, setup_time, answer_time, "
+                "end_time, outcome) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [c.row() for c in calls]
+            )
+
+    def close(self):
+        self.db.close()
+
+
+class JSONLinesSink:
+    """Append-only JSON lines; the file is renamed aside once it reaches max_bytes."""
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.f = open(path, "ab")
+
+    def write(self, calls):
+        data = b"".join(
+            json.dumps(dict(zip(FIELDS, c.row())), ensure_ascii=False).encode("utf-8") + b"\n"
+            for c in calls
+        )
+        self.f.write(data)
+        self.f.flush()
+        if self.max_bytes and self.f.tell() >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.f.close()
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        target = f"{self.path}.{stamp}"
+        n = 1
+        while os.path.exists(target):
+            target = f"{self.path}.{stamp}.{n}"
+            n += 1
+        os.rename(self.path, target)
+        self.f = open(self.path, "ab")
+
+    def close(self):
+        self.f.close()
+
+
+# ============================================================
+#  WRITER
+# ============================================================
+
+class Writer(threading.Thread):
+    def __init__(self, open_sink, batch, interval):
+        super().__init__(name="cdr-writer", daemon=True)
+        self.open_sink = open_sink
+        self.batch = batch
+        self.interval = interval
+        self.ready = threading.Event()
+        self.error = None
+
+    def run(self):
+        try:
+            sink = self.open_sink()
+        except (OSError, sqlite3.Error) as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.ready.set()
+        stop = False
+        while not stop:
+            calls = [_queue.get()]
+            while len(calls) < self.batch:
+                try:
+                    calls.append(_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in calls:
+                calls = calls[:calls.index(None)]
+                stop = True
+            if calls:
+                t0 = time.monotonic()
+                try:
+                    sink.write(calls)
+                    stats["written"] += len(calls)
+                    stats["batches"] += 1
+                except (OSError, sqlite3.Error) as e:
+                    stats["failed"] += len(calls)
+                    pbx_log.error("cdr_write_failed", "Αποτυχία εγγραφής {count} CDR: {error}",
+                                  count=len(calls), error=e)
+                if not stop and len(calls) < self.batch:
+                    # Let records gather instead of committing each one
+                    time.sleep(max(0.0, self.interval - (time.monotonic() - t0)))
+        sink.close()
+
+
+def start(path, fmt="sqlite", batch=1000, interval=0.5, rotate_bytes=64 * 1024 * 1024):
+    """Start the writer thread; raises what opening the store raised."""
+    global _writer
+    if fmt == "sqlite":
+        open_sink = lambda: SQLiteSink(path)
+    elif fmt == "jsonl":
+        open_sink = lambda: JSONLinesSink(path, rotate_bytes)
+    else:
+        raise ValueError(f"unknown CDR format {fmt!r}")
+    writer = Writer(open_sink, batch, interval)
+    writer.start()
+    writer.ready.wait()
+    if writer.error is not None:
+        raise writer.error
+    _writer = writer
+
+
+def stop(timeout=5.0):
+    """Write what is still queued and stop the writer."""
+    global _writer
+    writer, _writer = _writer, None
+    if writer is not None:
+        _queue.put(None)
+        writer.join(timeout)
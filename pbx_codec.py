@@ -0,0 +1,311 @@
+"""Signalling codecs: newline-delimited JSON and a compact binary framing.
+
+JSON stays the default.  The binary framing is opt-in and negotiated:
+
+    endpoints  the client adds "framing": "binary" to its JSON register
+               message; register_ok echoes the framing the server accepted
+               and both sides switch from then on
+    trunks     trunk_hello offers "framings"; the peer answers with
+               trunk_hello_ok naming the one it picked
+
+Binary frame layout (network byte order):
+
+    0xB5  u16 payload-length  u8 type-code  payload
+
+Each known message type has a fixed field layout.  Extensions are packed as
+a tagged u32 when they are plain numbers ("5001") and as a short string
+otherwise; text fields are u16-length-prefixed UTF-8.  A message that does
+not fit its layout (unknown type, extra keys, odd values) is carried as
+type code 0 with a JSON payload, so every dict round-trips.
+
+FrameReader accepts both framings on the same stream: 0xB5 can never start
+a JSON line, so a peer may switch framing at any message boundary.
+"""
+
+import json
+import struct
+
+MAGIC = 0xB5
+MAX_PAYLOAD = 0xFFFF
+MAX_LINE = 1024 * 1024
+
+_HEADER = struct.Struct("!BHB")
+_U16 = struct.Struct("!H")
+_EXT_NUM = struct.Struct("!BI")
+
+_ABSENT = 0xFFFF     # u16 length marking a missing text field
+_EXT_NONE = 0
+_EXT_INT = 1
+_EXT_STR = 2
+
+EXT = "ext"
+STR = "str"
+
+# code, type, ((field, kind), ...)
+MESSAGES = (
+    (1, "register", (("extension", EXT),)),
+    (2, "register_ok", (("extension", EXT),)),
+    (3, "call", (("to", EXT),)),
+    (4, "call_proceeding", (("to", EXT),)),
+    (5, "incoming_call", (("from", EXT),)),
+    (6, "incoming_call_waiting", (("from", EXT),)),
+    (7, "answer", ()),
+    (8, "call_answered", (("by", EXT),)),
+    (9, "hangup", (("by", EXT),)),
+    (10, "busy", (("to", EXT),)),
+    (11, "ivr", (("to", EXT),)),
+    (12, "ivr_choice", (("digit", STR),)),
+    (13, "ivr_message", (("text", STR),)),
+    (14, "ivr_info", (("text", STR),)),
+    (15, "chat", (("from", EXT), ("text", STR))),
+    (16, "chat_sent", (("to", EXT),)),
+    (17, "error", (("reason", STR),)),
+    (18, "ping", ()),
+    (19, "pong", ()),
+    (20, "no_answer", (("from", EXT), ("to", EXT))),
+    (32, "trunk_call", (("from", EXT), ("to", EXT))),
+    (33, "trunk_call_answered", (("from", EXT), ("to", EXT))),
+    (34, "trunk_hangup", (("from", EXT), ("to", EXT))),
+    (35, "trunk_busy", (("from", EXT), ("to", EXT))),
+    (36, "trunk_chat", (("from", EXT), ("to", EXT), ("text", STR))),
+)
+
+_by_type = {mtype: (code, fields) for code, mtype, fields in MESSAGES}
+_by_code = {code: (mtype, fields) for code, mtype, fields in MESSAGES}
+
+
+# ============================================================
+#  FIELD PACKING
+# ============================================================
+
+def _pack_ext(value):
+    if value is None:
+        return b"\x00"
+    if value.isascii() and value.isdigit() and value[0] != "0" and len(value) < 10:
+        return _EXT_NUM.pack(_EXT_INT, int(value))
+    raw = value.encode("utf-8")
+    if len(raw) > 255:
+        raise ValueError("extension too long")
+    return bytes((_EXT_STR, len(raw))) + raw
+
+
+def _pack_str(value):
+    if value is None:
+        return b"\xff\xff"
+    raw = value.encode("utf-8")
+    if len(raw) >= _ABSENT:
+        raise ValueError("text too long")
+    return _U16.pack(len(raw)) + raw
+
+
+_packers = {EXT: _pack_ext, STR: _pack_str}
+
+
+def _unpack_ext(buf, pos):
+    tag = buf[pos]
+    if tag == _EXT_INT:
+        return str(_EXT_NUM.unpack_from(buf, pos)[1]), pos + 5
+    if tag == _EXT_STR:
+        end = pos + 2 + buf[pos + 1]
+        return bytes(buf[pos + 2:end]).decode("utf-8"), end
+    if tag == _EXT_NONE:
+        return None, pos + 1
+    raise ValueError(f"bad extension tag {tag}")
+
+
+def _unpack_str(buf, pos):
+    (length,) = _U16.unpack_from(buf, pos)
+    if length == _ABSENT:
+        return None, pos + 2
+    end = pos + 2 + length
+    return bytes(buf[pos + 2:end]).decode("utf-8"), end
+
+
+_unpackers = {EXT: _unpack_ext, STR: _unpack_str}
+
+
+# ============================================================
+#  CODECS
+# ============================================================
+
+class JsonCodec:
+    name = "json"
+
+    @staticmethod
+    def encode(obj):
+        return json.dumps(obj).encode("utf-8") + b"\n"
+
+
+class BinaryCodec:
+    name = "binary"
+
+    @staticmethod
+    def encode(obj):
+        spec = _by_type.get(obj.get("type"))
+        if spec is not None and len(obj) <= len(spec[1]) + 1:
+            code, fields = spec
+            try:
+                payload = b"".join([_packers[kind](obj.get(name)) for name, kind in fields])
+            except (AttributeError, TypeError, ValueError, struct.error):
+                payload = None
+            if payload is not None and len(obj) - 1 == sum(1 for name, _ in fields if name in obj):
+                return _HEADER.pack(MAGIC, len(payload), code) + payload
+
+        payload = json.dumps(obj).encode("utf-8")
+        if len(payload) > MAX_PAYLOAD:
+            raise ValueError("message too large for binary framing")
+        return _HEADER.pack(MAGIC, len(payload), 0) + payload
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+CODECS = {c.name: c for c in (JSON, BINARY)}
+
+
+def choose(offered, default=JSON):
+    """Pick the first offered framing we support (a name or a list of names)."""
+    if isinstance(offered, str):
+        offered = [offered]
+    for name in offered or ():
+        if name in CODECS:
+            return CODECS[name]
+    return default
+
+
+# ============================================================
+#  PRE-ENCODED FRAMES
+# ============================================================
+
+class Frame:
+    """A constant message, encoded once per codec."""
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.frames = {codec: codec.encode(obj) for codec in CODECS.values()}
+
+    def encode(self, codec):
+        frame = self.frames.get(codec)
+        return frame if frame is not None else codec.encode(self.obj)
+
+
+def _json_value(value):
+    if type(value) is str and value.isascii() and value.isalnum():
+        return b'"' + value.encode("ascii") + b'"'    # nothing to escape
+    return json.dumps(value).encode("utf-8")
+
+
+class Template:
+    """A message type with variable fields; the constant bytes are built once.
+
+    Template("hangup", "by").encode(codec, "5001") gives the same frame as
+    codec.encode({"type": "hangup", "by": "5001"}) without building the dict:
+    JSON splices the escaped values between pre-encoded pieces, binary packs
+    only the variable fields behind the header.
+    """
+
+    def __init__(self, mtype, *fields):
+        self.mtype = mtype
+        self.fields = fields
+
+        # JSON: encode once with placeholders and keep the pieces around them
+        marks = [f"\x00{i}\x00" for i in range(len(fields))]
+        text = json.dumps({"type": mtype, **dict(zip(fields, marks))}).encode("utf-8") + b"\n"
+        self.json_parts = []
+        for mark in marks:
+            head, text = text.split(json.dumps(mark).encode("utf-8"), 1)
+            self.json_parts.append(head)
+        self.json_tail = text
+
+        # Binary: only when the fields are exactly the type's layout
+        self.binary = None
+        spec = _by_type.get(mtype)
+        if spec is not None and sorted(name for name, _ in spec[1]) == sorted(fields):
+            code, layout = spec
+            self.binary = (code, [(fields.index(name), _packers[kind]) for name, kind in layout])
+
+    def build(self, values):
+        return {"type": self.mtype, **dict(zip(self.fields, values))}
+
+    def encode(self, codec, *values):
+        if codec is JSON:
+            out = []
+            for part, value in zip(self.json_parts, values):
+                out.append(part)
+                out.append(_json_value(value))
+            out.append(self.json_tail)
+            return b"".join(out)
+        if codec is BINARY and self.binary is not None:
+            code, packers = self.binary
+            try:
+                payload = b"".join([pack(values[i]) for i, pack in packers])
+            except (AttributeError, TypeError, ValueError, struct.error):
+                payload = None
+            if payload is not None and len(payload) <= MAX_PAYLOAD:
+                return _HEADER.pack(MAGIC, len(payload), code) + payload
+        return codec.encode(self.build(values))
+
+
+def _decode_binary(code, buf, pos, end):
+    if code == 0:
+        return json.loads(bytes(buf[pos:end]))
+    spec = _by_code.get(code)
+    if spec is None:
+        return None
+    mtype, fields = spec
+    msg = {"type": mtype}
+    for name, kind in fields:
+        value, pos = _unpackers[kind](buf, pos)
+        if value is not None:
+            msg[name] = value
+    if pos != end:
+        raise ValueError(f"{mtype}: payload length mismatch")
+    return msg
+
+
+class FrameReader:
+    """Incremental decoder for a byte stream mixing JSON lines and binary frames.
+
+    feed() returns every complete message in the buffer, parsed in one pass.
+    Each JSON line is parsed on its own (never joined with its neighbours,
+    so a line is exactly one message or none).  Malformed frames are skipped, like malformed JSON lines always were;
+    a frame that can never complete (line over MAX_LINE) raises ValueError.
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data):
+        buf = self.buf
+        buf += data
+        n = len(buf)
+        pos = 0
+        msgs = []
+        while pos < n:
+            if buf[pos] == MAGIC:
+                if n - pos < _HEADER.size:
+                    break
+                _, length, code = _HEADER.unpack_from(buf, pos)
+                start = pos + _HEADER.size
+                end = start + length
+                if end > n:
+                    break
+                pos = end
+                try:
+                    msgs.append(_decode_binary(code, buf, start, end))
+                except (ValueError, IndexError, struct.error, UnicodeDecodeError):
+                    continue
+            else:
+                nl = buf.find(b"\n", pos)
+                if nl < 0:
+                    if n - pos > MAX_LINE:
+                        raise ValueError("line too long")
+                    break
+                line = buf[pos:nl].strip()
+                pos = nl + 1
+                if line:
+                    try:
+                        msgs.append(json.loads(line))
+                    except (ValueError, UnicodeDecodeError):
+                        continue
+        del buf[:pos]
+        return [m for m in msgs if isinstance(m, dict)]
@@ -0,0 +1,388 @@
+"""Conference rooms: every participant hears the sum of all the others.
+
+A participant joins a room over signalling and gets a UDP port of its own
+from the media port range (conference_joined carries "media_host" and
+"media_port").  It sends RTP there every 20 ms with 160 samples at 8 kHz
+in the codec it negotiated at register (L16 if it did not), and receives
+the room's mix back, in the same codec, from the same port at the address
+it sends from (latched on the first packet, as in pbx_media).
+
+Incoming frames go through a per-participant jitter buffer that reorders
+them and plays them out a fixed number of frames late.  One mixer thread
+ticks every 20 ms: it takes the next frame of every participant of every
+room, decodes them to linear samples and mixes them with NumPy, all rooms
+of the same size in one array operation: a room's frames are summed once
+and every listener gets the sum minus its own frame, clipped to 16 bits
+and encoded in its codec.  The arrays are reused between
+ticks and rebuilt only when someone joins or leaves.
+
+NumPy is optional for the server as a whole; without it (or without a
+media port range) conferences are unavailable.
+"""
+
+import random
+import select
+import struct
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import pbx_media
+import pbx_transcode
+
+RATE = 8000
+PTIME = 0.020
+SAMPLES = 160                   # per 20 ms frame
+CODEC = pbx_transcode.L16       # for endpoints that did not negotiate one
+
+RTP = struct.Struct("!BBHII")
+MAX_PACKET = 2048
+
+# a mixer tick this late is skipped rather than caught up on
+MAX_LAG = 0.1
+
+# join() outcomes
+OK = "ok"
+UNAVAILABLE = "unavailable"
+FULL = "full"
+NO_PORTS = "no_ports"
+
+enabled = False
+max_members = 50
+depth = 3                       # jitter buffer delay, in frames
+
+_rooms = {}                     # room name -> Room
+_members = {}                   # extension -> Member
+_fds = {}                       # RTP socket fd -> Member
+_lock = threading.Lock()
+_epoll = None
+_layout = None                  # current Layout, None after a membership change
+
+stats = {"mixed": 0, "late": 0, "lost": 0, "invalid": 0, "dropped": 0, "overruns": 0}
+
+
+class JitterBuffer:
+    """Reorders one participant's frames and plays them out `depth` frames late.
+
+    Sequence numbers are extended past 16 bits relative to the frame due
+    next.  Playout starts once `depth` frames are buffered; when the buffer
+    runs dry (silence suppression, a stalled sender) it waits for `depth`
+    frames again, so it never runs ahead of the sender.
+    """
+
+    __slots__ = ("depth", "slots", "seqs", "next", "count", "primed")
+
+    def __init__(self, depth):
+        self.depth = depth
+        size = 4 * max(depth, 2)
+        self.slots = [None] * size
+        self.seqs = [-1] * size
+        self.next = None        # extended sequence number played out next
+        self.count = 0          # frames held
+        self.primed = False
+
+    def push(self, seq, payload):
+        size = len(self.slots)
+        if self.next is None:
+            self.next = seq
+        ext = self.next + ((seq - self.next + 0x8000) & 0xFFFF) - 0x8000
+        if ext < self.next:
+            stats["late"] += 1
+            return
+        if ext >= self.next + size:
+            # A long gap or a restarted sender: start over from this frame
+            self.seqs = [-1] * size
+            self.next = ext
+            self.count = 0
+            self.primed = False
+        i = ext % size
+        if self.seqs[i] != ext:
+            self.count += 1
+        self.slots[i] = payload
+        self.seqs[i] = ext
+        if not self.primed and ext - self.next + 1 >= self.depth:
+            self.primed = True
+
+    def pop(self):
+        """Next frame's payload, or None (not primed yet, lost, or run dry)."""
+        if not self.primed:
+            return None
+        if not self.count:
+            self.primed = False
+            self.next = None
+            return None
+        i = self.next % len(self.slots)
+        payload = None
+        if self.seqs[i] == self.next:
+            payload = self.slots[i]
+            self.slots[i] = None
+            self.seqs[i] = -1
+            self.count -= 1
+        else:
+            stats["lost"] += 1
+        self.next += 1
+        return payload
+
+
+class Member:
+    """One participant: its RTP/RTCP socket pair, codec, latched address and jitter buffer."""
+
+    __slots__ = ("ext", "home", "room", "socks", "port", "codec", "size", "ptype", "silence",
+                 "addr", "jitter", "ssrc", "seq", "ts")
+
+    def __init__(self, ext, room, socks, home=None, codec=None):
+        self.ext = ext
+        self.home = home            # worker the extension is registered on (None: here)
+        self.room = room
+        self.socks = socks
+        self.codec = codec if codec in pbx_transcode.CODECS else CODEC
+        self.size = SAMPLES * pbx_transcode.SAMPLE_BYTES[self.codec]    # payload bytes
+        self.ptype = pbx_transcode.PAYLOAD_TYPES[self.codec]
+        self.silence = pbx_transcode.silence(self.codec, SAMPLES)
+        self.port = socks[0].getsockname()[1]
+        self.addr = None            # latched from the first packet
+        self.jitter = JitterBuffer(depth)
+        self.ssrc = random.getrandbits(32)
+        self.seq = random.getrandbits(16)
+        self.ts = random.getrandbits(32)
+
+    def receive(self):
+        """Read one datagram into the jitter buffer.
+
+        The socket is polled level-triggered, so anything left behind is
+        reported again; reading just one spares the failing recv that
+        would end a read-until-empty loop.
+        """
+        try:
+            data, addr = self.socks[0].recvfrom(MAX_PACKET)
+        except OSError:
+            return      # nothing there after all, or closed under us
+        if self.addr is None:
+            self.addr = addr
+        elif addr != self.addr:
+            stats["dropped"] += 1
+            return
+        n = len(data)
+        if n < RTP.size or data[0] >> 6 != 2:
+            stats["invalid"] += 1
+            return
+        start = RTP.size
+        if data[0] != 0x80:
+            # CSRCs and/or a header extension before the payload
+            start += 4 * (data[0] & 0x0F)
+            if data[0] & 0x10 and n >= start + 4:
+                start += 4 + 4 * (data[start + 2] << 8 | data[start + 3])
+        if n - start != self.size:
+            stats["invalid"] += 1
+            return
+        self.jitter.push(data[2] << 8 | data[3], memoryview(data)[start:])
+
+    def send(self, payload):
+        """Send one mixed frame to the latched address."""
+        if self.addr is None:
+            return
+        header = RTP.pack(0x80, self.ptype, self.seq & 0xFFFF, self.ts & 0xFFFFFFFF, self.ssrc)
+        self.seq += 1
+        self.ts += SAMPLES
+        try:
+            self.socks[0].sendmsg([header, payload], (), 0, self.addr)
+        except OSError:
+            stats["dropped"] += 1
+
+    def close(self):
+        for s in self.socks:
+            if _epoll is not None:
+                try:
+                    _epoll.unregister(s.fileno())
+                except (OSError, ValueError):
+                    pass
+            _fds.pop(s.fileno(), None)
+            s.close()
+
+
+class Room:
+    __slots__ = ("name", "members")
+
+    def __init__(self, name):
+        self.name = name
+        self.members = []
+
+
+class Block:
+    """Every room of one size, mixed together.
+
+    Frames are decoded into an array of shape (rooms, size, samples), one
+    pbx_transcode call per codec in use, so each room's sum is a single sum
+    over axis 1 and each listener's mix that sum minus its own row; the
+    mixes are encoded back per codec the same way.  No work per room in
+    Python.
+    """
+
+    def __init__(self, rooms):
+        self.members = [m for room in rooms for m in room.members]
+        self.shape = (len(rooms), len(rooms[0].members), SAMPLES)
+        self.pcm = np.zeros(self.shape, dtype=np.int16)
+        self.mix = np.zeros(self.shape, dtype=np.int32)
+        by_codec = {}
+        for row, m in enumerate(self.members):
+            by_codec.setdefault(m.codec, []).append(row)
+        # (codec, rows, members); rows is a plain slice when everyone shares a codec
+        self.groups = []
+        for codec, rows in by_codec.items():
+            index = slice(None) if len(by_codec) == 1 else np.array(rows, dtype=np.intp)
+            self.groups.append((codec, index, [self.members[r] for r in rows]))
+
+    def run(self, send=True):
+        pcm = self.pcm.reshape(-1, SAMPLES)
+        for codec, rows, members in self.groups:
+            silence = members[0].silence
+            frames = b"".join([m.jitter.pop() or silence for m in members])
+            pcm[rows] = pbx_transcode.decode(frames, codec).reshape(len(members), SAMPLES)
+        np.subtract(self.pcm.sum(axis=1, dtype=np.int32, keepdims=True), self.pcm, out=self.mix)
+        np.clip(self.mix, -32768, 32767, out=self.mix)
+        mix = self.mix.reshape(-1, SAMPLES)
+        for codec, rows, members in self.groups:
+            out = memoryview(pbx_transcode.encode(mix[rows], codec))
+            if send:
+                size = members[0].size
+                for i, m in enumerate(members):
+                    m.send(out[i * size:(i + 1) * size])
+        return len(self.members)
+
+
+class Layout:
+    """One mixing pass: the rooms with two or more members, in blocks by size."""
+
+    def __init__(self, rooms):
+        by_size = {}
+        for room in rooms:
+            if len(room.members) >= 2:
+                by_size.setdefault(len(room.members), []).append(room)
+        self.blocks = [Block(rs) for _, rs in sorted(by_size.items())]
+
+
+def mix(layout, send=True):
+    """Play out one frame of every member and mix each room; returns frames mixed."""
+    n = 0
+    for block in layout.blocks:
+        n += block.run(send)
+    stats["mixed"] += n
+    return n
+
+
+# ============================================================
+#  ROOMS
+# ============================================================
+
+def configure(jitter_ms=60, members=50):
+    """Enable conferences (needs NumPy and the media port range)."""
+    global enabled, depth, max_members
+    if jitter_ms < 0 or members < 2:
+        raise ValueError("the jitter buffer cannot be negative and rooms need two members")
+    depth = max(1, round(jitter_ms / 1000 / PTIME))
+    max_members = members
+    enabled = np is not None and pbx_media.enabled
+
+
+def join(ext, room, home=None, codec=None):
+    """Add ext to a room, opening it if needed.
+
+    Returns (outcome, member, others): the new Member when the outcome is
+    OK, and the members already in the room (to tell them).
+    """
+    global _layout
+    if not enabled:
+        return UNAVAILABLE, None, []
+    with _lock:
+        r = _rooms.get(room)
+        if r is None:
+            r = _rooms[room] = Room(room)
+        others = [m for m in r.members if m.ext != ext]
+        if len(others) >= max_members:
+            return FULL, None, others
+        old = _members.get(ext)
+        if old is not None and old.room is r:
+            return OK, old, others      # joined twice
+        socks = pbx_media.bind_pair()
+        if socks is None:
+            if not r.members:
+                del _rooms[room]
+            return NO_PORTS, None, others
+        member = Member(ext, r, socks, home, codec)
+        r.members.append(member)
+        _members[ext] = member
+        _fds[socks[0].fileno()] = member
+        _epoll.register(socks[0].fileno(), select.EPOLLIN)
+        _layout = None
+    return OK, member, others
+
+
+def leave(ext):
+    """Take ext out of its room; returns (room name, remaining members) or (None, [])."""
+    global _layout
+    with _lock:
+        member = _members.pop(ext, None)
+        if member is None:
+            return None, []
+        room = member.room
+        room.members.remove(member)
+        if not room.members:
+            del _rooms[room.name]
+        member.close()
+        pbx_media.free_pair(member.port)
+        _layout = None
+        return room.name, list(room.members)
+
+
+def members(room):
+    with _lock:
+        r = _rooms.get(room)
+        return [m.ext for m in r.members] if r is not None else []
+
+
+def rooms():
+    return len(_rooms)
+
+
+def participants():
+    return len(_members)
+
+
+# ============================================================
+#  MIXER
+# ============================================================
+
+def _run():
+    global _layout
+    poll = _epoll.poll
+    next_tick = time.monotonic() + PTIME
+    while True:
+        events = poll(max(0.0, next_tick - time.monotonic()))
+        with _lock:
+            for fd, _ in events:
+                member = _fds.get(fd)
+                if member is not None:
+                    member.receive()
+            now = time.monotonic()
+            if now < next_tick:
+                continue
+            next_tick += PTIME
+            if now - next_tick > MAX_LAG:
+                stats["overruns"] += 1
+                next_tick = now + PTIME
+            if _layout is None:
+                _layout = Layout(_rooms.values())
+            mix(_layout)
+
+
+def start():
+    """Start the mixer thread (after forking workers)."""
+    global _epoll
+    if not enabled or _epoll is not None:
+        return
+    _epoll = select.epoll()
+    threading.Thread(target=_run, name="conference", daemon=True).start()
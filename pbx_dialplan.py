@@ -0,0 +1,343 @@
+"""Dial plan: what a number dialled by an endpoint does, from a file of patterns.
+
+Dial plan file format (one rule per line; a `#` standing on its own, as in
+`# comment`, starts a comment - in a pattern it is the key):
+
+    <pattern> <action> [<arg>]
+
+Patterns match the whole number, one character per element:
+
+    0-9 * # +     that character
+    X  Z  N       any digit, 1-9, 2-9
+    [1-58]        one of the listed digits or ranges
+    .  !          last only: one or more / zero or more of anything
+
+Actions:
+
+    local               an extension of this PBX
+    route               the trunk the routes table picks (--routes)
+    trunk <name>        that trunk
+    block [<reason>]    refused with that error reason (default dial_plan)
+    ivr                 the local IVR menu
+    rewrite <template>  dial the template instead: {n} in it stands for
+                        the number from its n-th character on, so
+                        `9. rewrite {1}` drops a leading 9 and a short
+                        code is just `*1 rewrite 5001`
+
+When several patterns match, the most specific wins: the one whose
+element at the first position where they differ matches fewer characters
+(a digit before [1-5] before X before `.`), then the earlier line.
+
+The plan is compiled into one DFA, so a number is matched in a single
+pass over its characters whatever the number of rules: the states are
+sets of (rule, position) reached by the characters so far, built up
+front from the start state over the characters the patterns mention
+(any other character is one more symbol), and each keeps the best rule
+that ends in it.  Results are cached per number like the routes table's.
+A reload compiles a new plan off to the side and swaps it in whole.
+"""
+
+import re
+import threading
+from array import array
+
+LOCAL = "local"
+ROUTE = "route"
+TRUNK = "trunk"
+BLOCK = "block"
+IVR = "ivr"
+REWRITE = "rewrite"
+
+# action -> numbers of arguments it takes
+ACTIONS = {
+    LOCAL: (0,),
+    ROUTE: (0,),
+    TRUNK: (1,),
+    BLOCK: (0, 1),
+    IVR: (0,),
+    REWRITE: (1,),
+}
+
+MAX_REWRITES = 8        # rewrites of one number before it counts as a loop
+
+_DIGITS = "0123456789"
+_CLASSES = {"X": _DIGITS, "Z": _DIGITS[1:], "N": _DIGITS[2:]}
+_LITERALS = set(_DIGITS + "*#+")
+# shared element sets: one object per class however many rules use it
+_SETS = {ch: frozenset(ch) for ch in _LITERALS}
+_SETS.update((name, frozenset(chars)) for name, chars in _CLASSES.items())
+_ANY = None             # element that matches every character
+_DEAD = array("i", [-1])  # no transition: no pattern matches
+_WILD = 1000            # specificity of `.`; `!` is one more
+_PLACEHOLDER = re.compile(r"\{(\d+)\}")
+
+
+class Rule:
+    """One line of the plan."""
+
+    __slots__ = ("pattern", "action", "arg", "line", "rank")
+
+    def __init__(self, pattern, action, arg=None, line=0):
+        self.pattern = pattern
+        self.action = action
+        self.arg = arg
+        self.line = line
+        self.rank = None
+
+    def __repr__(self):
+        arg = f" {self.arg}" if self.arg is not None else ""
+        return f"<Rule {self.pattern} {self.action}{arg}>"
+
+    def rewrite(self, number):
+        """The number a rewrite rule dials instead of `number`."""
+        return _PLACEHOLDER.sub(lambda m: number[int(m.group(1)):], self.arg)
+
+
+def parse_pattern(pattern):
+    """(elements, tail): one char set per position, then None, '.' or '!'."""
+    elements = []
+    i, n = 0, len(pattern)
+    while i < n:
+        ch = pattern[i]
+        if ch in ".!":
+            if i != n - 1:
+                raise ValueError(f"pattern {pattern!r}: {ch} only at the end")
+            return elements, ch
+        if ch in _LITERALS or ch in _CLASSES:
+            elements.append(_SETS[ch])
+        elif ch == "[":
+            end = pattern.find("]", i)
+            if end < 0:
+                raise ValueError(f"pattern {pattern!r}: unclosed [")
+            body = pattern[i + 1:end]
+            chars = set()
+            j = 0
+            while j < len(body):
+                if j + 2 < len(body) and body[j + 1] == "-":
+                    lo, hi = body[j], body[j + 2]
+                    if not (lo in _DIGITS and hi in _DIGITS and lo <= hi):
+                        raise ValueError(f"pattern {pattern!r}: bad range {lo}-{hi}")
+                    chars.update(_DIGITS[int(lo):int(hi) + 1])
+                    j += 3
+                elif body[j] in _LITERALS:
+                    chars.add(body[j])
+                    j += 1
+                else:
+                    raise ValueError(f"pattern {pattern!r}: bad character {body[j]!r} in []")
+            if not chars:
+                raise ValueError(f"pattern {pattern!r}: empty []")
+            elements.append(_SETS.setdefault(frozenset(chars), frozenset(chars)))
+            i = end
+        else:
+            raise ValueError(f"pattern {pattern!r}: bad character {ch!r}")
+        i += 1
+    if not elements:
+        raise ValueError("empty pattern")
+    return elements, None
+
+
+class Automaton:
+    """The rules as a DFA, with a result cache."""
+
+    def __init__(self, rules=(), cache_size=65536):
+        self.rules = list(rules)
+        self.cache_size = cache_size
+        self._cache = {}
+        self._compile()
+
+    def __len__(self):
+        return len(self.rules)
+
+    @property
+    def states(self):
+        return len(self._accept)
+
+    def _compile(self):
+        # NFA: each state has at most one transition, (char set or _ANY, next)
+        sets, nexts, accepts = [], [], []
+        starts = []
+        alphabet = set()
+        for index, rule in enumerate(self.rules):
+            elements, tail = parse_pattern(rule.pattern)
+            rule.rank = (tuple(len(e) for e in elements)
+                         + ((_WILD if tail == "." else _WILD + 1,) if tail else ()), index)
+            starts.append(len(sets))
+            for element in elements:
+                alphabet |= element
+                sets.append(element)
+                nexts.append(len(sets))
+                accepts.append(None)
+            base = len(sets)
+            if tail == ".":
+                sets += [_ANY, _ANY]
+                nexts += [base + 1, base + 1]
+                accepts += [None, index]
+            elif tail == "!":
+                sets.append(_ANY)
+                nexts.append(base)
+                accepts.append(index)
+            else:
+                sets.append(frozenset())
+                nexts.append(-1)
+                accepts.append(index)
+
+        # Symbols: each character some pattern names, then "anything else";
+        # NFA states step on one of a few distinct char sets, each numbered
+        symbols = {ch: i for i, ch in enumerate(sorted(alphabet))}
+        other = len(symbols)
+        width = other + 1
+        kinds = {}
+        kind_of = [kinds.setdefault(s, len(kinds)) for s in sets]
+        kind_symbols = [tuple(range(width)) if s is _ANY else tuple(symbols[c] for c in s)
+                        for s in kinds]
+        ranks = [rule.rank for rule in self.rules]
+
+        # A DFA state is the sorted tuple of the NFA states it stands for
+        # (a frozenset each would take several times the memory)
+        start = tuple(starts)
+        ids = {start: 0}
+        pending = [start]
+        trans = array("i")
+        accept = []
+        while pending:
+            state = pending.pop()
+            sid = ids[state]
+            if len(accept) <= sid:
+                grow = sid + 1 - len(accept)
+                accept.extend([None] * grow)
+                trans.extend(_DEAD * width * grow)
+            groups = {}
+            best = None
+            for q in state:
+                group = groups.get(kind_of[q])
+                if group is None:
+                    groups[kind_of[q]] = [nexts[q]]
+                else:
+                    group.append(nexts[q])
+                a = accepts[q]
+                if a is not None and (best is None or ranks[a] < ranks[best]):
+                    best = a
+            accept[sid] = self.rules[best] if best is not None else None
+            buckets = [None] * width
+            for kind, targets in groups.items():
+                for sym in kind_symbols[kind]:
+                    if buckets[sym] is None:
+                        buckets[sym] = targets
+                    else:
+                        buckets[sym] = buckets[sym] + targets
+            row = sid * width
+            for sym, targets in enumerate(buckets):
+                if targets is None:
+                    continue
+                target = tuple(sorted(set(targets)))
+                tid = ids.get(target)
+                if tid is None:
+                    tid = ids[target] = len(ids)
+                    pending.append(target)
+                trans[row + sym] = tid
+
+        # (transitions, rule per state, char -> symbol, width) swapped as one
+        self._index = (trans, accept, symbols, width)
+        self._accept = accept
+        self._cache = {}
+
+    def match(self, number):
+        """The rule for `number`, or None when no pattern matches it."""
+        cache = self._cache
+        hit = cache.get(number, cache)
+        if hit is not cache:
+            return hit
+
+        trans, accept, symbols, width = self._index
+        other = width - 1
+        state = 0
+        for ch in number:
+            state = trans[state * width + symbols.get(ch, other)]
+            if state < 0:
+                rule = None
+                break
+        else:
+            rule = accept[state]
+
+        if len(cache) >= self.cache_size:
+            cache.clear()
+        cache[number] = rule
+        return rule
+
+
+class DialPlan:
+    """The compiled plan, replaced as a whole on reload."""
+
+    def __init__(self, rules=()):
+        self._automaton = Automaton(rules)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._automaton)
+
+    @property
+    def states(self):
+        return self._automaton.states
+
+    def replace(self, rules):
+        """Compile `rules` and swap them in."""
+        automaton = Automaton(rules)
+        with self._lock:
+            self._automaton = automaton
+
+    def match(self, number):
+        return self._automaton.match(number)
+
+    def resolve(self, number):
+        """(rule, number) after following rewrites; rule None when nothing matches.
+
+        Too many rewrites in a row count as no match.
+        """
+        automaton = self._automaton
+        for _ in range(MAX_REWRITES + 1):
+            rule = automaton.match(number)
+            if rule is None or rule.action != REWRITE:
+                return rule, number
+            number = rule.rewrite(number)
+        return None, number
+
+
+def default_plan(local_prefix, remote_prefix, ivr_ext):
+    """The plan a PBX without --dialplan has: the numbering of the two centers."""
+    rules = [Rule(ivr_ext, IVR), Rule(f"{local_prefix}!", LOCAL), Rule(".", ROUTE)]
+    if remote_prefix:
+        rules.append(Rule(f"{remote_prefix}000", BLOCK, "remote_ivr"))
+    return rules
+
+
+def load_dialplan(path, trunks=(), reasons=None):
+    """Parse a dial plan file into a list of Rules.
+
+    `trunks` are the names trunk rules may use; `reasons`, when given, the
+    error reasons block rules may use.  Patterns are checked here too.
+    """
+    rules = []
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            fields = line.split()
+            if "#" in fields:
+                fields = fields[:fields.index("#")]
+            if not fields:
+                continue
+            where = f"{path}:{lineno}"
+            if len(fields) < 2 or fields[1] not in ACTIONS:
+                raise ValueError(f"{where}: cannot parse {line.strip()!r}")
+            pattern, action, args = fields[0], fields[1], fields[2:]
+            if len(args) not in ACTIONS[action]:
+                raise ValueError(f"{where}: wrong arguments for {action}")
+            arg = args[0] if args else None
+            if action == TRUNK and arg not in trunks:
+                raise ValueError(f"{where}: unknown trunk {arg!r}")
+            if action == BLOCK and arg is not None and reasons is not None and arg not in reasons:
+                raise ValueError(f"{where}: unknown reason {arg!r}")
+            try:
+                parse_pattern(pattern)
+            except ValueError as e:
+                raise ValueError(f"{where}: {e}") from None
+            rules.append(Rule(pattern, action, arg, lineno))
+    return rules
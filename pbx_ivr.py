@@ -0,0 +1,332 @@
+"""IVR engine: menu trees from a file, and the extensions inside them.
+
+Menus file format (one entry per line; a line starting with `#` is a
+comment - elsewhere `#` is a key or text):
+
+    menu <name> <timeout> <prompt>          a menu: the seconds it waits for
+                                            a key, and the text it sends
+    option <menu> <key> <action> [<arg>]    what a key does in that menu
+
+Keys are 0-9, * and #, plus two that are not pressed: t, when the
+menu's timeout runs out, and i, a key the menu has no option for.
+Actions:
+
+    menu <name>          go to that menu (nested menus, or back up)
+    transfer <number>    leave the IVR dialling number (by the dial plan)
+    queue <ext>          leave the IVR into that ACD queue
+    info <text>          send the text and stay in the menu
+    hangup               leave the IVR
+
+The first menu is the one the IVR extension answers with.  In texts `\\n`
+starts a new line.  A menu without t hangs up when its timeout runs out,
+and so does any menu after MAX_TIMEOUTS of them in a row; one without i
+answers an unknown key with invalid_ivr_choice and keeps waiting.
+
+Every prompt, info text and the hang-up are Frames built when the menus
+are configured, so a key costs a dict lookup and a write of ready bytes.
+A caller inside a menu is a Session (its menu, its timer and the timeouts
+in a row) in one table.  The timer is armed on the timing wheel with the
+menu's timeout and moved on by every key; a session goes from the table
+when it leaves the IVR, times out, or its extension disconnects or
+stops being idle (it calls, is called or joins a conference) - none is
+left behind, and a timeout never hangs up a call.
+"""
+
+import threading
+
+import pbx_timers
+from pbx_calltable import IDLE
+from pbx_codec import Frame
+
+MENU = "menu"
+TRANSFER = "transfer"
+QUEUE = "queue"
+INFO = "info"
+HANGUP = "hangup"
+
+ACTIONS = (MENU, TRANSFER, QUEUE, INFO, HANGUP)
+KEYS = set("0123456789*#")
+TIMEOUT_KEY = "t"
+INVALID_KEY = "i"
+
+MAX_TIMEOUTS = 3            # timeouts in a row before a menu hangs up anyway
+DEFAULT_TIMEOUT = 30.0      # seconds, of the built-in menu
+
+DEFAULT_INFO = (
+    "Το τηλεφωνικό κέντρο λειτουργεί Δευτέρα–Παρασκευή 09:00–17:00.\n"
+    "Για τεχνική υποστήριξη επικοινωνήστε με τον διαχειριστή."
+)
+
+menus = {}              # name -> Menu
+_root = None
+_hangup = None          # Option that ends a session (timeouts without t)
+_send = None            # send(ext, frame) to the extension's connection
+_error = None           # error(ext, reason)
+_transfer = None        # transfer(ext, number): dial number for ext
+_queue = None           # queue(ext, queue_ext): put ext in an ACD queue
+_state_of = None        # state_of(ext) -> call-table state, None when not registered
+_sessions = {}          # ext -> Session
+_lock = threading.Lock()
+
+stats = {"entered": 0, "transfer": 0, "queue": 0, "hangup": 0, "timeout": 0, "left": 0}
+
+
+class Option:
+    """What a key does: `arg` is the Menu of a menu option, the number or queue otherwise."""
+
+    __slots__ = ("action", "arg", "frame")
+
+    def __init__(self, action, arg=None, frame=None):
+        self.action = action
+        self.arg = arg
+        self.frame = frame      # info text / hang-up, ready to send
+
+
+class Menu:
+    __slots__ = ("name", "timeout", "prompt", "options", "on_timeout", "on_invalid")
+
+    def __init__(self, name, timeout, prompt):
+        self.name = name
+        self.timeout = timeout
+        self.prompt = Frame({"type": "ivr_message", "text": prompt})
+        self.options = {}
+        self.on_timeout = None
+        self.on_invalid = None
+
+
+class Session:
+    __slots__ = ("menu", "timer", "timeouts")
+
+    def __init__(self, menu):
+        self.menu = menu
+        self.timer = None
+        self.timeouts = 0
+
+
+def configure(definitions, ivr_ext, send, error, transfer, queue, state_of):
+    """Build the menus of {name: (timeout, prompt, {key: (action, arg)})}, first one the root.
+
+    The server's callbacks carry out what the engine decides.
+    """
+    global _root, _hangup, _send, _error, _transfer, _queue, _state_of
+    hangup = Option(HANGUP, frame=Frame({"type": "hangup", "by": ivr_ext}))
+    built = {name: Menu(name, timeout, prompt)
+             for name, (timeout, prompt, _) in definitions.items()}
+    for name, (_, _, options) in definitions.items():
+        menu = built[name]
+        for key, (action, arg) in options.items():
+            if action == MENU:
+                option = Option(MENU, built[arg])
+            elif action == INFO:
+                option = Option(INFO, frame=Frame({"type": "ivr_info", "text": arg}))
+            elif action == HANGUP:
+                option = hangup
+            else:
+                option = Option(action, arg)
+            if key == TIMEOUT_KEY:
+                menu.on_timeout = option
+            elif key == INVALID_KEY:
+                menu.on_invalid = option
+            else:
+                menu.options[key] = option
+    with _lock:
+        for session in _sessions.values():
+            pbx_timers.cancel(session.timer)
+        _sessions.clear()
+        menus.clear()
+        menus.update(built)
+        _root = next(iter(built.values()))
+        _hangup = hangup
+    _send, _error, _transfer, _queue, _state_of = send, error, transfer, queue, state_of
+
+
+def default_menus(ivr_ext, local_prefix):
+    """The built-in menu: 0 for information, 1-9 for the extensions prefix001-prefix009."""
+    center_label = "A" if ivr_ext == "5000" else "B" if ivr_ext == "7000" else "Local"
+    prompt = (
+        f"--- IVR Center {center_label} ({ivr_ext}) ---\n"
+        "0 → Πληροφορίες για το τηλεφωνικό κέντρο\n"
+        f"1–9 → Κλήση στα {local_prefix}001–{local_prefix}009 (αν είναι καταχωρημένα)\n"
+    )
+    options = {"0": (INFO, DEFAULT_INFO)}
+    for digit in "123456789":
+        options[digit] = (TRANSFER, f"{local_prefix}00{digit}")
+    return {"main": (DEFAULT_TIMEOUT, prompt, options)}
+
+
+def load_menus(path):
+    """Parse a menus file into {name: (timeout, prompt, {key: (action, arg)})}."""
+    defined = {}
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            text = line.strip()
+            if not text or text.startswith("#"):
+                continue
+            where = f"{path}:{lineno}"
+            kind = text.split(None, 1)[0]
+            if kind == "menu":
+                fields = text.split(None, 3)
+                if len(fields) != 4:
+                    raise ValueError(f"{where}: cannot parse {text!r}")
+                _, name, timeout, prompt = fields
+                try:
+                    timeout = float(timeout)
+                except ValueError:
+                    timeout = 0
+                if timeout <= 0:
+                    raise ValueError(f"{where}: the timeout must be a positive number of seconds")
+                if name in defined:
+                    raise ValueError(f"{where}: menu {name!r} defined twice")
+                defined[name] = (timeout, prompt.replace("\\n", "\n"), {})
+            elif kind == "option":
+                fields = text.split(None, 4)
+                if len(fields) < 4 or fields[3] not in ACTIONS:
+                    raise ValueError(f"{where}: cannot parse {text!r}")
+                _, name, key, action = fields[:4]
+                arg = fields[4] if len(fields) == 5 else None
+                if name not in defined:
+                    raise ValueError(f"{where}: option for unknown menu {name!r}")
+                if key not in KEYS and key not in (TIMEOUT_KEY, INVALID_KEY):
+                    raise ValueError(f"{where}: bad key {key!r}")
+                if (action == HANGUP) != (arg is None) or (arg and action != INFO and " " in arg):
+                    raise ValueError(f"{where}: wrong arguments for {action}")
+                if action == INFO:
+                    arg = arg.replace("\\n", "\n")
+                defined[name][2][key] = (action, arg)
+            else:
+                raise ValueError(f"{where}: cannot parse {text!r}")
+
+    if not defined:
+        raise ValueError(f"{path}: no menus")
+    for name, (_, _, options) in defined.items():
+        for key, (action, arg) in options.items():
+            if action == MENU and arg not in defined:
+                raise ValueError(f"{path}: menu {name!r} key {key} goes to unknown menu {arg!r}")
+    return defined
+
+
+# ============================================================
+#  SESSIONS
+# ============================================================
+
+def _arm(ext, session):
+    # under _lock
+    if session.timer is not None:
+        pbx_timers.cancel(session.timer)
+    session.timer = pbx_timers.schedule(session.menu.timeout, _expire, ext, session)
+
+
+def _end(ext, session):
+    # under _lock
+    del _sessions[ext]
+    pbx_timers.cancel(session.timer)
+
+
+def enter(ext):
+    """ext calls the IVR: the root menu, from the top even when it was in one."""
+    _lock.acquire()
+    try:
+        session = _sessions.get(ext)
+        if session is None:
+            session = _sessions[ext] = Session(_root)
+        else:
+            session.menu, session.timeouts = _root, 0
+        _arm(ext, session)
+        stats["entered"] += 1
+        prompt = _root.prompt
+    finally:
+        _lock.release()
+    _send(ext, prompt)
+
+
+def choose(ext, key):
+    """A key pressed by ext; False when it is not in a menu."""
+    _lock.acquire()
+    try:
+        session = _sessions.get(ext)
+        if session is None:
+            return False
+        menu = session.menu
+        option = menu.options.get(key) or menu.on_invalid
+        session.timeouts = 0
+        _step(ext, session, option)
+    finally:
+        _lock.release()
+    _run(ext, option)
+    return True
+
+
+def leave(ext):
+    """ext is gone or busy elsewhere: drop its session; False when it had none."""
+    if ext not in _sessions:
+        return False
+    _lock.acquire()
+    try:
+        session = _sessions.get(ext)
+        if session is None:
+            return False
+        _end(ext, session)
+        stats["left"] += 1
+        return True
+    finally:
+        _lock.release()
+
+
+def _expire(ext, session):
+    """Timer callback: the menu's timeout ran out."""
+    _lock.acquire()
+    try:
+        if _sessions.get(ext) is not session or session.timer.pending:
+            # Gone, or a key re-armed it meanwhile
+            return
+        if _state_of(ext) != IDLE:
+            # In a call it was not told of yet: nothing to hang up
+            _end(ext, session)
+            stats["left"] += 1
+            return
+        stats["timeout"] += 1
+        session.timeouts += 1
+        option = session.menu.on_timeout
+        if option is None or session.timeouts >= MAX_TIMEOUTS:
+            option = _hangup
+        _step(ext, session, option)
+    finally:
+        _lock.release()
+    _run(ext, option)
+
+
+def _step(ext, session, option):
+    # under _lock: where the session goes
+    if option is None or option.action == INFO:
+        _arm(ext, session)
+    elif option.action == MENU:
+        session.menu = option.arg
+        _arm(ext, session)
+    else:
+        _end(ext, session)
+        stats[option.action] += 1
+
+
+def _run(ext, option):
+    # outside the lock: what the caller gets
+    if option is None:
+        _error(ext, "invalid_ivr_choice")
+    elif option.action == MENU:
+        _send(ext, option.arg.prompt)
+    elif option.action == TRANSFER:
+        _transfer(ext, option.arg)
+    elif option.action == QUEUE:
+        _queue(ext, option.arg)
+    else:
+        _send(ext, option.frame)
+
+
+def active():
+    return len(_sessions)
+
+
+def queue_targets():
+    """The queue extensions queue options use, to check against the configured queues."""
+    return {option.arg for menu in menus.values()
+            for option in (*menu.options.values(), menu.on_timeout, menu.on_invalid)
+            if option is not None and option.action == QUEUE}
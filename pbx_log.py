@@ -0,0 +1,216 @@
+"""Structured logging off the signalling path.
+
+Handlers call info("register", "Extension {ext} registered από {addr}",
+ext=ext, addr=addr): a level check and a deque append, with the message
+template left unformatted.  A writer thread wakes every `interval`,
+formats whatever has queued up and writes it to stdout in one write(), so
+a registration storm costs the handlers no stdout lock and no syscalls.
+Lines look like they always did ("[PBX] ..."), or are JSON objects with
+the level, event and fields when the format is "json".
+
+Per event, records can be sampled (one in N) and rate limited (at most R
+per second; the number left out is logged once the second is over).
+
+The deque is bounded; what does not fit is dropped and counted.  Before
+the writer thread runs (and in a process that never starts it, like the
+worker supervisor) flush() writes the queue out synchronously.
+"""
+
+import collections
+import json
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+_names = {v: k for k, v in LEVELS.items()}
+
+FORMATS = ("text", "json")
+
+# records waiting for the writer; beyond this they are dropped
+MAX_PENDING = 100_000
+
+_level = INFO
+_format = "text"
+_limits = {}        # event -> Limit
+_queue = collections.deque()
+_writer = None
+_out = sys.stdout
+
+stats = {"written": 0, "dropped": 0, "suppressed": 0}
+
+
+class Limit:
+    """Sampling and rate limit of one event.
+
+    Counters are updated without a lock: a race can let an extra record
+    through or skip one, which is fine for log thinning.
+    """
+
+    def __init__(self, event, sample=1, rate=None):
+        self.event = event
+        self.sample = sample
+        self.rate = rate
+        self.seen = 0
+        self.second = 0
+        self.in_second = 0
+        self.suppressed = 0
+
+    def allow(self):
+        self.seen += 1
+        if self.sample > 1 and self.seen % self.sample:
+            return False
+        if self.rate is None:
+            return True
+        now = int(time.monotonic())
+        if now != self.second:
+            if self.suppressed:
+                _put(WARNING, "log_suppressed", "{count} εγγραφές {what} παραλείφθηκαν",
+                     {"what": self.event, "count": self.suppressed})
+                self.suppressed = 0
+            self.second = now
+            self.in_second = 0
+        self.in_second += 1
+        if self.in_second > self.rate:
+            self.suppressed += 1
+            stats["suppressed"] += 1
+            return False
+        return True
+
+
+def _put(level, event, msg, fields):
+    if len(_queue) >= MAX_PENDING:
+        stats["dropped"] += 1
+        return
+    _queue.append((time.time(), level, event, msg, fields))
+
+
+def log(level, event, msg, **fields):
+    if level < _level:
+        return
+    limit = _limits.get(event)
+    if limit is not None and not limit.allow():
+        return
+    _put(level, event, msg, fields)
+
+
+def debug(event, msg, **fields):
+    log(DEBUG, event, msg, **fields)
+
+
+def info(event, msg, **fields):
+    log(INFO, event, msg, **fields)
+
+
+def warning(event, msg, **fields):
+    log(WARNING, event, msg, **fields)
+
+
+def error(event, msg, **fields):
+    log(ERROR, event, msg, **fields)
+
+
+# ============================================================
+#  OUTPUT
+# ============================================================
+
+def _text(record):
+    _, _, _, msg, fields = record
+    try:
+        return "[PBX] " + msg.format(**fields) + "\n"
+    except (KeyError, IndexError, ValueError):
+        return f"[PBX] {msg} {fields}\n"
+
+
+def _json(record):
+    ts, level, event, msg, fields = record
+    out = {"ts": round(ts, 6), "level": _names.get(level, level), "event": event}
+    out.update(fields)
+    try:
+        out["msg"] = msg.format(**fields)
+    except (KeyError, IndexError, ValueError):
+        out["msg"] = msg
+    return json.dumps(out, ensure_ascii=False, default=str) + "\n"
+
+
+def flush():
+    """Format and write everything queued so far."""
+    fmt = _json if _format == "json" else _text
+    lines = []
+    popleft = _queue.popleft
+    while True:
+        try:
+            lines.append(fmt(popleft()))
+        except IndexError:
+            break
+    if lines:
+        try:
+            _out.write("".join(lines))
+            _out.flush()
+        except (OSError, ValueError):
+            return
+        stats["written"] += len(lines)
+
+
+def _run(stop, interval):
+    while not stop.wait(interval):
+        flush()
+    flush()
+
+
+def configure(level="info", fmt="text", sample=None, rate=None, out=None):
+    """Set the level, format and per-event limits ({event: N} / {event: per second})."""
+    global _level, _format, _out
+    if level not in LEVELS:
+        raise ValueError(f"unknown log level {level!r}")
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown log format {fmt!r}")
+    _level = LEVELS[level]
+    _format = fmt
+    if out is not None:
+        _out = out
+    _limits.clear()
+    for event in set(sample or ()) | set(rate or ()):
+        _limits[event] = Limit(event, (sample or {}).get(event, 1), (rate or {}).get(event))
+
+
+def parse_limits(items, kind):
+    """["register=100", ...] -> {"register": 100}; ValueError on a malformed item."""
+    limits = {}
+    for item in items or ():
+        event, sep, value = item.partition("=")
+        if not sep or not event:
+            raise ValueError(f"{item!r}: expected EVENT=N")
+        n = kind(value)
+        if n <= 0:
+            raise ValueError(f"{item!r}: must be positive")
+        limits[event] = n
+    return limits
+
+
+def start(interval=0.05):
+    """Start the writer thread (after forking workers: threads do not survive a fork)."""
+    global _writer
+    if _writer is not None:
+        return
+    stop_event = threading.Event()
+    thread = threading.Thread(target=_run, args=(stop_event, interval),
+                              name="log-writer", daemon=True)
+    _writer = (thread, stop_event)
+    thread.start()
+
+
+def stop(timeout=2.0):
+    """Stop the writer thread and write out what is left."""
+    global _writer
+    writer, _writer = _writer, None
+    if writer is not None:
+        thread, stop_event = writer
+        stop_event.set()
+        thread.join(timeout)
+    flush()
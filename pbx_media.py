@@ -0,0 +1,260 @@
+"""UDP media relay for answered calls.
+
+Every answered call gets a relay: a pair of UDP sockets, one per leg, bound
+to ports from the configured range.  call_answered tells each endpoint the
+port of its own leg ("media_host", "media_port"); whatever arrives on one
+leg's socket is sent out of the other leg's socket to the address latched
+for that leg.  A leg latches the source address of the first packet it
+receives (symmetric RTP, so NAT is no problem); later packets from any
+other address are dropped.
+
+On a trunk call each PBX relays its own side: the leg facing the trunk is
+advertised to the other PBX in trunk_call_answered, and the caller's PBX
+sends straight to that address until it hears back from it.
+
+Packets are forwarded by one media thread that polls every relay socket
+with epoll and moves datagrams with recvfrom_into() into a single
+preallocated buffer, so forwarding allocates no packet buffers.  The
+signalling threads (or the event loop) only open and close relays.
+
+When the two sides negotiated different codecs (pbx_transcode), each
+packet's payload is converted on its way through and its payload type
+rewritten; only those packets are copied.
+"""
+
+import collections
+import select
+import socket
+import threading
+
+import pbx_transcode
+
+# big enough for any RTP packet over Ethernet
+MAX_PACKET = 2048
+
+enabled = False
+host = None             # address the relay sockets bind to
+advertise = None        # address put in call_answered
+
+_free = collections.deque()     # first port of each free pair
+_relays = {}                    # local extension -> Relay
+_fds = {}                       # socket fd -> (Relay, leg)
+_lock = threading.Lock()
+_epoll = None
+
+stats = {"relays": 0, "exhausted": 0, "packets": 0, "bytes": 0, "dropped": 0, "transcoded": 0}
+
+
+class Relay:
+    """The two legs of one call: sockets, ports and latched peer addresses."""
+
+    __slots__ = ("exts", "call", "socks", "ports", "addrs", "latched", "convert", "types")
+
+    def __init__(self, exts, call, socks, codecs=(None, None)):
+        self.exts = exts                # local extensions served (one, or both of a local call)
+        self.call = call                # both parties, local or not
+        self.socks = socks
+        self.ports = tuple(s.getsockname()[1] for s in socks)
+        self.addrs = [None, None]       # where each leg's packets come from / go to
+        self.latched = [False, False]
+        # payload conversion of packets arriving on each leg, and the
+        # payload type the other leg expects
+        self.convert = (pbx_transcode.converter(codecs[0], codecs[1]),
+                        pbx_transcode.converter(codecs[1], codecs[0]))
+        self.types = tuple(pbx_transcode.PAYLOAD_TYPES.get(c) for c in codecs)
+
+    def port_of(self, ext):
+        """Relay port that `ext` sends its media to (a trunk leg's is leg 1's)."""
+        return self.ports[self.exts.index(ext)] if ext in self.exts else self.ports[1]
+
+    def close(self):
+        for s in self.socks:
+            try:
+                _epoll.unregister(s.fileno())
+            except (OSError, ValueError):
+                pass
+            _fds.pop(s.fileno(), None)
+            s.close()
+
+
+def configure(bind_host, advertise_host, low, high, worker_id=0, workers=1):
+    """Enable relaying on ports low..high; workers split the pairs between them."""
+    global enabled, host, advertise
+    if low < 1 or high > 65535 or high - low < 1:
+        raise ValueError("media port range must hold at least one pair")
+    host = bind_host
+    advertise = advertise_host
+    _free.clear()
+    for n, port in enumerate(range(low - low % 2, high, 2)):
+        if port >= low and n % workers == worker_id:
+            _free.append(port)
+    enabled = True
+
+
+def bind_pair():
+    """Two UDP sockets on the next free port pair, skipping ports in use (None if none)."""
+    for _ in range(len(_free)):
+        with _lock:
+            if not _free:
+                return None
+            port = _free.popleft()
+        socks = []
+        try:
+            for p in (port, port + 1):
+                s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                socks.append(s)
+                s.bind((host, p))
+                s.setblocking(False)
+            return socks
+        except OSError:
+            for s in socks:
+                s.close()
+            # Taken by someone else; it goes to the back of the queue
+            with _lock:
+                _free.append(port)
+    return None
+
+
+def allocate(ext, peer, trunk=False, remote=None, codecs=(None, None)):
+    """Open a relay for an answered call, or None when media is off or out of ports.
+
+    Leg 0 serves `ext`.  Leg 1 serves `peer`, or with `trunk` faces the
+    other PBX, which advertised `remote` ((ip, port) or None) for its side.
+    `codecs` are what each leg sends and expects (None: whatever it gets).
+    """
+    if not enabled:
+        return None
+    relay = _relays.get(ext)
+    if relay is not None and relay.call == {ext, peer}:
+        return relay    # answered twice
+    socks = bind_pair()
+    if socks is None:
+        stats["exhausted"] += 1
+        return None
+    relay = Relay((ext,) if trunk else (ext, peer), frozenset((ext, peer)), socks, codecs)
+    if remote is not None:
+        relay.addrs[1] = remote
+    with _lock:
+        for ext_ in relay.exts:
+            _relays[ext_] = relay
+        for leg, s in enumerate(socks):
+            _fds[s.fileno()] = (relay, leg)
+            _epoll.register(s.fileno(), select.EPOLLIN)
+        stats["relays"] += 1
+    return relay
+
+
+def release(ext, peer=None):
+    """Close the relay of ext's call (with `peer`, when given) and free its ports."""
+    if not enabled:
+        return
+    with _lock:
+        relay = _relays.get(ext)
+        if relay is None or (peer is not None and peer not in relay.call):
+            return
+        for ext_ in relay.exts:
+            if _relays.get(ext_) is relay:
+                del _relays[ext_]
+        relay.close()
+        _free.append(relay.ports[0])
+
+
+def free_pair(port):
+    """Give back a pair taken with bind_pair() once its sockets are closed."""
+    with _lock:
+        _free.append(port)
+
+
+def active():
+    return len({id(r) for r in _relays.values()})
+
+
+def resolve(host_, port):
+    """(ip, port) for an advertised media address, or None if unusable."""
+    try:
+        return socket.gethostbyname(host_), int(port)
+    except (OSError, TypeError, ValueError, UnicodeError):
+        return None
+
+
+def _transcode(buf, n, convert, ptype):
+    """A converted copy of the RTP packet in buf[:n], or None if it is not one."""
+    first = buf[0]
+    start = 12 + 4 * (first & 0x0F)
+    if first & 0x10 and n >= start + 4:
+        start += 4 + 4 * (buf[start + 2] << 8 | buf[start + 3])
+    if first & 0x20 and n > start:
+        n -= buf[n - 1]     # padding
+    if first >> 6 != 2 or n <= start:
+        return None
+    try:
+        payload = convert(bytes(buf[start:n]))
+    except ValueError:
+        return None         # e.g. an odd number of L16 bytes
+    header = bytearray(buf[:start])
+    header[0] = first & ~0x20
+    header[1] = (header[1] & 0x80) | ptype
+    return header + payload
+
+
+def _run():
+    buf = bytearray(MAX_PACKET)
+    view = memoryview(buf)
+    fds = _fds
+    poll = _epoll.poll
+    while True:
+        packets = nbytes = dropped = transcoded = 0
+        for fd, _ in poll():
+            entry = fds.get(fd)
+            if entry is None:
+                continue    # closed since the poll returned
+            relay, leg = entry
+            sock = relay.socks[leg]
+            out = relay.socks[1 - leg]
+            addrs = relay.addrs
+            while True:
+                try:
+                    n, addr = sock.recvfrom_into(buf)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError:
+                    break   # socket closed under us
+                if not relay.latched[leg]:
+                    addrs[leg] = addr
+                    relay.latched[leg] = True
+                elif addr != addrs[leg]:
+                    dropped += 1
+                    continue
+                dest = addrs[1 - leg]
+                if dest is None:
+                    dropped += 1    # the other leg has not been heard from yet
+                    continue
+                convert = relay.convert[leg]
+                if convert is None:
+                    packet = view[:n]
+                else:
+                    packet = _transcode(buf, n, convert, relay.types[1 - leg])
+                    if packet is None:
+                        dropped += 1
+                        continue
+                    transcoded += 1
+                try:
+                    out.sendto(packet, dest)
+                except OSError:
+                    dropped += 1
+                    continue
+                packets += 1
+                nbytes += n
+        stats["packets"] += packets
+        stats["bytes"] += nbytes
+        stats["dropped"] += dropped
+        stats["transcoded"] += transcoded
+
+
+def start():
+    """Start the media thread (after forking workers)."""
+    global _epoll
+    if not enabled or _epoll is not None:
+        return
+    _epoll = select.epoll()
+    threading.Thread(target=_run, name="media", daemon=True).start()
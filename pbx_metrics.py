@@ -0,0 +1,236 @@
+"""Counters, gauges and latency histograms in Prometheus text format.
+
+Recording is a dict update (counters) or a bisect plus two additions
+(histograms) under one module lock, cheap enough to leave on; --no-metrics
+turns it off.  Gauges are computed only when the admin port is scraped, by
+callbacks the server registers, so they cost nothing in between.
+
+The admin port answers GET /metrics.  The thread engine serves it from an
+http.server thread, the asyncio engine from a handler on its own loop.
+"""
+
+import asyncio
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pbx_codec
+
+enabled = True
+
+# read -> end of dispatch, seconds
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+                   0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# message types that get their own label; anything else a peer sends is "other"
+KNOWN_TYPES = frozenset([mtype for _, mtype, _ in pbx_codec.MESSAGES]
+                        + ["trunk_hello", "trunk_hello_ok"])
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_lock = threading.Lock()
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names, values, extra=""):
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values = {}
+        _registry.append(self)
+
+    def inc(self, *labelvalues, n=1):
+        if not enabled:
+            return
+        # acquire/release rather than `with`: this is on every message's path
+        _lock.acquire()
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + n
+        _lock.release()
+
+    def render(self, out):
+        out.append(f"# HELP {self.name} {self.doc}")
+        out.append(f"# TYPE {self.name} counter")
+        with _lock:
+            items = sorted(self.values.items())
+        for values, n in items:
+            out.append(f"{self.name}{_labels(self.labels, values)} {n}")
+
+
+class Histogram:
+    """Cumulative histogram per value of a single label."""
+
+    def __init__(self, name, doc, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.label = label
+        self.buckets = buckets
+        self.series = {}    # label value -> [bucket counts..., +Inf count], sum
+        _registry.append(self)
+
+    def observe(self, labelvalue, value):
+        if not enabled:
+            return
+        i = bisect_left(self.buckets, value)
+        _lock.acquire()
+        s = self.series.get(labelvalue)
+        if s is None:
+            s = self.series[labelvalue] = [[0] * (len(self.buckets) + 1), 0.0]
+        s[0][i] += 1
+        s[1] += value
+        _lock.release()
+
+    def render(self, out):
+        out.append(f"# HELP {self.name} {self.doc}")
+        out.append(f"# TYPE {self.name} histogram")
+        with _lock:
+            items = sorted((k, list(c), total) for k, (c, total) in self.series.items())
+        names = (self.label,)
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = f'le="{_number(bound)}"'
+                out.append(f"{self.name}_bucket{_labels(names, (key,), le)} {cumulative}")
+            out.append(f"{self.name}_sum{_labels(names, (key,))} {total!r}")
+            out.append(f"{self.name}_count{_labels(names, (key,))} {cumulative}")
+
+
+class Callback:
+    """Gauge (or externally kept counter) read from fn() at scrape time.
+
+    fn returns a number, or a dict mapping label value tuples to numbers.
+    """
+
+    def __init__(self, name, doc, fn, labels=(), kind="gauge"):
+        self.name = name
+        self.doc = doc
+        self.fn = fn
+        self.labels = labels
+        self.kind = kind
+        _registry.append(self)
+
+    def render(self, out):
+        value = self.fn()
+        out.append(f"# HELP {self.name} {self.doc}")
+        out.append(f"# TYPE {self.name} {self.kind}")
+        if isinstance(value, dict):
+            for values, n in sorted(value.items()):
+                out.append(f"{self.name}{_labels(self.labels, values)} {_number(n)}")
+        else:
+            out.append(f"{self.name} {_number(value)}")
+
+
+# ============================================================
+#  PBX METRICS
+# ============================================================
+
+registrations = Counter("pbx_registrations_total", "Extension registrations.")
+resumes = Counter("pbx_resumes_total", "Registrations resumed from a snapshot, by result.",
+                  ("result",))
+calls = Counter("pbx_calls_total", "Calls set up, by kind (local, trunk_out, trunk_in).",
+                ("kind",))
+trunk_calls = Counter("pbx_trunk_calls_total", "Trunk calls set up, by trunk and direction.",
+                      ("trunk", "direction"))
+timeouts = Counter("pbx_timeouts_total",
+                   "Calls given up unanswered (no_answer) and endpoints dropped as idle (idle).",
+                   ("kind",))
+errors = Counter("pbx_errors_total", "Error and busy replies sent to endpoints, by reason.",
+                 ("reason",))
+messages = Histogram("pbx_message_dispatch_seconds",
+                     "Time from socket read to the end of handler dispatch, by message type.",
+                     "type")
+
+
+def observe_dispatch(mtype, seconds):
+    messages.observe(mtype if mtype in KNOWN_TYPES else "other", seconds)
+
+
+def gauge(name, doc, fn, labels=()):
+    return Callback(name, doc, fn, labels)
+
+
+def counter_callback(name, doc, fn, labels=()):
+    return Callback(name, doc, fn, labels, kind="counter")
+
+
+def render():
+    out = []
+    for metric in _registry:
+        metric.render(out)
+    out.append("")
+    return "\n".join(out).encode("utf-8")
+
+
+# ============================================================
+#  ADMIN PORT
+# ============================================================
+
+def _response(path):
+    if path.split("?", 1)[0] == "/metrics":
+        return 200, CONTENT_TYPE, render()
+    return 404, "text/plain; charset=utf-8", b"not found\n"
+
+
+class _AdminHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        status, ctype, body = _response(self.path)
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def start_admin_thread(host, port):
+    """Serve /metrics from a daemon thread (thread engine)."""
+    srv = ThreadingHTTPServer((host, port), _AdminHandler)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+
+async def _handle_admin(reader, writer):
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)
+        method, path, _ = head.split(b"\r\n", 1)[0].decode("latin-1").split(" ", 2)
+        if method != "GET":
+            status, ctype, body = 405, "text/plain; charset=utf-8", b"method not allowed\n"
+        else:
+            status, ctype, body = _response(path)
+        reason = {200: "OK", 404: "Not Found", 405: "Method Not Allowed"}[status]
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\nContent-Type: {ctype}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+            ValueError, OSError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_admin_async(host, port):
+    """Serve /metrics on the running event loop (asyncio engine)."""
+    return await asyncio.start_server(_handle_admin, host, port, reuse_address=True)
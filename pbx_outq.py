@@ -0,0 +1,399 @@
+"""Bounded per-connection outbound queues.
+
+Handlers never write to a socket directly: send_json() hands the encoded
+bytes to the connection's queue and returns immediately.  Each queue has a
+high and a low watermark (in bytes).  When a peer stops reading and its
+backlog crosses the high watermark, the configured policy applies:
+
+    drop        new messages are discarded until the backlog falls back
+                under the low watermark
+    disconnect  the connection is aborted (slow-consumer eviction)
+
+The thread engine drains every OutboundQueue with its own writer thread;
+the asyncio engine gets the same behaviour from AsyncOutbound on top of the
+transport's write buffer.
+
+Kinds with a batch window (trunks) coalesce messages: whatever is produced
+within `window` seconds of the first pending message, or until `batch_bytes`
+accumulate, goes out in a single write.  A window of 0 still merges all
+messages that are already queued when the writer gets to run.
+"""
+
+import asyncio
+import socket
+import threading
+import time
+import weakref
+from collections import deque
+
+import pbx_codec
+
+POLICIES = ("drop", "disconnect")
+
+# Per-kind settings, overridden from the command line via configure().
+# window=None disables coalescing (each message is written as it comes).
+_settings = {
+    "client": {"high": 256 * 1024, "low": 64 * 1024, "policy": "disconnect",
+               "window": None, "batch_bytes": 64 * 1024},
+    "trunk": {"high": 4 * 1024 * 1024, "low": 1024 * 1024, "policy": "drop",
+              "window": 0.0, "batch_bytes": 64 * 1024},
+}
+
+_queues = weakref.WeakSet()
+_stats_lock = threading.Lock()
+_counters = {
+    "dropped_msgs": 0,
+    "dropped_bytes": 0,
+    "evictions": 0,
+}
+
+# upper bounds of the messages-per-batch and flush-latency (seconds) buckets
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+FLUSH_LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.05)
+
+
+class BatchStats:
+    """Per-kind counters for coalesced writes."""
+
+    def __init__(self):
+        self.batches = 0
+        self.messages = 0
+        self.bytes = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.size_hist = [0] * (len(BATCH_SIZE_BUCKETS) + 1)
+        self.latency_hist = [0] * (len(FLUSH_LATENCY_BUCKETS) + 1)
+
+    def record(self, messages, nbytes, latency):
+        with _stats_lock:
+            self.batches += 1
+            self.messages += messages
+            self.bytes += nbytes
+            self.latency_sum += latency
+            if latency > self.latency_max:
+                self.latency_max = latency
+            self.size_hist[_bucket(BATCH_SIZE_BUCKETS, messages)] += 1
+            self.latency_hist[_bucket(FLUSH_LATENCY_BUCKETS, latency)] += 1
+
+    def snapshot(self):
+        with _stats_lock:
+            n = self.batches or 1
+            return {
+                "batches": self.batches,
+                "messages": self.messages,
+                "bytes": self.bytes,
+                "avg_messages": self.messages / n,
+                "avg_bytes": self.bytes / n,
+                "avg_flush_latency": self.latency_sum / n,
+                "max_flush_latency": self.latency_max,
+                "size_hist": list(zip(BATCH_SIZE_BUCKETS + (float("inf"),), self.size_hist)),
+                "latency_hist": list(zip(FLUSH_LATENCY_BUCKETS + (float("inf"),),
+                                         self.latency_hist)),
+            }
+
+
+def _bucket(bounds, value):
+    for i, bound in enumerate(bounds):
+        if value <= bound:
+            return i
+    return len(bounds)
+
+
+_batch_stats = {kind: BatchStats() for kind in _settings}
+
+
+def configure(kind, high, low, policy, window=None, batch_bytes=64 * 1024):
+    if policy not in POLICIES:
+        raise ValueError(f"unknown policy {policy!r}")
+    if not 0 <= low <= high:
+        raise ValueError("need 0 <= low watermark <= high watermark")
+    if window is not None and window < 0:
+        raise ValueError("batch window must not be negative")
+    _settings[kind] = {"high": high, "low": low, "policy": policy,
+                       "window": window, "batch_bytes": batch_bytes}
+    _batch_stats.setdefault(kind, BatchStats())
+
+
+def batch_stats(kind="trunk"):
+    """Batch size and flush latency figures for one kind of connection."""
+    return _batch_stats[kind].snapshot()
+
+
+def _count(key, n=1):
+    with _stats_lock:
+        _counters[key] += n
+
+
+def stats(kind=None):
+    """Aggregate counters over every live queue (of one kind, if given).
+
+    The drop and eviction counters are always process-wide.
+    """
+    queues = [q for q in list(_queues) if kind is None or q.kind == kind]
+    sizes = [q.queued_bytes for q in queues]
+    with _stats_lock:
+        out = dict(_counters)
+    out["connections"] = len(queues)
+    out["queued_bytes"] = sum(sizes)
+    out["max_queued_bytes"] = max(sizes, default=0)
+    out["throttled"] = sum(1 for q in queues if q.throttled)
+    return out
+
+
+class OutboundQueue:
+    """Outbound queue of one socket, drained by a dedicated writer thread."""
+
+    def __init__(self, sock, kind="client"):
+        self.sock = sock
+        self.kind = kind
+        self.codec = pbx_codec.JSON    # framing send_json encodes with; switched on negotiation
+        cfg = _settings[kind]
+        self.high, self.low, self.policy = cfg["high"], cfg["low"], cfg["policy"]
+        self.window = cfg["window"] or 0.0
+        self.batch_bytes = cfg["batch_bytes"]
+        self.stats = _batch_stats[kind] if cfg["window"] is not None else None
+        self.queued_bytes = 0          # queued + being written
+        self.throttled = False
+        self.closed = False
+        self._items = deque()
+        self._pending_bytes = 0        # queued, not yet picked up by the writer
+        self._first_ts = 0.0           # when the oldest pending message was queued
+        self._cond = threading.Condition(threading.Lock())
+        try:
+            # Writes are already whole messages or batches; Nagle only adds delay
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+        _queues.add(self)
+        threading.Thread(target=self._writer, daemon=True).start()
+
+    def send(self, data):
+        """Queue bytes for sending; returns False if they were dropped."""
+        evict = False
+        with self._cond:
+            if self.closed:
+                return False
+            if self.throttled:
+                if self.queued_bytes > self.low:
+                    _count("dropped_msgs")
+                    _count("dropped_bytes", len(data))
+                    return False
+                self.throttled = False
+            if self.queued_bytes + len(data) > self.high:
+                if self.policy == "disconnect":
+                    evict = True
+                else:
+                    self.throttled = True
+                    _count("dropped_msgs")
+                    _count("dropped_bytes", len(data))
+                    return False
+            else:
+                items = self._items
+                items.append(data)
+                self.queued_bytes += len(data)
+                self._pending_bytes += len(data)
+                if len(items) == 1:
+                    self._first_ts = time.monotonic()
+                    self._cond.notify()
+                elif self._pending_bytes >= self.batch_bytes:
+                    self._cond.notify()
+        if evict:
+            _count("evictions")
+            self.abort()
+            return False
+        return True
+
+    def _writer(self):
+        sock = self.sock
+        cond = self._cond
+        while True:
+            with cond:
+                while not self._items and not self.closed:
+                    cond.wait()
+                if self.window:
+                    # Let producers add to this batch until the window closes
+                    deadline = self._first_ts + self.window
+                    while self._pending_bytes < self.batch_bytes and not self.closed:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        cond.wait(remaining)
+                if not self._items:
+                    break
+                # Everything queued so far goes out in one write, up to batch_bytes
+                items = self._items
+                if self._pending_bytes <= self.batch_bytes:
+                    batch = list(items)
+                    items.clear()
+                else:
+                    batch = []
+                    size = 0
+                    while items and size < self.batch_bytes:
+                        size += len(items[0])
+                        batch.append(items.popleft())
+                count = len(batch)
+                chunk = b"".join(batch)
+                self._pending_bytes -= len(chunk)
+                first_ts = self._first_ts
+                if items:
+                    self._first_ts = time.monotonic()
+            try:
+                sock.sendall(chunk)
+            except OSError:
+                self.abort()
+                break
+            if self.stats is not None:
+                self.stats.record(count, len(chunk), time.monotonic() - first_ts)
+            with cond:
+                self.queued_bytes -= len(chunk)
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        """Flush what is queued (bounded by a timeout), then close the socket."""
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            self._cond.notify()
+        try:
+            self.sock.settimeout(5)
+        except OSError:
+            pass
+
+    def detach(self):
+        """Close our descriptor only, for a socket another process now owns.
+
+        No shutdown() and no settimeout(): both act on the shared socket.
+        """
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+    def abort(self):
+        """Drop anything queued and tear the socket down right away.
+
+        shutdown() also wakes a reader blocked in recv() on the same socket,
+        so the owning session cleans up as if the peer had disconnected.  It
+        comes first: once closed is set, the writer thread may close the
+        socket, and a close() does not wake that reader.
+        """
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        with self._cond:
+            self.closed = True
+            self._items.clear()
+            self.queued_bytes = 0
+            self._pending_bytes = 0
+            self._cond.notify()
+
+
+class AsyncOutbound:
+    """OutboundQueue semantics on top of an asyncio transport.
+
+    The transport already buffers whatever the kernel does not take; we let
+    it signal the watermarks through pause_writing()/resume_writing() on the
+    protocol, which forwards them here.  Coalescing kinds collect messages in
+    a pending list flushed by a loop callback (call_soon for a zero window).
+    """
+
+    def __init__(self, transport, kind="client"):
+        self.transport = transport
+        self.kind = kind
+        self.codec = pbx_codec.JSON    # framing send_json encodes with; switched on negotiation
+        cfg = _settings[kind]
+        self.high, self.low, self.policy = cfg["high"], cfg["low"], cfg["policy"]
+        self.window = cfg["window"]
+        self.batch_bytes = cfg["batch_bytes"]
+        self.stats = _batch_stats[kind] if self.window is not None else None
+        self.throttled = False
+        self._pending = []
+        self._pending_bytes = 0
+        self._first_ts = 0.0
+        self._flush_handle = None
+        self._loop = asyncio.get_running_loop()
+        transport.set_write_buffer_limits(high=self.high, low=self.low)
+        _queues.add(self)
+
+    @property
+    def queued_bytes(self):
+        return self.transport.get_write_buffer_size() + self._pending_bytes
+
+    @property
+    def closed(self):
+        return self.transport.is_closing()
+
+    def send(self, data):
+        if self.transport.is_closing():
+            return False
+        if self.throttled:
+            _count("dropped_msgs")
+            _count("dropped_bytes", len(data))
+            return False
+        if self.window is None:
+            self.transport.write(data)
+            return True
+
+        pending = self._pending
+        pending.append(data)
+        self._pending_bytes += len(data)
+        if len(pending) == 1:
+            self._first_ts = time.monotonic()
+            if self.window:
+                self._flush_handle = self._loop.call_later(self.window, self.flush)
+            else:
+                self._flush_handle = self._loop.call_soon(self.flush)
+        elif self._pending_bytes >= self.batch_bytes:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Write every pending message in one transport.write()."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending = self._pending
+        if not pending:
+            return
+        chunk = b"".join(pending)
+        count = len(pending)
+        self._pending = []
+        self._pending_bytes = 0
+        if not self.transport.is_closing():
+            self.transport.write(chunk)
+            self.stats.record(count, len(chunk), time.monotonic() - self._first_ts)
+
+    def fileno(self):
+        return self.transport.get_extra_info("socket").fileno()
+
+    def pause_writing(self):
+        if self.policy == "disconnect":
+            _count("evictions")
+            self.abort()
+        else:
+            self.throttled = True
+
+    def resume_writing(self):
+        self.throttled = False
+
+    def close(self):
+        self.flush()
+        self.transport.close()
+
+    def detach(self):
+        self.transport.close()
+
+    def abort(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._pending = []
+        self._pending_bytes = 0
+        self.transport.abort()
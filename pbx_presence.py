@@ -0,0 +1,247 @@
+"""Presence (BLF): endpoints watch the state of other extensions.
+
+A subscriber names extensions and/or prefixes to watch.  Both go into
+reverse indexes - watched extension -> subscribers, watched prefix ->
+subscribers, with the distinct prefix lengths kept apart as in
+pbx_routing - so a state change only visits the subscribers that watch
+that extension: one dict probe for the extension and one per prefix
+length in use, then O(watchers).
+
+Changes are not sent straight away.  Each subscriber collects the
+extensions that changed since its last notification in a set, and a
+flush every `interval` sends one presence message per subscriber with
+the state each of them is in at flush time.  An extension that changes
+three times within an interval costs its watchers one entry, and a
+subscriber that sees a hundred changes gets one message.
+
+Extensions of another PBX (or worker) are watched by subscribing over the
+trunk: that side then counts the trunk as one more subscriber and sends
+its states back in trunk_presence, which are cached here and fanned out
+to the local watchers like local changes.
+
+The server supplies where notifications go and what state an extension
+of ours is in (configure()); subscribers are keyed (ENDPOINT, ext) or
+(TRUNK, trunk name).
+"""
+
+import threading
+
+OFFLINE = "offline"     # not registered (the call table's own states otherwise)
+
+# subscriber kinds
+ENDPOINT = "ext"
+TRUNK = "trunk"
+
+interval = 0.05
+max_watch = 10_000      # extensions + prefixes one endpoint may watch
+
+_subs = {}              # subscriber -> (set of extensions, set of prefixes)
+_watchers = {}          # watched extension -> set of subscribers
+_prefixes = {}          # watched prefix -> set of subscribers
+_lengths = ()           # distinct lengths in _prefixes
+_pending = {}           # subscriber -> set of extensions changed since its last notification
+_remote = {}            # extension of another PBX/worker -> last state it reported
+_lock = threading.Lock()
+_deliver = None
+_state_of = None
+_writer = None
+
+stats = {"changes": 0, "notifications": 0, "states": 0}
+
+
+def configure(deliver, state_of, interval_ms=50.0, max_watched=10_000):
+    """Set deliver(subscriber, {ext: state}), state_of(ext) for our own extensions and limits."""
+    global _deliver, _state_of, interval, max_watch
+    if interval_ms <= 0 or max_watched < 1:
+        raise ValueError("the interval and the watch limit must be positive")
+    _deliver = deliver
+    _state_of = state_of
+    interval = interval_ms / 1000
+    max_watch = max_watched
+
+
+def _mark(sub, ext):
+    pending = _pending.get(sub)
+    if pending is None:
+        pending = _pending[sub] = set()
+    pending.add(ext)
+
+
+def _fan_out(ext, endpoints_only=False):
+    """Mark ext changed for everyone watching it (under _lock)."""
+    groups = [_watchers.get(ext)]
+    for n in _lengths:
+        groups.append(_prefixes.get(ext[:n]))
+    pending = _pending
+    for subs in groups:
+        if not subs:
+            continue
+        # _mark() inlined: this loop is the whole cost of a change
+        for sub in subs:
+            if endpoints_only and sub[0] != ENDPOINT:
+                continue
+            changed_ = pending.get(sub)
+            if changed_ is None:
+                pending[sub] = {ext}
+            else:
+                changed_.add(ext)
+
+
+def changed(ext):
+    """The call table's listener: ext changed state (or registered / went away)."""
+    if not _watchers and not _prefixes:
+        return
+    with _lock:
+        stats["changes"] += 1
+        _fan_out(ext)
+
+
+def update(states):
+    """States reported over a trunk; only endpoints here hear about them."""
+    with _lock:
+        for ext, state in states.items():
+            if state == OFFLINE:
+                _remote.pop(ext, None)
+            else:
+                _remote[ext] = state
+            stats["changes"] += 1
+            _fan_out(ext, endpoints_only=True)
+
+
+# ============================================================
+#  SUBSCRIPTIONS
+# ============================================================
+
+def _index_lengths():
+    global _lengths
+    _lengths = tuple(sorted({len(p) for p in _prefixes}))
+
+
+def subscribe(sub, exts=(), prefixes=(), current=(), limit=None):
+    """Add extensions and prefixes to what `sub` watches.
+
+    `current` are extensions whose state the subscriber should get in the
+    next notification even though they did not change (what it just
+    started watching, where it is known).  False, and nothing changes, when
+    the subscriber would watch more than `limit` extensions and prefixes.
+    """
+    with _lock:
+        watched, watched_prefixes = _subs.get(sub) or (set(), set())
+        exts = set(exts) - watched
+        prefixes = set(prefixes) - watched_prefixes
+        if limit is not None and (len(watched) + len(watched_prefixes)
+                                  + len(exts) + len(prefixes)) > limit:
+            return False
+        _subs[sub] = (watched | exts, watched_prefixes | prefixes)
+        for ext in exts:
+            _watchers.setdefault(ext, set()).add(sub)
+        for prefix in prefixes:
+            _prefixes.setdefault(prefix, set()).add(sub)
+        if prefixes:
+            _index_lengths()
+        for ext in current:
+            _mark(sub, ext)
+    return True
+
+
+def _drop(index, key, sub):
+    subs = index.get(key)
+    if subs is not None:
+        subs.discard(sub)
+        if not subs:
+            del index[key]
+
+
+def unsubscribe(sub, exts=None, prefixes=None):
+    """Stop watching the given extensions and prefixes (everything when neither is given)."""
+    with _lock:
+        entry = _subs.get(sub)
+        if entry is None:
+            return
+        watched, watched_prefixes = entry
+        if exts is None and prefixes is None:
+            exts, prefixes = watched, watched_prefixes
+            _pending.pop(sub, None)
+        exts = set(exts or ()) & watched
+        prefixes = set(prefixes or ()) & watched_prefixes
+        for ext in exts:
+            _drop(_watchers, ext, sub)
+        for prefix in prefixes:
+            _drop(_prefixes, prefix, sub)
+        if prefixes:
+            _index_lengths()
+        watched = watched - exts
+        watched_prefixes = watched_prefixes - prefixes
+        if watched or watched_prefixes:
+            _subs[sub] = (watched, watched_prefixes)
+        else:
+            del _subs[sub]
+
+
+def watched(sub):
+    """(extensions, prefixes) that `sub` watches."""
+    with _lock:
+        exts, prefixes = _subs.get(sub) or ((), ())
+        return list(exts), list(prefixes)
+
+
+def known(ext):
+    """Last state an extension of another PBX reported, or None."""
+    return _remote.get(ext)
+
+
+def known_under(prefixes):
+    """Extensions of other PBXs with a known state that start with one of the prefixes."""
+    prefixes = tuple(prefixes)
+    with _lock:
+        return [ext for ext in _remote if ext.startswith(prefixes)]
+
+
+def subscribers():
+    return len(_subs)
+
+
+# ============================================================
+#  NOTIFICATIONS
+# ============================================================
+
+def flush():
+    """Send every subscriber with pending changes one message; returns how many were sent."""
+    global _pending
+    with _lock:
+        if not _pending:
+            return 0
+        pending, _pending = _pending, {}
+    remote = _remote
+    state_of = _state_of
+    states_now = {}
+    count = 0
+    for sub, exts in pending.items():
+        states = {}
+        for ext in exts:
+            state = states_now.get(ext)
+            if state is None:
+                state = states_now[ext] = remote.get(ext) or state_of(ext)
+            states[ext] = state
+        _deliver(sub, states)
+        count += len(states)
+    stats["notifications"] += len(pending)
+    stats["states"] += count
+    return len(pending)
+
+
+def _run(stop, interval_):
+    while not stop.wait(interval_):
+        flush()
+
+
+def start():
+    """Start the flush thread (thread engine; the asyncio engine flushes on its loop)."""
+    global _writer
+    if _writer is not None:
+        return
+    stop_event = threading.Event()
+    thread = threading.Thread(target=_run, args=(stop_event, interval),
+                              name="presence", daemon=True)
+    _writer = (thread, stop_event)
+    thread.start()
@@ -0,0 +1,292 @@
+"""Call-state reconciliation between two PBXs after their trunk comes back.
+
+Each call across a trunk has a leg on both PBXs.  An outage (or a restart
+on the other side) can leave a leg here whose other half is gone there,
+stuck in a call nobody is on.  When our outbound link of a trunk is
+greeted, the two sides compare the calls they have over that trunk and
+each hangs up its legs the other one does not have.
+
+Comparing must not mean exchanging the tables.  Every call is a pair
+(extension on one PBX, extension on the other), written in the same order
+on both sides (the extension of the PBX whose node name sorts first goes
+first) and hashed into one of LEAVES leaves of a two-level tree: GROUPS
+groups of LEAVES // GROUPS leaves.  A leaf's hash is the XOR of the
+hashes of its pairs and a group's the XOR of its leaves, so the call
+table keeps them current in O(1) per call (add()/discard()), and equal
+sets of calls have equal hashes.  A round goes:
+
+  trunk_sync         initiator -> responder: the GROUPS group hashes
+  trunk_sync_leaves  responder -> initiator: the leaf hashes of the groups
+                     that differ (trunk_sync_done when none does)
+  trunk_sync_pairs   step 1, initiator: its pairs in the leaves that differ
+                     step 2, responder: its pairs in the same leaves
+                     step 3, initiator: its pairs there again, after its
+                     own clean-up
+
+so what travels grows with the number of differences, not of calls.
+
+A leg is an orphan when it was in the pairs its side sent and is missing
+from the other side's answer to them.  The answer is written after the
+other side has handled everything we sent before our list (each direction
+of a trunk is one ordered stream), so a call we set up is in it unless the
+other side lost or ended it - and an end it sent us arrives before its
+answer, so our leg is gone by then.  A call that only appeared meanwhile
+was not in our list and is left alone.  Orphans are hung up with the
+synthetic hangup the server supplies, as if the other side had sent it.
+
+Worker mode is left out: there each worker holds part of the calls and
+the hub alone talks to the other PBX, so neither would see a whole table.
+"""
+
+import hashlib
+import itertools
+import threading
+
+import pbx_log
+import pbx_timers
+
+GROUPS = 64
+LEAVES = 4096           # GROUPS groups of 64 leaves
+ROUND_TIMEOUT = 30.0    # seconds a round's state is kept waiting for the other side
+
+_PER_GROUP = LEAVES // GROUPS
+
+TYPES = ("trunk_sync", "trunk_sync_leaves", "trunk_sync_pairs", "trunk_sync_done")
+
+enabled = False
+node = None
+_send = None            # send(trunk, message) on the trunk to the other PBX
+_hangup = None          # hangup(local ext, remote ext) of an orphaned leg
+
+_trunks = {}            # trunk -> Digest
+_lock = threading.Lock()
+_rounds = {}            # (trunk, round id, role) -> state of an unfinished round
+_ids = itertools.count(1)
+
+stats = {"rounds": 0, "clean": 0, "pairs_sent": 0, "orphans": 0}
+
+
+def configure(node_name, send, hangup):
+    """Turn reconciliation on for this PBX (not in worker mode)."""
+    global enabled, node, _send, _hangup
+    node = node_name
+    _send = send
+    _hangup = hangup
+    enabled = True
+
+
+def pair_hash(a, b):
+    return int.from_bytes(hashlib.blake2b(f"{a}\0{b}".encode(), digest_size=8).digest(), "big")
+
+
+class Digest:
+    """The calls over one trunk as a hash tree; mutated under the module lock."""
+
+    __slots__ = ("local_first", "leaves", "pairs")
+
+    def __init__(self, trunk):
+        self.local_first = node < trunk     # pair order shared with the other side
+        self.leaves = [0] * LEAVES
+        self.pairs = {}                     # leaf -> set of pairs
+
+    def toggle(self, pair, h, add):
+        leaf = h & (LEAVES - 1)
+        bucket = self.pairs.get(leaf)
+        if add:
+            if bucket is None:
+                bucket = self.pairs[leaf] = set()
+            elif pair in bucket:
+                return
+            bucket.add(pair)
+        else:
+            if bucket is None or pair not in bucket:
+                return
+            bucket.remove(pair)
+            if not bucket:
+                del self.pairs[leaf]
+        self.leaves[leaf] ^= h
+
+    def groups(self):
+        out = []
+        leaves = self.leaves
+        for g in range(GROUPS):
+            x = 0
+            for h in leaves[g * _PER_GROUP:(g + 1) * _PER_GROUP]:
+                x ^= h
+            out.append(x)
+        return out
+
+    def group_leaves(self, g):
+        return self.leaves[g * _PER_GROUP:(g + 1) * _PER_GROUP]
+
+    def listed(self, leaves):
+        return [list(p) for leaf in leaves for p in self.pairs.get(leaf, ())]
+
+
+def _digest(trunk):
+    # under _lock
+    digest = _trunks.get(trunk)
+    if digest is None:
+        digest = _trunks[trunk] = Digest(trunk)
+    return digest
+
+
+# ============================================================
+#  CALL TABLE HOOKS
+# ============================================================
+
+def add(trunk, local, remote):
+    """A local leg entered a call with `remote` over `trunk` (CallTable.index)."""
+    pair = (local, remote) if node < trunk else (remote, local)
+    h = pair_hash(*pair)
+    _lock.acquire()
+    try:
+        _digest(trunk).toggle(pair, h, True)
+    finally:
+        _lock.release()
+
+
+def discard(trunk, local, remote):
+    pair = (local, remote) if node < trunk else (remote, local)
+    h = pair_hash(*pair)
+    _lock.acquire()
+    try:
+        digest = _trunks.get(trunk)
+        if digest is not None:
+            digest.toggle(pair, h, False)
+    finally:
+        _lock.release()
+
+
+def calls(trunk):
+    """Calls over `trunk` the digest holds."""
+    with _lock:
+        digest = _trunks.get(trunk)
+        return sum(len(b) for b in digest.pairs.values()) if digest else 0
+
+
+# ============================================================
+#  ROUNDS
+# ============================================================
+
+def start(trunk):
+    """Begin a round over `trunk` (our outbound link to it has just been greeted)."""
+    if not enabled:
+        return
+    rid = next(_ids)
+    with _lock:
+        groups = _digest(trunk).groups()
+    stats["rounds"] += 1
+    _keep((trunk, rid, "initiator"), {})
+    _send(trunk, {"type": "trunk_sync", "round": rid, "groups": groups})
+
+
+def _keep(key, state):
+    with _lock:
+        _rounds[key] = state
+    pbx_timers.schedule(ROUND_TIMEOUT, _expire, key, state)
+
+
+def _expire(key, state):
+    # Keys come back (round ids restart with the other side), so a timer
+    # drops only the state it was set for, never a newer round's
+    with _lock:
+        if _rounds.get(key) is state:
+            del _rounds[key]
+
+
+def handle(msg, trunk):
+    """A trunk_sync* message from the PBX on the other end of `trunk`."""
+    if not enabled:
+        return
+    mtype = msg.get("type")
+    rid = msg.get("round")
+    try:
+        if mtype == "trunk_sync":
+            _on_sync(trunk, rid, msg["groups"])
+        elif mtype == "trunk_sync_leaves":
+            _on_leaves(trunk, rid, msg["leaves"])
+        elif mtype == "trunk_sync_done":
+            if _rounds.pop((trunk, rid, "initiator"), None) is not None:
+                stats["clean"] += 1
+        elif mtype == "trunk_sync_pairs":
+            _on_pairs(trunk, rid, msg.get("step"), msg["leaves"], msg["pairs"])
+    except (KeyError, TypeError, ValueError, IndexError) as e:
+        pbx_log.warning("sync_invalid", "Άκυρο {type} από TRUNK {trunk}: {error}",
+                        type=mtype, trunk=trunk, error=e)
+
+
+def _on_sync(trunk, rid, theirs):
+    # responder: which groups differ
+    with _lock:
+        digest = _digest(trunk)
+        ours = digest.groups()
+        differ = [[g, digest.group_leaves(g)] for g in range(GROUPS) if ours[g] != theirs[g]]
+    if not differ:
+        _send(trunk, {"type": "trunk_sync_done", "round": rid})
+        return
+    _send(trunk, {"type": "trunk_sync_leaves", "round": rid, "leaves": differ})
+
+
+def _on_leaves(trunk, rid, groups):
+    # initiator: which leaves differ; list ours there (step 1)
+    key = (trunk, rid, "initiator")
+    state = _rounds.get(key)
+    if state is None:
+        return
+    with _lock:
+        digest = _digest(trunk)
+        leaves = []
+        for g, theirs in groups:
+            ours = digest.group_leaves(g)
+            leaves += [g * _PER_GROUP + i for i in range(_PER_GROUP) if ours[i] != theirs[i]]
+        pairs = digest.listed(leaves)
+    if not leaves:
+        # changed back meanwhile
+        _rounds.pop(key, None)
+        stats["clean"] += 1
+        _send(trunk, {"type": "trunk_sync_done", "round": rid})
+        return
+    state["leaves"], state["pairs"] = leaves, pairs
+    _send_pairs(trunk, rid, 1, leaves, pairs)
+
+
+def _on_pairs(trunk, rid, step, leaves, theirs):
+    if step == 1:
+        # responder: our pairs in the same leaves, kept to judge step 3 by
+        with _lock:
+            pairs = _digest(trunk).listed(leaves)
+        _keep((trunk, rid, "responder"), {"pairs": pairs})
+        _send_pairs(trunk, rid, 2, leaves, pairs)
+        return
+    role = "initiator" if step == 2 else "responder"
+    state = _rounds.pop((trunk, rid, role), None)
+    if state is None:
+        return
+    _orphans(trunk, state["pairs"], theirs)
+    if step == 2:
+        with _lock:
+            pairs = _digest(trunk).listed(leaves)
+        _send_pairs(trunk, rid, 3, leaves, pairs)
+
+
+def _send_pairs(trunk, rid, step, leaves, pairs):
+    stats["pairs_sent"] += len(pairs)
+    _send(trunk, {"type": "trunk_sync_pairs", "round": rid, "step": step,
+                  "leaves": leaves, "pairs": pairs})
+
+
+def _orphans(trunk, ours, theirs):
+    """Hang up our legs of the pairs we listed that the other side did not."""
+    have = {tuple(p) for p in theirs}
+    with _lock:
+        local_first = _digest(trunk).local_first
+    gone = [tuple(p) for p in ours if tuple(p) not in have]
+    for a, b in gone:
+        local, remote = (a, b) if local_first else (b, a)
+        _hangup(local, remote)
+    if gone:
+        stats["orphans"] += len(gone)
+        pbx_log.warning("sync_orphans",
+                        "TRUNK {trunk}: {count} κλήσεις που δεν υπάρχουν στην άλλη πλευρά, "
+                        "τερματίστηκαν", trunk=trunk, count=len(gone))
@@ -0,0 +1,97 @@
+"""Longest-prefix routing of dialled numbers to named trunks.
+
+Routes file format (one entry per line, `#` starts a comment):
+
+    trunk <name> <host> <port>      outbound trunk link to another PBX
+    route <prefix> <trunk-name>     numbers starting with prefix go to that trunk
+
+The longest matching prefix wins, so `route 7 B` and `route 71 C` send 7123
+to C and 7234 to B.
+"""
+
+import threading
+
+
+class RouteTable:
+    """Prefix -> trunk index with a lookup cache.
+
+    Prefixes are kept in one dict and the distinct prefix lengths in
+    descending order, so a lookup probes at most one slice per length that
+    actually occurs - O(length of the number) like a trie, without a node
+    object per digit (100k prefixes stay a few MB).
+    """
+
+    def __init__(self, cache_size=65536):
+        # (prefix -> trunk, descending lengths), swapped as one object so a
+        # concurrent lookup never mixes an old dict with new lengths
+        self._index = ({}, ())
+        self._cache = {}
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._index[0])
+
+    def add(self, prefix, trunk):
+        with self._lock:
+            prefixes = dict(self._index[0])
+            prefixes[prefix] = trunk
+            self._compile(prefixes)
+
+    def replace(self, prefixes):
+        """Swap in a whole new prefix -> trunk mapping."""
+        with self._lock:
+            self._compile(dict(prefixes))
+
+    def _compile(self, prefixes):
+        lengths = tuple(sorted({len(p) for p in prefixes}, reverse=True))
+        self._index = (prefixes, lengths)
+        self._cache = {}
+
+    def lookup(self, number):
+        """Trunk name for the longest prefix of number, or None."""
+        cache = self._cache
+        hit = cache.get(number, cache)
+        if hit is not cache:
+            return hit
+
+        prefixes, lengths = self._index
+        trunk = None
+        n = len(number)
+        for length in lengths:
+            if length <= n:
+                trunk = prefixes.get(number[:length])
+                if trunk is not None:
+                    break
+
+        if len(cache) >= self.cache_size:
+            # Cheap bounded cache: start over rather than track recency
+            cache.clear()
+        cache[number] = trunk
+        return trunk
+
+    def items(self):
+        return self._index[0].items()
+
+
+def load_routes(path):
+    """Parse a routes file into ({trunk: (host, port)}, {prefix: trunk})."""
+    trunks = {}
+    prefixes = {}
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            kind = fields[0]
+            if kind == "trunk" and len(fields) == 4:
+                trunks[fields[1]] = (fields[2], int(fields[3]))
+            elif kind == "route" and len(fields) == 3:
+                prefixes[fields[1]] = fields[2]
+            else:
+                raise ValueError(f"{path}:{lineno}: cannot parse {line.strip()!r}")
+
+    for prefix, trunk in prefixes.items():
+        if trunk not in trunks:
+            raise ValueError(f"{path}: route {prefix} uses unknown trunk {trunk!r}")
+    return trunks, prefixes
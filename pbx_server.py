@@ -1,216 +1,390 @@
+import abc
+import atexit
+import os
+import signal
 import socket
+import sqlite3
+import sys
 import threading
-import json
 import argparse
 import time
 
-# extension -> {conn, addr, state, peer, remote}
-clients = {}
-lock = threading.Lock()
+import pbx_acd
+import pbx_admission
+import pbx_calltable
+import pbx_cdr
+import pbx_codec
+import pbx_conference
+import pbx_dialplan
+import pbx_ivr
+import pbx_log
+import pbx_media
+import pbx_metrics
+import pbx_outq
+import pbx_presence
+import pbx_reconcile
+import pbx_snapshot
+import pbx_spool
+import pbx_timers
+import pbx_transcode
+import pbx_workers
+from pbx_calltable import CallTable
+from pbx_codec import Frame, FrameReader, Template
+from pbx_outq import OutboundQueue
+from pbx_routing import RouteTable, load_routes
+
+# extension -> Extension(conn, addr, state, peer, remote), sharded locking
+clients = CallTable()
+
+# trunk links: name -> outbound queue we use to SEND trunk messages (None while down)
+trunk_outbound = {}
+trunk_outbound_lock = threading.Lock()
 
-# extensions currently in an IVR session
-ivr_sessions = set()
+# real trunk name -> pbx_spool.Spool of what it has not acknowledged (--trunk-spool)
+spools = {}
 
-# trunk sockets
-trunk_outbound = None      # socket we use to SEND trunk messages
-trunk_outbound_lock = threading.Lock()
+# dialled prefix -> trunk name, longest prefix wins
+routes = RouteTable()
+
+# what a dialled number does (--dialplan, or the built-in numbering); reloaded on SIGHUP
+dialplan = pbx_dialplan.DialPlan()
+
+# our name on the trunks, announced in trunk_hello
+node_name = None
+
+# framing we offer first on outbound trunks
+trunk_framing = pbx_codec.JSON
+
+# this process's pbx_workers.Worker in --workers mode, else None
+worker = None
+
+# trunk names that are links to sibling workers ("w1", ...)
+worker_links = set()
+
+# snapshot loaded at startup (pbx_snapshot.Snapshot) endpoints resume from, or None
+snapshot = None
+
+# registrations get resume tokens (--snapshot)
+resume_tokens = False
+
+# trunk -> (extensions, prefixes) we watch on the other side, resent on reconnect
+presence_upstream = {}
+
+# seconds a call may ring before it is given up (--ring-timeout; 0: forever)
+ring_timeout = 60.0
+
+# seconds of silence after which an endpoint is dropped (--idle-timeout; 0: never)
+idle_timeout = 0.0
+
+# extension -> pbx_timers.Timer of the no-answer timeout of the call it rings in
+ringing = {}
+
+
+# ============================================================
+#  PRE-ENCODED FRAMES
+# ============================================================
+# Replies are built once at startup: constants as ready bytes per codec,
+# the rest as templates that only splice in the extensions and text.
+
+CALL_PROCEEDING = Template("call_proceeding", "to")
+INCOMING_CALL = Template("incoming_call", "from")
+INCOMING_CALL_WAITING = Template("incoming_call_waiting", "from")
+CALL_ANSWERED = Template("call_answered", "by")
+CALL_ANSWERED_MEDIA = Template("call_answered", "by", "media_host", "media_port")
+HANGUP = Template("hangup", "by")
+NO_ANSWER = Template("no_answer", "from", "to")
+BUSY = Template("busy", "to")
+CHAT = Template("chat", "from", "text")
+CHAT_SENT = Template("chat_sent", "to")
+
+TRUNK_CALL = Template("trunk_call", "from", "to")
+TRUNK_CALL_ANSWERED = Template("trunk_call_answered", "from", "to")
+TRUNK_CALL_ANSWERED_MEDIA = Template("trunk_call_answered", "from", "to", "media_host",
+                                     "media_port", "codec")
+TRUNK_HANGUP = Template("trunk_hangup", "from", "to")
+TRUNK_NO_ANSWER = Template("trunk_hangup", "from", "to", "reason")
+TRUNK_BUSY = Template("trunk_busy", "from", "to")
+TRUNK_CHAT = Template("trunk_chat", "from", "to", "text")
+TRUNK_REDIRECT = Template("trunk_redirect", "from", "to", "via")
+
+CONFERENCE_MEMBER_JOINED = Template("conference_member_joined", "room", "ext")
+CONFERENCE_MEMBER_LEFT = Template("conference_member_left", "room", "ext")
+CONFERENCE_LEFT = Template("conference_left", "room")
+
+PING = Frame({"type": "ping"})
+PONG = Frame({"type": "pong"})
+
+PRESENCE = Template("presence", "states")
+TRUNK_SUBSCRIBE = Template("trunk_subscribe", "exts", "prefixes")
+TRUNK_PRESENCE = Template("trunk_presence", "states")
+
+# reason label -> error frame
+ERRORS = {reason: Frame({"type": "error", "reason": text}) for reason, text in [
+    ("caller_busy", "Δεν μπορείς να ξεκινήσεις νέα κλήση ενώ είσαι σε κλήση."),
+    ("no_call_to_answer", "Δεν υπάρχει κλήση για απάντηση."),
+    ("no_call_for_chat", "Δεν υπάρχει ενεργή κλήση για chat."),
+    ("ivr_in_call", "Δεν μπορείς να καλέσεις IVR ενώ είσαι σε κλήση."),
+    ("no_ivr_session", "Δεν υπάρχει ενεργό IVR."),
+    ("ivr_choice_in_call", "Δεν μπορείς να ξεκινήσεις νέα κλήση από το IVR ενώ είσαι σε κλήση."),
+    ("invalid_ivr_choice", "Μη έγκυρη επιλογή IVR."),
+    ("remote_ivr", "Δεν επιτρέπεται κλήση προς το IVR του άλλου τηλεφωνικού κέντρου."),
+    ("dial_plan", "Dial plan violation."),
+    ("not_an_ivr", "Δεν επιτρέπεται κλήση IVR σε αυτόν τον αριθμό."),
+    ("conference_in_call", "Δεν μπορείς να μπεις σε conference ενώ είσαι σε κλήση."),
+    ("conference_unavailable", "Τα conferences δεν είναι διαθέσιμα σε αυτό το τηλεφωνικό κέντρο."),
+    ("conference_full", "Το conference είναι γεμάτο."),
+    ("conference_no_ports", "Δεν υπάρχουν ελεύθερες θύρες media για το conference."),
+    ("presence_too_many", "Παρακολουθείς ήδη τον μέγιστο αριθμό extensions."),
+    ("resume_failed", "Η συνεδρία δεν μπορεί να συνεχιστεί, κάνε register."),
+]}
 
 
 def send_json(conn, obj):
-    """Send a JSON object terminated by newline."""
-    try:
-        data = json.dumps(obj).encode("utf-8") + b"\n"
-        conn.sendall(data)
-    except Exception:
-        pass
+    """Queue a message on the connection's outbound queue.
+
+    It is encoded with the framing negotiated for that connection (a JSON
+    line unless the peer asked for binary).  Never blocks: a peer that stops
+    reading only grows its own queue, and the queue's policy decides what
+    happens when it falls too far behind.
+    """
+    return conn.send(conn.codec.encode(obj))
+
+
+def send_frame(conn, frame, *values):
+    """Queue a pre-encoded Frame, or a Template filled in with `values`."""
+    return conn.send(frame.encode(conn.codec, *values))
+
+
+def send_error(conn, reason, text=None):
+    """Send an error to an endpoint, counted under a stable reason label.
+
+    Without `text` the cached frame for `reason` is sent.
+    """
+    pbx_metrics.errors.inc(reason)
+    if text is None:
+        return send_frame(conn, ERRORS[reason])
+    return send_json(conn, {
+        "type": "error",
+        "reason": text
+    })
+
+
+def send_answered(conn, by, relay, ext):
+    """call_answered to ext, with its media relay port when the call has one."""
+    if relay is None:
+        return send_frame(conn, CALL_ANSWERED, by)
+    return send_frame(conn, CALL_ANSWERED_MEDIA, by, pbx_media.advertise, relay.port_of(ext))
 
 
 def get_client(ext):
-    with lock:
-        return clients.get(ext)
+    return clients.get(ext)
+
 
+def set_state(ext, state, peer=None, remote=False, trunk=None):
+    clients.set_state(ext, state, peer, remote, trunk)
 
-def set_state(ext, state, peer=None, remote=False):
-    with lock:
-        if ext in clients:
-            clients[ext]["state"] = state
-            clients[ext]["peer"] = peer
-            clients[ext]["remote"] = remote
 
+def trunk_send(trunk, msg, *values):
+    """Send a message (dict or Template + values) on a trunk's outbound connection.
 
-def trunk_send(obj):
-    """Send a JSON message on the outbound trunk connection (if available)."""
-    global trunk_outbound
+    On a spooled trunk the message is kept until the other side acknowledges
+    it, and replayed if the link drops first.
+    """
+    spool = spools.get(trunk)
+    if spool is not None:
+        spool.send(msg, values)
+        return
     with trunk_outbound_lock:
-        conn = trunk_outbound
-    if conn is not None:
-        send_json(conn, obj)
+        conn = trunk_outbound.get(trunk)
+    if conn is None:
+        return
+    if isinstance(msg, dict):
+        send_json(conn, msg)
+    else:
+        send_frame(conn, msg, *values)
+
+
+def owner_of(ext):
+    """Worker that owns an extension (None when not running workers)."""
+    if worker is None:
+        return None
+    return worker.owner(ext)
+
+
+class ViaHub:
+    """Stand-in outbound conn for a remote trunk on a non-hub worker.
+
+    Messages go to the hub over our link, tagged with the trunk they are
+    meant for; the hub forwards them on the real trunk connection.
+    """
+
+    def __init__(self, link, trunk):
+        self.link = link
+        self.trunk = trunk
+
+    @property
+    def codec(self):
+        return self
+
+    def encode(self, obj):
+        return self.link.codec.encode(dict(obj, trunk=self.trunk))
+
+    def send(self, data):
+        return self.link.send(data)
 
 
 # ============================================================
 #  LOCAL CALL HANDLING
 # ============================================================
 
-def handle_local_call(caller_ext, callee_ext):
-    caller = get_client(caller_ext)
-    callee = get_client(callee_ext)
+def handle_local_call(caller_ext, callee_ext, ivr=False):
+    # Both legs are checked and reserved in one critical section
+    cdr = pbx_cdr.begin(caller_ext, callee_ext, "local", ivr=ivr)
+    outcome, caller, callee = clients.reserve_pair(caller_ext, callee_ext, cdr)
 
     if caller is None:
         return
 
-    if caller["state"] != "idle":
-        send_json(caller["conn"], {
-            "type": "error",
-            "reason": "Δεν μπορείς να ξεκινήσεις νέα κλήση ενώ είσαι σε κλήση."
-        })
+    if outcome == pbx_calltable.CALLER_BUSY:
+        send_error(caller.conn, "caller_busy")
         return
 
-    if callee is None:
-        send_json(caller["conn"], {
-            "type": "error",
-            "reason": f"Το extension {callee_ext} δεν είναι καταχωρημένο."
-        })
+    if outcome == pbx_calltable.CALLEE_MISSING:
+        pbx_cdr.failed(caller_ext, callee_ext, "local", pbx_cdr.UNREGISTERED, ivr=ivr)
+        send_error(caller.conn, "callee_not_registered",
+                   f"Το extension {callee_ext} δεν είναι καταχωρημένο.")
         return
 
-    if callee["state"] == "idle":
-        set_state(caller_ext, "in_call", peer=callee_ext, remote=False)
-        set_state(callee_ext, "in_call", peer=caller_ext, remote=False)
-
-        send_json(caller["conn"], {
-            "type": "call_proceeding",
-            "to": callee_ext
-        })
-        send_json(callee["conn"], {
-            "type": "incoming_call",
-            "from": caller_ext
-        })
+    if outcome == pbx_calltable.OK:
+        pbx_metrics.calls.inc("local")
+        start_ringing(caller_ext)
+        send_frame(caller.conn, CALL_PROCEEDING, callee_ext)
+        send_frame(callee.conn, INCOMING_CALL, caller_ext)
     else:
         # Call waiting behaviour
-        send_json(caller["conn"], {
-            "type": "busy",
-            "to": callee_ext
-        })
-        send_json(callee["conn"], {
-            "type": "incoming_call_waiting",
-            "from": caller_ext
-        })
+        pbx_metrics.errors.inc("callee_busy")
+        pbx_cdr.failed(caller_ext, callee_ext, "local", pbx_cdr.BUSY, ivr=ivr)
+        send_frame(caller.conn, BUSY, callee_ext)
+        send_frame(callee.conn, INCOMING_CALL_WAITING, caller_ext)
 
 
 # ============================================================
 #  TRUNK CALL HANDLING
 # ============================================================
 
-def handle_outgoing_trunk_call(caller_ext, callee_ext):
+def handle_outgoing_trunk_call(caller_ext, callee_ext, trunk, ivr=False):
     """Caller on this PBX wants to call a remote extension via trunk."""
-    caller = get_client(caller_ext)
+    if trunk in worker_links:
+        # To the callee's worker; still a local call as far as records go
+        cdr = pbx_cdr.begin(caller_ext, callee_ext, "local", ivr=ivr)
+    else:
+        cdr = pbx_cdr.begin(caller_ext, callee_ext, "trunk_out", trunk, ivr)
+    caller = clients.reserve(caller_ext, peer=callee_ext, remote=True, trunk=trunk, cdr=cdr)
     if caller is None:
+        c = get_client(caller_ext)
+        if c:
+            send_error(c.conn, "caller_busy")
         return
 
-    if caller["state"] != "idle":
-        send_json(caller["conn"], {
-            "type": "error",
-            "reason": "Δεν μπορείς να ξεκινήσεις νέα κλήση ενώ είσαι σε κλήση."
-        })
-        return
-
-    set_state(caller_ext, "in_call", peer=callee_ext, remote=True)
-
-    send_json(caller["conn"], {
-        "type": "call_proceeding",
-        "to": callee_ext
-    })
+    if trunk in worker_links:
+        pbx_metrics.calls.inc("local")
+    else:
+        pbx_metrics.calls.inc("trunk_out")
+        pbx_metrics.trunk_calls.inc(trunk, "out")
+    start_ringing(caller_ext)
+    send_frame(caller.conn, CALL_PROCEEDING, callee_ext)
 
-    trunk_send({
-        "type": "trunk_call",
-        "from": caller_ext,
-        "to": callee_ext
-    })
+    trunk_send(trunk, TRUNK_CALL, caller_ext, callee_ext)
 
 
-def handle_incoming_trunk_call(data):
-    """Received trunk_call from remote PBX."""
+def handle_incoming_trunk_call(data, trunk):
+    """Received trunk_call from remote PBX over the given trunk."""
     from_ext = data["from"]
     to_ext = data["to"]
 
+    if to_ext in pbx_acd.queues:
+        handle_incoming_queue_call(from_ext, to_ext, trunk)
+        return
+
+    # The caller's worker keeps the record of calls between workers
+    cdr = None if trunk in worker_links else pbx_cdr.begin(from_ext, to_ext, "trunk_in", trunk)
+    callee = clients.reserve(to_ext, peer=from_ext, remote=True, trunk=trunk, cdr=cdr,
+                             incoming=True)
+    if callee is not None:
+        if trunk not in worker_links:
+            pbx_metrics.calls.inc("trunk_in")
+            pbx_metrics.trunk_calls.inc(trunk, "in")
+        start_ringing(to_ext)
+        send_frame(callee.conn, INCOMING_CALL, from_ext)
+        return
+
     callee = get_client(to_ext)
     if callee is None:
         # Destination not registered -> remote caller should see busy and reset state
-        trunk_send({
+        busy = {
             "type": "trunk_busy",
             "from": to_ext,
             "to": from_ext
-        })
-        return
-
-    if callee["state"] == "idle":
-        set_state(to_ext, "in_call", peer=from_ext, remote=True)
-        send_json(callee["conn"], {
-            "type": "incoming_call",
-            "from": from_ext
-        })
+        }
+        if trunk in worker_links:
+            # A sibling worker reports it like a local call would
+            busy["reason"] = "not_registered"
+        else:
+            pbx_cdr.failed(from_ext, to_ext, "trunk_in", pbx_cdr.UNREGISTERED, trunk)
+        trunk_send(trunk, busy)
     else:
-        send_json(callee["conn"], {
-            "type": "incoming_call_waiting",
-            "from": from_ext
-        })
-        trunk_send({
-            "type": "trunk_busy",
-            "from": to_ext,
-            "to": from_ext
-        })
+        if trunk not in worker_links:
+            pbx_cdr.failed(from_ext, to_ext, "trunk_in", pbx_cdr.BUSY, trunk)
+        send_frame(callee.conn, INCOMING_CALL_WAITING, from_ext)
+        trunk_send(trunk, TRUNK_BUSY, to_ext, from_ext)
 
 
 def handle_trunk_busy(data):
     """Remote PBX reports that the call could not be established."""
     to_ext = data["to"]
     frm = data["from"]
-    caller = get_client(to_ext)
-    if caller:
-        # Reset local state to idle and notify busy
-        set_state(to_ext, "idle", peer=None, remote=False)
-        send_json(caller["conn"], {
-            "type": "busy",
-            "to": frm
-        })
+    # Reset local state to idle and notify busy (unless that call is already over)
+    caller, cdr = clients.release(to_ext, peer=frm)
+    if caller is None:
+        return
+    stop_ringing(to_ext)
+    if data.get("reason") == "not_registered":
+        pbx_cdr.end(cdr, pbx_cdr.UNREGISTERED)
+        send_error(caller.conn, "callee_not_registered",
+                   f"Το extension {frm} δεν είναι καταχωρημένο.")
+        return
+    pbx_cdr.end(cdr, pbx_cdr.BUSY)
+    pbx_metrics.errors.inc("trunk_busy")
+    send_frame(caller.conn, BUSY, frm)
 
 
 def handle_answer(ext):
-    me = get_client(ext)
+    me = clients.answer(ext)
     if me is None:
+        me = get_client(ext)
+        if me is not None:
+            send_error(me.conn, "no_call_to_answer")
         return
 
-    if me["state"] != "in_call":
-        send_json(me["conn"], {
-            "type": "error",
-            "reason": "Δεν υπάρχει κλήση για απάντηση."
-        })
-        return
-
-    peer_ext = me["peer"]
-    remote = me["remote"]
-
+    peer_ext, remote, trunk = me.peer, me.remote, me.trunk
+    stop_ringing(ext, peer_ext)
+    pbx_cdr.answered(me.cdr)
     if not remote:
         peer = get_client(peer_ext)
+        relay = pbx_media.allocate(ext, peer_ext, codecs=(me.codec, peer and peer.codec))
         if peer:
-            send_json(peer["conn"], {
-                "type": "call_answered",
-                "by": ext
-            })
-        send_json(me["conn"], {
-            "type": "call_answered",
-            "by": peer_ext
-        })
+            send_answered(peer.conn, ext, relay, peer_ext)
+        send_answered(me.conn, peer_ext, relay, ext)
     else:
-        # Inform remote PBX that the local callee has answered
-        trunk_send({
-            "type": "trunk_call_answered",
-            "from": ext,
-            "to": peer_ext
-        })
-        send_json(me["conn"], {
-            "type": "call_answered",
-            "by": peer_ext
-        })
+        # Inform remote PBX that the local callee has answered, and where
+        # its side of the media goes; the caller's side converts codecs
+        relay = pbx_media.allocate(ext, peer_ext, trunk=True)
+        if relay is None:
+            trunk_send(trunk, TRUNK_CALL_ANSWERED, ext, peer_ext)
+        else:
+            trunk_send(trunk, TRUNK_CALL_ANSWERED_MEDIA, ext, peer_ext, pbx_media.advertise,
+                       relay.ports[1], me.codec)
+        send_answered(me.conn, peer_ext, relay, ext)
 
 
 def handle_trunk_answer(data):
@@ -218,56 +392,137 @@ def handle_trunk_answer(data):
     caller_ext = data["to"]   # local caller
     receiver_ext = data["from"]  # remote party
 
-    caller = get_client(caller_ext)
-    if caller:
-        send_json(caller["conn"], {
-            "type": "call_answered",
-            "by": receiver_ext
-        })
+    caller = clients.connect(caller_ext, receiver_ext)
+    if caller is None:
+        # Given up (or hung up) meanwhile; our trunk_hangup is on its way
+        return
+    stop_ringing(caller_ext)
+    pbx_cdr.answered(caller.cdr)
+    # Relay only when the other PBX relays its side too
+    relay = None
+    remote = None
+    if "media_port" in data:
+        remote = pbx_media.resolve(data.get("media_host"), data["media_port"])
+    if remote is not None:
+        relay = pbx_media.allocate(caller_ext, receiver_ext, trunk=True, remote=remote,
+                                   codecs=(caller.codec, data.get("codec")))
+    send_answered(caller.conn, receiver_ext, relay, caller_ext)
 
 
 def handle_hangup(ext):
     me = get_client(ext)
-    if me is None or me["state"] != "in_call":
+    if me is not None and me.state == pbx_calltable.CONFERENCE:
+        handle_conference_leave(ext, me.peer)
         return
+    # Releases our leg and, for a local call, the peer's leg atomically
+    me, peer_ext, trunk, peer, cdr = clients.release_pair(ext)
+    if me is None:
+        return
+    stop_ringing(ext, peer_ext)
+    pbx_cdr.end(cdr)
+    pbx_media.release(ext, peer_ext)
 
-    peer_ext = me["peer"]
-    remote = me["remote"]
-
-    # Reset local
-    set_state(ext, "idle", peer=None, remote=False)
-    send_json(me["conn"], {
-        "type": "hangup",
-        "by": ext
-    })
+    send_frame(me.conn, HANGUP, ext)
 
-    if not remote:
-        peer = get_client(peer_ext)
+    if trunk is None:
         if peer:
-            set_state(peer_ext, "idle", peer=None, remote=False)
-            send_json(peer["conn"], {
-                "type": "hangup",
-                "by": ext
-            })
+            send_frame(peer.conn, HANGUP, ext)
+        else:
+            pbx_acd.abandon(peer_ext, ext)
     else:
         # Remote peer is on the other PBX
-        trunk_send({
-            "type": "trunk_hangup",
-            "from": ext,
-            "to": peer_ext
-        })
+        trunk_send(trunk, TRUNK_HANGUP, ext, peer_ext)
 
 
 def handle_trunk_hangup(data):
     to_ext = data["to"]
     frm = data["from"]
-    local = get_client(to_ext)
-    if local:
-        set_state(to_ext, "idle", peer=None, remote=False)
-        send_json(local["conn"], {
-            "type": "hangup",
-            "by": frm
-        })
+    local, cdr = clients.release(to_ext, peer=frm)
+    if local is None:
+        queue_abandoned(to_ext, frm, data.get("reason"))
+        return
+    stop_ringing(to_ext)
+    if data.get("reason") == "no_answer":
+        # The other side gave up ringing
+        pbx_cdr.end(cdr, pbx_cdr.NO_ANSWER)
+        if local.incoming:
+            send_frame(local.conn, NO_ANSWER, frm, to_ext)
+        else:
+            send_frame(local.conn, NO_ANSWER, to_ext, frm)
+        return
+    pbx_cdr.end(cdr)
+    pbx_media.release(to_ext, frm)
+    send_frame(local.conn, HANGUP, frm)
+
+
+# ============================================================
+#  NO-ANSWER TIMEOUT
+# ============================================================
+# A call rings until answered, hung up or `ring_timeout` runs out.  The
+# leg that set the call up here arms the timer: the caller of a local or
+# outgoing trunk call, the callee of an incoming one.  Both PBXs of a
+# trunk call time out on their own, so a dead link does not leave a leg
+# ringing either.
+
+def start_ringing(ext):
+    if ring_timeout:
+        ringing[ext] = pbx_timers.schedule(ring_timeout, no_answer, ext)
+
+
+def stop_ringing(*exts):
+    for ext in exts:
+        timer = ringing.pop(ext, None)
+        if timer is not None:
+            pbx_timers.cancel(timer)
+
+
+def no_answer(ext):
+    """Timer callback: give up a call that is still ringing."""
+    timer = ringing.get(ext)
+    if timer is None or timer.pending:
+        # The call was over before we ran; a pending timer is a newer call's
+        return
+    ringing.pop(ext, None)
+    me, peer_ext, trunk, peer, cdr = clients.release_pair(ext, (pbx_calltable.RINGING,))
+    if me is None:
+        return
+    pbx_metrics.timeouts.inc("no_answer")
+    pbx_cdr.end(cdr, pbx_cdr.NO_ANSWER)
+    caller, callee = (peer_ext, ext) if me.incoming else (ext, peer_ext)
+    send_frame(me.conn, NO_ANSWER, caller, callee)
+    if trunk is None:
+        if peer:
+            send_frame(peer.conn, NO_ANSWER, caller, callee)
+        else:
+            pbx_acd.abandon(peer_ext, ext)
+    else:
+        trunk_send(trunk, TRUNK_NO_ANSWER, ext, peer_ext, "no_answer")
+
+
+def ringing_gone(rec):
+    """A leg that went away while ringing (rec: its record, already unregistered)."""
+    stop_ringing(rec.ext, rec.peer)
+    if rec.remote:
+        trunk_send(rec.trunk, TRUNK_HANGUP, rec.ext, rec.peer)
+        return
+    peer, _ = clients.release(rec.peer, rec.ext, (pbx_calltable.RINGING,))
+    if peer is not None:
+        send_frame(peer.conn, HANGUP, rec.ext)
+    else:
+        pbx_acd.abandon(rec.peer, rec.ext)
+
+
+def call_gone(ext):
+    """A leg whose endpoint went away mid-call: both legs released, the peer told."""
+    me, peer_ext, trunk, peer, cdr = clients.release_pair(ext, (pbx_calltable.IN_CALL,))
+    if me is None:
+        return
+    pbx_cdr.end(cdr)
+    pbx_media.release(ext, peer_ext)
+    if trunk is not None:
+        trunk_send(trunk, TRUNK_HANGUP, ext, peer_ext)
+    elif peer is not None:
+        send_frame(peer.conn, HANGUP, ext)
 
 
 # ============================================================
@@ -279,39 +534,19 @@ def handle_chat(ext, text):
     if me is None:
         return
 
-    if me["state"] != "in_call":
-        send_json(me["conn"], {
-            "type": "error",
-            "reason": "Δεν υπάρχει ενεργή κλήση για chat."
-        })
+    state, peer_ext, remote, trunk = me.state, me.peer, me.remote, me.trunk
+    if state != "in_call":
+        send_error(me.conn, "no_call_for_chat")
         return
 
-    peer_ext = me["peer"]
-    remote = me["remote"]
-
     if not remote:
         peer = get_client(peer_ext)
         if peer:
-            send_json(peer["conn"], {
-                "type": "chat",
-                "from": ext,
-                "text": text
-            })
-            send_json(me["conn"], {
-                "type": "chat_sent",
-                "to": peer_ext
-            })
+            send_frame(peer.conn, CHAT, ext, text)
+            send_frame(me.conn, CHAT_SENT, peer_ext)
     else:
-        trunk_send({
-            "type": "trunk_chat",
-            "from": ext,
-            "to": peer_ext,
-            "text": text
-        })
-        send_json(me["conn"], {
-            "type": "chat_sent",
-            "to": peer_ext
-        })
+        trunk_send(trunk, TRUNK_CHAT, ext, peer_ext, text)
+        send_frame(me.conn, CHAT_SENT, peer_ext)
 
 
 def handle_trunk_chat(data):
@@ -321,277 +556,1241 @@ def handle_trunk_chat(data):
 
     peer = get_client(to_ext)
     if peer:
-        send_json(peer["conn"], {
-            "type": "chat",
-            "from": frm,
-            "text": text
-        })
+        send_frame(peer.conn, CHAT, frm, text)
 
 
 # ============================================================
 #  IVR HANDLING
 # ============================================================
 
-def ivr_start(ext, ivr_ext, local_prefix):
+def ivr_start(ext):
     """Start an IVR session for extension ext."""
     me = get_client(ext)
     if me is None:
         return
 
-    if me["state"] != "idle":
-        send_json(me["conn"], {
-            "type": "error",
-            "reason": "Δεν μπορείς να καλέσεις IVR ενώ είσαι σε κλήση."
-        })
+    if me.state != "idle":
+        send_error(me.conn, "ivr_in_call")
         return
 
-    ivr_sessions.add(ext)
+    pbx_ivr.enter(ext)
 
-    center_label = "A" if ivr_ext == "5000" else "B" if ivr_ext == "7000" else "Local"
-    menu_text = (
-        f"--- IVR Center {center_label} ({ivr_ext}) ---\n"
-        "0 → Πληροφορίες για το τηλεφωνικό κέντρο\n"
-        f"1–9 → Κλήση στα {local_prefix}001–{local_prefix}009 (αν είναι καταχωρημένα)\n"
-    )
 
-    send_json(me["conn"], {
-        "type": "ivr_message",
-        "text": menu_text
-    })
+def ivr_choice(ext, digit):
+    me = get_client(ext)
+    if me is None:
+        return
 
+    if me.state != "idle":
+        # Busy elsewhere meanwhile: the menu is abandoned
+        send_error(me.conn, "ivr_choice_in_call" if pbx_ivr.leave(ext) else "no_ivr_session")
+        return
 
-def ivr_choice(ext, digit, local_prefix, remote_prefix):
-    if ext not in ivr_sessions:
-        c = get_client(ext)
-        if c:
-            send_json(c["conn"], {
-                "type": "error",
-                "reason": "Δεν υπάρχει ενεργό IVR."
-            })
+    if not pbx_ivr.choose(ext, digit):
+        send_error(me.conn, "no_ivr_session")
+
+
+def ivr_send(ext, frame):
+    """pbx_ivr: a menu, info text or hang-up to ext."""
+    c = get_client(ext)
+    if c:
+        send_frame(c.conn, frame)
+
+
+def ivr_error(ext, reason):
+    c = get_client(ext)
+    if c:
+        send_error(c.conn, reason)
+
+
+def ivr_transfer(ext, number):
+    handle_call(ext, number, ivr_ext=None, from_ivr=True)
+
+
+def ivr_queue(ext, queue_ext):
+    handle_queue_call(ext, queue_ext, ivr=True)
+
+
+# ============================================================
+#  CONFERENCE HANDLING
+# ============================================================
+# A room lives on one worker (crc32 of its name, like extensions), which
+# mixes its media; participants registered on other workers join and leave
+# over the worker links and get the room's messages back the same way.
+
+def conference_owner(room):
+    """Worker that hosts a room (None when not running workers)."""
+    return owner_of("conference:" + room)
+
+
+def conference_send(ext, home, room, msg, *values):
+    """Send a room message to a participant registered here (home None) or on worker `home`."""
+    if home is not None:
+        if isinstance(msg, Template):
+            msg = msg.build(values)
+        trunk_send(pbx_workers.link_name(home), {
+            "type": "conference_notify",
+            "to": ext,
+            "msg": msg
+        })
         return
+    me = get_client(ext)
+    # Nothing for a participant that has left the room in the meantime
+    if me is None or me.state != pbx_calltable.CONFERENCE or me.peer != room:
+        return
+    if isinstance(msg, dict):
+        send_json(me.conn, msg)
+    else:
+        send_frame(me.conn, msg, *values)
 
-    ivr_sessions.discard(ext)
 
+def handle_conference(ext, room):
+    """An endpoint asks to join a room."""
     me = get_client(ext)
     if me is None:
         return
+    if not pbx_conference.enabled:
+        send_error(me.conn, "conference_unavailable")
+        return
+    if clients.reserve(ext, peer=room, remote=False, state=pbx_calltable.CONFERENCE) is None:
+        send_error(me.conn, "conference_in_call")
+        return
 
-    if me["state"] != "idle":
-        send_json(me["conn"], {
-            "type": "error",
-            "reason": "Δεν μπορείς να ξεκινήσεις νέα κλήση από το IVR ενώ είσαι σε κλήση."
+    owner = conference_owner(room)
+    if owner is None or owner == worker.id:
+        conference_add(ext, room, None, me.codec)
+    else:
+        trunk_send(pbx_workers.link_name(owner), {
+            "type": "conference_join",
+            "from": ext,
+            "room": room,
+            "home": worker.id,
+            "codec": me.codec
         })
+
+
+def handle_conference_leave(ext, room):
+    """An endpoint hangs up its conference."""
+    me, _ = clients.release(ext, room, (pbx_calltable.CONFERENCE,))
+    if me is None:
         return
+    send_frame(me.conn, CONFERENCE_LEFT, room)
+    conference_leave(ext, room)
+
 
-    # Digit 0 -> info
-    if digit == "0":
-        send_json(me["conn"], {
-            "type": "ivr_info",
-            "text": (
-                "Το τηλεφωνικό κέντρο λειτουργεί Δευτέρα–Παρασκευή 09:00–17:00.\n"
-                "Για τεχνική υποστήριξη επικοινωνήστε με τον διαχειριστή."
-            )
+def conference_leave(ext, room):
+    """Take ext out of a room, on whichever worker hosts it."""
+    owner = conference_owner(room)
+    if owner is None or owner == worker.id:
+        conference_remove(ext)
+    else:
+        trunk_send(pbx_workers.link_name(owner), {
+            "type": "conference_leave",
+            "from": ext,
+            "room": room
         })
+
+
+def conference_add(ext, room, home=None, codec=None):
+    """Add a participant to a room hosted here and tell everyone in it."""
+    outcome, member, others = pbx_conference.join(ext, room, home, codec)
+    if outcome != pbx_conference.OK:
+        if home is None:
+            conference_refused(ext, room, outcome)
+        else:
+            trunk_send(pbx_workers.link_name(home), {
+                "type": "conference_refused",
+                "to": ext,
+                "room": room,
+                "reason": outcome
+            })
         return
 
-    # Digits 1-9 -> local extensions prefix00d (e.g. 5003, 7003)
-    if not digit.isdigit() or not (1 <= int(digit) <= 9):
-        send_json(me["conn"], {
-            "type": "error",
-            "reason": "Μη έγκυρη επιλογή IVR."
-        })
+    conference_send(ext, home, room, {
+        "type": "conference_joined",
+        "room": room,
+        "members": [m.ext for m in others],
+        "media_host": pbx_media.advertise,
+        "media_port": member.port,
+        "codec": f"{member.codec}/{pbx_transcode.RATE}",
+        "ptime": int(pbx_conference.PTIME * 1000)
+    })
+    for m in others:
+        conference_send(m.ext, m.home, room, CONFERENCE_MEMBER_JOINED, room, ext)
+
+
+def conference_remove(ext):
+    """Remove a participant from the room hosted here that it is in."""
+    room, others = pbx_conference.leave(ext)
+    for m in others:
+        conference_send(m.ext, m.home, room, CONFERENCE_MEMBER_LEFT, room, ext)
+
+
+def conference_refused(ext, room, outcome):
+    """The room could not take ext: back to idle, with the reason."""
+    me, _ = clients.release(ext, room, (pbx_calltable.CONFERENCE,))
+    if me is not None:
+        send_error(me.conn, "conference_" + outcome)
+
+
+def dispatch_conference(msg):
+    """Conference messages between workers."""
+    mtype = msg.get("type")
+    if mtype == "conference_join":
+        conference_add(msg["from"], msg["room"], msg["home"], msg.get("codec"))
+    elif mtype == "conference_leave":
+        conference_remove(msg["from"])
+    elif mtype == "conference_refused":
+        conference_refused(msg["to"], msg["room"], msg["reason"])
+    elif mtype == "conference_notify":
+        inner = msg["msg"]
+        conference_send(msg["to"], None, inner.get("room"), inner)
+
+
+# ============================================================
+#  PRESENCE HANDLING
+# ============================================================
+# Our own extensions are watched in pbx_presence directly; the rest are
+# watched on the PBX (or worker) that has them, which reports their states
+# back in trunk_presence.  Subscriptions made over a trunk stay for as
+# long as its link does.
+
+def presence_state(ext):
+    rec = clients.get(ext)
+    return rec.state if rec is not None else pbx_presence.OFFLINE
+
+
+def presence_deliver(sub, states):
+    kind, name = sub
+    if kind == pbx_presence.TRUNK:
+        trunk_send(name, TRUNK_PRESENCE, states)
+        return
+    me = get_client(name)
+    if me is not None:
+        send_frame(me.conn, PRESENCE, states)
+
+
+def presence_local(ext, local_prefix):
+    """Trunk (or worker link) an extension's state comes over, None when it is ours."""
+    if local_prefix is None or ext.startswith(local_prefix):
+        owner = owner_of(ext)
+        if owner is None or owner == worker.id:
+            return None
+        return pbx_workers.link_name(owner)
+    return routes.lookup(ext)
+
+
+def presence_watching(trunk, ext):
+    """Whether ext is already watched over `trunk`."""
+    with trunk_outbound_lock:
+        watched = presence_upstream.get(trunk)
+        return watched is not None and ext in watched[0]
+
+
+def presence_forward(trunk, exts, prefixes):
+    """Watch extensions and prefixes on the other side of a trunk, once each."""
+    with trunk_outbound_lock:
+        watched = presence_upstream.setdefault(trunk, (set(), set()))
+        exts = [e for e in exts if e not in watched[0]]
+        prefixes = [p for p in prefixes if p not in watched[1]]
+        watched[0].update(exts)
+        watched[1].update(prefixes)
+    if exts or prefixes:
+        trunk_send(trunk, TRUNK_SUBSCRIBE, exts, prefixes)
+
+
+def presence_resubscribe(trunk):
+    """A fresh trunk link: ask again for everything we watch over it."""
+    with trunk_outbound_lock:
+        watched = presence_upstream.get(trunk)
+        if watched is None:
+            return
+        exts, prefixes = sorted(watched[0]), sorted(watched[1])
+    trunk_send(trunk, TRUNK_SUBSCRIBE, exts, prefixes)
+
+
+def presence_refresh(trunk):
+    """A fresh trunk link: send the other side every state it watches here again."""
+    sub = (pbx_presence.TRUNK, trunk)
+    exts, prefixes = pbx_presence.watched(sub)
+    if exts or prefixes:
+        pbx_presence.subscribe(sub, current=exts + registered_under(prefixes))
+
+
+def registered_under(prefixes):
+    """Extensions registered here that start with one of the prefixes."""
+    if not prefixes:
+        return []
+    prefixes = tuple(prefixes)
+    return [ext for ext, _, _, _, _ in clients.snapshot() if ext.startswith(prefixes)]
+
+
+def handle_subscribe(ext, exts, prefixes, local_prefix):
+    """An endpoint starts watching extensions and prefixes."""
+    me = get_client(ext)
+    if me is None:
+        return
+    exts = [str(e) for e in exts if e]
+    prefixes = [str(p) for p in prefixes if p]
+
+    # Ours are reported at once, and so are the others when they are
+    # already watched over their trunk; the rest once their PBX answers
+    current = []
+    upstream = {}
+    for e in exts:
+        trunk = presence_local(e, local_prefix)
+        if trunk is None or pbx_presence.known(e) is not None or presence_watching(trunk, e):
+            current.append(e)
+        if trunk is not None:
+            upstream.setdefault(trunk, ([], []))[0].append(e)
+    for p in prefixes:
+        if local_prefix is None or p.startswith(local_prefix) or local_prefix.startswith(p):
+            for link in worker_links:
+                upstream.setdefault(link, ([], []))[1].append(p)
+        for route, trunk in routes.items():
+            if route.startswith(p) or p.startswith(route):
+                upstream.setdefault(trunk, ([], []))[1].append(p)
+    if prefixes:
+        current += registered_under(prefixes) + pbx_presence.known_under(prefixes)
+
+    if not pbx_presence.subscribe((pbx_presence.ENDPOINT, ext), exts, prefixes, current,
+                                  pbx_presence.max_watch):
+        send_error(me.conn, "presence_too_many")
+        return
+    for trunk, (trunk_exts, trunk_prefixes) in upstream.items():
+        presence_forward(trunk, trunk_exts, trunk_prefixes)
+
+
+def handle_unsubscribe(ext, exts, prefixes):
+    if exts is None and prefixes is None:
+        pbx_presence.unsubscribe((pbx_presence.ENDPOINT, ext))
+    else:
+        pbx_presence.unsubscribe((pbx_presence.ENDPOINT, ext), exts or (), prefixes or ())
+
+
+def handle_trunk_subscribe(data, trunk):
+    """The other side of a trunk watches extensions of ours."""
+    exts = [str(e) for e in data.get("exts") or ()]
+    prefixes = [str(p) for p in data.get("prefixes") or ()]
+    pbx_presence.subscribe((pbx_presence.TRUNK, trunk), exts, prefixes,
+                           exts + registered_under(prefixes))
+
+
+def presence_from_trunk(msg, trunk):
+    """Hub: presence traffic on a real trunk concerns every worker, not one owner."""
+    if msg.get("type") == "trunk_presence":
+        for w in worker.links:
+            trunk_send(pbx_workers.link_name(w), dict(msg, trunk=trunk))
+        dispatch_trunk(msg, trunk)
+        return
+    by_owner = {}
+    for ext in msg.get("exts") or ():
+        by_owner.setdefault(worker.owner(str(ext)), []).append(ext)
+    prefixes = msg.get("prefixes") or []
+    for w in worker.links:
+        if w in by_owner or prefixes:
+            trunk_send(pbx_workers.link_name(w), dict(msg, exts=by_owner.get(w, []), trunk=trunk))
+    dispatch_trunk(dict(msg, exts=by_owner.get(worker.id, [])), trunk)
+
+
+# ============================================================
+#  CALL QUEUES (ACD)
+# ============================================================
+# A call to a queue extension goes to an idle agent of the queue, or
+# waits in pbx_acd's line ringing the queue itself until an agent frees
+# up.  A caller on another PBX has no record here while it waits (it is
+# in the reconciliation digest as a call with the queue, though), and
+# its PBX learns which agent took the call from trunk_redirect.
+
+def handle_queue_call(caller_ext, queue_ext, ivr=False):
+    """A local caller dials a queue."""
+    cdr = pbx_cdr.begin(caller_ext, queue_ext, "local", ivr=ivr)
+    caller = clients.reserve(caller_ext, peer=queue_ext, remote=False, cdr=cdr)
+    if caller is None:
+        c = get_client(caller_ext)
+        if c:
+            send_error(c.conn, "caller_busy")
+        return
+    pbx_metrics.calls.inc("local")
+    start_ringing(caller_ext)
+    send_frame(caller.conn, CALL_PROCEEDING, queue_ext)
+    pbx_acd.enqueue(queue_ext, caller_ext)
+
+
+def handle_incoming_queue_call(from_ext, queue_ext, trunk):
+    """A caller on another PBX dials one of our queues."""
+    pbx_metrics.calls.inc("trunk_in")
+    pbx_metrics.trunk_calls.inc(trunk, "in")
+    queue_digest(trunk, queue_ext, from_ext, True)
+    pbx_acd.enqueue(queue_ext, from_ext, trunk, pbx_cdr.begin(from_ext, queue_ext, "trunk_in", trunk))
+
+
+def queue_connect(queue_ext, caller_ext, trunk, cdr, agent_ext):
+    """pbx_acd: ring agent_ext with a call waiting in queue_ext; returns a pbx_acd outcome."""
+    if trunk is None:
+        outcome, caller, agent = clients.reserve_pair(caller_ext, agent_ext, via=queue_ext)
+        if outcome in (pbx_calltable.CALLEE_MISSING, pbx_calltable.CALLEE_BUSY):
+            return pbx_acd.AGENT_GONE
+        if outcome != pbx_calltable.OK:
+            return pbx_acd.CALLER_GONE
+        # The agent gets a full ring timeout of its own
+        stop_ringing(caller_ext)
+        start_ringing(caller_ext)
+        pbx_cdr.redirected(caller.cdr, agent_ext)
+        send_frame(caller.conn, CALL_PROCEEDING, agent_ext)
+        send_frame(agent.conn, INCOMING_CALL, caller_ext)
+        return pbx_acd.OK
+
+    agent = clients.reserve(agent_ext, peer=caller_ext, remote=True, trunk=trunk, cdr=cdr,
+                            incoming=True)
+    if agent is None:
+        return pbx_acd.AGENT_GONE
+    queue_digest(trunk, queue_ext, caller_ext, False)
+    start_ringing(agent_ext)
+    pbx_cdr.redirected(cdr, agent_ext)
+    trunk_send(trunk, TRUNK_REDIRECT, agent_ext, caller_ext, queue_ext)
+    send_frame(agent.conn, INCOMING_CALL, caller_ext)
+    return pbx_acd.OK
+
+
+def queue_abandoned(queue_ext, caller_ext, reason=None):
+    """A caller on another PBX hung up (or gave up) while waiting in a queue."""
+    waiter = pbx_acd.abandon(queue_ext, caller_ext)
+    if waiter is None:
         return
+    queue_digest(waiter.trunk, queue_ext, caller_ext, False)
+    pbx_cdr.end(waiter.cdr, pbx_cdr.NO_ANSWER if reason == "no_answer" else None)
 
-    target_ext = f"{local_prefix}00{digit}"
-    # Use normal call routing, but we know this is a local extension by design
-    handle_call(ext, target_ext, local_prefix, remote_prefix, ivr_ext=None)
+
+def queue_digest(trunk, queue_ext, caller_ext, add):
+    # A remote caller waiting in a queue is a call over the trunk to reconcile
+    index = clients.index
+    if index is not None:
+        if add:
+            index.add(trunk, queue_ext, caller_ext)
+        else:
+            index.discard(trunk, queue_ext, caller_ext)
+
+
+def handle_trunk_redirect(data, trunk):
+    """The other PBX handed our caller's queue call to one of its agents."""
+    caller_ext = data["to"]
+    agent_ext = data["from"]
+    caller = clients.redirect(caller_ext, data.get("via"), agent_ext)
+    if caller is None:
+        # Gone meanwhile: free the agent
+        trunk_send(trunk, TRUNK_HANGUP, caller_ext, agent_ext)
+        return
+    pbx_cdr.redirected(caller.cdr, agent_ext)
+    send_frame(caller.conn, CALL_PROCEEDING, agent_ext)
+
+
+def table_state(ext):
+    rec = clients.get(ext)
+    return rec.state if rec is not None else None
+
+
+def table_changed(ext):
+    """CallTable listener: presence, the agents' heaps, and the IVR menus.
+
+    An extension that stops being idle, whether it calls, is called or
+    joins a conference, is no longer in a menu.
+    """
+    pbx_presence.changed(ext)
+    if ext in pbx_acd.agents:
+        pbx_acd.changed(ext)
+    if table_state(ext) != pbx_calltable.IDLE:
+        pbx_ivr.leave(ext)
 
 
 # ============================================================
 #  GENERIC CALL ROUTER
 # ============================================================
 
-def handle_call(caller_ext, target_ext, local_prefix, remote_prefix, ivr_ext):
-    """Route a call depending on prefix and IVR rules."""
+def reload_dialplan(path, trunks):
+    """SIGHUP: compile the dial plan file again and swap it in; on errors the old one stays."""
+    if not path:
+        pbx_log.info("dialplan_reload",
+                     "Χωρίς --dialplan δεν υπάρχει σχέδιο κλήσεων να ξαναφορτωθεί.")
+        return
+    t0 = time.perf_counter()
+    try:
+        dialplan.replace(pbx_dialplan.load_dialplan(path, trunks, ERRORS))
+    except (OSError, ValueError) as e:
+        pbx_log.error("dialplan_reload", "Το σχέδιο κλήσεων δεν ξαναφορτώθηκε: {error}", error=e)
+        return
+    pbx_log.info("dialplan_reload",
+                 "Σχέδιο κλήσεων ξαναφορτώθηκε: {rules} κανόνες, {states} καταστάσεις σε {ms} ms",
+                 rules=len(dialplan), states=dialplan.states,
+                 ms=round((time.perf_counter() - t0) * 1000))
+
+
+def block_reason(rule):
+    """Error reason of a block rule (dial_plan unless it names one)."""
+    return rule.arg if rule.arg in ERRORS else "dial_plan"
+
+
+def handle_call(caller_ext, target_ext, ivr_ext, from_ivr=False):
+    """Route a call by the dial plan."""
     caller = get_client(caller_ext)
     if caller is None:
         return
+    if not from_ivr:
+        # Dialling out of a menu abandons it
+        pbx_ivr.leave(caller_ext)
+
+    rule, number = dialplan.resolve(target_ext)
+    action = rule.action if rule is not None else None
 
     # Local IVR: allow both 'ivr' command and 'call 5000/7000' to start IVR
-    if ivr_ext is not None and target_ext == ivr_ext:
-        ivr_start(caller_ext, ivr_ext, local_prefix)
+    if action == pbx_dialplan.IVR and ivr_ext is not None:
+        ivr_start(caller_ext)
         return
 
-    # Do not allow calling the remote IVR
-    remote_ivr = None
-    if remote_prefix:
-        remote_ivr = f"{remote_prefix}000"
+    if action in (None, pbx_dialplan.BLOCK, pbx_dialplan.IVR):
+        # e.g. the remote IVR, which may not be called from here
+        pbx_cdr.failed(caller_ext, number, "trunk_out", pbx_cdr.DIAL_PLAN, ivr=from_ivr)
+        send_error(caller.conn, block_reason(rule) if action == pbx_dialplan.BLOCK else "dial_plan")
+        return
 
-    if remote_ivr and target_ext == remote_ivr:
-        send_json(caller["conn"], {
-            "type": "error",
-            "reason": "Δεν επιτρέπεται κλήση προς το IVR του άλλου τηλεφωνικού κέντρου."
-        })
+    if number in pbx_acd.queues:
+        handle_queue_call(caller_ext, number, from_ivr)
         return
 
-    # Normal local / remote routing
-    if target_ext.startswith(local_prefix):
-        handle_local_call(caller_ext, target_ext)
-    elif remote_prefix and target_ext.startswith(remote_prefix):
-        handle_outgoing_trunk_call(caller_ext, target_ext)
+    if action == pbx_dialplan.LOCAL:
+        owner = owner_of(number)
+        if owner is None or owner == worker.id:
+            handle_local_call(caller_ext, number, from_ivr)
+        else:
+            # Callee lives on a sibling worker: a trunk call over our link to it
+            handle_outgoing_trunk_call(caller_ext, number, pbx_workers.link_name(owner),
+                                       from_ivr)
+        return
+
+    trunk = rule.arg if action == pbx_dialplan.TRUNK else routes.lookup(number)
+    if trunk is not None:
+        handle_outgoing_trunk_call(caller_ext, number, trunk, from_ivr)
     else:
-        send_json(caller["conn"], {
-            "type": "error",
-            "reason": "Dial plan violation."
+        pbx_cdr.failed(caller_ext, number, "trunk_out", pbx_cdr.DIAL_PLAN, ivr=from_ivr)
+        send_error(caller.conn, "dial_plan")
+
+
+# ============================================================
+#  SESSIONS (shared by the thread and asyncio engines)
+# ============================================================
+
+class Session(abc.ABC):
+    """Protocol state of one connection.
+
+    The engine that owns the socket feeds it raw bytes and calls close()
+    exactly once when the connection goes away.  The FrameReader splits the
+    stream into messages whichever framing the peer currently uses.  A
+    session that has passed its socket to another worker sets `detached`;
+    the engine then stops reading and closes only its own descriptor.
+    """
+
+    detached = False
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.reader = FrameReader()
+
+    def feed(self, data):
+        if not pbx_metrics.enabled:
+            for msg in self.reader.feed(data):
+                self.handle(msg)
+            return
+        # Latency of each message counts from the read, so decoding is included
+        t0 = time.perf_counter()
+        for msg in self.reader.feed(data):
+            self.handle(msg)
+            pbx_metrics.observe_dispatch(msg.get("type"), time.perf_counter() - t0)
+
+    @abc.abstractmethod
+    def handle(self, msg):
+        """One decoded message from the peer."""
+
+    def close(self):
+        self.conn.close()
+
+
+class ClientSession(Session):
+    """An endpoint connection."""
+
+    def __init__(self, conn, addr, local_prefix, ivr_ext):
+        super().__init__(conn)
+        self.addr = addr
+        self.ext = None
+        self.local_prefix = local_prefix
+        self.ivr_ext = ivr_ext
+        self.handoff_to = None     # worker that owns the extension being registered
+        self.held = []             # messages to pass along with the connection
+        self.heard = time.monotonic()
+        self.idle_timer = None
+        if idle_timeout:
+            self.idle_timer = pbx_timers.schedule(idle_timeout / 2, self.idle_check)
+        pbx_log.info("connect", "Σύνδεση από {addr}", addr=addr)
+
+    def feed(self, data):
+        self.heard = time.monotonic()
+        super().feed(data)
+        if self.handoff_to is not None and not self.detached:
+            self.hand_off()
+
+    def hand_off(self):
+        """Pass the socket and everything read so far to the owning worker."""
+        payload = b"".join(pbx_codec.JSON.encode(m) for m in self.held) + bytes(self.reader.buf)
+        worker.hand_off(self.handoff_to, self.conn.fileno(), payload)
+        self.detached = True
+
+    def handle(self, msg):
+        mtype = msg.get("type")
+        conn = self.conn
+        ext = self.ext
+
+        if self.handoff_to is not None:
+            self.held.append(msg)
+            return
+
+        # Keepalive: anything received counts, a ping also gets its pong
+        if mtype == "ping":
+            send_frame(conn, PONG)
+            return
+        if mtype == "pong":
+            return
+
+        # Registration
+        if mtype in ("register", "resume"):
+            ext = msg.get("extension")
+            if not ext:
+                return
+            owner = owner_of(ext)
+            if owner is not None and owner != worker.id:
+                # Another worker owns this extension and takes the connection over
+                self.handoff_to = owner
+                self.held.append(msg)
+                return
+            if mtype == "resume":
+                self.resume(ext, msg.get("token"))
+                return
+            self.ext = ext
+            codec = pbx_transcode.choose(msg.get("codecs"))
+            token = os.urandom(pbx_snapshot.TOKEN_BYTES) if resume_tokens else None
+            clients.register(ext, conn, self.addr, codec, token)
+            pbx_metrics.registrations.inc()
+            pbx_log.info("register", "Extension {ext} registered από {addr}",
+                         ext=ext, addr=self.addr)
+            reply = {
+                "type": "register_ok",
+                "extension": ext
+            }
+            if "codecs" in msg:
+                reply["codec"] = codec
+            if token is not None:
+                reply["resume_token"] = token.hex()
+            framing = pbx_codec.choose(msg.get("framing"))
+            if "framing" in msg:
+                reply["framing"] = framing.name
+            send_json(conn, reply)
+            # Everything after register_ok goes out in the negotiated framing
+            conn.codec = framing
+            return
+
+        if ext is None:
+            # Ignore messages from unregistered clients
+            return
+
+        if mtype == "call":
+            dest = msg.get("to")
+            if not dest:
+                return
+            handle_call(ext, dest, self.ivr_ext)
+
+        elif mtype == "answer":
+            handle_answer(ext)
+
+        elif mtype == "hangup":
+            handle_hangup(ext)
+
+        elif mtype == "ivr":
+            dest = msg.get("to")
+            # Only allow IVR calls to the local IVR number
+            if dest == self.ivr_ext:
+                ivr_start(ext)
+            else:
+                c = get_client(ext)
+                if c:
+                    send_error(c.conn, "not_an_ivr")
+
+        elif mtype == "ivr_choice":
+            digit = msg.get("digit")
+            if digit is not None:
+                ivr_choice(ext, str(digit))
+
+        elif mtype == "chat":
+            text = msg.get("text", "")
+            handle_chat(ext, text)
+
+        elif mtype == "conference":
+            room = msg.get("room")
+            if room:
+                handle_conference(ext, str(room))
+
+        elif mtype == "subscribe":
+            exts, prefixes = msg.get("exts") or [], msg.get("prefixes") or []
+            if isinstance(exts, list) and isinstance(prefixes, list):
+                handle_subscribe(ext, exts, prefixes, self.local_prefix)
+
+        elif mtype == "unsubscribe":
+            handle_unsubscribe(ext, msg.get("exts"), msg.get("prefixes"))
+
+    def resume(self, ext, token):
+        """Take back a registration from the snapshot, call state included."""
+        conn = self.conn
+        found = None
+        if snapshot is not None and isinstance(token, str):
+            try:
+                token = bytes.fromhex(token)
+            except ValueError:
+                token = b""
+            found = snapshot.claim(token, ext)
+        if found is None:
+            pbx_metrics.resumes.inc("failed")
+            send_error(conn, "resume_failed")
+            return
+        _, codec, framing, state, peer, remote, trunk = found
+        self.ext = ext
+        clients.register(ext, conn, self.addr, codec, token)
+        if state == pbx_calltable.IN_CALL:
+            # The peer resumes its side (or is gone, and hangup clears ours)
+            clients.set_state(ext, state, peer, remote, trunk)
+        else:
+            # Rooms do not outlive a restart, and nor does the timeout of a ringing call
+            state, peer = pbx_calltable.IDLE, None
+        pbx_metrics.resumes.inc("ok")
+        pbx_log.info("resume", "Extension {ext} resumed από {addr}", ext=ext, addr=self.addr)
+        send_json(conn, {
+            "type": "resume_ok",
+            "extension": ext,
+            "codec": codec,
+            "framing": framing,
+            "state": state,
+            "peer": peer
         })
+        conn.codec = pbx_codec.CODECS[framing]
+
+    def idle_check(self):
+        """Keepalive timer: ping after half the idle timeout of silence, drop after all of it."""
+        if self.conn.closed:
+            return
+        quiet = time.monotonic() - self.heard
+        if quiet >= idle_timeout:
+            pbx_metrics.timeouts.inc("idle")
+            pbx_log.info("idle_timeout", "Καμία απάντηση από {ext} για {seconds:.0f}s, αποσύνδεση",
+                         ext=self.ext, addr=self.addr, seconds=quiet)
+            # The engine sees the connection drop and closes the session as usual
+            self.conn.abort()
+            return
+        if quiet >= idle_timeout / 2:
+            send_frame(self.conn, PING)
+            wait = idle_timeout - quiet
+        else:
+            wait = idle_timeout / 2 - quiet
+        self.idle_timer = pbx_timers.schedule(wait, self.idle_check)
+
+    def close(self):
+        if self.idle_timer is not None:
+            pbx_timers.cancel(self.idle_timer)
+        ext = self.ext
+        if ext:
+            pbx_presence.unsubscribe((pbx_presence.ENDPOINT, ext))
+            rec = clients.get(ext)
+            if rec is not None and rec.conn is self.conn and rec.state == pbx_calltable.IN_CALL:
+                # Hung up like any call first, while the record is still there
+                call_gone(ext)
+            # A newer connection may have re-registered the same extension
+            rec = clients.unregister(ext, self.conn)
+            if rec is not None:
+                pbx_ivr.leave(ext)
+            if rec is not None and rec.state == pbx_calltable.RINGING:
+                pbx_cdr.end(rec.cdr)
+                ringing_gone(rec)
+            elif rec is not None and rec.state == pbx_calltable.CONFERENCE:
+                conference_leave(ext, rec.peer)
+        if self.detached:
+            self.conn.detach()
+            return
+        self.conn.close()
+        pbx_log.info("disconnect", "Αποσύνδεση {ext}", ext=ext, addr=self.addr)
+
+
+class TrunkSession(Session):
+    """Inbound trunk connection (messages FROM a remote PBX).
+
+    The remote side opens with trunk_hello naming its node and the framings
+    it can send; we answer with trunk_hello_ok on the same socket.  Replies
+    to the calls it sets up go back out on our outbound link of that name.
+    """
+
+    def __init__(self, conn):
+        super().__init__(conn)
+        # A peer that predates trunk_hello can only be our single trunk
+        real = [name for name in trunk_outbound if name not in worker_links]
+        self.trunk = real[0] if len(real) == 1 else None
+        # counts and acknowledges what a spooling peer sends (pbx_spool)
+        self.receiver = None
+        pbx_log.info("trunk_in_up", "TRUNK inbound συνδέθηκε.")
+
+    def handle(self, msg):
+        mtype = msg.get("type")
+
+        if mtype == "trunk_hello":
+            node = msg.get("node")
+            if node in trunk_outbound and node not in worker_links:
+                self.trunk = node
+                pbx_log.info("trunk_in_hello", "TRUNK inbound από {node}", node=node)
+            else:
+                pbx_log.warning("trunk_in_unknown", "TRUNK inbound από άγνωστο κόμβο {node!r}",
+                                node=node)
+            reply = {
+                "type": "trunk_hello_ok",
+                "node": node_name,
+                "framing": pbx_codec.choose(msg.get("framings")).name
+            }
+            seq = msg.get("seq")
+            if self.trunk is not None and isinstance(seq, int):
+                if self.receiver is not None:
+                    self.receiver.close()
+                self.receiver = pbx_spool.Receiver(node, msg.get("epoch"), seq, self.conn)
+                reply["ack"] = self.receiver.last
+            send_json(self.conn, reply)
+            return
+
+        if self.trunk is None:
+            # Cannot route replies for an unidentified peer
+            return
+
+        if self.receiver is not None and not self.receiver.accept():
+            # Replayed after a reconnect, but we had it the first time
+            return
+
+        if worker is not None and mtype in ("trunk_subscribe", "trunk_presence"):
+            presence_from_trunk(msg, self.trunk)
+            return
+
+        owner = owner_of(msg.get("to") or "")
+        if owner is not None and owner != worker.id:
+            # Hub: the destination belongs to another worker, which answers
+            # back through us on this trunk
+            trunk_send(pbx_workers.link_name(owner), dict(msg, trunk=self.trunk))
+            return
+
+        dispatch_trunk(msg, self.trunk)
+
+    def close(self):
+        if self.trunk is not None:
+            # The other side subscribes again when its link comes back
+            pbx_presence.unsubscribe((pbx_presence.TRUNK, self.trunk))
+        if self.receiver is not None:
+            self.receiver.close()
+        self.conn.close()
+        pbx_log.info("trunk_in_down", "TRUNK inbound έκλεισε.", trunk=self.trunk)
+
+
+def dispatch_trunk(msg, trunk):
+    """Run the handler of a trunk message that arrived over `trunk`."""
+    mtype = msg.get("type")
+    if mtype == "trunk_call":
+        handle_incoming_trunk_call(msg, trunk)
+    elif mtype == "trunk_call_answered":
+        handle_trunk_answer(msg)
+    elif mtype == "trunk_hangup":
+        handle_trunk_hangup(msg)
+    elif mtype == "trunk_busy":
+        handle_trunk_busy(msg)
+    elif mtype == "trunk_chat":
+        handle_trunk_chat(msg)
+    elif mtype == "trunk_redirect":
+        handle_trunk_redirect(msg, trunk)
+    elif mtype == "trunk_subscribe":
+        handle_trunk_subscribe(msg, trunk)
+    elif mtype == "trunk_presence":
+        states = msg.get("states")
+        if isinstance(states, dict):
+            pbx_presence.update(states)
+    elif mtype in pbx_reconcile.TYPES:
+        pbx_reconcile.handle(msg, trunk)
+    elif trunk in worker_links:
+        dispatch_conference(msg)
+
+
+class WorkerLinkSession(Session):
+    """Link to a sibling worker (--workers mode), used both ways like a trunk.
+
+    Messages tagged with "trunk" travel between the hub and the worker that
+    owns the local extension of a call on a real trunk: the hub sends them
+    out on that trunk, the owner handles them as if they came in on it.
+    """
+
+    def __init__(self, peer, conn):
+        super().__init__(conn)
+        self.trunk = pbx_workers.link_name(peer)
+        conn.codec = pbx_codec.BINARY    # both ends run this same code
+        with trunk_outbound_lock:
+            trunk_outbound[self.trunk] = conn
+            if peer == pbx_workers.HUB:
+                # Our remote trunks are reached through the hub
+                for name in trunk_outbound:
+                    if name not in worker_links:
+                        trunk_outbound[name] = ViaHub(conn, name)
+
+    def handle(self, msg):
+        via = msg.pop("trunk", None)
+        if via is None:
+            dispatch_trunk(msg, self.trunk)
+        elif worker.is_hub and msg.get("type") == "trunk_subscribe":
+            # Remembered here too, so a reconnected trunk gets it again
+            presence_forward(via, msg.get("exts") or [], msg.get("prefixes") or [])
+        elif worker.is_hub:
+            trunk_send(via, msg)
+        else:
+            dispatch_trunk(msg, via)
+
+    def close(self):
+        with trunk_outbound_lock:
+            trunk_outbound[self.trunk] = None
+        self.conn.close()
+        pbx_log.warning("worker_link_down", "Σύνδεση με worker {trunk} έκλεισε.", trunk=self.trunk)
+
+
+class TrunkLinkSession(Session):
+    """Our outbound side of a trunk: the connection trunk_send writes to.
+
+    A fresh link first announces our node name and framing offer, so the
+    remote PBX can tell which of its trunks the following messages belong
+    to; its trunk_hello_ok tells us which framing to switch to.  On a
+    spooled trunk the hello is numbered and followed by the replay of what
+    the last link left unacknowledged.
+    """
+
+    def __init__(self, trunk, conn):
+        super().__init__(conn)
+        self.trunk = trunk
+        self.spool = spools.get(trunk)
+        self.greeted = False
+        framings = [trunk_framing.name] if trunk_framing is pbx_codec.JSON else [trunk_framing.name, "json"]
+        hello = {
+            "type": "trunk_hello",
+            "node": node_name,
+            "framings": framings
+        }
+        if self.spool is None:
+            send_json(conn, hello)
+        else:
+            self.spool.connected(conn, hello)
+        with trunk_outbound_lock:
+            trunk_outbound[trunk] = conn
+        presence_resubscribe(trunk)
+        presence_refresh(trunk)
+        pbx_log.info("trunk_out_up", "TRUNK {trunk} outbound συνδέθηκε.", trunk=trunk)
+
+    def handle(self, msg):
+        mtype = msg.get("type")
+        if mtype == "trunk_ack":
+            if self.spool is not None:
+                self.spool.ack(msg.get("seq"))
+        elif mtype == "trunk_hello_ok":
+            self.conn.codec = pbx_codec.choose(msg.get("framing"))
+            self.greeted = True
+            if self.spool is not None:
+                self.spool.greeted(msg.get("ack"))
+            pbx_log.info("trunk_framing", "TRUNK {trunk} framing {framing}",
+                         trunk=self.trunk, framing=self.conn.codec.name)
+            # Calls either side lost track of during the outage
+            pbx_reconcile.start(self.trunk)
+
+    def close(self):
+        if self.spool is not None:
+            self.spool.disconnected(self.conn)
+        with trunk_outbound_lock:
+            if trunk_outbound.get(self.trunk) is self.conn:
+                trunk_outbound[self.trunk] = None
+        self.conn.close()
+        pbx_log.info("trunk_out_down", "TRUNK {trunk} outbound έκλεισε.", trunk=self.trunk)
+
+
+def read_loop(sock, session):
+    """Feed everything read from a blocking socket to its session until EOF."""
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return
+        session.feed(data)
+        if session.detached:
+            return
 
 
 # ============================================================
 #  CLIENT THREAD
 # ============================================================
 
-def client_thread(conn, addr, local_prefix, remote_prefix, ivr_ext):
-    ext = None
-    print(f"[PBX] Σύνδεση από {addr}")
-    f = conn.makefile("r", encoding="utf-8")
-
+def client_thread(sock, addr, local_prefix, ivr_ext, initial=b""):
+    session = ClientSession(OutboundQueue(sock, "client"), addr, local_prefix, ivr_ext)
     try:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                msg = json.loads(line)
-            except json.JSONDecodeError:
-                continue
-
-            mtype = msg.get("type")
-
-            # Registration
-            if mtype == "register":
-                ext = msg.get("extension")
-                if not ext:
-                    continue
-                with lock:
-                    clients[ext] = {
-                        "conn": conn,
-                        "addr": addr,
-                        "state": "idle",
-                        "peer": None,
-                        "remote": False
-                    }
-                print(f"[PBX] Extension {ext} registered από {addr}")
-                send_json(conn, {
-                    "type": "register_ok",
-                    "extension": ext
-                })
-                continue
-
-            if ext is None:
-                # Ignore messages from unregistered clients
-                continue
-
-            if mtype == "call":
-                dest = msg.get("to")
-                if not dest:
-                    continue
-                handle_call(ext, dest, local_prefix, remote_prefix, ivr_ext)
-
-            elif mtype == "answer":
-                handle_answer(ext)
-
-            elif mtype == "hangup":
-                handle_hangup(ext)
-
-            elif mtype == "ivr":
-                dest = msg.get("to")
-                # Only allow IVR calls to the local IVR number
-                if dest == ivr_ext:
-                    ivr_start(ext, ivr_ext, local_prefix)
-                else:
-                    c = get_client(ext)
-                    if c:
-                        send_json(c["conn"], {
-                            "type": "error",
-                            "reason": "Δεν επιτρέπεται κλήση IVR σε αυτόν τον αριθμό."
-                        })
-
-            elif mtype == "ivr_choice":
-                digit = msg.get("digit")
-                if digit is not None:
-                    ivr_choice(ext, str(digit), local_prefix, remote_prefix)
-
-            elif mtype == "chat":
-                text = msg.get("text", "")
-                handle_chat(ext, text)
+        if initial:
+            # Bytes a sibling worker read before handing the connection over
+            session.feed(initial)
+        if not session.detached:
+            read_loop(sock, session)
 
     except Exception as e:
-        print(f"[PBX] Σφάλμα client {addr}: {e}")
+        pbx_log.warning("client_error", "Σφάλμα client {addr}: {error}", addr=addr, error=e)
 
     finally:
-        if ext:
-            with lock:
-                if ext in clients:
-                    clients.pop(ext)
-        conn.close()
-        print(f"[PBX] Αποσύνδεση {ext}")
+        session.close()
+        pbx_admission.closed()
 
 
 # ============================================================
 #  TRUNK HANDLERS
 # ============================================================
 
-def trunk_inbound_thread(conn):
+def trunk_inbound_thread(sock):
     """Handle messages coming FROM the remote PBX."""
-    print("[PBX] TRUNK inbound συνδέθηκε.")
-    f = conn.makefile("r", encoding="utf-8")
-
+    session = TrunkSession(OutboundQueue(sock, "trunk"))
     try:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                msg = json.loads(line)
-            except json.JSONDecodeError:
-                continue
-
-            mtype = msg.get("type")
-
-            if mtype == "trunk_call":
-                handle_incoming_trunk_call(msg)
-            elif mtype == "trunk_call_answered":
-                handle_trunk_answer(msg)
-            elif mtype == "trunk_hangup":
-                handle_trunk_hangup(msg)
-            elif mtype == "trunk_busy":
-                handle_trunk_busy(msg)
-            elif mtype == "trunk_chat":
-                handle_trunk_chat(msg)
+        read_loop(sock, session)
 
     except Exception as e:
-        print(f"[PBX] Σφάλμα TRUNK inbound: {e}")
+        pbx_log.warning("trunk_in_error", "Σφάλμα TRUNK inbound: {error}", error=e)
+    finally:
+        session.close()
+
+
+def worker_link_thread(peer, sock):
+    """Serve the link to one sibling worker (--workers mode)."""
+    session = WorkerLinkSession(peer, OutboundQueue(sock, "trunk"))
+    try:
+        read_loop(sock, session)
+    except Exception as e:
+        pbx_log.error("worker_link_error", "Σφάλμα link worker {peer}: {error}",
+                      peer=peer, error=e)
     finally:
-        print("[PBX] TRUNK inbound έκλεισε.")
+        session.close()
 
 
-def trunk_outbound_connector(host, port):
-    """Continuously try to connect outbound trunk to the remote PBX."""
-    global trunk_outbound
+def handoff_receiver(local_prefix, ivr_ext):
+    """Adopt the connections sibling workers hand over to us."""
     while True:
+        got = worker.receive()
+        if got is None:
+            continue
+        sock, payload = got
+        try:
+            sock.setblocking(True)
+            addr = sock.getpeername()
+        except OSError:
+            sock.close()
+            continue
+        pbx_admission.adopted()
+        threading.Thread(
+            target=client_thread,
+            args=(sock, addr, local_prefix, ivr_ext, payload),
+            daemon=True
+        ).start()
+
+
+def trunk_outbound_connector(trunk, host, port):
+    """Continuously try to connect one outbound trunk to its remote PBX.
+
+    Failed attempts back off (pbx_spool.backoff); a link the other side
+    greeted starts the count over.
+    """
+    attempt = 0
+    while True:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.connect((host, port))
-            with trunk_outbound_lock:
-                trunk_outbound = s
-            print("[PBX] TRUNK outbound συνδέθηκε.")
-            f = s.makefile("r", encoding="utf-8")
-            for _ in f:
-                # We don't expect messages on the outbound side; inbound thread handles them.
-                pass
         except Exception as e:
-            print(f"[PBX] TRUNK outbound απέτυχε ({e}), retry σε 1sec")
-            time.sleep(1)
+            s.close()
+            delay = pbx_spool.backoff(attempt)
+            attempt += 1
+            pbx_log.warning("trunk_out_retry",
+                            "TRUNK {trunk} outbound απέτυχε ({error}), retry σε {delay:.1f}sec",
+                            trunk=trunk, error=e, delay=delay)
+            time.sleep(delay)
+            continue
+
+        session = TrunkLinkSession(trunk, OutboundQueue(s, "trunk"))
+        try:
+            read_loop(s, session)
+        except Exception as e:
+            pbx_log.warning("trunk_out_error", "Σφάλμα TRUNK {trunk} outbound: {error}",
+                            trunk=trunk, error=e)
+        finally:
+            session.close()
+        if session.greeted:
+            attempt = 0
+        else:
+            # connected but dropped before the hello went through: back off as well
+            time.sleep(pbx_spool.backoff(attempt))
+            attempt += 1
+
+
+# ============================================================
+#  METRICS
+# ============================================================
+
+def active_calls():
+    local_legs = trunk_legs = 0
+    for _, state, _, remote, _ in clients.snapshot():
+        if state == pbx_calltable.IN_CALL:
+            if remote:
+                trunk_legs += 1
+            else:
+                local_legs += 1
+    return {("local",): local_legs // 2, ("trunk",): trunk_legs}
+
+
+def outq_gauge(key):
+    return lambda: {(kind,): pbx_outq.stats(kind)[key] for kind in ("client", "trunk")}
+
+
+def trunks_up():
+    with trunk_outbound_lock:
+        return {(name,): int(conn is not None) for name, conn in trunk_outbound.items()}
+
+
+def snapshot_records():
+    """What pbx_snapshot saves: every registration, and those of the last snapshot not back yet."""
+    records = [(token, ext, codec, conn.codec.name, state, peer, remote, trunk)
+               for token, ext, codec, conn, state, peer, remote, trunk in clients.export()
+               if token is not None]
+    if snapshot is not None and len(snapshot.used) < len(snapshot):
+        live = {r[1] for r in records}
+        records += [r for r in snapshot.records() if r[1] not in live]
+    return records
+
+
+def register_gauges():
+    """Scrape-time gauges over the server's own state."""
+    pbx_metrics.gauge("pbx_registered_extensions", "Extensions currently registered.",
+                      lambda: len(clients))
+    pbx_metrics.gauge("pbx_active_calls", "Calls in progress, by kind.", active_calls, ("kind",))
+    pbx_metrics.gauge("pbx_ivr_sessions", "Extensions inside an IVR menu.", pbx_ivr.active)
+    pbx_metrics.counter_callback("pbx_ivr_sessions_total",
+                                 "IVR sessions entered, and how they ended.",
+                                 lambda: {(k,): v for k, v in pbx_ivr.stats.items()}, ("outcome",))
+    pbx_metrics.gauge("pbx_trunk_up", "1 while the outbound link of a trunk is connected.",
+                      trunks_up, ("trunk",))
+    pbx_metrics.gauge("pbx_trunk_spooled", "Messages sent on a trunk and not acknowledged yet.",
+                      lambda: {(name,): len(spool) for name, spool in spools.items()}, ("trunk",))
+    pbx_metrics.counter_callback("pbx_trunk_spool_total",
+                                 "Spooled trunk messages, by what became of them.",
+                                 lambda: {(k,): pbx_spool.stats[k]
+                                          for k in ("replayed", "dropped", "duplicates")},
+                                 ("result",))
+    pbx_metrics.counter_callback("pbx_trunk_ack_timeouts_total",
+                                 "Trunk links dropped for not acknowledging in time.",
+                                 lambda: pbx_spool.stats["dead"])
+    pbx_metrics.counter_callback("pbx_trunk_sync_rounds_total",
+                                 "Call-state reconciliation rounds started after a trunk "
+                                 "reconnect.", lambda: pbx_reconcile.stats["rounds"])
+    pbx_metrics.counter_callback("pbx_trunk_sync_pairs_total",
+                                 "Calls listed to the other PBX while reconciling.",
+                                 lambda: pbx_reconcile.stats["pairs_sent"])
+    pbx_metrics.counter_callback("pbx_trunk_sync_orphans_total",
+                                 "Call legs hung up because the other PBX did not have them.",
+                                 lambda: pbx_reconcile.stats["orphans"])
+    pbx_metrics.gauge("pbx_connections", "Open connections, by kind.",
+                      outq_gauge("connections"), ("kind",))
+    pbx_metrics.gauge("pbx_outq_queued_bytes", "Bytes waiting in outbound queues, by kind.",
+                      outq_gauge("queued_bytes"), ("kind",))
+    pbx_metrics.gauge("pbx_outq_max_queued_bytes", "Deepest single outbound queue, by kind.",
+                      outq_gauge("max_queued_bytes"), ("kind",))
+    pbx_metrics.gauge("pbx_outq_throttled", "Queues dropping above their high watermark.",
+                      outq_gauge("throttled"), ("kind",))
+    pbx_metrics.counter_callback("pbx_outq_dropped_messages_total",
+                                 "Messages dropped by outbound queues.",
+                                 lambda: pbx_outq.stats()["dropped_msgs"])
+    pbx_metrics.counter_callback("pbx_outq_evictions_total",
+                                 "Slow consumers disconnected.",
+                                 lambda: pbx_outq.stats()["evictions"])
+    pbx_metrics.counter_callback("pbx_trunk_batches_total", "Coalesced trunk writes.",
+                                 lambda: pbx_outq.batch_stats("trunk")["batches"])
+    pbx_metrics.counter_callback("pbx_trunk_batched_messages_total",
+                                 "Messages sent in coalesced trunk writes.",
+                                 lambda: pbx_outq.batch_stats("trunk")["messages"])
+    pbx_metrics.gauge("pbx_endpoint_connections", "Endpoint connections admitted and open.",
+                      pbx_admission.open_connections)
+    pbx_metrics.counter_callback("pbx_admission_refused_total",
+                                 "Endpoint connections refused, by the limit they hit.",
+                                 lambda: {(k,): n for k, n in pbx_admission.stats.items()},
+                                 ("limit",))
+    pbx_metrics.gauge("pbx_calls_ringing", "Calls ringing with a no-answer timeout armed here.",
+                      lambda: len(ringing))
+    pbx_metrics.gauge("pbx_dialplan_rules", "Rules in the dial plan.", lambda: len(dialplan))
+    pbx_metrics.gauge("pbx_dialplan_states", "States of the compiled dial plan automata.",
+                      lambda: dialplan.states)
+    pbx_metrics.gauge("pbx_timers_armed", "Timers armed on the timing wheel.", pbx_timers.armed)
+    pbx_metrics.counter_callback("pbx_timers_fired_total", "Timers that ran out.",
+                                 lambda: pbx_timers.wheel.fired)
+    pbx_metrics.gauge("pbx_threads", "Live threads in the process.", threading.active_count)
+    pbx_metrics.counter_callback("pbx_log_records_total", "Log records by what became of them.",
+                                 lambda: {(k,): pbx_log.stats[k]
+                                          for k in ("written", "dropped", "suppressed")},
+                                 ("result",))
+    pbx_metrics.gauge("pbx_media_relays", "Calls with an open media relay.", pbx_media.active)
+    pbx_metrics.counter_callback("pbx_media_packets_total", "Media packets, by result.",
+                                 lambda: {("relayed",): pbx_media.stats["packets"],
+                                          ("dropped",): pbx_media.stats["dropped"]},
+                                 ("result",))
+    pbx_metrics.counter_callback("pbx_media_bytes_total", "Media bytes relayed.",
+                                 lambda: pbx_media.stats["bytes"])
+    pbx_metrics.counter_callback("pbx_media_transcoded_packets_total",
+                                 "Relayed media packets converted between codecs.",
+                                 lambda: pbx_media.stats["transcoded"])
+    pbx_metrics.counter_callback("pbx_media_exhausted_total",
+                                 "Answered calls left without a relay (no free ports).",
+                                 lambda: pbx_media.stats["exhausted"])
+    pbx_metrics.gauge("pbx_conference_rooms", "Conference rooms open.", pbx_conference.rooms)
+    pbx_metrics.gauge("pbx_conference_participants", "Extensions in a conference.",
+                      pbx_conference.participants)
+    pbx_metrics.counter_callback("pbx_conference_frames_total",
+                                 "Conference frames, by what became of them.",
+                                 lambda: {(k,): pbx_conference.stats[k]
+                                          for k in ("mixed", "lost", "late", "invalid", "dropped")},
+                                 ("result",))
+    pbx_metrics.counter_callback("pbx_conference_overruns_total",
+                                 "Mixer ticks skipped because the mixer fell behind.",
+                                 lambda: pbx_conference.stats["overruns"])
+    pbx_metrics.gauge("pbx_presence_subscribers", "Endpoints and trunks watching extensions here.",
+                      pbx_presence.subscribers)
+    pbx_metrics.counter_callback("pbx_presence_changes_total",
+                                 "State changes of watched extensions.",
+                                 lambda: pbx_presence.stats["changes"])
+    pbx_metrics.counter_callback("pbx_presence_notifications_total",
+                                 "Presence messages sent (each carries every state that changed).",
+                                 lambda: pbx_presence.stats["notifications"])
+    pbx_metrics.counter_callback("pbx_snapshots_total", "Registration snapshots written.",
+                                 lambda: pbx_snapshot.stats["written"])
+    pbx_metrics.gauge("pbx_queue_waiting", "Callers waiting in a call queue.",
+                      pbx_acd.waiting, ("queue",))
+    pbx_metrics.gauge("pbx_queue_idle_agents", "Agents of a call queue free to take a call.",
+                      pbx_acd.idle_agents, ("queue",))
+    pbx_metrics.counter_callback("pbx_queue_calls_total",
+                                 "Queue calls handed to an agent or abandoned in line.",
+                                 pbx_acd.calls, ("queue", "result"))
+    pbx_metrics.gauge("pbx_snapshot_records", "Registrations in the last snapshot.",
+                      lambda: pbx_snapshot.stats["records"])
+    pbx_metrics.gauge("pbx_snapshot_seconds", "Time the last snapshot took to write.",
+                      lambda: pbx_snapshot.stats["seconds"])
+    pbx_metrics.gauge("pbx_cdr_pending", "Finished calls waiting for the CDR writer.",
+                      pbx_cdr.pending)
+    pbx_metrics.counter_callback("pbx_cdr_records_total", "CDRs by what became of them.",
+                                 lambda: {(k,): pbx_cdr.stats[k]
+                                          for k in ("written", "dropped", "failed")},
+                                 ("result",))
 
 
 # ============================================================
@@ -599,29 +1798,342 @@ def trunk_outbound_connector(host, port):
 # ============================================================
 
 def main():
+    global node_name, trunk_framing, worker, snapshot, resume_tokens, ring_timeout, idle_timeout
+
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", required=True)
     parser.add_argument("--port", type=int, required=True)
     parser.add_argument("--mode", choices=["A", "B"], required=True)
     parser.add_argument("--prefix", required=True)
-    parser.add_argument("--remote-prefix", required=True)
+    parser.add_argument("--remote-prefix")
     parser.add_argument("--ivr-ext", required=True)
-    parser.add_argument("--trunk-remote-host", required=True)
-    parser.add_argument("--trunk-remote-port", type=int, required=True)
+    parser.add_argument("--trunk-remote-host")
+    parser.add_argument("--trunk-remote-port", type=int)
     parser.add_argument("--trunk-listen-port", type=int, required=True)
+    parser.add_argument("--routes",
+                        help="routes file (trunk/route lines); replaces --remote-prefix "
+                             "and --trunk-remote-host/--trunk-remote-port")
+    parser.add_argument("--node", help="our name in trunk_hello (default: --mode)")
+    parser.add_argument("--dialplan", metavar="PATH",
+                        help="dial plan file (patterns per context); reloaded on SIGHUP. "
+                             "Default: --ivr-ext, --prefix local, --remote-prefix 000 blocked, "
+                             "the rest by --routes")
+    parser.add_argument("--ivr-menus", metavar="PATH",
+                        help="IVR menus file (menu/option lines); default: one menu, "
+                             "0 for information, 1-9 for --prefix001-009")
+    parser.add_argument("--queues", metavar="PATH",
+                        help="ACD call queues file (queue/member lines)")
+    parser.add_argument("--trunk-framing", choices=sorted(pbx_codec.CODECS), default="json",
+                        help="framing offered on outbound trunks (json is always the fallback)")
+    parser.add_argument("--engine", choices=["thread", "asyncio"], default="thread",
+                        help="thread: one OS thread per socket; asyncio: one event loop for all sockets")
+    parser.add_argument("--backlog", type=int, default=100,
+                        help="listen() backlog of the endpoint socket")
+    parser.add_argument("--max-connections", type=int, default=0,
+                        help="endpoint connections open at once (0: no limit; per worker)")
+    parser.add_argument("--ip-rate", type=float, default=0.0,
+                        help="new endpoint connections per second from one IP (0: no limit)")
+    parser.add_argument("--ip-burst", type=int, default=0,
+                        help="connections one IP may open at once above --ip-rate "
+                             "(default: one second's worth)")
+    parser.add_argument("--register-rate", type=float, default=0.0,
+                        help="registrations per second the PBX accepts (0: no limit; per worker)")
+    parser.add_argument("--register-burst", type=int, default=0,
+                        help="registrations accepted at once above --register-rate "
+                             "(default: one second's worth)")
+    parser.add_argument("--ring-timeout", type=float, default=60.0,
+                        help="seconds a call rings before it is given up as not answered "
+                             "(0: no timeout)")
+    parser.add_argument("--idle-timeout", type=float, default=0.0,
+                        help="ping an endpoint silent for half this many seconds and drop it "
+                             "once silent for all of them (0: never)")
+    parser.add_argument("--outq-high", type=int, default=256 * 1024,
+                        help="endpoint outbound queue high watermark (bytes)")
+    parser.add_argument("--outq-low", type=int, default=64 * 1024,
+                        help="endpoint outbound queue low watermark (bytes)")
+    parser.add_argument("--outq-policy", choices=pbx_outq.POLICIES, default="disconnect",
+                        help="what to do with an endpoint above the high watermark")
+    parser.add_argument("--trunk-outq-high", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--trunk-outq-low", type=int, default=1024 * 1024)
+    parser.add_argument("--trunk-outq-policy", choices=pbx_outq.POLICIES, default="drop")
+    parser.add_argument("--trunk-batch-window", type=float, default=0.0,
+                        help="ms to hold trunk messages for coalescing (0: merge only what is queued)")
+    parser.add_argument("--trunk-batch-bytes", type=int, default=64 * 1024,
+                        help="flush a trunk batch early once it reaches this many bytes")
+    parser.add_argument("--trunk-spool", type=int, default=100_000,
+                        help="messages kept per trunk until the other PBX acknowledges them, "
+                             "replayed after a reconnect (0: no spool)")
+    parser.add_argument("--trunk-retry-min", type=float, default=0.5,
+                        help="seconds before the first trunk reconnect attempt")
+    parser.add_argument("--trunk-retry-max", type=float, default=30.0,
+                        help="longest wait between trunk reconnect attempts (doubling from "
+                             "--trunk-retry-min, with jitter)")
+    parser.add_argument("--admin-host", default="127.0.0.1",
+                        help="address of the admin port")
+    parser.add_argument("--admin-port", type=int,
+                        help="serve Prometheus metrics on this port at /metrics")
+    parser.add_argument("--no-metrics", action="store_true",
+                        help="do not record counters and latency histograms")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the endpoint port (extensions are "
+                             "sharded across them; admin ports are --admin-port + worker id)")
+    parser.add_argument("--cdr", metavar="PATH",
+                        help="write call detail records here (per worker: PATH with .w<id> "
+                             "before the extension)")
+    parser.add_argument("--cdr-format", choices=pbx_cdr.FORMATS, default="sqlite",
+                        help="sqlite database or append-only JSON lines")
+    parser.add_argument("--cdr-batch", type=int, default=1000,
+                        help="most CDRs written in one transaction")
+    parser.add_argument("--cdr-interval", type=float, default=0.5,
+                        help="seconds to let CDRs gather between writes")
+    parser.add_argument("--cdr-rotate-bytes", type=int, default=64 * 1024 * 1024,
+                        help="start a new JSON lines file past this size (0: never)")
+    parser.add_argument("--log-level", choices=sorted(pbx_log.LEVELS, key=pbx_log.LEVELS.get),
+                        default="info")
+    parser.add_argument("--log-format", choices=pbx_log.FORMATS, default="text",
+                        help="text lines as before, or one JSON object per record")
+    parser.add_argument("--log-sample", action="append", metavar="EVENT=N",
+                        help="log one in N records of EVENT (e.g. register=100); repeatable")
+    parser.add_argument("--log-rate", action="append", metavar="EVENT=N",
+                        help="log at most N records of EVENT per second; repeatable")
+    parser.add_argument("--media-ports", metavar="LOW-HIGH",
+                        help="relay the media of answered calls over UDP ports in this range "
+                             "(two per call; off when not given)")
+    parser.add_argument("--media-host",
+                        help="address the media relay binds to (default: --host)")
+    parser.add_argument("--media-advertise",
+                        help="address put in call_answered for media (default: --media-host, "
+                             "or this host's address when that is a wildcard)")
+    parser.add_argument("--conference-jitter", type=float, default=60.0,
+                        help="ms of jitter buffer per conference participant")
+    parser.add_argument("--conference-max", type=int, default=50,
+                        help="most participants in one conference room")
+    parser.add_argument("--presence-interval", type=float, default=50.0,
+                        help="ms over which presence changes are coalesced per subscriber")
+    parser.add_argument("--snapshot", metavar="PATH",
+                        help="save registrations here and let endpoints resume from it after "
+                             "a restart (per worker: PATH with .w<id> before the extension)")
+    parser.add_argument("--snapshot-interval", type=float, default=10.0,
+                        help="seconds between snapshots (one more is written at exit)")
+    parser.add_argument("--presence-max", type=int, default=10_000,
+                        help="most extensions and prefixes one endpoint may watch")
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.ring_timeout < 0 or args.idle_timeout < 0:
+        parser.error("--ring-timeout and --idle-timeout cannot be negative")
+    ring_timeout = args.ring_timeout
+    idle_timeout = args.idle_timeout
+    try:
+        pbx_log.configure(args.log_level, args.log_format,
+                          pbx_log.parse_limits(args.log_sample, int),
+                          pbx_log.parse_limits(args.log_rate, float))
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        pbx_outq.configure("client", args.outq_high, args.outq_low, args.outq_policy)
+        pbx_outq.configure("trunk", args.trunk_outq_high, args.trunk_outq_low,
+                           args.trunk_outq_policy, args.trunk_batch_window / 1000,
+                           args.trunk_batch_bytes)
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        pbx_spool.configure(args.trunk_spool, args.trunk_retry_min, args.trunk_retry_max)
+    except ValueError as e:
+        parser.error(f"--trunk-spool/--trunk-retry-min/--trunk-retry-max: {e}")
+
+    node_name = args.node or args.mode
+    trunk_framing = pbx_codec.CODECS[args.trunk_framing]
+    if args.routes:
+        try:
+            trunks, prefixes = load_routes(args.routes)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+    elif args.remote_prefix and args.trunk_remote_host and args.trunk_remote_port:
+        # Classic two-PBX setup: a single trunk named after the other center
+        other = "B" if args.mode == "A" else "A"
+        trunks = {other: (args.trunk_remote_host, args.trunk_remote_port)}
+        prefixes = {args.remote_prefix: other}
+    else:
+        parser.error("either --routes or --remote-prefix, --trunk-remote-host "
+                     "and --trunk-remote-port are required")
+    routes.replace(prefixes)
+    for name in trunks:
+        trunk_outbound[name] = None
+    pbx_log.info("routes", "{trunks} trunks, {routes} routes",
+                 trunks=len(trunks), routes=len(routes))
+
+    queues = {}
+    if args.queues:
+        if args.workers > 1:
+            parser.error("--queues needs a single process (no --workers)")
+        try:
+            queues = pbx_acd.load_queues(args.queues)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
 
     local_prefix = args.prefix
     remote_prefix = args.remote_prefix
     ivr_ext = args.ivr_ext
+    if args.dialplan:
+        try:
+            dialplan.replace(pbx_dialplan.load_dialplan(args.dialplan, trunks, ERRORS))
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+    else:
+        dialplan.replace(pbx_dialplan.default_plan(local_prefix, remote_prefix, ivr_ext))
+    pbx_log.info("dialplan", "Σχέδιο κλήσεων: {rules} κανόνες, {states} καταστάσεις",
+                 rules=len(dialplan), states=dialplan.states)
+    if args.ivr_menus:
+        try:
+            ivr_menus = pbx_ivr.load_menus(args.ivr_menus)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+    else:
+        ivr_menus = pbx_ivr.default_menus(ivr_ext, local_prefix)
+
+    pbx_metrics.enabled = not args.no_metrics
+    register_gauges()
+
+    admin_port = args.admin_port
+    if args.workers > 1:
+        # Fork before any thread or event loop exists; the parent stays in spawn()
+        worker = pbx_workers.spawn(args.workers)
+        for peer in worker.links:
+            worker_links.add(pbx_workers.link_name(peer))
+            trunk_outbound[pbx_workers.link_name(peer)] = None
+        if admin_port:
+            admin_port += worker.id
+        pbx_log.info("worker", "Worker {worker}/{count} (pid {pid})",
+                     worker=worker.id, count=worker.count, pid=os.getpid())
+
+    if args.trunk_spool and (worker is None or worker.is_hub):
+        for name in trunks:
+            spools[name] = pbx_spool.Spool(name)
+
+    if args.media_ports:
+        media_host = args.media_host or args.host
+        advertise = args.media_advertise or media_host
+        if advertise in ("0.0.0.0", ""):
+            advertise = socket.gethostbyname(socket.gethostname())
+        try:
+            low, _, high = args.media_ports.partition("-")
+            pbx_media.configure(media_host, advertise, int(low), int(high),
+                                worker.id if worker else 0, worker.count if worker else 1)
+        except ValueError as e:
+            parser.error(f"--media-ports: {e}")
+        pbx_media.start()
+        pbx_log.info("media", "Media relay στο {host}:{ports} (advertised {advertise})",
+                     host=media_host, ports=args.media_ports, advertise=advertise)
+        try:
+            pbx_conference.configure(args.conference_jitter, args.conference_max)
+        except ValueError as e:
+            parser.error(f"--conference-jitter/--conference-max: {e}")
+        if pbx_conference.enabled:
+            pbx_conference.start()
+        else:
+            pbx_log.warning("conference", "Χωρίς NumPy δεν υπάρχουν conferences.")
+
+    try:
+        pbx_presence.configure(presence_deliver, presence_state, args.presence_interval,
+                               args.presence_max)
+    except ValueError as e:
+        parser.error(f"--presence-interval/--presence-max: {e}")
+    clients.listener = table_changed
+    if queues:
+        pbx_acd.configure(queues, queue_connect, table_state)
+        pbx_log.info("queues", "{queues} ουρές κλήσεων, {agents} agents",
+                     queues=len(queues), agents=len(pbx_acd.agents))
+    pbx_ivr.configure(ivr_menus, ivr_ext, ivr_send, ivr_error, ivr_transfer, ivr_queue,
+                      table_state)
+    unknown = pbx_ivr.queue_targets() - set(pbx_acd.queues)
+    if unknown:
+        parser.error(f"--ivr-menus: no such queue {', '.join(sorted(unknown))} (--queues)")
+    pbx_log.info("ivr", "IVR {ext}: {menus} μενού", ext=ivr_ext, menus=len(pbx_ivr.menus))
+    if worker is None:
+        pbx_reconcile.configure(node_name, trunk_send,
+                                lambda local, remote: handle_trunk_hangup({"from": remote,
+                                                                          "to": local}))
+        clients.index = pbx_reconcile
+
+    try:
+        pbx_admission.configure(args.max_connections, args.ip_rate, args.ip_burst,
+                                args.register_rate, args.register_burst)
+    except ValueError as e:
+        parser.error(f"admission limits: {e}")
+
+    pbx_log.start()
+    # Write out queued log records (and CDRs) on exit, including on SIGTERM
+    atexit.register(pbx_log.stop)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Compiling a large plan takes a while: off the signal handler, in a thread
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+        target=reload_dialplan, args=(args.dialplan, trunks), daemon=True).start())
+
+    if args.cdr:
+        path = args.cdr
+        if worker is not None:
+            root, ext = os.path.splitext(path)
+            path = f"{root}.w{worker.id}{ext}"
+        try:
+            pbx_cdr.start(path, args.cdr_format, args.cdr_batch, args.cdr_interval,
+                          args.cdr_rotate_bytes)
+        except (OSError, sqlite3.Error) as e:
+            parser.error(f"--cdr {path}: {e}")
+        atexit.register(pbx_cdr.stop)
+        pbx_log.info("cdr", "CDR ({format}) στο {path}", format=args.cdr_format, path=path)
+
+    if args.snapshot:
+        path = args.snapshot
+        if worker is not None:
+            root, ext = os.path.splitext(path)
+            path = f"{root}.w{worker.id}{ext}"
+        t0 = time.perf_counter()
+        snapshot = pbx_snapshot.load(path)
+        if snapshot is not None:
+            pbx_log.info("snapshot", "Snapshot {path}: {count} extensions σε {ms:.1f} ms",
+                         path=path, count=len(snapshot), ms=(time.perf_counter() - t0) * 1000)
+        resume_tokens = True
+        pbx_snapshot.start(path, snapshot_records, args.snapshot_interval)
+        atexit.register(pbx_snapshot.stop)
+
+    if args.engine == "asyncio":
+        import pbx_aio
+        pbx_aio.run(
+            args,
+            trunks,
+            lambda conn, addr: ClientSession(conn, addr, local_prefix, ivr_ext),
+            lambda conn, addr: TrunkSession(conn),
+            TrunkLinkSession,
+            worker,
+            WorkerLinkSession,
+            [(pbx_presence.interval, pbx_presence.flush),
+             (pbx_timers.wheel.resolution, pbx_timers.advance)],
+        )
+        return
+
+    pbx_presence.start()
+    pbx_timers.start()
+
+    if worker is not None:
+        for peer, sock in worker.links.items():
+            threading.Thread(target=worker_link_thread, args=(peer, sock), daemon=True).start()
+        threading.Thread(
+            target=handoff_receiver,
+            args=(local_prefix, ivr_ext),
+            daemon=True
+        ).start()
 
     # Start trunk listener
     def start_trunk_listener():
         srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         srv.bind(("0.0.0.0", args.trunk_listen_port))
-        srv.listen(1)
-        print(f"[PBX] TRUNK listener στο 0.0.0.0:{args.trunk_listen_port}")
+        srv.listen(len(trunks) + 1)
+        pbx_log.info("trunk_listen", "TRUNK listener στο 0.0.0.0:{port}",
+                     port=args.trunk_listen_port)
         while True:
             conn, _ = srv.accept()
             threading.Thread(
@@ -630,29 +2142,51 @@ def main():
                 daemon=True
             ).start()
 
-    threading.Thread(target=start_trunk_listener, daemon=True).start()
+    if admin_port:
+        pbx_metrics.start_admin_thread(args.admin_host, admin_port)
+        pbx_log.info("admin_listen", "Admin/metrics στο {host}:{port}",
+                     host=args.admin_host, port=admin_port)
 
-    # Start trunk outbound connector
-    threading.Thread(
-        target=trunk_outbound_connector,
-        args=(args.trunk_remote_host, args.trunk_remote_port),
-        daemon=True
-    ).start()
+    # Only the hub holds the real trunks in worker mode
+    if worker is None or worker.is_hub:
+        threading.Thread(target=start_trunk_listener, daemon=True).start()
+
+        # Start one outbound connector per trunk
+        for name, (host, port) in trunks.items():
+            threading.Thread(
+                target=trunk_outbound_connector,
+                args=(name, host, port),
+                daemon=True
+            ).start()
 
     # Start PBX listener for clients
     srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if worker is not None:
+        srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     srv.bind((args.host, args.port))
-    srv.listen(100)
-    print(f"[PBX] {args.mode} listening on {args.host}:{args.port}")
+    srv.listen(args.backlog)
+    pbx_log.info("listen", "{mode} listening on {host}:{port}",
+                 mode=args.mode, host=args.host, port=args.port)
 
     while True:
         conn, addr = srv.accept()
-        threading.Thread(
-            target=client_thread,
-            args=(conn, addr, local_prefix, remote_prefix, ivr_ext),
-            daemon=True
-        ).start()
+        retry_after = pbx_admission.admit(addr[0])
+        if retry_after is not None:
+            pbx_admission.refuse(conn, retry_after)
+            continue
+        try:
+            threading.Thread(
+                target=client_thread,
+                args=(conn, addr, local_prefix, ivr_ext),
+                daemon=True
+            ).start()
+        except RuntimeError as e:
+            # Out of threads: turn the connection away instead of dying with it
+            pbx_admission.closed()
+            pbx_admission.refuse(conn, pbx_admission.FULL_RETRY)
+            pbx_log.warning("accept_failed", "Αδύνατη η εξυπηρέτηση {addr}: {error}",
+                            addr=addr, error=e)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,220 @@
+"""Registration snapshots: endpoints resume after a restart without registering again.
+
+Every registration gets a random resume token (register_ok carries it as
+"resume_token").  A writer thread saves the call table every `interval`
+seconds and once more at exit: per extension its token, media codec,
+signalling framing and call state.  A restarted server maps the last
+snapshot into memory and an endpoint that reconnects sends
+
+    {"type": "resume", "extension": "5001", "token": "<hex>"}
+
+to get its registration back - framing, codec and the call it was in -
+in one step (resume_ok), or an error telling it to register normally.
+
+The file is built for a start that reads nothing: a header, then one
+fixed-size index entry per extension sorted by token (token, offset of
+its record), then the variable-length records.  load() only maps the file
+and checks the header; find() is a binary search over the mapped index,
+so a snapshot of any size is usable within a millisecond and costs memory
+only for the pages resumes touch.
+
+    header   magic "PBXS", version, count, created (unix time)
+    index    count x (token 16 bytes, record offset u32)
+    record   codec, framing, state, remote (one byte each), then ext,
+             peer, trunk as u8 length + UTF-8
+"""
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+import pbx_codec
+import pbx_log
+from pbx_calltable import CONFERENCE, IDLE, IN_CALL, RINGING
+
+MAGIC = b"PBXS"
+VERSION = 1
+TOKEN_BYTES = 16
+
+HEADER = struct.Struct("!4sHxxId")
+ENTRY = struct.Struct(f"!{TOKEN_BYTES}sI")
+RECORD = struct.Struct("!BBBB")
+
+# byte values of the coded fields; new values only ever go at the end
+CODECS = (None, "PCMU", "PCMA", "L16")
+FRAMINGS = (pbx_codec.JSON.name, pbx_codec.BINARY.name)
+STATES = (IDLE, IN_CALL, CONFERENCE, RINGING)
+
+_writer = None
+
+stats = {"written": 0, "records": 0, "bytes": 0, "seconds": 0.0, "failed": 0}
+
+
+def encode(records, created=None):
+    """Snapshot bytes for (token, ext, codec, framing, state, peer, remote, trunk) tuples."""
+    records = sorted(records, key=lambda r: r[0])
+    codecs = {v: i for i, v in enumerate(CODECS)}
+    framings = {v: i for i, v in enumerate(FRAMINGS)}
+    states = {v: i for i, v in enumerate(STATES)}
+    entries = []
+    body = []
+    offset = HEADER.size + ENTRY.size * len(records)
+    for token, ext, codec, framing, state, peer, remote, trunk in records:
+        record = RECORD.pack(codecs.get(codec, 0), framings.get(framing, 0),
+                             states.get(state, 0), 1 if remote else 0)
+        for field in (ext, peer, trunk):
+            field = field.encode("utf-8")[:255] if field else b""
+            record += bytes((len(field),)) + field
+        entries.append(ENTRY.pack(token, offset))
+        body.append(record)
+        offset += len(record)
+    header = HEADER.pack(MAGIC, VERSION, len(records), time.time() if created is None else created)
+    return b"".join([header, *entries, *body])
+
+
+def write(path, records):
+    """Replace the snapshot at `path` atomically; returns its size in bytes."""
+    data = encode(records)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return len(data)
+
+
+class Snapshot:
+    """A snapshot file mapped into memory."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < HEADER.size:
+            raise ValueError("truncated snapshot")
+        magic, version, self.count, self.created = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a snapshot of this version")
+        if len(self.map) < HEADER.size + ENTRY.size * self.count:
+            raise ValueError("truncated snapshot")
+        self.used = set()       # tokens already resumed; each works once
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def find(self, token):
+        """The record with this token, or None: (ext, codec, framing, state, peer, remote, trunk)."""
+        if len(token) != TOKEN_BYTES or token in self.used:
+            return None
+        m = self.map
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = HEADER.size + mid * ENTRY.size
+            if m[pos:pos + TOKEN_BYTES] < token:
+                lo = mid + 1
+            else:
+                hi = mid
+        pos = HEADER.size + lo * ENTRY.size
+        if lo == self.count or m[pos:pos + TOKEN_BYTES] != token:
+            return None
+        _, offset = ENTRY.unpack_from(m, pos)
+        codec, framing, state, remote = RECORD.unpack_from(m, offset)
+        offset += RECORD.size
+        fields = []
+        for _ in range(3):
+            n = m[offset]
+            fields.append(m[offset + 1:offset + 1 + n].decode("utf-8"))
+            offset += 1 + n
+        ext, peer, trunk = fields
+        return (ext, CODECS[codec] if codec < len(CODECS) else None,
+                FRAMINGS[framing] if framing < len(FRAMINGS) else FRAMINGS[0],
+                STATES[state] if state < len(STATES) else IDLE,
+                peer or None, bool(remote), trunk or None)
+
+    def claim(self, token, ext=None):
+        """find(), and the token is used up if found: of two resumes racing, one gets it.
+
+        With `ext`, only a record of that extension is claimed.
+        """
+        with self._lock:
+            rec = self.find(token)
+            if rec is None or (ext is not None and rec[0] != ext):
+                return None
+            self.used.add(token)
+            return rec
+
+    def records(self):
+        """Every record not resumed yet, in write() form."""
+        m = self.map
+        for i in range(self.count):
+            token = m[HEADER.size + i * ENTRY.size:HEADER.size + i * ENTRY.size + TOKEN_BYTES]
+            if token not in self.used:
+                rec = self.find(token)
+                if rec is not None:
+                    yield (token, *rec)
+
+    def close(self):
+        self.map.close()
+
+
+def load(path):
+    """The snapshot at `path`, or None when there is none (or it is unusable)."""
+    try:
+        return Snapshot(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        pbx_log.warning("snapshot_bad", "Αγνοείται το snapshot {path}: {error}",
+                        path=path, error=e)
+        return None
+
+
+# ============================================================
+#  WRITER
+# ============================================================
+
+def save(path, collect):
+    """Write one snapshot of what collect() returns."""
+    t0 = time.perf_counter()
+    try:
+        records = collect()
+        size = write(path, records)
+    except OSError as e:
+        stats["failed"] += 1
+        pbx_log.warning("snapshot_failed", "Αποτυχία snapshot {path}: {error}",
+                        path=path, error=e)
+        return
+    stats["written"] += 1
+    stats["records"] = len(records)
+    stats["bytes"] = size
+    stats["seconds"] = time.perf_counter() - t0
+
+
+def _run(stop, path, collect, interval):
+    while not stop.wait(interval):
+        save(path, collect)
+    save(path, collect)
+
+
+def start(path, collect, interval=10.0):
+    """Save collect() to `path` every `interval` seconds, and at stop()."""
+    global _writer
+    if _writer is not None:
+        return
+    stop_event = threading.Event()
+    thread = threading.Thread(target=_run, args=(stop_event, path, collect, interval),
+                              name="snapshot", daemon=True)
+    _writer = (thread, stop_event)
+    thread.start()
+
+
+def stop(timeout=5.0):
+    """Stop the writer after a last snapshot."""
+    global _writer
+    writer, _writer = _writer, None
+    if writer is not None:
+        thread, stop_event = writer
+        stop_event.set()
+        thread.join(timeout)
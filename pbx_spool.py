@@ -0,0 +1,265 @@
+"""Trunk outbound spool: messages survive a trunk reconnect.
+
+Every message trunk_send() puts on a trunk gets the trunk's next sequence
+number and stays in its spool until the other PBX acknowledges it.  The
+numbers do not travel inside the messages: they would not fit the fixed
+layouts of the binary framing, and TCP keeps the order within one
+connection anyway.  Instead trunk_hello carries the number of the first
+message after it (and the sender's `epoch`, a random id per process) and
+both sides count from there.  The receiving PBX answers trunk_hello_ok
+with the last number it has handled (`ack`), then acknowledges
+cumulatively with trunk_ack every ACK_EVERY messages, or ACK_DELAY after
+the first one it has not acknowledged yet.
+
+A link that comes back replays everything unacknowledged right after its
+trunk_hello, before anything new; the receiver skips numbers it has
+already handled, so each message is handled once.  A restarted sender
+has a new epoch and is counted afresh.  A spool holds at most `limit`
+messages; past that the oldest go (stats["dropped"]).  A peer whose
+trunk_hello_ok has no ack (an older PBX) never acknowledges: nothing is
+kept for it while its link is up.  A link with messages unacknowledged
+for ACK_TIMEOUT seconds is taken for dead and aborted, which also catches
+a peer that vanished without closing the connection.
+
+Reconnects wait backoff(attempt): exponential from `retry_min` up to
+`retry_max`, the upper half of each step drawn at random so the trunks of
+a restarted PBX do not all come back in step.
+"""
+
+import os
+import random
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+import pbx_log
+import pbx_timers
+
+ACK_EVERY = 128         # messages received before an ack goes out regardless
+ACK_DELAY = 0.05        # seconds an ack may wait for more messages to cover
+ACK_TIMEOUT = 10.0      # seconds without an ack before a busy link counts as dead
+
+EPOCH = os.urandom(8).hex()
+
+limit = 100_000
+retry_min = 0.5
+retry_max = 30.0
+
+_seen = {}              # sending node -> [epoch, last number handled]
+
+stats = {"replayed": 0, "dropped": 0, "duplicates": 0, "dead": 0}
+
+
+def configure(spool_limit=100_000, backoff_min=0.5, backoff_max=30.0):
+    global limit, retry_min, retry_max
+    if spool_limit < 0 or backoff_min <= 0 or backoff_max < backoff_min:
+        raise ValueError("the spool limit cannot be negative and the backoff needs "
+                         "0 < minimum <= maximum")
+    limit = spool_limit
+    retry_min = backoff_min
+    retry_max = backoff_max
+
+
+def backoff(attempt):
+    """Seconds to wait before reconnect attempt `attempt` (0: the first retry)."""
+    step = min(retry_max, retry_min * 2 ** min(attempt, 32))
+    return step / 2 + random.random() * step / 2
+
+
+def _encode(conn, msg, values):
+    if isinstance(msg, dict):
+        return conn.codec.encode(msg)
+    return msg.encode(conn.codec, *values)
+
+
+# ============================================================
+#  SENDING SIDE
+# ============================================================
+
+class Spool:
+    """Unacknowledged messages of one trunk, and the link they go out on.
+
+    Only what the link's outbound queue took counts as sent: a message it
+    drops (above its high watermark) would throw the peer's count off, so
+    it and everything after it wait in the spool until acks show the queue
+    has drained, and go out then.
+    """
+
+    def __init__(self, trunk, size=None):
+        self.trunk = trunk
+        self.size = limit if size is None else size
+        self.items = deque()    # (message, values) not acknowledged yet, oldest first
+        self.first = 1          # number of items[0]
+        self.sent = 1           # number of the next item to write on the link
+        self.conn = None        # link while it is up
+        self.acks = True        # the peer acknowledges (or may: not greeted yet)
+        self.acked_at = 0.0     # when the oldest unacknowledged message started waiting
+        self.timer = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def send(self, msg, values=()):
+        """Number and keep a message, and write it out if the link is up."""
+        lost = None
+        self._lock.acquire()
+        try:
+            conn = self.conn
+            if conn is not None and not self.acks:
+                # An older peer: nothing to replay to it
+                conn.send(_encode(conn, msg, values))
+                return
+            items = self.items
+            if not items:
+                self.acked_at = time.monotonic()
+            items.append((msg, values))
+            if len(items) > self.size:
+                items.popleft()
+                stats["dropped"] += 1
+                if self.sent == self.first and conn is not None:
+                    # never written, and the peer counts on getting it: renumber
+                    # from the next trunk_hello
+                    lost, self.conn = conn, None
+                self.first += 1
+                self.sent = max(self.sent, self.first)
+            if self.conn is not None and self.sent == self.first + len(items) - 1:
+                if conn.send(_encode(conn, msg, values)):
+                    self.sent += 1
+        finally:
+            self._lock.release()
+        if lost is not None:
+            lost.abort()
+
+    def _pump(self):
+        # Called with the lock held: write what the link has not had yet
+        conn = self.conn
+        if conn is None:
+            return 0
+        start = self.sent
+        for msg, values in islice(self.items, self.sent - self.first, None):
+            if not conn.send(_encode(conn, msg, values)):
+                break
+            self.sent += 1
+        return self.sent - start
+
+    def connected(self, conn, hello):
+        """A new link: send `hello` numbered, replay what is unacknowledged, go live."""
+        with self._lock:
+            self.acks = True
+            conn.send(_encode(conn, dict(hello, epoch=EPOCH, seq=self.first), ()))
+            self.acked_at = time.monotonic()
+            self.conn = conn
+            self.sent = self.first
+            stats["replayed"] += self._pump()
+            if self.timer is None:
+                self.timer = pbx_timers.schedule(ACK_TIMEOUT / 2, self._check)
+
+    def greeted(self, ack):
+        """trunk_hello_ok: `ack` is the last number the peer has (None: it does not ack)."""
+        if ack is None:
+            with self._lock:
+                self._pump()
+                self.acks = False
+                self.first = self.sent = self.first + len(self.items)
+                self.items.clear()
+            return
+        self.ack(ack)
+
+    def ack(self, seq):
+        """The peer has handled everything up to `seq`."""
+        if not isinstance(seq, int):
+            return
+        with self._lock:
+            n = min(seq - self.first + 1, self.sent - self.first)
+            if n <= 0:
+                return
+            items = self.items
+            for _ in range(n):
+                items.popleft()
+            self.first += n
+            self.acked_at = time.monotonic()
+            if self.sent < self.first + len(items):
+                self._pump()
+
+    def disconnected(self, conn):
+        with self._lock:
+            if self.conn is conn:
+                self.conn = None
+
+    def _check(self):
+        """Timer: abort a link that has not acknowledged anything for ACK_TIMEOUT."""
+        with self._lock:
+            conn = self.conn
+            dead = (conn is not None and self.acks and self.items
+                    and time.monotonic() - self.acked_at > ACK_TIMEOUT)
+            if conn is None or dead:
+                self.timer = None
+            else:
+                self.timer = pbx_timers.schedule(ACK_TIMEOUT / 2, self._check)
+        if dead:
+            stats["dead"] += 1
+            pbx_log.warning("trunk_ack_timeout",
+                            "TRUNK {trunk}: {count} μηνύματα χωρίς ack για {seconds:.0f}s, "
+                            "νέα σύνδεση", trunk=self.trunk, count=len(self.items),
+                            seconds=ACK_TIMEOUT)
+            conn.abort()
+
+
+# ============================================================
+#  RECEIVING SIDE
+# ============================================================
+
+class Receiver:
+    """Counts the messages of one inbound trunk link and acknowledges them."""
+
+    def __init__(self, node, epoch, seq, conn):
+        state = _seen.get(node)
+        if state is None or state[0] != epoch:
+            # A sender we have not heard from (or that restarted): all of it is new
+            state = _seen[node] = [epoch, seq - 1]
+        self.state = state
+        self.expect = seq
+        self.acked = state[1]
+        self.conn = conn
+        self.timer = None
+        self._lock = threading.Lock()
+
+    @property
+    def last(self):
+        return self.state[1]
+
+    def accept(self):
+        """Count the next message; False for one handled already (a replay)."""
+        n = self.expect
+        self.expect = n + 1
+        state = self.state
+        if n <= state[1]:
+            stats["duplicates"] += 1
+            return False
+        state[1] = n
+        if n - self.acked >= ACK_EVERY:
+            self.flush()
+        elif self.timer is None:
+            with self._lock:
+                if self.timer is None:
+                    self.timer = pbx_timers.schedule(ACK_DELAY, self._delayed)
+        return True
+
+    def _delayed(self):
+        with self._lock:
+            self.timer = None
+        self.flush()
+
+    def flush(self):
+        last = self.state[1]
+        if last > self.acked:
+            self.acked = last
+            conn = self.conn
+            conn.send(conn.codec.encode({"type": "trunk_ack", "seq": last}))
+
+    def close(self):
+        timer = self.timer
+        if timer is not None:
+            pbx_timers.cancel(timer)
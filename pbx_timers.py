@@ -0,0 +1,160 @@
+"""Timers on one hashed timing wheel: no-answer and keepalive timeouts.
+
+These timers are armed and cancelled far more often than they fire (most
+calls are answered, most endpoints keep talking), so both have to be
+O(1) with hundreds of thousands armed.  The wheel has `slots` buckets,
+one per tick of `resolution` seconds; a timer due in n ticks goes into
+bucket (tick + n) & mask and remembers its due tick.  Each tick empties
+only its own bucket of the timers that are due, leaving those a lap or
+more away; cancel() takes a timer out of its bucket.  Timers fire within
+about a tick of when they are due.
+
+There is one wheel per process.  The thread engine turns it from a
+thread of its own (start()), the asyncio engine from a ticker on the
+loop, so there callbacks run on the loop and may touch transports.
+Callbacks run outside the wheel's lock and must not block; one that was
+cancelled while already firing still runs, so they check that what they
+time out is still there.
+"""
+
+import threading
+import time
+
+import pbx_log
+
+RESOLUTION = 0.1        # seconds per tick
+SLOTS = 1024            # a lap of ~100 s: most timeouts are due within one
+
+
+class Timer:
+    __slots__ = ("due", "fn", "args", "slot")
+
+    def __init__(self, due, fn, args):
+        self.due = due      # wheel tick it fires at
+        self.fn = fn
+        self.args = args
+        self.slot = None    # the bucket holding it while armed
+
+    @property
+    def pending(self):
+        """Armed and not fired yet."""
+        return self.slot is not None
+
+
+class Wheel:
+    """A hashed timing wheel; `now` arguments are time.monotonic() values."""
+
+    def __init__(self, resolution=RESOLUTION, slots=SLOTS, now=None):
+        if resolution <= 0 or slots < 1 or slots & (slots - 1):
+            raise ValueError("the resolution must be positive and the slots a power of two")
+        self.resolution = resolution
+        self._mask = slots - 1
+        self._slots = [set() for _ in range(slots)]
+        self._origin = time.monotonic() if now is None else now
+        self._lock = threading.Lock()
+        self.tick = 0           # last tick processed
+        self.armed = 0
+        self.fired = 0
+
+    def schedule(self, delay, fn, *args):
+        """Call fn(*args) in `delay` seconds; returns the Timer to cancel() it with."""
+        ticks = int(-(-delay // self.resolution))
+        # one tick more: the current one is already partly over
+        timer = Timer(self.tick + 1 + (ticks if ticks > 0 else 0), fn, args)
+        # acquire()/release(): a third of what `with` costs, on the hottest path here
+        self._lock.acquire()
+        try:
+            timer.slot = slot = self._slots[timer.due & self._mask]
+            slot.add(timer)
+            self.armed += 1
+        finally:
+            self._lock.release()
+        return timer
+
+    def cancel(self, timer):
+        """Disarm a timer; False when it had already fired (or been cancelled)."""
+        self._lock.acquire()
+        try:
+            slot = timer.slot
+            if slot is None:
+                return False
+            slot.remove(timer)
+            timer.slot = None
+            self.armed -= 1
+        finally:
+            self._lock.release()
+        return True
+
+    def advance(self, now=None):
+        """Process the ticks up to `now` and fire what is due; returns how many fired."""
+        target = int(((time.monotonic() if now is None else now) - self._origin)
+                      / self.resolution)
+        due = []
+        with self._lock:
+            if target - self.tick > len(self._slots):
+                # behind by more than a lap: every bucket has something due
+                self.tick = target
+                for slot in self._slots:
+                    self._expire(slot, target, due)
+            while self.tick < target:
+                self.tick += 1
+                slot = self._slots[self.tick & self._mask]
+                if slot:
+                    self._expire(slot, self.tick, due)
+            self.armed -= len(due)
+        for timer in due:
+            try:
+                timer.fn(*timer.args)
+            except Exception as e:
+                pbx_log.warning("timer_failed", "Σφάλμα timer {fn}: {error}",
+                                fn=getattr(timer.fn, "__qualname__", timer.fn), error=e)
+        self.fired += len(due)
+        return len(due)
+
+    @staticmethod
+    def _expire(slot, tick, due):
+        ready = [t for t in slot if t.due <= tick]
+        for timer in ready:
+            slot.remove(timer)
+            timer.slot = None
+        due += ready
+
+    def __len__(self):
+        return self.armed
+
+
+wheel = Wheel()
+_thread = None
+
+
+def schedule(delay, fn, *args):
+    """Arm a timer on the process's wheel (see Wheel.schedule)."""
+    return wheel.schedule(delay, fn, *args)
+
+
+def cancel(timer):
+    return wheel.cancel(timer)
+
+
+def advance():
+    return wheel.advance()
+
+
+def armed():
+    return wheel.armed
+
+
+def _run(stop):
+    while not stop.wait(wheel.resolution):
+        wheel.advance()
+
+
+def start():
+    """Turn the wheel from a thread (thread engine; the asyncio engine ticks it on its loop)."""
+    global _thread
+    if _thread is not None:
+        return
+    stop_event = threading.Event()
+    thread = threading.Thread(target=_run, args=(stop_event,), name="timers", daemon=True)
+    _thread = (thread, stop_event)
+    thread.start()
@@ -0,0 +1,159 @@
+"""Audio codecs of the media path: G.711 u-law, G.711 A-law and L16.
+
+An endpoint names the codecs it can send at register, best first; the PBX
+takes the first one it knows and answers with it in register_ok.  When the
+two parties of a call ended up with different codecs the media relay
+converts every packet, and a conference decodes each participant's frames
+and encodes the mix back in that participant's codec.
+
+Conversion is table driven.  Decoding a G.711 byte is an index into a
+256-entry table of samples; encoding a sample is an index into a
+65536-entry table of G.711 bytes (the sample's 16 bits read as unsigned).
+The tables are applied to whole frames, or to many frames at once, with
+NumPy fancy indexing; u-law <-> A-law needs no samples at all and is a
+bytes.translate() over the payload.  The tables are computed once at
+import from the reference algorithms below, which are also the
+sample-by-sample fallback they replace.
+
+L16 is big-endian as in RTP.  Without NumPy only u-law <-> A-law can be
+converted; calls that would need more are relayed unchanged.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+PCMU = "PCMU"
+PCMA = "PCMA"
+L16 = "L16"
+CODECS = (PCMU, PCMA, L16)
+
+RATE = 8000
+PAYLOAD_TYPES = {PCMU: 0, PCMA: 8, L16: 96}    # L16/8000 has no static type
+SAMPLE_BYTES = {PCMU: 1, PCMA: 1, L16: 2}
+
+_ULAW_BIAS = 0x84               # 0x21 in the 14-bit domain linear_to_ulaw works in
+_ULAW_CLIP = 8159
+
+
+# ============================================================
+#  REFERENCE ALGORITHMS (one sample)
+# ============================================================
+
+def ulaw_to_linear(u):
+    u = ~u & 0xFF
+    exponent = (u >> 4) & 0x07
+    sample = ((((u & 0x0F) << 3) + _ULAW_BIAS) << exponent) - _ULAW_BIAS
+    return -sample if u & 0x80 else sample
+
+
+def linear_to_ulaw(sample):
+    value = sample >> 2                 # u-law works on 14 bits
+    if value < 0:
+        mask = 0x7F
+        value = -value
+    else:
+        mask = 0xFF
+    value = min(value, _ULAW_CLIP) + (_ULAW_BIAS >> 2)
+    segment = max(0, value.bit_length() - 6)
+    if segment >= 8:
+        return 0x7F ^ mask
+    return (segment << 4 | (value >> (segment + 1)) & 0x0F) ^ mask
+
+
+def alaw_to_linear(a):
+    a ^= 0x55
+    segment = (a & 0x70) >> 4
+    sample = (a & 0x0F) << 4
+    if segment == 0:
+        sample += 8
+    else:
+        sample = (sample + 0x108) << (segment - 1)
+    return sample if a & 0x80 else -sample
+
+
+def linear_to_alaw(sample):
+    value = sample >> 3                 # A-law works on 13 bits
+    if value >= 0:
+        mask = 0xD5
+    else:
+        mask = 0x55
+        value = -value - 1
+    segment = value.bit_length() - 5 if value > 0x1F else 0
+    if segment >= 8:
+        return 0x7F ^ mask
+    if segment < 2:
+        return (segment << 4 | (value >> 1) & 0x0F) ^ mask
+    return (segment << 4 | (value >> segment) & 0x0F) ^ mask
+
+
+# ============================================================
+#  TABLES
+# ============================================================
+
+ULAW_TO_ALAW = bytes(linear_to_alaw(ulaw_to_linear(u)) for u in range(256))
+ALAW_TO_ULAW = bytes(linear_to_ulaw(alaw_to_linear(a)) for a in range(256))
+
+SILENCE_BYTE = {PCMU: linear_to_ulaw(0), PCMA: linear_to_alaw(0)}
+
+if np is not None:
+    _DECODE = {
+        PCMU: np.array([ulaw_to_linear(u) for u in range(256)], dtype=np.int16),
+        PCMA: np.array([alaw_to_linear(a) for a in range(256)], dtype=np.int16),
+    }
+    _samples = [i - 65536 if i >= 32768 else i for i in range(65536)]
+    _ENCODE = {
+        PCMU: np.array([linear_to_ulaw(s) for s in _samples], dtype=np.uint8),
+        PCMA: np.array([linear_to_alaw(s) for s in _samples], dtype=np.uint8),
+    }
+    del _samples
+
+
+def choose(offered):
+    """First codec of an endpoint's list that we know, or None."""
+    if isinstance(offered, str):
+        offered = [offered]
+    for name in offered or ():
+        if isinstance(name, str) and name.upper() in CODECS:
+            return name.upper()
+    return None
+
+
+def silence(codec, samples):
+    """`samples` samples of silence in `codec`."""
+    if codec == L16:
+        return bytes(2 * samples)
+    return bytes([SILENCE_BYTE[codec]]) * samples
+
+
+def decode(data, codec):
+    """Payload bytes (one frame or many back to back) -> int16 samples."""
+    if codec == L16:
+        return np.frombuffer(data, dtype=">i2").astype(np.int16)
+    return _DECODE[codec][np.frombuffer(data, dtype=np.uint8)]
+
+
+def encode(samples, codec):
+    """Samples (any integer array already within 16 bits, any shape) -> payload bytes."""
+    if samples.dtype != np.int16:
+        samples = samples.astype(np.int16)
+    if codec == L16:
+        return samples.astype(">i2").tobytes()
+    return _ENCODE[codec][samples.view(np.uint16)].tobytes()
+
+
+def converter(src, dst):
+    """Function converting a payload from src to dst, or None for no conversion.
+
+    None also when either codec is unknown or the conversion needs NumPy
+    and it is missing.
+    """
+    if src == dst or src not in CODECS or dst not in CODECS:
+        return None
+    if {src, dst} == {PCMU, PCMA}:
+        table = ULAW_TO_ALAW if src == PCMU else ALAW_TO_ULAW
+        return lambda payload: payload.translate(table)
+    if np is None:
+        return None
+    return lambda payload: encode(decode(payload, src), dst)
@@ -0,0 +1,166 @@
+"""Multi-process mode: N forked workers behind one endpoint port.
+
+Every worker binds the endpoint port with SO_REUSEPORT, so the kernel
+spreads new connections over them.  Each extension belongs to exactly one
+worker, crc32(extension) % N (str hashes differ per process, crc32 does
+not).  When a register arrives at the wrong worker, the connection's file
+descriptor is passed over a Unix datagram socket (SCM_RIGHTS) to the owner,
+together with the bytes already read from it, and the owner carries on as
+if it had accepted the connection itself.
+
+Workers are joined pairwise by Unix stream sockets that speak the trunk
+protocol, so a call between extensions of two workers is a trunk call over
+the link "w<peer>".  Worker 0, the hub, is the only one with real trunks:
+the others send their remote-trunk messages to it tagged with the trunk
+name ("trunk": "B"), and it forwards incoming trunk messages to the worker
+that owns the destination the same way.  The remote PBX therefore sees a
+single trunk connection whose writes merge the traffic of all workers.
+
+The parent process only supervises: if a worker dies the links cannot be
+rebuilt, so it stops the others and exits.
+"""
+
+import os
+import signal
+import socket
+import zlib
+
+import pbx_log
+
+HUB = 0
+
+# bytes read before the hand-off (the register message, rarely more)
+MAX_HANDOFF = 60000
+
+
+def owner(ext, count):
+    return zlib.crc32(ext.encode("utf-8")) % count
+
+
+def link_name(wid):
+    return f"w{wid}"
+
+
+class Worker:
+    def __init__(self, wid, count, links, inbox, outboxes):
+        self.id = wid
+        self.count = count
+        self.links = links          # peer id -> Unix stream socket to that worker
+        self.inbox = inbox          # datagram socket receiving handed-off connections
+        self.outboxes = outboxes    # peer id -> datagram socket to that worker's inbox
+
+    @property
+    def is_hub(self):
+        return self.id == HUB
+
+    def owner(self, ext):
+        return owner(ext, self.count)
+
+    def hand_off(self, peer, fd, payload):
+        """Pass a connection (and what was already read from it) to another worker."""
+        if len(payload) > MAX_HANDOFF:
+            raise ValueError("too much buffered data to hand off")
+        socket.send_fds(self.outboxes[peer], [payload], [fd])
+
+    def receive(self):
+        """Next handed-off connection as (socket, payload), or None for a stray datagram."""
+        payload, fds, _, _ = socket.recv_fds(self.inbox, MAX_HANDOFF, 1)
+        if not fds:
+            return None
+        return socket.socket(fileno=fds[0]), payload
+
+
+def spawn(count):
+    """Fork `count` workers and return the Worker of the calling child.
+
+    The parent never returns from here: it supervises the workers until
+    one of them exits or it is told to stop.
+    """
+    links = {}
+    for i in range(count):
+        for j in range(i + 1, count):
+            links[i, j] = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    inboxes = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(count)]
+
+    pids = []
+    for wid in range(count):
+        pbx_log.flush()     # or the children would write the queued records again
+        pid = os.fork()
+        if pid == 0:
+            return _child(wid, count, links, inboxes)
+        pids.append(pid)
+
+    for pair in list(links.values()) + inboxes:
+        for s in pair:
+            s.close()
+    pbx_log.info("workers", "{count} workers: {pids}", count=count, pids=", ".join(map(str, pids)))
+    pbx_log.flush()
+    _supervise(pids)
+
+
+def _child(wid, count, links, inboxes):
+    mine = {}
+    for (i, j), (a, b) in links.items():
+        if i == wid:
+            mine[j] = a
+            b.close()
+        elif j == wid:
+            mine[i] = b
+            a.close()
+        else:
+            a.close()
+            b.close()
+
+    outboxes = {}
+    for k, (rx, tx) in enumerate(inboxes):
+        if k == wid:
+            inbox = rx
+            tx.close()
+        else:
+            outboxes[k] = tx
+            rx.close()
+    return Worker(wid, count, mine, inbox, outboxes)
+
+
+def _supervise(pids):
+    def stop(signum, frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        # Workers may still be writing out state (CDRs) on their way down
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        raise SystemExit(0)
+
+    def forward(signum, frame):
+        # Reload (the dial plan): each worker reloads its own
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, forward)
+    pid, _ = os.wait()
+    pbx_log.error("worker_exit", "Worker {pid} τερματίστηκε, σταματούν όλοι", pid=pid)
+    pbx_log.flush()
+    for other in pids:
+        if other != pid:
+            try:
+                os.kill(other, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    for other in pids:
+        if other != pid:
+            try:
+                os.waitpid(other, 0)
+            except ChildProcessError:
+                pass
+    raise SystemExit(1)
@@ -0,0 +1,4 @@
+"""Behaviour tests for the PBX. Run from the repository root:
+
+    python -m pytest -q tests
+"""
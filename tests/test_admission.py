@@ -0,0 +1,87 @@
+"""Admission control: token buckets, retry hints and the per-IP table."""
+
+import json
+
+import pytest
+
+import pbx_admission
+from pbx_admission import TokenBucket
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    # Hints without jitter, and every limit back off after each test
+    monkeypatch.setattr(pbx_admission.random, "random", lambda: 0.0)
+    yield
+    pbx_admission.configure()
+    pbx_admission._open = 0
+
+
+def test_bucket_burst_then_rate():
+    b = TokenBucket(rate=2, burst=3, now=0.0)
+    assert [b.take(0.0) for _ in range(3)] == [0, 0, 0]
+    assert b.take(0.0) == pytest.approx(0.5)
+    assert b.take(0.5) == 0
+    assert b.take(10.0) == 0
+    assert b.tokens == pytest.approx(2)     # refills up to the burst only
+
+
+def test_refused_callers_get_successive_slots():
+    b = TokenBucket(rate=10, burst=1, now=0.0)
+    b.take(0.0)
+    waits = [b.take(0.0) for _ in range(5)]
+    assert waits == pytest.approx([0.1, 0.2, 0.3, 0.4, 0.5])
+
+
+def test_slots_are_capped():
+    b = TokenBucket(rate=0.001, burst=1, now=0.0)
+    b.take(0.0)
+    assert b.take(0.0) == pbx_admission.MAX_RETRY
+
+
+def test_connection_limit():
+    pbx_admission.configure(connections=2)
+    assert pbx_admission.admit("10.0.0.1") is None
+    assert pbx_admission.admit("10.0.0.2") is None
+    assert pbx_admission.admit("10.0.0.3") == pbx_admission.FULL_RETRY
+    pbx_admission.closed()
+    assert pbx_admission.admit("10.0.0.3") is None
+    assert pbx_admission.open_connections() == 2
+
+
+def test_per_ip_rate_is_per_address():
+    pbx_admission.configure(per_ip_rate=1)
+    assert pbx_admission.admit("10.0.0.1") is None
+    assert pbx_admission.admit("10.0.0.1") is not None
+    assert pbx_admission.admit("10.0.0.2") is None
+
+
+def test_register_rate_is_global():
+    pbx_admission.configure(reg_rate=1)
+    assert pbx_admission.admit("10.0.0.1") is None
+    assert pbx_admission.admit("10.0.0.2") is not None
+
+
+def test_source_table_is_an_lru_with_a_hard_cap(monkeypatch):
+    monkeypatch.setattr(pbx_admission, "MAX_SOURCES", 3)
+    pbx_admission.configure(per_ip_rate=0.001)
+    for ip in ("10.0.0.1", "10.0.0.2", "10.0.0.3"):
+        assert pbx_admission.admit(ip) is None
+    # Seen again (and refused): now the most recent
+    assert pbx_admission.admit("10.0.0.1") is not None
+    assert pbx_admission.admit("10.0.0.4") is None
+    assert list(pbx_admission._sources) == ["10.0.0.3", "10.0.0.1", "10.0.0.4"]
+    # None of them full, still never more than the cap
+    for i in range(5, 50):
+        pbx_admission.admit(f"10.0.0.{i}")
+        assert len(pbx_admission._sources) == 3
+
+
+def test_refusal_is_a_json_line():
+    msg = json.loads(pbx_admission.refusal(1.5))
+    assert (msg["type"], msg["retry_after"]) == ("error", 1.5)
+
+
+def test_negative_limits():
+    with pytest.raises(ValueError):
+        pbx_admission.configure(connections=-1)
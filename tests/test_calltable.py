@@ -0,0 +1,119 @@
+"""CallTable transitions: reservation, answer and release of both legs."""
+
+import threading
+
+from pbx_calltable import (CALLEE_BUSY, CALLEE_MISSING, CALLER_BUSY, IDLE, IN_CALL, OK, RINGING,
+                           CallTable)
+
+
+def table(*exts):
+    t = CallTable(shards=4)
+    for ext in exts:
+        t.register(ext, object(), None)
+    return t
+
+
+def test_reserve_pair_rings_both_legs():
+    t = table("5001", "5002")
+    outcome, caller, callee = t.reserve_pair("5001", "5002", cdr="cdr")
+    assert outcome == OK
+    assert (caller.state, caller.peer, caller.incoming) == (RINGING, "5002", False)
+    assert (callee.state, callee.peer, callee.incoming) == (RINGING, "5001", True)
+    assert caller.cdr == callee.cdr == "cdr"
+
+
+def test_reserve_pair_refuses_busy_and_missing_legs():
+    t = table("5001", "5002", "5003")
+    assert t.reserve_pair("5001", "5002")[0] == OK
+    assert t.reserve_pair("5003", "5002")[0] == CALLEE_BUSY
+    assert t.reserve_pair("5001", "5003")[0] == CALLER_BUSY
+    assert t.reserve_pair("5003", "5009")[0] == CALLEE_MISSING
+    assert t.reserve_pair("5003", "5003")[0] == CALLER_BUSY
+    assert t.get("5003").state == IDLE
+
+
+def test_reserve_pair_never_double_books_a_callee():
+    callers = [f"50{i:02d}" for i in range(10, 42)]
+    t = table("5001", *callers)
+    start = threading.Barrier(len(callers))
+    outcomes = []
+
+    def dial(ext):
+        start.wait()
+        outcomes.append(t.reserve_pair(ext, "5001")[0])
+
+    threads = [threading.Thread(target=dial, args=(ext,)) for ext in callers]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    assert outcomes.count(OK) == 1
+    assert outcomes.count(CALLEE_BUSY) == len(callers) - 1
+    winner = t.get("5001").peer
+    assert [ext for ext in callers if t.get(ext).state == RINGING] == [winner]
+
+
+def test_answer_only_by_the_called_leg():
+    t = table("5001", "5002")
+    t.reserve_pair("5001", "5002")
+    assert t.answer("5001") is None
+    assert t.answer("5002") is not None
+    assert t.get("5001").state == t.get("5002").state == IN_CALL
+
+
+def test_release_pair_idles_both_legs():
+    t = table("5001", "5002")
+    t.reserve_pair("5001", "5002", cdr="cdr")
+    t.answer("5002")
+    me, peer_ext, trunk, peer, cdr = t.release_pair("5002")
+    assert (me.ext, peer_ext, trunk, peer.ext, cdr) == ("5002", "5001", None, "5001", "cdr")
+    assert t.get("5001").state == t.get("5002").state == IDLE
+    assert t.release_pair("5001")[0] is None
+
+
+def test_release_pair_respects_states():
+    t = table("5001", "5002")
+    t.reserve_pair("5001", "5002")
+    assert t.release_pair("5001", (IN_CALL,))[0] is None
+    assert t.get("5001").state == RINGING
+    assert t.release_pair("5001", (RINGING,))[0] is not None
+
+
+def test_release_of_a_remote_leg_tells_the_index():
+    seen = []
+
+    class Index:
+        def add(self, trunk, ext, peer):
+            seen.append(("add", trunk, ext, peer))
+
+        def discard(self, trunk, ext, peer):
+            seen.append(("discard", trunk, ext, peer))
+
+    t = table("5001")
+    t.index = Index()
+    t.reserve("5001", "7001", remote=True, trunk="B")
+    me, peer_ext, trunk, peer, _ = t.release_pair("5001")
+    assert (peer_ext, trunk, peer) == ("7001", "B", None)
+    assert seen == [("add", "B", "5001", "7001"), ("discard", "B", "5001", "7001")]
+
+
+def test_unregister_only_for_its_own_connection():
+    t = CallTable(shards=4)
+    old, new = object(), object()
+    t.register("5001", old, None)
+    t.register("5001", new, None)
+    assert t.unregister("5001", old) is None
+    assert t.unregister("5001", new) is not None
+    assert "5001" not in t
+
+
+def test_listener_sees_every_change_after_the_locks():
+    t = table("5001", "5002")
+    changes = []
+    # Reads the table from inside the listener: would deadlock under a shard lock
+    t.listener = lambda ext: changes.append((ext, t.get(ext).state))
+    t.reserve_pair("5001", "5002")
+    t.answer("5002")
+    t.release_pair("5001")
+    assert changes == [("5001", RINGING), ("5002", RINGING), ("5002", IN_CALL),
+                       ("5001", IN_CALL), ("5001", IDLE), ("5002", IDLE)]
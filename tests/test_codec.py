@@ -0,0 +1,89 @@
+"""Signalling codecs: binary layouts, the JSON fallback and FrameReader on mixed streams."""
+
+import pytest
+
+from pbx_codec import BINARY, JSON, MAGIC, MAX_LINE, Frame, FrameReader, Template, choose
+
+MESSAGES = [
+    {"type": "register", "extension": "5001"},
+    {"type": "call", "to": "7001"},
+    {"type": "incoming_call", "from": "0123"},          # leading zero: a string extension
+    {"type": "answer"},
+    {"type": "chat", "from": "5001", "text": "γεια σου"},
+    {"type": "no_answer", "from": "5001", "to": "7001"},
+    {"type": "trunk_chat", "from": "5001", "to": "7001", "text": ""},
+    {"type": "error", "reason": "Μη έγκυρη επιλογή IVR."},
+    {"type": "ivr_choice", "digit": "#"},
+    # Off their layouts: carried as JSON inside a binary frame
+    {"type": "call", "to": "7001", "extra": 1},
+    {"type": "subscribe", "exts": ["5001", "5002"]},
+    {"type": "hangup", "by": 5001},
+]
+
+
+@pytest.mark.parametrize("codec", [JSON, BINARY])
+@pytest.mark.parametrize("msg", MESSAGES)
+def test_round_trip(codec, msg):
+    assert FrameReader().feed(codec.encode(msg)) == [msg]
+
+
+def test_known_types_are_compact():
+    frame = BINARY.encode({"type": "call", "to": "7001"})
+    assert frame[0] == MAGIC
+    assert len(frame) == 4 + 5      # header, then a tagged u32 extension
+
+
+def test_byte_at_a_time():
+    stream = b"".join(codec.encode(msg) for msg in MESSAGES for codec in (JSON, BINARY))
+    reader = FrameReader()
+    out = []
+    for i in range(len(stream)):
+        out += reader.feed(stream[i:i + 1])
+    assert out == [msg for msg in MESSAGES for _ in range(2)]
+
+
+def test_framings_mix_on_one_stream_in_order():
+    ping, pong = {"type": "ping"}, {"type": "pong"}
+    data = JSON.encode(ping) + BINARY.encode(pong) + JSON.encode(pong) + BINARY.encode(ping)
+    assert FrameReader().feed(data) == [ping, pong, pong, ping]
+
+
+def test_malformed_lines_and_frames_are_skipped():
+    bad_frame = bytes((MAGIC, 0, 2, 3)) + b"\x09\x00"      # call with a bad extension tag
+    data = b"not json\n" + bad_frame + b"[1, 2]\n" + JSON.encode({"type": "ping"})
+    assert FrameReader().feed(data) == [{"type": "ping"}]
+
+
+def test_one_line_is_one_message():
+    # Two objects on one line must not pass as two messages
+    data = b'{"a":1}, {"type":"ping"}\n{"type":"pong"}\n'
+    assert FrameReader().feed(data) == [{"type": "pong"}]
+    data = b'{"type":"ping"}\n,{"type":"call","to":"5002"}\n'
+    assert FrameReader().feed(data) == [{"type": "ping"}]
+
+
+def test_line_too_long():
+    with pytest.raises(ValueError):
+        FrameReader().feed(b"x" * (MAX_LINE + 1))
+
+
+@pytest.mark.parametrize("codec", [JSON, BINARY])
+def test_template_matches_plain_encoding(codec):
+    chat = Template("trunk_chat", "from", "to", "text")
+    values = ("5001", "7001", 'he said "γεια"\n')
+    msg = {"type": "trunk_chat", "from": "5001", "to": "7001", "text": values[2]}
+    assert chat.encode(codec, *values) == codec.encode(msg)
+    assert FrameReader().feed(chat.encode(codec, *values)) == [msg]
+
+
+def test_frame_is_encoded_once_per_codec():
+    frame = Frame({"type": "ping"})
+    assert frame.encode(JSON) is frame.encode(JSON)
+    assert frame.encode(BINARY) == BINARY.encode({"type": "ping"})
+
+
+def test_choose():
+    assert choose("binary") is BINARY
+    assert choose(["cbor", "binary", "json"]) is BINARY
+    assert choose(["cbor"]) is JSON
+    assert choose(None) is JSON
@@ -0,0 +1,120 @@
+"""Dial plan: pattern syntax, which rule wins, rewrites and the file format."""
+
+import pytest
+
+import pbx_dialplan
+from pbx_dialplan import BLOCK, LOCAL, REWRITE, ROUTE, Automaton, DialPlan, Rule, load_dialplan
+
+
+def plan(*rules):
+    return DialPlan([Rule(pattern, action, arg) for pattern, action, arg in rules])
+
+
+def test_classes_and_ranges():
+    a = Automaton([Rule("5XXX", LOCAL), Rule("[1-35]ZN", ROUTE)])
+    assert a.match("5123").pattern == "5XXX"
+    assert a.match("51") is None
+    assert a.match("51234") is None
+    assert a.match("312").pattern == "[1-35]ZN"
+    assert a.match("302") is None      # Z is 1-9
+    assert a.match("311") is None      # N is 2-9
+    assert a.match("412") is None
+
+
+def test_open_ended_tails():
+    a = Automaton([Rule("9.", ROUTE), Rule("0!", LOCAL)])
+    assert a.match("9") is None        # `.` needs one more character
+    assert a.match("912345").pattern == "9."
+    assert a.match("0").pattern == "0!"
+    assert a.match("0*#+").pattern == "0!"
+
+
+def test_most_specific_rule_wins_whatever_the_order():
+    rules = [Rule(".", ROUTE), Rule("5XXX", LOCAL), Rule("5[0-4]XX", BLOCK),
+             Rule("5000", REWRITE, "5001")]
+    for ordered in (rules, rules[::-1]):
+        a = Automaton([Rule(r.pattern, r.action, r.arg) for r in ordered])
+        assert a.match("5000").pattern == "5000"
+        assert a.match("5001").pattern == "5[0-4]XX"
+        assert a.match("5901").pattern == "5XXX"
+        assert a.match("59012").pattern == "."
+
+
+def test_the_first_position_that_differs_decides():
+    a = Automaton([Rule("X1", ROUTE), Rule("1X", LOCAL)])
+    assert a.match("11").pattern == "1X"
+
+
+def test_earlier_line_wins_a_tie():
+    a = Automaton([Rule("5X", LOCAL), Rule("5X", BLOCK)])
+    assert a.match("51").action == LOCAL
+
+
+def test_rewrites_are_followed():
+    p = plan(("9.", REWRITE, "{1}"), ("*1", REWRITE, "5001"), ("5XXX", LOCAL, None))
+    rule, number = p.resolve("95002")
+    assert (rule.action, number) == (LOCAL, "5002")
+    rule, number = p.resolve("*1")
+    assert (rule.action, number) == (LOCAL, "5001")
+
+
+def test_rewrite_loop_is_no_match():
+    p = plan(("*1", REWRITE, "*2"), ("*2", REWRITE, "*1"))
+    rule, _ = p.resolve("*1")
+    assert rule is None
+
+
+def test_rewrite_chain_up_to_the_limit():
+    n = pbx_dialplan.MAX_REWRITES
+    rules = [(f"*{i}", REWRITE, f"*{i + 1}") for i in range(n)] + [(f"*{n}", LOCAL, None)]
+    rule, number = plan(*rules).resolve("*0")
+    assert (rule.action, number) == (LOCAL, f"*{n}")
+    # One rewrite more is taken for a loop
+    rule, _ = plan(*rules, ("#", REWRITE, "*0")).resolve("#")
+    assert rule is None
+
+
+def test_replace_swaps_the_whole_plan():
+    p = plan(("5XXX", LOCAL, None))
+    p.replace([Rule("5XXX", BLOCK)])
+    assert p.match("5001").action == BLOCK
+    assert len(p) == 1
+
+
+@pytest.mark.parametrize("pattern", ["", "5.X", "5[", "5[9-1]", "5[]", "5A"])
+def test_bad_patterns(pattern):
+    with pytest.raises(ValueError):
+        pbx_dialplan.parse_pattern(pattern)
+
+
+def test_load_dialplan(tmp_path):
+    path = tmp_path / "plan"
+    path.write_text("# numbering\n"
+                    "5XXX local\n"
+                    "#31# rewrite 5001   # a pattern with #\n"
+                    "7XXX trunk B\n"
+                    "666X block dial_plan\n", encoding="utf-8")
+    rules = load_dialplan(path, trunks=["B"], reasons={"dial_plan": None})
+    assert [(r.pattern, r.action, r.arg, r.line) for r in rules] == [
+        ("5XXX", LOCAL, None, 2),
+        ("#31#", REWRITE, "5001", 3),
+        ("7XXX", pbx_dialplan.TRUNK, "B", 4),
+        ("666X", BLOCK, "dial_plan", 5),
+    ]
+
+
+@pytest.mark.parametrize("line", ["5XXX frobnicate", "5XXX local extra", "7XXX trunk C",
+                                  "6XXX block nonsense", "5.X local", "rewrite"])
+def test_load_dialplan_errors(tmp_path, line):
+    path = tmp_path / "plan"
+    path.write_text(line + "\n", encoding="utf-8")
+    with pytest.raises(ValueError, match=":1:"):
+        load_dialplan(path, trunks=["B"], reasons={"dial_plan": None})
+
+
+def test_default_plan():
+    p = DialPlan(pbx_dialplan.default_plan("5", "7", "5000"))
+    assert p.match("5000").action == pbx_dialplan.IVR
+    assert p.match("5123").action == LOCAL
+    assert p.match("7000").arg == "remote_ivr"
+    assert p.match("7001").action == ROUTE
@@ -0,0 +1,218 @@
+"""IVR engine: menu navigation, actions, and sessions expiring on the timing wheel."""
+
+import pytest
+
+import pbx_ivr
+import pbx_timers
+from pbx_calltable import IDLE, IN_CALL
+from pbx_ivr import HANGUP, INFO, MENU, QUEUE, TRANSFER
+from pbx_timers import Wheel
+
+TIMEOUT = 1.0
+
+
+class Harness:
+    """The server's side of pbx_ivr: what it was asked to do, on a wheel turned by hand."""
+
+    def __init__(self, definitions):
+        self.out = []
+        self.state = {}
+        self.now = 0.0
+        self.wheel = Wheel(now=0.0)
+        pbx_ivr.configure(definitions, "5000",
+                          lambda ext, frame: self.out.append((ext, frame.obj)),
+                          lambda ext, reason: self.out.append((ext, "error", reason)),
+                          lambda ext, number: self.out.append((ext, TRANSFER, number)),
+                          lambda ext, queue: self.out.append((ext, QUEUE, queue)),
+                          lambda ext: self.state.get(ext, IDLE))
+
+    def last(self):
+        return self.out[-1]
+
+    def text(self):
+        return self.out[-1][1]["text"]
+
+    def wait(self, seconds):
+        self.now += seconds
+        self.wheel.advance(self.now)
+
+
+@pytest.fixture
+def ivr(monkeypatch):
+    def build(definitions):
+        harness = Harness(definitions)
+        monkeypatch.setattr(pbx_timers, "wheel", harness.wheel)
+        return harness
+    yield build
+    # No session of one test left for the next
+    pbx_ivr.configure({"main": (TIMEOUT, "", {})}, "5000", *[None] * 5)
+
+
+def menus():
+    return {
+        "main": (TIMEOUT, "main", {
+            "0": (INFO, "hours"),
+            "1": (MENU, "sales"),
+            "2": (QUEUE, "5100"),
+            "#": (HANGUP, None),
+        }),
+        "sales": (TIMEOUT, "sales", {
+            "1": (TRANSFER, "5001"),
+            "*": (MENU, "main"),
+            "t": (MENU, "main"),
+            "i": (INFO, "1 or *"),
+        }),
+    }
+
+
+def test_enter_sends_the_root_menu(ivr):
+    h = ivr(menus())
+    pbx_ivr.enter("5010")
+    assert h.last() == ("5010", {"type": "ivr_message", "text": "main"})
+    assert pbx_ivr.active() == 1
+
+
+def test_keys_walk_the_tree(ivr):
+    h = ivr(menus())
+    pbx_ivr.enter("5010")
+    assert pbx_ivr.choose("5010", "0")
+    assert h.last() == ("5010", {"type": "ivr_info", "text": "hours"})
+    pbx_ivr.choose("5010", "1")
+    assert h.text() == "sales"
+    pbx_ivr.choose("5010", "9")
+    assert h.text() == "1 or *"
+    pbx_ivr.choose("5010", "*")
+    assert h.text() == "main"
+
+
+def test_unknown_key_without_i_keeps_waiting(ivr):
+    h = ivr(menus())
+    pbx_ivr.enter("5010")
+    pbx_ivr.choose("5010", "7")
+    assert h.last() == ("5010", "error", "invalid_ivr_choice")
+    assert pbx_ivr.active() == 1
+
+
+@pytest.mark.parametrize("keys, action", [("11", (TRANSFER, "5001")), ("2", (QUEUE, "5100"))])
+def test_leaving_actions_end_the_session(ivr, keys, action):
+    h = ivr(menus())
+    pbx_ivr.enter("5010")
+    for key in keys:
+        pbx_ivr.choose("5010", key)
+    assert h.last() == ("5010", *action)
+    assert pbx_ivr.active() == 0
+    assert len(h.wheel) == 0
+    assert not pbx_ivr.choose("5010", "1")
+
+
+def test_hangup_key(ivr):
+    h = ivr(menus())
+    pbx_ivr.enter("5010")
+    pbx_ivr.choose("5010", "#")
+    assert h.last() == ("5010", {"type": "hangup", "by": "5000"})
+    assert pbx_ivr.active() == 0
+
+
+def test_timeout_without_t_hangs_up(ivr):
+    h = ivr(menus())
+    pbx_ivr.enter("5010")
+    h.wait(TIMEOUT / 2)
+    assert pbx_ivr.active() == 1
+    h.wait(TIMEOUT)
+    assert h.last() == ("5010", {"type": "hangup", "by": "5000"})
+    assert pbx_ivr.active() == 0
+
+
+def test_keys_move_the_timeout_on(ivr):
+    h = ivr(menus())
+    pbx_ivr.enter("5010")
+    for _ in range(5):
+        h.wait(TIMEOUT * 0.6)
+        pbx_ivr.choose("5010", "0")
+    assert pbx_ivr.active() == 1
+
+
+def test_t_option_then_hangup_after_max_timeouts(ivr):
+    definitions = {"main": (TIMEOUT, "main", {"t": (INFO, "still there?")})}
+    h = ivr(definitions)
+    pbx_ivr.enter("5010")
+    for _ in range(pbx_ivr.MAX_TIMEOUTS - 1):
+        h.wait(TIMEOUT + 0.2)
+        assert h.text() == "still there?"
+    h.wait(TIMEOUT + 0.2)
+    assert h.last() == ("5010", {"type": "hangup", "by": "5000"})
+    assert pbx_ivr.active() == 0
+
+
+def test_sub_menu_times_out_back_up(ivr):
+    h = ivr(menus())
+    pbx_ivr.enter("5010")
+    pbx_ivr.choose("5010", "1")
+    h.wait(TIMEOUT + 0.2)
+    assert h.text() == "main"
+    assert pbx_ivr.active() == 1
+
+
+def test_timeout_never_hangs_up_a_call(ivr):
+    h = ivr(menus())
+    pbx_ivr.enter("5010")
+    # Called meanwhile, and the server has not dropped the session yet
+    h.state["5010"] = IN_CALL
+    sent = len(h.out)
+    h.wait(TIMEOUT + 0.2)
+    assert len(h.out) == sent
+    assert pbx_ivr.active() == 0
+
+
+def test_leave(ivr):
+    h = ivr(menus())
+    pbx_ivr.enter("5010")
+    assert pbx_ivr.leave("5010")
+    assert not pbx_ivr.leave("5010")
+    assert len(h.wheel) == 0
+    h.wait(TIMEOUT * 2)
+    assert h.out == [("5010", {"type": "ivr_message", "text": "main"})]
+
+
+def test_queue_targets(ivr):
+    ivr(menus())
+    assert pbx_ivr.queue_targets() == {"5100"}
+
+
+def test_load_menus(tmp_path):
+    path = tmp_path / "menus"
+    path.write_text("# menus\n"
+                    "menu main 5 Welcome\\n1 sales\n"
+                    "menu sales 2.5 Sales\n"
+                    "option main 1 menu sales\n"
+                    "option main # hangup\n"
+                    "option main 0 info Open 9-5\\nWeekdays\n"
+                    "option sales t transfer 5001\n", encoding="utf-8")
+    assert pbx_ivr.load_menus(path) == {
+        "main": (5.0, "Welcome\n1 sales", {
+            "1": (MENU, "sales"),
+            "#": (HANGUP, None),
+            "0": (INFO, "Open 9-5\nWeekdays"),
+        }),
+        "sales": (2.5, "Sales", {"t": (TRANSFER, "5001")}),
+    }
+
+
+@pytest.mark.parametrize("text", [
+    "menu main 0 Welcome\n",
+    "menu main soon Welcome\n",
+    "menu main 5\n",
+    "menu main 5 A\nmenu main 5 B\n",
+    "menu main 5 A\noption other 1 hangup\n",
+    "menu main 5 A\noption main x hangup\n",
+    "menu main 5 A\noption main 1 dance\n",
+    "menu main 5 A\noption main 1 hangup now\n",
+    "menu main 5 A\noption main 1 transfer\n",
+    "menu main 5 A\noption main 1 menu nowhere\n",
+    "# nothing\n",
+])
+def test_load_menus_errors(tmp_path, text):
+    path = tmp_path / "menus"
+    path.write_text(text, encoding="utf-8")
+    with pytest.raises(ValueError):
+        pbx_ivr.load_menus(path)
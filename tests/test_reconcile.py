@@ -0,0 +1,132 @@
+"""Trunk reconciliation: digests, and rounds between two PBXs finding orphaned legs."""
+
+import importlib.util
+from collections import deque
+
+import pytest
+
+import pbx_reconcile
+import pbx_timers
+from pbx_timers import Wheel
+
+
+def instance(name):
+    """A pbx_reconcile of its own: one per PBX of the test."""
+    spec = importlib.util.spec_from_file_location(f"pbx_reconcile_{name}",
+                                                  pbx_reconcile.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Pair:
+    """PBXs A and B joined by a trunk; messages are delivered in order by run()."""
+
+    def __init__(self):
+        self.wire = deque()
+        self.hung_up = {"A": [], "B": []}
+        self.a = self.node("A", "B")
+        self.b = self.node("B", "A")
+
+    def node(self, name, other):
+        module = instance(name)
+
+        def hangup(local, remote):
+            # What the server's synthetic hangup does to the digest
+            self.hung_up[name].append((local, remote))
+            module.discard(other, local, remote)
+
+        module.configure(name, lambda trunk, msg: self.wire.append((other, trunk, msg)), hangup)
+        return module
+
+    def run(self):
+        sent = []
+        while self.wire:
+            to, trunk, msg = self.wire.popleft()
+            sent.append(msg["type"])
+            peer = self.a if to == "A" else self.b
+            peer.handle(msg, "B" if to == "A" else "A")
+        return sent
+
+
+@pytest.fixture
+def wheel(monkeypatch):
+    w = Wheel(now=0.0)
+    monkeypatch.setattr(pbx_timers, "wheel", w)
+    return w
+
+
+@pytest.fixture
+def pbxs(wheel):
+    return Pair()
+
+
+def calls(pair, n):
+    for i in range(n):
+        pair.a.add("B", f"5{i:03d}", f"7{i:03d}")
+        pair.b.add("A", f"7{i:03d}", f"5{i:03d}")
+
+
+def test_equal_calls_have_equal_digests(monkeypatch):
+    monkeypatch.setattr(pbx_reconcile, "node", "A")
+    one, two = pbx_reconcile.Digest("B"), pbx_reconcile.Digest("B")
+    pairs = [(f"5{i:03d}", f"7{i:03d}") for i in range(100)]
+    for p in pairs:
+        one.toggle(p, pbx_reconcile.pair_hash(*p), True)
+    for p in reversed(pairs):
+        two.toggle(p, pbx_reconcile.pair_hash(*p), True)
+        two.toggle(p, pbx_reconcile.pair_hash(*p), True)     # twice is once
+    assert one.leaves == two.leaves
+    assert one.groups() == two.groups()
+    p = pairs[0]
+    two.toggle(p, pbx_reconcile.pair_hash(*p), False)
+    assert one.groups() != two.groups()
+    assert two.listed([pbx_reconcile.pair_hash(*p) & (pbx_reconcile.LEAVES - 1)]) == []
+
+
+def test_in_step_round_is_clean(pbxs):
+    calls(pbxs, 50)
+    pbxs.a.start("B")
+    assert pbxs.run() == ["trunk_sync", "trunk_sync_done"]
+    assert pbxs.a.stats["clean"] == 1
+    assert pbxs.a._rounds == {}
+
+
+def test_orphans_are_hung_up_on_both_sides(pbxs):
+    calls(pbxs, 50)
+    pbxs.a.add("B", "5900", "7900")         # B lost this call
+    pbxs.b.add("A", "7901", "5901")         # and A this one
+    pbxs.a.start("B")
+    assert pbxs.run() == ["trunk_sync", "trunk_sync_leaves",
+                          "trunk_sync_pairs", "trunk_sync_pairs", "trunk_sync_pairs"]
+    assert pbxs.hung_up == {"A": [("5900", "7900")], "B": [("7901", "5901")]}
+    assert pbxs.a.calls("B") == pbxs.b.calls("A") == 50
+    # Only the differing leaves travelled, not the table
+    assert pbxs.a.stats["pairs_sent"] + pbxs.b.stats["pairs_sent"] < 10
+    assert pbxs.a._rounds == pbxs.b._rounds == {}
+    pbxs.a.start("B")
+    assert pbxs.run()[-1] == "trunk_sync_done"
+
+
+def test_unanswered_round_expires(pbxs, wheel):
+    pbxs.a.start("B")
+    pbxs.wire.clear()                       # the other side never answers
+    wheel.advance(pbx_reconcile.ROUND_TIMEOUT + 1)
+    assert pbxs.a._rounds == {}
+
+
+def test_timer_leaves_a_newer_round_with_the_same_key(wheel):
+    rounds = pbx_reconcile._rounds
+    key = ("B", 1, "responder")
+    try:
+        pbx_reconcile._keep(key, {"pairs": []})
+        wheel.advance(pbx_reconcile.ROUND_TIMEOUT / 2)
+        # The other side restarted and numbers its rounds from 1 again
+        newer = {"pairs": [["5001", "7001"]]}
+        pbx_reconcile._keep(key, newer)
+        wheel.advance(pbx_reconcile.ROUND_TIMEOUT + 1)
+        assert rounds[key] is newer
+        wheel.advance(pbx_reconcile.ROUND_TIMEOUT * 2)
+        assert key not in rounds
+    finally:
+        rounds.pop(key, None)
@@ -0,0 +1,101 @@
+"""Call handling end to end: a PBX process per engine and VoipClient endpoints."""
+
+import asyncio
+
+import pytest
+
+from benchmarks.common import free_port, spawn_pbx
+from voip_client import VoipClient
+
+RING_TIMEOUT = 1.0
+MENU_TIMEOUT = 1.0
+
+
+@pytest.fixture(scope="module", params=["thread", "asyncio"])
+def pbx(request, tmp_path_factory):
+    menus = tmp_path_factory.mktemp("ivr") / "menus"
+    menus.write_text(f"menu main {MENU_TIMEOUT} Menu\noption main 0 info Info\n",
+                     encoding="utf-8")
+    port = free_port()
+    proc = spawn_pbx(port, "--engine", request.param, "--ring-timeout", str(RING_TIMEOUT),
+                     "--ivr-menus", str(menus))
+    yield port
+    proc.terminate()
+    proc.wait()
+
+
+def run(port, scenario, *exts):
+    async def main():
+        clients = [VoipClient("127.0.0.1", port, ext, reconnect=False) for ext in exts]
+        for c in clients:
+            c.events()      # queue events from the start
+            await c.register()
+        try:
+            await scenario(*clients)
+        finally:
+            for c in clients:
+                await c.close()
+    asyncio.run(main())
+
+
+async def expect(client, mtype, timeout=3.0):
+    """The next event of type mtype, skipping the replies to our own requests."""
+    async def first():
+        # A generator of its own each time: a timeout closes the one it cancels
+        async for event in client.events():
+            if event["type"] == mtype:
+                return event
+    return await asyncio.wait_for(first(), timeout)
+
+
+async def nothing(client, mtype, seconds):
+    try:
+        event = await expect(client, mtype, seconds)
+    except asyncio.TimeoutError:
+        return
+    raise AssertionError(f"unexpected {event}")
+
+
+async def connect(caller, callee):
+    await caller.call(callee.extension)
+    await expect(callee, "incoming_call")
+    await callee.answer()
+
+
+def test_unanswered_call_times_out(pbx):
+    async def scenario(a, b):
+        await a.call(b.extension)
+        await expect(b, "incoming_call")
+        for leg in (a, b):
+            event = await expect(leg, "no_answer", RING_TIMEOUT + 2)
+            assert (event["from"], event["to"]) == (a.extension, b.extension)
+        # Both legs are idle again
+        await b.call(a.extension)
+        await expect(a, "incoming_call")
+
+    run(pbx, scenario, "5101", "5102")
+
+
+def test_ivr_session_ends_when_called(pbx):
+    async def scenario(a, b):
+        await b.ivr("5000")
+        await connect(a, b)
+        # The menu timeout passes: the call carries on
+        await nothing(b, "hangup", MENU_TIMEOUT + 1)
+        assert (await b.chat("still here"))["type"] == "chat_sent"
+        await a.hangup()
+        assert (await expect(b, "hangup"))["by"] == a.extension
+
+    run(pbx, scenario, "5111", "5112")
+
+
+def test_peer_hung_up_when_endpoint_drops_mid_call(pbx):
+    async def scenario(a, b, c):
+        await connect(a, b)
+        a.transport.abort()
+        assert (await expect(b, "hangup"))["by"] == a.extension
+        # b is free for a new call
+        await b.call(c.extension)
+        await expect(c, "incoming_call")
+
+    run(pbx, scenario, "5121", "5122", "5123")
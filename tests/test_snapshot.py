@@ -0,0 +1,74 @@
+"""Registration snapshots: the file format, lookups and tokens that work once."""
+
+import os
+import threading
+
+import pytest
+
+import pbx_snapshot
+from pbx_calltable import IDLE, IN_CALL
+
+
+def token(i):
+    return i.to_bytes(pbx_snapshot.TOKEN_BYTES, "big")
+
+
+@pytest.fixture
+def records():
+    return [(token(i), f"5{i:03d}", "PCMU", "json", IDLE, None, False, None)
+            for i in range(1, 200, 3)] + [
+            (token(500), "5500", "PCMA", "binary", IN_CALL, "7001", True, "B")]
+
+
+@pytest.fixture
+def snap(tmp_path, records):
+    path = tmp_path / "snapshot"
+    pbx_snapshot.write(path, records)
+    s = pbx_snapshot.load(path)
+    yield s
+    s.close()
+
+
+def test_find_every_record(snap, records):
+    assert len(snap) == len(records)
+    for rec in records:
+        assert snap.find(rec[0]) == rec[1:]
+    assert snap.find(token(2)) is None
+    assert snap.find(token(9999)) is None
+    assert snap.find(b"short") is None
+
+
+def test_claim_works_once(snap):
+    assert snap.claim(token(500), "5500") == ("5500", "PCMA", "binary", IN_CALL, "7001", True, "B")
+    assert snap.claim(token(500), "5500") is None
+    assert snap.find(token(500)) is None
+    assert all(r[0] != token(500) for r in snap.records())
+
+
+def test_claim_for_another_extension_keeps_the_token(snap):
+    assert snap.claim(token(1), "5999") is None
+    assert snap.claim(token(1), "5001") is not None
+
+
+def test_racing_claims_one_wins(snap):
+    start = threading.Barrier(16)
+    won = []
+
+    def resume():
+        start.wait()
+        if snap.claim(token(4)) is not None:
+            won.append(1)
+
+    threads = [threading.Thread(target=resume) for _ in range(16)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    assert won == [1]
+
+
+def test_load_missing_or_bad(tmp_path):
+    assert pbx_snapshot.load(tmp_path / "none") is None
+    bad = tmp_path / "bad"
+    bad.write_bytes(b"PBXS" + os.urandom(4))
+    assert pbx_snapshot.load(bad) is None
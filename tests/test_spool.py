@@ -0,0 +1,117 @@
+"""Trunk spool: messages kept until acknowledged, replayed once after a reconnect."""
+
+import json
+
+import pbx_codec
+import pbx_spool
+from pbx_spool import Receiver, Spool
+
+HELLO = {"type": "trunk_hello", "node": "A"}
+
+
+class Conn:
+    codec = pbx_codec.JSON
+
+    def __init__(self):
+        self.sent = []
+        self.aborted = False
+
+    def send(self, data):
+        self.sent.append(json.loads(data))
+        return True
+
+    def abort(self):
+        self.aborted = True
+
+
+def numbers(conn):
+    return [m.get("n") for m in conn.sent if m["type"] == "x"]
+
+
+def test_kept_while_down_then_replayed_after_hello():
+    spool = Spool("B")
+    spool.send({"type": "x", "n": 1})
+    spool.send({"type": "x", "n": 2})
+    conn = Conn()
+    spool.connected(conn, HELLO)
+    assert conn.sent[0] == dict(HELLO, epoch=pbx_spool.EPOCH, seq=1)
+    assert numbers(conn) == [1, 2]
+    spool.send({"type": "x", "n": 3})
+    assert numbers(conn) == [1, 2, 3]
+    assert len(spool) == 3
+
+
+def test_ack_releases_and_reconnect_replays_the_rest():
+    spool = Spool("B")
+    conn = Conn()
+    spool.connected(conn, HELLO)
+    for n in range(1, 5):
+        spool.send({"type": "x", "n": n})
+    spool.ack(2)
+    assert len(spool) == 2
+    spool.disconnected(conn)
+    spool.send({"type": "x", "n": 5})
+    again = Conn()
+    spool.connected(again, HELLO)
+    assert again.sent[0]["seq"] == 3
+    assert numbers(again) == [3, 4, 5]
+
+
+def test_ack_beyond_what_was_sent_is_ignored():
+    spool = Spool("B")
+    spool.send({"type": "x", "n": 1})
+    spool.ack(5)
+    assert len(spool) == 1
+    spool.ack("junk")
+    assert len(spool) == 1
+
+
+def test_peer_without_acks_keeps_nothing():
+    spool = Spool("B")
+    spool.send({"type": "x", "n": 1})
+    conn = Conn()
+    spool.connected(conn, HELLO)
+    spool.greeted(None)
+    spool.send({"type": "x", "n": 2})
+    assert numbers(conn) == [1, 2]
+    assert len(spool) == 0
+
+
+def test_limit_drops_the_oldest():
+    dropped = pbx_spool.stats["dropped"]
+    spool = Spool("B", size=2)
+    for n in range(1, 4):
+        spool.send({"type": "x", "n": n})
+    assert pbx_spool.stats["dropped"] == dropped + 1
+    conn = Conn()
+    spool.connected(conn, HELLO)
+    assert conn.sent[0]["seq"] == 2
+    assert numbers(conn) == [2, 3]
+
+
+def test_receiver_skips_what_it_has_handled():
+    conn = Conn()
+    first = Receiver("test-replay", "e1", 1, conn)
+    assert [first.accept() for _ in range(3)] == [True, True, True]
+    first.close()
+    # The link came back before our ack got through: 2 and 3 again, then 4
+    again = Receiver("test-replay", "e1", 2, conn)
+    assert [again.accept() for _ in range(3)] == [False, False, True]
+    assert again.last == 4
+    again.close()
+
+
+def test_receiver_starts_afresh_for_a_restarted_sender():
+    conn = Conn()
+    Receiver("test-restart", "e1", 1, conn).accept()
+    restarted = Receiver("test-restart", "e2", 1, conn)
+    assert restarted.accept()
+
+
+def test_receiver_acks_every_so_often():
+    conn = Conn()
+    receiver = Receiver("test-ack", "e1", 1, conn)
+    for _ in range(pbx_spool.ACK_EVERY):
+        receiver.accept()
+    assert conn.sent == [{"type": "trunk_ack", "seq": pbx_spool.ACK_EVERY}]
+    receiver.close()
@@ -0,0 +1,49 @@
+"""Timing wheel: timers fire about when due, once, and not at all when cancelled."""
+
+from pbx_timers import Wheel
+
+
+def test_fires_when_due():
+    wheel = Wheel(resolution=0.1, slots=8, now=0.0)
+    fired = []
+    timer = wheel.schedule(0.5, fired.append, "x")
+    assert timer.pending
+    wheel.advance(0.45)
+    assert fired == []
+    wheel.advance(0.65)
+    assert fired == ["x"]
+    assert not timer.pending
+    wheel.advance(2.0)
+    assert fired == ["x"]
+    assert len(wheel) == 0
+
+
+def test_more_than_a_lap_away():
+    wheel = Wheel(resolution=0.1, slots=8, now=0.0)
+    fired = []
+    wheel.schedule(3.0, fired.append, "late")
+    for step in range(1, 29):
+        wheel.advance(step / 10)
+    assert fired == []
+    wheel.advance(3.2)
+    assert fired == ["late"]
+
+
+def test_cancel():
+    wheel = Wheel(resolution=0.1, slots=8, now=0.0)
+    fired = []
+    timer = wheel.schedule(0.2, fired.append, "x")
+    assert wheel.cancel(timer)
+    assert not wheel.cancel(timer)
+    wheel.advance(1.0)
+    assert fired == []
+    assert len(wheel) == 0
+
+
+def test_far_behind_catches_up():
+    wheel = Wheel(resolution=0.1, slots=8, now=0.0)
+    fired = []
+    for delay in (0.1, 0.5, 2.0):
+        wheel.schedule(delay, fired.append, delay)
+    wheel.advance(100.0)
+    assert sorted(fired) == [0.1, 0.5, 2.0]
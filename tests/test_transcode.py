@@ -0,0 +1,96 @@
+"""G.711 and L16: the reference algorithms, the tables built from them and frame conversion."""
+
+import pytest
+
+import pbx_transcode
+from pbx_transcode import L16, PCMA, PCMU
+
+np = pytest.importorskip("numpy")
+
+CODES = range(256)
+
+
+def test_reference_values():
+    assert pbx_transcode.ulaw_to_linear(0xFF) == 0
+    assert pbx_transcode.ulaw_to_linear(0x80) == 32124
+    assert pbx_transcode.ulaw_to_linear(0x00) == -32124
+    assert pbx_transcode.alaw_to_linear(0xD5) == 8
+    assert pbx_transcode.alaw_to_linear(0xAA) == 32256
+    assert pbx_transcode.alaw_to_linear(0x2A) == -32256
+    assert pbx_transcode.linear_to_ulaw(32767) == 0x80      # clipped
+    assert pbx_transcode.linear_to_alaw(-32768) == 0x2A
+
+
+@pytest.mark.parametrize("codec, to_linear, to_code", [
+    (PCMU, pbx_transcode.ulaw_to_linear, pbx_transcode.linear_to_ulaw),
+    (PCMA, pbx_transcode.alaw_to_linear, pbx_transcode.linear_to_alaw),
+])
+def test_every_code_survives_a_round_trip(codec, to_linear, to_code):
+    for c in CODES:
+        assert to_linear(to_code(to_linear(c))) == to_linear(c)
+    # u-law has two zeros; every other code is its own round trip
+    assert sum(to_code(to_linear(c)) != c for c in CODES) == (codec == PCMU)
+
+
+@pytest.mark.parametrize("codec, to_linear", [(PCMU, pbx_transcode.ulaw_to_linear),
+                                              (PCMA, pbx_transcode.alaw_to_linear)])
+def test_decode_table_is_the_reference(codec, to_linear):
+    samples = pbx_transcode.decode(bytes(CODES), codec)
+    assert samples.dtype == np.int16
+    assert samples.tolist() == [to_linear(c) for c in CODES]
+
+
+@pytest.mark.parametrize("codec, to_code", [(PCMU, pbx_transcode.linear_to_ulaw),
+                                            (PCMA, pbx_transcode.linear_to_alaw)])
+def test_encode_table_is_the_reference(codec, to_code):
+    samples = np.arange(-32768, 32768, dtype=np.int16)
+    assert pbx_transcode.encode(samples, codec) == bytes(to_code(int(s)) for s in samples)
+
+
+@pytest.mark.parametrize("codec", [PCMU, PCMA])
+def test_quantisation_error_grows_with_the_level(codec):
+    samples = np.arange(-32000, 32000, 7, dtype=np.int16)
+    back = pbx_transcode.decode(pbx_transcode.encode(samples, codec), codec).astype(np.int32)
+    error = np.abs(back - samples)
+    assert (error <= np.maximum(np.abs(samples.astype(np.int32)) // 16, 16)).all()
+
+
+def test_ulaw_alaw_translate_matches_going_through_samples():
+    payload = bytes(CODES)
+    for src, dst in ((PCMU, PCMA), (PCMA, PCMU)):
+        via_samples = pbx_transcode.encode(pbx_transcode.decode(payload, src), dst)
+        assert pbx_transcode.converter(src, dst)(payload) == via_samples
+
+
+def test_l16_is_big_endian():
+    samples = np.array([1, -2, 32767, -32768], dtype=np.int16)
+    data = pbx_transcode.encode(samples, L16)
+    assert data[:4] == b"\x00\x01\xff\xfe"
+    assert pbx_transcode.decode(data, L16).tolist() == samples.tolist()
+
+
+def test_many_frames_at_once():
+    frames = np.arange(-8000, 8000, dtype=np.int32).reshape(10, 1600)
+    data = pbx_transcode.encode(frames, PCMA)
+    assert data == b"".join(pbx_transcode.encode(f, PCMA) for f in frames)
+
+
+@pytest.mark.parametrize("src, dst", [(PCMU, L16), (L16, PCMA), (PCMA, PCMU)])
+def test_converter_keeps_the_frame_length_in_samples(src, dst):
+    payload = pbx_transcode.silence(src, 160)
+    out = pbx_transcode.converter(src, dst)(payload)
+    assert len(out) == 160 * pbx_transcode.SAMPLE_BYTES[dst]
+    # A-law has no zero: its silence is +8, and stays that close to it
+    assert np.abs(pbx_transcode.decode(out, dst)).max() <= 8
+
+
+def test_no_converter_needed_or_possible():
+    assert pbx_transcode.converter(PCMU, PCMU) is None
+    assert pbx_transcode.converter(PCMU, "G729") is None
+
+
+def test_choose():
+    assert pbx_transcode.choose(["g729", "pcma", "PCMU"]) == PCMA
+    assert pbx_transcode.choose("l16") == L16
+    assert pbx_transcode.choose(["g729", 8]) is None
+    assert pbx_transcode.choose(None) is None
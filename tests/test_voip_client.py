@@ -0,0 +1,154 @@
+"""The client SDK against a real PBX: replies, errors, call state, framing and reconnects."""
+
+import asyncio
+import signal
+
+import pytest
+
+import pbx_codec
+import voip_client
+from benchmarks.common import free_port, spawn_pbx
+from voip_client import IDLE, IN_CALL, RINGING, VoipClient, VoipError
+
+
+def stop(proc):
+    proc.send_signal(signal.SIGTERM)      # exits cleanly: logs flushed, snapshot written
+    proc.wait(10)
+
+
+@pytest.fixture(scope="module")
+def pbx():
+    port = free_port()
+    proc = spawn_pbx(port, "--engine", "asyncio")
+    yield port
+    stop(proc)
+
+
+def clients(port, *exts, **options):
+    return [VoipClient("127.0.0.1", port, ext, reconnect=False, timeout=3.0, **options)
+            for ext in exts]
+
+
+async def expect(client, mtype, timeout=3.0):
+    async def first():
+        async for event in client.events():
+            if event["type"] == mtype:
+                return event
+    return await asyncio.wait_for(first(), timeout)
+
+
+def test_backoff_grows_within_bounds():
+    for attempt in range(40):
+        step = min(30.0, 0.5 * 2 ** attempt)
+        assert step / 2 <= voip_client.backoff(attempt, 0.5, 30.0) <= step
+
+
+def test_call_state_follows_the_server(pbx):
+    async def main():
+        a, b = clients(pbx, "5201", "5202")
+        b.events()
+        assert (await a.register())["type"] == "register_ok"
+        await b.register()
+        assert a.registered and a.state == IDLE
+        assert (await a.call("5202"))["type"] == "call_proceeding"
+        assert (a.state, a.peer) == (RINGING, "5202")
+        await expect(b, "incoming_call")
+        assert (b.state, b.peer) == (RINGING, "5201")
+        assert (await b.answer())["type"] == "call_answered"
+        assert (b.state, b.peer) == (IN_CALL, "5201")
+        assert (await b.chat("γεια"))["type"] == "chat_sent"
+        await a.hangup()
+        await expect(b, "hangup")
+        assert a.state == b.state == IDLE
+        for c in (a, b):
+            await c.close()
+
+    asyncio.run(main())
+
+
+def test_errors_raise_and_silence_is_none(pbx):
+    async def main():
+        a, b, c = clients(pbx, "5211", "5212", "5213")
+        for x in (a, b, c):
+            await x.register()
+        with pytest.raises(VoipError) as refused:
+            await a.answer()
+        assert refused.value.msg["type"] == "error"
+        with pytest.raises(VoipError):
+            await a.call("5999")
+        assert await a.hangup() is None         # nothing to end, and nothing said
+        await a.call("5212")
+        with pytest.raises(VoipError) as busy:
+            await c.call("5212")
+        assert busy.value.msg["type"] == "busy"
+        assert c.state == IDLE
+        for x in (a, b, c):
+            await x.close()
+
+    asyncio.run(main())
+
+
+def test_binary_framing(pbx):
+    async def main():
+        a, b = clients(pbx, "5221", "5222", framing="binary")
+        b.events()
+        await a.register()
+        await b.register()
+        assert a.codec is pbx_codec.BINARY
+        await a.call("5222")
+        await expect(b, "incoming_call")
+        await b.answer()
+        await a.chat("binary γεια")
+        assert (await expect(b, "chat"))["text"] == "binary γεια"
+        for x in (a, b):
+            await x.close()
+
+    asyncio.run(main())
+
+
+def test_close_ends_events_and_requests(pbx):
+    async def main():
+        a, = clients(pbx, "5231")
+        await a.register()
+        events = a.events()
+        await a.close()
+        assert [e async for e in events] == []
+        with pytest.raises(ConnectionError):
+            await a.call("5232")
+
+    asyncio.run(main())
+
+
+def test_reconnect_resumes_the_call(tmp_path):
+    port = free_port()
+    options = ("--engine", "asyncio", "--snapshot", str(tmp_path / "snapshot"))
+    proc = spawn_pbx(port, *options)
+
+    async def main():
+        nonlocal proc
+        a, b = [VoipClient("127.0.0.1", port, ext, timeout=3.0, retry_min=0.1, retry_max=0.5)
+                for ext in ("5241", "5242")]
+        b.events()
+        await a.register()
+        await b.register()
+        await a.call("5242")
+        await expect(b, "incoming_call")
+        await b.answer()
+        a.events()
+        stop(proc)
+        assert (await expect(a, "disconnected"))["reconnect"] is True
+        with pytest.raises(ConnectionError):
+            await a.chat("lost")
+        proc = spawn_pbx(port, *options)
+        for x in (a, b):
+            assert (await expect(x, "resume_ok", 10.0))["extension"] == x.extension
+        assert (a.state, a.peer) == (IN_CALL, "5242")
+        assert (await a.chat("πάλι εδώ"))["type"] == "chat_sent"
+        assert (await expect(b, "chat"))["text"] == "πάλι εδώ"
+        for x in (a, b):
+            await x.close()
+
+    try:
+        asyncio.run(main())
+    finally:
+        stop(proc)
@@ -0,0 +1,334 @@
+"""Embeddable asyncio client for the PBX endpoint protocol.
+
+One VoipClient is one registered extension; it is its own asyncio
+Protocol and holds no task while connected, so a process can run
+thousands of them on one event loop (softphones, test rigs, IVR bots):
+
+    client = VoipClient("127.0.0.1", 5000, "5001")
+    await client.register()
+    await client.call("5002")               # call_proceeding
+    async for event in client.events():
+        if event["type"] == "call_answered":
+            await client.chat("γεια")
+            await client.hangup()
+
+Every request is awaitable and returns the server's reply (a message
+dict), or None when the server had nothing to say to it; an error reply
+(or busy, for calls) raises VoipError.  The protocol has no request ids,
+so each request goes out followed by a ping: the server answers in
+order, and its pong closes the request whether or not a reply came
+first.
+
+events() yields every message from the server (pings and pongs aside),
+replies included, plus {"type": "disconnected", "reconnect": bool} when
+the connection drops.  Events are only queued once events() has been
+called, at most `max_events` of them (the oldest go first).
+
+After the first successful register() a dropped connection is re-opened
+on its own, waiting backoff(attempt) between tries (or the retry_after
+of an admission refusal, if longer), and the extension is registered
+again - resumed, call state included, when the server handed out a
+resume token.  Requests in flight when the connection drops raise
+ConnectionError; so do requests made while it is down.
+"""
+
+import asyncio
+import random
+import socket
+from collections import deque
+
+import pbx_codec
+
+PING = pbx_codec.Frame({"type": "ping"})
+PONG = pbx_codec.Frame({"type": "pong"})
+
+IDLE = "idle"
+RINGING = "ringing"
+IN_CALL = "in_call"
+CONFERENCE = "conference"
+
+
+class VoipError(Exception):
+    """The server refused a request; `msg` is its error (or busy) message."""
+
+    def __init__(self, msg):
+        super().__init__(msg.get("reason") or msg.get("type"))
+        self.msg = msg
+        self.retry_after = msg.get("retry_after")
+
+
+def backoff(attempt, low, high):
+    """Seconds before reconnect attempt `attempt`: exponential, upper half of each step at random."""
+    step = min(high, low * 2 ** min(attempt, 32))
+    return step / 2 + random.random() * step / 2
+
+
+class VoipClient(asyncio.Protocol):
+    """One extension registered on a PBX."""
+
+    def __init__(self, host, port, extension, framing="json", codecs=None, resume_token=None,
+                 reconnect=True, retry_min=0.5, retry_max=30.0, timeout=10.0, max_events=10_000):
+        self.host = host
+        self.port = port
+        self.extension = extension
+        self.framing = framing
+        self.codecs = codecs                # audio codecs offered at register, best first
+        self.resume_token = resume_token    # from the last register_ok (None: register afresh)
+        self.reconnect = reconnect
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.timeout = timeout
+        self.max_events = max_events
+
+        # Call state as the server last reported it
+        self.state = IDLE
+        self.peer = None
+        self.registered = False
+
+        self.codec = pbx_codec.JSON
+        self.transport = None
+        self._reader = None
+        self._pending = deque()     # (reply types, future) of requests, oldest first
+        self._events = None         # deque of events once events() is in use
+        self._wakeup = None
+        self._started = False       # registered once: drops are reconnected from now on
+        self._closing = False
+        self._reconnecting = None
+        self._retry_after = None
+        self._lost = None
+        self._ended = False
+
+    def __repr__(self):
+        return f"<VoipClient {self.extension} {self.state} peer={self.peer}>"
+
+    # --------------------------------------------------------
+    #  Requests
+    # --------------------------------------------------------
+
+    async def register(self):
+        """Connect (if needed) and register, or resume with `resume_token`; returns the reply."""
+        if self.transport is None:
+            await self._connect()
+        reply = await self._handshake()
+        self._started = True
+        return reply
+
+    async def call(self, to):
+        """call_proceeding (or ivr_message when `to` is the local IVR); busy raises."""
+        return await self._request({"type": "call", "to": to},
+                                   ("call_proceeding", "ivr_message", "error", "busy"))
+
+    async def answer(self):
+        return await self._request({"type": "answer"}, ("call_answered", "error"))
+
+    async def hangup(self):
+        """Hang up the call or leave the conference; None when there was nothing to end."""
+        return await self._request({"type": "hangup"}, ("hangup", "conference_left", "error"))
+
+    async def ivr(self, to):
+        """The IVR menu (ivr_message) of the local IVR `to`."""
+        return await self._request({"type": "ivr", "to": to}, ("ivr_message", "error"))
+
+    async def ivr_choice(self, digit):
+        """A key in the IVR: the next menu (ivr_message), ivr_info, call_proceeding for
+        the number it dials, or hangup when the menu lets the caller go."""
+        return await self._request({"type": "ivr_choice", "digit": str(digit)},
+                                   ("ivr_message", "ivr_info", "call_proceeding", "hangup",
+                                    "error", "busy"))
+
+    async def chat(self, text):
+        """chat_sent, or None when the peer of a local call is gone."""
+        return await self._request({"type": "chat", "text": text}, ("chat_sent", "error"))
+
+    async def conference(self, room):
+        """conference_joined; None when the room is on another worker (the reply is an event)."""
+        return await self._request({"type": "conference", "room": room},
+                                   ("conference_joined", "error"))
+
+    async def subscribe(self, exts=(), prefixes=()):
+        """Watch extensions and prefixes (BLF); their states arrive as presence events."""
+        return await self._request({"type": "subscribe", "exts": list(exts),
+                                    "prefixes": list(prefixes)}, ("error",))
+
+    async def unsubscribe(self):
+        return await self._request({"type": "unsubscribe"}, ())
+
+    async def close(self):
+        """Hang up the connection for good; events() ends."""
+        self._closing = True
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+        if self.transport is not None:
+            lost = self._lost
+            self.transport.close()
+            await lost
+        self._end()
+
+    def events(self):
+        """Every message from the server from now on, as it arrives, until close()."""
+        if self._events is None:
+            self._events = deque([None] if self._ended else ())
+            self._wakeup = asyncio.Event()
+        return self._iterate()
+
+    async def _iterate(self):
+        events = self._events
+        while True:
+            while not events:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            event = events.popleft()
+            if event is None:
+                return
+            yield event
+
+    # --------------------------------------------------------
+    #  Connection
+    # --------------------------------------------------------
+
+    async def _connect(self):
+        loop = asyncio.get_running_loop()
+        self._lost = loop.create_future()
+        await asyncio.wait_for(loop.create_connection(lambda: self, self.host, self.port),
+                               self.timeout)
+
+    async def _handshake(self):
+        if self.resume_token:
+            try:
+                return await self._request({"type": "resume", "extension": self.extension,
+                                            "token": self.resume_token},
+                                           ("resume_ok", "error"), required=True)
+            except VoipError:
+                self.resume_token = None
+        msg = {"type": "register", "extension": self.extension}
+        if self.framing != "json":
+            msg["framing"] = self.framing
+        if self.codecs:
+            msg["codecs"] = list(self.codecs)
+        return await self._request(msg, ("register_ok", "error"), required=True)
+
+    async def _request(self, msg, types, required=False):
+        transport = self.transport
+        if transport is None or self._closing:
+            raise ConnectionError(f"{self.extension}: δεν υπάρχει σύνδεση")
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((types, fut))
+        transport.write(self.codec.encode(msg) + PING.encode(self.codec))
+        reply = await asyncio.wait_for(fut, self.timeout)
+        if reply is None and required:
+            raise VoipError({"type": "error", "reason": f"καμία απάντηση σε {msg['type']}"})
+        return reply
+
+    async def _reconnect(self):
+        attempt = 0
+        try:
+            while not self._closing:
+                delay = backoff(attempt, self.retry_min, self.retry_max)
+                if self._retry_after is not None:
+                    delay = max(delay, self._retry_after)
+                    self._retry_after = None
+                await asyncio.sleep(delay)
+                try:
+                    await self._connect()
+                    await self._handshake()
+                    return
+                except (OSError, asyncio.TimeoutError, VoipError):
+                    if self.transport is not None:
+                        self.transport.abort()
+                    attempt += 1
+        finally:
+            self._reconnecting = None
+
+    def _emit(self, event):
+        events = self._events
+        if events is None:
+            return
+        if len(events) >= self.max_events:
+            events.popleft()
+        events.append(event)
+        self._wakeup.set()
+
+    def _end(self):
+        if not self._ended:
+            self._ended = True
+            self._emit(None)
+
+    # --------------------------------------------------------
+    #  asyncio.Protocol
+    # --------------------------------------------------------
+
+    def connection_made(self, transport):
+        transport.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.transport = transport
+        self.codec = pbx_codec.JSON
+        self._reader = pbx_codec.FrameReader()
+
+    def data_received(self, data):
+        for msg in self._reader.feed(data):
+            self._received(msg)
+
+    def _received(self, msg):
+        mtype = msg.get("type")
+        if mtype == "ping":
+            self.transport.write(PONG.encode(self.codec))
+            return
+        pending = self._pending
+        if mtype == "pong":
+            # Everything the server had to say to the oldest request is in
+            if pending:
+                _, fut = pending.popleft()
+                if not fut.done():
+                    fut.set_result(None)
+            return
+        self._track(msg, mtype)
+        if pending:
+            types, fut = pending[0]
+            if mtype in types and not fut.done():
+                if mtype in ("error", "busy"):
+                    fut.set_exception(VoipError(msg))
+                else:
+                    fut.set_result(msg)
+        self._emit(msg)
+
+    def _track(self, msg, mtype):
+        """Follow the call state through the messages that change it."""
+        if mtype == "register_ok":
+            self.codec = pbx_codec.choose(msg.get("framing"))
+            self.resume_token = msg.get("resume_token")
+            self.registered = True
+            self.state, self.peer = IDLE, None
+        elif mtype == "resume_ok":
+            self.codec = pbx_codec.choose(msg.get("framing"))
+            self.registered = True
+            self.state, self.peer = msg.get("state") or IDLE, msg.get("peer")
+        elif mtype == "call_proceeding":
+            self.state, self.peer = RINGING, msg.get("to")
+        elif mtype == "incoming_call":
+            self.state, self.peer = RINGING, msg.get("from")
+        elif mtype == "call_answered":
+            self.state, self.peer = IN_CALL, msg.get("by")
+        elif mtype in ("hangup", "no_answer", "busy", "conference_left"):
+            self.state, self.peer = IDLE, None
+        elif mtype == "conference_joined":
+            self.state, self.peer = CONFERENCE, msg.get("room")
+        elif mtype == "error" and msg.get("retry_after") is not None:
+            # Refused by admission control; the server closes the connection
+            self._retry_after = msg["retry_after"]
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.registered = False
+        pending, self._pending = self._pending, deque()
+        for _, fut in pending:
+            if not fut.done():
+                fut.set_exception(ConnectionError(f"{self.extension}: η σύνδεση έκλεισε"))
+        if self._lost is not None and not self._lost.done():
+            self._lost.set_result(None)
+        if self._closing or self._reconnecting is not None:
+            return
+        again = self.reconnect and self._started
+        self._emit({"type": "disconnected", "reconnect": again})
+        if again:
+            self._reconnecting = asyncio.get_running_loop().create_task(self._reconnect())
+        else:
+            self._end()